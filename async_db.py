@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from metrics import get_metrics
+
+# عدد خيوط قاعدة البيانات المشتركة بين جميع الواجهات غير المتزامنة
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+# زمن تنفيذ كل دالة داخل خيط القاعدة (وللكتابات من الإرسال حتى الحفظ)، وزمن انتظارها لخيط متاح
+_call_latency = get_metrics().histogram(
+    'bot_db_call_duration_seconds', "Database method run time in the DB thread; for writes, queue to commit",
+    ('backend', 'method'))
+_wait_latency = get_metrics().histogram(
+    'bot_db_wait_duration_seconds', "Time a database call waited for a free DB thread", ('backend',), errors=False)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the shared executor used for blocking database calls"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    return _executor
+
+
+def shutdown_executor(wait: bool = True):
+    """Shut down the shared database executor"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+class AsyncDatabase:
+    """Async facade that runs Database/ModerationSystem methods off the event loop"""
+
+    def __init__(self, backend: Any, executor: Optional[ThreadPoolExecutor] = None):
+        self.backend = backend
+        self._executor = executor
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking callable in the database executor and await its result"""
+        loop = asyncio.get_running_loop()
+        executor = self._executor or get_executor()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        backend = type(self.backend).__name__
+        labels = (backend, name)
+
+        queued = getattr(attr, 'queued', None)
+        if queued is not None:
+            # الكتابات تُرسل إلى كاتب القاعدة الوحيد مباشرة دون حجز خيط من المنفذ
+            @functools.wraps(attr)
+            async def write(*args, **kwargs):
+                started = time.perf_counter()
+                failed = False
+                try:
+                    return await queued(self.backend, *args, **kwargs)
+                except BaseException:
+                    failed = True
+                    raise
+                finally:
+                    _call_latency.observe(labels, (time.perf_counter() - started) * 1000, failed)
+
+            self.__dict__[name] = write
+            return write
+
+        def timed_call(submitted, *args, **kwargs):
+            started = time.perf_counter()
+            _wait_latency.observe((backend,), (started - submitted) * 1000)
+            failed = False
+            try:
+                return attr(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                _call_latency.observe(labels, (time.perf_counter() - started) * 1000, failed)
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await self.run(timed_call, time.perf_counter(), *args, **kwargs)
+
+        # تخزين الدالة المغلفة لتجنب إعادة إنشائها في كل استدعاء
+        self.__dict__[name] = wrapper
+        return wrapper
@@ -0,0 +1,130 @@
+"""Measure handler latency with database calls on the event loop and through AsyncDatabase.
+
+Updates arrive at a fixed rate (open loop) and each runs a handler made
+of the Database calls the real handler makes: a captain refreshing the
+available rides, a client's /start, a new ride request, and now and then
+an admin opening a user's details. Latency is measured from the moment
+an update was due, so time spent waiting behind another handler's
+blocking call counts. In "blocking" mode the handlers call Database
+directly, as main.py did before async_db existed; in "async" mode they
+await the same methods through AsyncDatabase.
+
+    python bench_async_db.py
+    python bench_async_db.py --rate 400 --updates 4000 --rides 200000
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+
+CAPTAINS = 200
+CLIENTS = 2000
+HEAVY_CLIENT = 1
+
+
+def populate(path: str, rides: int):
+    """Users and rides written directly, so the setup does not dominate the run"""
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, first_name, user_type, created_ts) VALUES (?, ?, ?, ?)",
+        [(user_id, f"u{user_id}", 'captain' if user_id > CLIENTS else 'client', now)
+         for user_id in range(1, CLIENTS + CAPTAINS + 1)])
+    rnd = random.Random(1)
+    conn.executemany("""
+        INSERT INTO rides (client_id, pickup_location, destination, status, created_ts)
+        VALUES (?, 'a', 'b', ?, ?)
+    """, [(HEAVY_CLIENT if i % 4 == 0 else rnd.randint(2, CLIENTS),
+           rnd.choice(('pending', 'completed', 'cancelled')), now - i) for i in range(rides)])
+    conn.commit()
+    conn.close()
+
+
+def handlers(rnd: random.Random):
+    """(name, list of (method, args)) for one update"""
+    captain = CLIENTS + rnd.randint(1, CAPTAINS)
+    client = rnd.randint(2, CLIENTS)
+    roll = rnd.random()
+    if roll < 0.5:
+        return 'view_rides', [('is_captain_subscribed', (captain,)), ('get_pending_rides', (10,))]
+    if roll < 0.8:
+        return 'start', [('add_user', (client, f"u{client}", f"u{client}")), ('get_user', (client,))]
+    if roll < 0.98:
+        return 'request_ride', [('create_ride', (client, 'a', 'b')), ('get_user_rides', (client, 5))]
+    return 'admin_user_details', [('get_user_details', (HEAVY_CLIENT,)), ('get_recent_rides', (10,))]
+
+
+async def run(mode: str, path: str, rate: float, updates: int, seed: int) -> dict:
+    from database import Database
+    from async_db import AsyncDatabase
+    from write_queue import stop_write_queues
+
+    db = Database(path)
+    facade = AsyncDatabase(db)
+    rnd = random.Random(seed)
+    latencies = {}
+
+    async def handle(name, calls, due):
+        for method, args in calls:
+            if mode == 'async':
+                await getattr(facade, method)(*args)
+            else:
+                getattr(db, method)(*args)
+        latencies.setdefault(name, []).append((time.perf_counter() - due) * 1000)
+
+    tasks = []
+    started = time.perf_counter()
+    for i in range(updates):
+        due = started + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        name, calls = handlers(rnd)
+        tasks.append(asyncio.create_task(handle(name, calls, due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    stop_write_queues()
+
+    def percentile(values, q):
+        return round(values[min(len(values) - 1, int(len(values) * q))], 2)
+
+    result = {'mode': mode, 'updates_per_s': round(updates / elapsed), 'handlers': {}}
+    everything = []
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        everything.extend(values)
+        result['handlers'][name] = {'count': len(values), 'p50_ms': percentile(values, 0.5),
+                                    'p99_ms': percentile(values, 0.99)}
+    everything.sort()
+    result['p50_ms'] = percentile(everything, 0.5)
+    result['p99_ms'] = percentile(everything, 0.99)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=300, help='updates arriving per second')
+    parser.add_argument('--updates', type=int, default=3000)
+    parser.add_argument('--rides', type=int, default=100000, help='rides in the database before the run')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for mode in ('blocking', 'async'):
+        path = os.path.join(tempfile.mkdtemp(prefix='bench-async-db-'), 'bench.db')
+        from database import Database
+        Database(path)
+        populate(path, args.rides)
+        result = asyncio.run(run(mode, path, args.rate, args.updates, args.seed))
+        print(f"{mode:>8}: {result['updates_per_s']} updates/s, all handlers p50 {result['p50_ms']} ms "
+              f"p99 {result['p99_ms']} ms")
+        for name, stats in result['handlers'].items():
+            print(f"          {name:<20} n={stats['count']:<5} p50 {stats['p50_ms']} ms  p99 {stats['p99_ms']} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Measure update throughput at several KeyedUpdateProcessor limits.
+
+Two measurements per limit in --limits:
+- ordering harness: --users users send --per-user updates each, in
+  interleaved order, to a KeyedUpdateProcessor whose handlers sleep 0-10
+  ms. It reports updates/s and checks that every user's updates finished
+  in arrival order and never ran two at a time;
+- load test: load_test.py with --concurrency set to the limit and a Bot
+  API latency of --api-latency-ms, run in its own process. It reports
+  updates/s and the p95 wall time of button_callback and
+  group_message_handler.
+
+    python bench_concurrency.py
+    python bench_concurrency.py --limits 1 16 64 --api-latency-ms 40 --skip-load-test
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+
+
+def make_update(update_id: int, user_id: int):
+    from telegram import Chat, Message, Update, User
+    chat = Chat(user_id, Chat.PRIVATE)
+    message = Message(update_id, datetime.now(timezone.utc), chat, from_user=User(user_id, f"u{user_id}", False),
+                      text='x')
+    return Update(update_id, message=message)
+
+
+async def ordering_run(limit: int, users: int, per_user: int, seed: int = 1):
+    from update_processor import KeyedUpdateProcessor
+    rnd = random.Random(seed)
+    processor = KeyedUpdateProcessor(limit)
+    finished = defaultdict(list)
+    active = set()
+    overlaps = 0
+
+    async def handle(user_id: int, seq: int, delay: float):
+        nonlocal overlaps
+        if user_id in active:
+            overlaps += 1
+        active.add(user_id)
+        await asyncio.sleep(delay)
+        active.discard(user_id)
+        finished[user_id].append(seq)
+
+    # التحديثات تصل متداخلة بين المستخدمين كما تصل من تيليجرام
+    arrivals = [(user_id, seq) for seq in range(per_user) for user_id in range(1, users + 1)]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        processor.process_update(make_update(n, user_id), handle(user_id, seq, rnd.uniform(0, 0.01)))
+        for n, (user_id, seq) in enumerate(arrivals)
+    ))
+    duration = time.perf_counter() - started
+    in_order = all(seqs == list(range(per_user)) for seqs in finished.values()) and len(finished) == users
+    return len(arrivals) / duration, in_order and not overlaps
+
+
+def load_test_run(limit: int, args) -> dict:
+    out = os.path.join(tempfile.mkdtemp(prefix='bench-concurrency-'), 'load.json')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_test.py')
+    subprocess.run([
+        sys.executable, script, '--concurrency', str(limit), '--api-latency-ms', str(args.api_latency_ms),
+        '--clients', str(args.clients), '--captains', str(args.captains),
+        '--group-messages', str(args.group_messages), '--out', out,
+    ], check=True, stdout=subprocess.DEVNULL)
+    with open(out, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--limits', type=int, nargs='+', default=[1, 8, 64, 256])
+    parser.add_argument('--users', type=int, default=200, help='users in the ordering harness')
+    parser.add_argument('--per-user', type=int, default=10, help='updates per user in the ordering harness')
+    parser.add_argument('--api-latency-ms', type=float, default=20)
+    parser.add_argument('--clients', type=int, default=300)
+    parser.add_argument('--captains', type=int, default=100)
+    parser.add_argument('--group-messages', type=int, default=600)
+    parser.add_argument('--skip-load-test', action='store_true')
+    args = parser.parse_args()
+
+    print(f"ordering harness: {args.users} users x {args.per_user} updates, 0-10 ms handlers")
+    print(f"{'limit':>6}{'updates/s':>11}  ordered")
+    for limit in args.limits:
+        rate, ordered = asyncio.run(ordering_run(limit, args.users, args.per_user))
+        print(f"{limit:>6}{rate:>11.0f}  {ordered}")
+
+    if args.skip_load_test:
+        return 0
+    print(f"\nload test: {args.clients} clients, {args.captains} captains, {args.group_messages} group messages, "
+          f"{args.api_latency_ms:g} ms API latency")
+    print(f"{'limit':>6}{'updates/s':>11}{'errors':>8}{'button p95 ms':>15}{'group p95 ms':>14}")
+    for limit in args.limits:
+        result = load_test_run(limit, args)
+        handlers = result['handlers']
+        print(f"{limit:>6}{result['throughput_per_s']:>11.0f}{result['errors']:>8}"
+              f"{handlers['button_callback']['p95_ms']:>15.0f}{handlers['group_message_handler']['p95_ms']:>14.0f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Compare ops/sec of common Database reads on pooled connections and one connection per call.
+
+"pooled" is the bot's ConnectionManager: one persistent connection per
+thread with WAL, tuned pragmas and a statement cache. "per-call" opens
+and closes a default sqlite3 connection around every call, as each
+Database method did before db_connection existed. Both run the same
+methods on the same database, in one thread and then from --threads
+threads at once.
+
+    python bench_connections.py
+    python bench_connections.py --seconds 2 --threads 4 --rides 50000
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+class PerCallConnections:
+    """Stand-in for ConnectionManager that opens a fresh connection for every call"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def populate(path: str, rides: int):
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, first_name, user_type, created_ts) VALUES (?, ?, ?, ?)",
+        [(user_id, f"u{user_id}", 'captain' if user_id > 1000 else 'client', now) for user_id in range(1, 1201)])
+    rnd = random.Random(1)
+    conn.executemany("""
+        INSERT INTO rides (client_id, captain_id, pickup_location, destination, status, created_ts)
+        VALUES (?, ?, 'a', 'b', ?, ?)
+    """, [(rnd.randint(1, 1000), rnd.randint(1001, 1200), rnd.choice(('pending', 'accepted', 'completed')), now - i)
+          for i in range(rides)])
+    conn.commit()
+    conn.close()
+
+
+CALLS = [
+    ('get_user', lambda db, rnd: db.get_user(rnd.randint(1, 1200))),
+    ('get_ride_by_id', lambda db, rnd: db.get_ride_by_id(rnd.randint(1, 1000))),
+    ('get_pending_rides', lambda db, rnd: db.get_pending_rides(10)),
+    ('get_user_rides', lambda db, rnd: db.get_user_rides(rnd.randint(1, 1000), 5)),
+    ('get_captain_active_rides', lambda db, rnd: db.get_captain_active_rides(rnd.randint(1001, 1200))),
+    ('get_subscription_info', lambda db, rnd: db.get_subscription_info(rnd.randint(1001, 1200))),
+]
+
+
+def measure(db, call, seconds: float, threads: int) -> float:
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(n):
+        rnd = random.Random(n)
+        while time.perf_counter() < deadline:
+            call(db, rnd)
+            counts[n] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=1.0, help='run time of each measurement')
+    parser.add_argument('--threads', type=int, default=4, help='threads in the concurrent measurement')
+    parser.add_argument('--rides', type=int, default=20000)
+    args = parser.parse_args()
+
+    from database import Database
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-connections-'), 'bench.db')
+    db = Database(path)
+    populate(path, args.rides)
+    pooled = db.connections
+    per_call = PerCallConnections(path)
+
+    print(f"{'call':<26}{'threads':>8}{'per-call ops/s':>16}{'pooled ops/s':>14}{'speedup':>9}")
+    for name, call in CALLS:
+        for threads in (1, args.threads):
+            db.connections = per_call
+            before = measure(db, call, args.seconds, threads)
+            db.connections = pooled
+            after = measure(db, call, args.seconds, threads)
+            print(f"{name:<26}{threads:>8}{before:>16.0f}{after:>14.0f}{after / before:>8.1f}x")
+    db.writes.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
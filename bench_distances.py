@@ -0,0 +1,70 @@
+"""Compare the batched distance functions in geo with a loop over calculate_distance.
+
+Computes every distance between --origins captains and --targets rides
+(1k x 10k by default) around Makkah three ways: a Python loop calling
+calculate_distance per pair, geo.distance_matrix without NumPy, and
+geo.distance_matrix with NumPy when it is installed. nearest_k (top 5
+per captain) is timed the same way. The largest difference from the
+loop is printed to show the engines agree.
+
+    python bench_distances.py
+    python bench_distances.py --origins 200 --targets 5000
+"""
+import sys
+import time
+import random
+import argparse
+
+MAKKAH_LAT, MAKKAH_LON = 21.4225, 39.8262
+
+
+def points(count: int, rnd: random.Random):
+    return [(MAKKAH_LAT + rnd.uniform(-0.3, 0.3), MAKKAH_LON + rnd.uniform(-0.3, 0.3)) for _ in range(count)]
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--origins', type=int, default=1000)
+    parser.add_argument('--targets', type=int, default=10000)
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    import geo
+    rnd = random.Random(1)
+    origins, targets = points(args.origins, rnd), points(args.targets, rnd)
+    pairs = args.origins * args.targets
+    numpy = geo.np
+
+    loop, loop_s = timed(lambda: [[geo.calculate_distance(lat1, lon1, lat2, lon2) for lat2, lon2 in targets]
+                                  for lat1, lon1 in origins])
+    print(f"{args.origins} x {args.targets} = {pairs} pairs")
+    print(f"{'engine':<28}{'seconds':>9}{'pairs/s':>14}{'speedup':>9}{'max diff km':>13}")
+    print(f"{'loop calculate_distance':<28}{loop_s:>9.2f}{pairs / loop_s:>14.0f}{1:>8.1f}x{0:>13}")
+
+    engines = [('distance_matrix (pure)', None)]
+    if numpy is not None:
+        engines.append(('distance_matrix (numpy)', numpy))
+    for name, module in engines:
+        geo.np = module
+        matrix, seconds = timed(lambda: geo.distance_matrix(origins, targets))
+        diff = max(abs(a - b) for row, expected in zip(matrix, loop) for a, b in zip(row, expected))
+        print(f"{name:<28}{seconds:>9.2f}{pairs / seconds:>14.0f}{loop_s / seconds:>8.1f}x{diff:>13.2e}")
+    if numpy is None:
+        print(f"{'distance_matrix (numpy)':<28}  skipped, NumPy is not installed")
+
+    for name, module in engines:
+        geo.np = module
+        _, seconds = timed(lambda: geo.nearest_k(origins, targets, args.k))
+        print(f"{'nearest_k ' + name.split()[-1]:<28}{seconds:>9.2f}{pairs / seconds:>14.0f}")
+    geo.np = numpy
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Time the time-window queries before and after the epoch columns on a large rides table.
+
+Builds a migrated database in a temporary directory with --rides rides
+(and a fifth as many subscriptions, half as many payments) spread over
+the last year, carrying both the legacy TEXT times and the epoch
+columns. Only subscriptions that ended within the last day are still
+flagged active, as between two expiry runs. Each query then runs in its
+old form, which wraps the column in DATE()/datetime() and cannot use an
+index, and in its current form, a range on an indexed epoch column with
+day boundaries computed in the bot timezone.
+
+    python bench_epoch_queries.py
+    python bench_epoch_queries.py --rides 200000 --repeat 20
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timezone
+
+YEAR = 365 * 86400
+
+
+def _rows(count: int, now: int, rnd: random.Random):
+    for _ in range(count):
+        ts = now - rnd.randint(0, YEAR)
+        yield ts, datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def populate(path: str, rides: int, seed: int = 1):
+    from migrations import migrate
+    rnd = random.Random(seed)
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    conn.executemany(
+        "INSERT INTO users (user_id, first_name, user_type) VALUES (?, ?, ?)",
+        [(user_id, f"u{user_id}", 'captain' if user_id > 9000 else 'client') for user_id in range(1, 10001)])
+    conn.executemany("""
+        INSERT INTO rides (client_id, pickup_location, destination, status, created_at, created_ts)
+        VALUES (?, 'a', 'b', 'completed', ?, ?)
+    """, ((rnd.randint(1, 9000), text, ts) for ts, text in _rows(rides, now, rnd)))
+    conn.executemany("""
+        INSERT INTO subscriptions (user_id, subscription_type, end_date, end_ts, is_active)
+        VALUES (?, 'captain_monthly', ?, ?, ?)
+    """, ((rnd.randint(9001, 10000), text, ts + 30 * 86400, ts + 30 * 86400 > now - 86400)
+          for ts, text in _rows(rides // 5, now, rnd)))
+    conn.executemany("""
+        INSERT INTO payments (user_id, payment_type, amount, payment_method, payment_status, created_at, created_ts)
+        VALUES (?, 'ride_payment', ?, 'cash', 'completed', ?, ?)
+    """, ((rnd.randint(1, 9000), rnd.randint(10, 50), text, ts) for ts, text in _rows(rides // 2, now, rnd)))
+    conn.commit()
+    conn.close()
+
+
+def queries():
+    from timeutil import day_range, now_ts
+    today = day_range()
+    week_start = day_range(now_ts() - 6 * 86400)[0]
+    return [
+        ("today's rides",
+         "SELECT COUNT(*) FROM rides WHERE DATE(created_at) = DATE('now')", (),
+         "SELECT COUNT(*) FROM rides WHERE created_ts >= ? AND created_ts < ?", today),
+        ("expired subscriptions",
+         "SELECT user_id FROM subscriptions WHERE is_active = 1 AND datetime(end_date) <= datetime('now')", (),
+         "SELECT user_id FROM subscriptions WHERE is_active = 1 AND end_ts <= ?", (now_ts(),)),
+        ("captain subscription",
+         "SELECT COUNT(*) FROM subscriptions WHERE user_id = ? AND is_active = 1 "
+         "AND datetime(end_date) > datetime('now')", (9500,),
+         "SELECT COUNT(*) FROM subscriptions WHERE user_id = ? AND is_active = 1 AND end_ts > ?",
+         (9500, now_ts())),
+        ("7-day revenue by day",
+         "SELECT DATE(created_at), SUM(amount) FROM payments WHERE payment_status = 'completed' "
+         "AND DATE(created_at) >= DATE('now', '-7 days') GROUP BY DATE(created_at)", (),
+         "SELECT (created_ts - ?) / 86400, SUM(amount) FROM payments WHERE payment_status = 'completed' "
+         "AND created_ts >= ? GROUP BY 1", (week_start, week_start)),
+    ]
+
+
+def timed(conn: sqlite3.Connection, sql: str, params: tuple, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rides', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each query')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-epoch-'), 'bench.db')
+    started = time.perf_counter()
+    populate(path, args.rides)
+    print(f"built {args.rides} rides in {time.perf_counter() - started:.0f}s")
+
+    conn = sqlite3.connect(path)
+    print(f"{'query':<24}{'before ms':>11}{'after ms':>10}   plan after")
+    for name, old_sql, old_params, new_sql, new_params in queries():
+        before = timed(conn, old_sql, old_params, args.repeat)
+        after = timed(conn, new_sql, new_params, args.repeat)
+        plan = '; '.join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + new_sql, new_params))
+        print(f"{name:<24}{before:>11.2f}{after:>10.3f}   {plan}")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Measure moderation throughput (messages/sec) with 10 and 10,000 banned terms.
+
+A corpus of group messages (ride requests, offers, greetings, a few
+adverts and links, some written with diacritics or tatweel) is checked
+two ways: the single-pass AhoCorasickMatcher the bot uses, and the
+per-word substring search plus 12 re.search calls it replaced. Extra
+terms are random Arabic words, so most messages stay clean and every
+check reads the whole text, which is the common case in the group.
+
+    python bench_moderation.py
+    python bench_moderation.py --terms 10 1000 10000 --messages 20000
+"""
+import re
+import sys
+import time
+import random
+import argparse
+
+DEFAULT_TERMS = ["زواج", "مسيار", "جنس", "سكس", "عري", "إباحي"]
+# أنماط الترويج كما كانت في الفحص القديم
+OLD_PROMO_PATTERNS = [
+    r'للبيع', r'للايجار', r'اعلان', r'اعلانات',
+    r'خصم', r'عرض', r'تخفيض', r'مجانا',
+    r'www\.', r'http', r'bit\.ly', r't\.me'
+]
+LETTERS = "ابتثجحخدذرزسشصضطظعغفقكلمنهوي"
+PLACES = ["الحرم", "العزيزية", "الشوقية", "النسيم", "المطار", "جدة", "الطائف", "العوالي", "الكعكية"]
+TEMPLATES = [
+    "السلام عليكم مين متوفر من {a} الى {b} الحين",
+    "أبغى مشوار من {a} إلى {b} بعد صلاة العصر لشخصين",
+    "كابتن متواجد في {a} وجاهز لأي مشوار",
+    "مطلوب توصيل يومي من {a} الى {b} للدوام الساعة ٧ الصبح",
+    "جزاكم الله خير تم الاتفاق",
+    "مشوار {a} - {b} كم السعر؟",
+    "مــشــوار عاجل من {a} الى {b}",
+    "السَّلامُ عَلَيْكُم أحتاج سيارة عائلية من {a}",
+    "سيارة للبيع نظيفة جدا تواصل خاص",
+    "اعلان: خصم ٥٠٪ على التوصيل http://example.com",
+    "تابعونا t.me/example_channel",
+]
+
+
+def corpus(count: int, rnd: random.Random):
+    return [rnd.choice(TEMPLATES).format(a=rnd.choice(PLACES), b=rnd.choice(PLACES)) for _ in range(count)]
+
+
+def terms(count: int, rnd: random.Random):
+    words = set(DEFAULT_TERMS)
+    while len(words) < count:
+        words.add(''.join(rnd.choice(LETTERS) for _ in range(rnd.randint(4, 7))))
+    return sorted(words)[:max(count, len(DEFAULT_TERMS))]
+
+
+def old_check(banned_words, message_text: str) -> bool:
+    message_lower = message_text.lower()
+    for banned_word in banned_words:
+        if banned_word in message_lower:
+            return True
+    for pattern in OLD_PROMO_PATTERNS:
+        if re.search(pattern, message_lower):
+            return True
+    return False
+
+
+def rate(check, messages) -> tuple:
+    started = time.perf_counter()
+    flagged = sum(1 for message in messages if check(message))
+    return len(messages) / (time.perf_counter() - started), flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--terms', type=int, nargs='+', default=[10, 10000])
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    from content_filter import PROMO_PATTERNS, AhoCorasickMatcher
+    rnd = random.Random(1)
+    messages = corpus(args.messages, rnd)
+    print(f"{'terms':>6}{'old msg/s':>12}{'matcher msg/s':>15}{'speedup':>9}{'build ms':>10}"
+          f"{'old flagged':>13}{'matcher flagged':>17}")
+    for count in args.terms:
+        words = terms(count, random.Random(count))
+        banned = {word.lower() for word in words}
+        started = time.perf_counter()
+        matcher = AhoCorasickMatcher(PROMO_PATTERNS)
+        matcher.add_many(words)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        old_rate, old_flagged = rate(lambda text: old_check(banned, text), messages)
+        new_rate, new_flagged = rate(lambda text: matcher.search(text) is not None, messages)
+        print(f"{len(words):>6}{old_rate:>12.0f}{new_rate:>15.0f}{new_rate / old_rate:>8.1f}x{build_ms:>10.1f}"
+              f"{old_flagged:>13}{new_flagged:>17}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Time the captain's nearby-rides query on the grid index against a scan of all pending rides.
+
+For each size in --pending, builds a database with that many pending
+rides whose pickups are spread over a --spread-km square around Makkah,
+then runs random captain locations through get_nearby_pending_rides
+(grid cells within the radius) and through the scan it replaced: read
+every pending ride and compute calculate_distance for each one. Both
+return every ride within the radius, nearest first, and the lists are
+compared.
+
+    python bench_nearby_rides.py
+    python bench_nearby_rides.py --pending 10000 100000 --radius-km 5
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+MAKKAH_LAT, MAKKAH_LON = 21.4225, 39.8262
+KM_PER_DEG = 111.32
+
+
+def _point(rnd: random.Random, spread_km: float):
+    half = spread_km / 2 / KM_PER_DEG
+    return MAKKAH_LAT + rnd.uniform(-half, half), MAKKAH_LON + rnd.uniform(-half, half)
+
+
+def populate(path: str, pending: int, spread_km: float, seed: int = 1):
+    from geo import grid_cell
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO users (user_id, first_name, user_type) VALUES (?, ?, 'client')",
+                     [(user_id, f"u{user_id}") for user_id in range(1, 1001)])
+    rows = []
+    for _ in range(pending):
+        lat, lon = _point(rnd, spread_km)
+        rows.append((rnd.randint(1, 1000), lat, lon, grid_cell(lat, lon)))
+    conn.executemany("""
+        INSERT INTO rides (client_id, pickup_location, destination, status,
+                           pickup_latitude, pickup_longitude, pickup_cell)
+        VALUES (?, 'a', 'b', 'pending', ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+
+def scan_nearby(db, latitude: float, longitude: float, radius_km: float, limit: int = 5):
+    """The O(all pending) version: every pending ride and one distance each"""
+    from geo import calculate_distance
+    with db.connections.connect() as conn:
+        rows = conn.execute("""
+            SELECT r.*, u.username, u.first_name
+            FROM rides r
+            JOIN users u ON r.client_id = u.user_id
+            WHERE r.status = 'pending' AND r.pickup_latitude IS NOT NULL
+        """).fetchall()
+    nearby = []
+    for row in rows:
+        distance = calculate_distance(latitude, longitude, row['pickup_latitude'], row['pickup_longitude'])
+        if distance <= radius_km:
+            ride = dict(row)
+            ride['pickup_distance'] = distance
+            nearby.append(ride)
+    nearby.sort(key=lambda ride: ride['pickup_distance'])
+    return nearby[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pending', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--spread-km', type=float, default=60, help='side of the square the pickups fall in')
+    parser.add_argument('--radius-km', type=float, nargs='+', default=[2, 10])
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    from database import Database
+    print(f"{'pending':>8}{'radius km':>10}{'found':>7}{'scan ms':>10}{'grid ms':>10}{'speedup':>9}  same results")
+    for pending in args.pending:
+        path = os.path.join(tempfile.mkdtemp(prefix='bench-nearby-'), 'bench.db')
+        db = Database(path)
+        populate(path, pending, args.spread_km)
+        rnd = random.Random(2)
+        captains = [_point(rnd, args.spread_km) for _ in range(args.queries)]
+
+        for radius_km in args.radius_km:
+            started = time.perf_counter()
+            scanned = [scan_nearby(db, lat, lon, radius_km, limit=pending) for lat, lon in captains]
+            scan_ms = (time.perf_counter() - started) / len(captains) * 1000
+            started = time.perf_counter()
+            grid = [db.get_nearby_pending_rides(lat, lon, radius_km, limit=pending) for lat, lon in captains]
+            grid_ms = (time.perf_counter() - started) / len(captains) * 1000
+
+            found = sum(map(len, grid)) // len(grid)
+            same = all([r['ride_id'] for r in a] == [r['ride_id'] for r in b] for a, b in zip(scanned, grid))
+            print(f"{pending:>8}{radius_km:>10g}{found:>7}{scan_ms:>10.2f}{grid_ms:>10.2f}"
+                  f"{scan_ms / grid_ms:>8.1f}x  {same}")
+        db.writes.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
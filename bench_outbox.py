@@ -0,0 +1,128 @@
+"""Measure how fast OutboxDispatcher drains thousands of pending notifications.
+
+For each size in --pending, a fresh database gets that many pending
+outbox rows, written with enqueue() as the database methods do, behind
+--sent-history rows that were already delivered. The dispatcher then
+drains them into a stand-in send queue that completes each send after
+--send-ms, with OUTBOX_BATCH sends in flight. The script reports
+notifications/s until the last send completes and checks that every row
+was sent once and ended up marked sent. It also times the /metrics
+outbox count: the old GROUP BY over the whole table against the
+pending and failed counts on their partial indexes.
+
+    python bench_outbox.py
+    python bench_outbox.py --pending 5000 50000 --send-ms 50 --batch 500
+"""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+from collections import Counter
+
+
+class FakeSendQueue:
+    """Completes every submitted send after a fixed delay"""
+
+    bot = None
+
+    def __init__(self, send_ms: float):
+        self.delay = send_ms / 1000
+        self.sent = Counter()
+        self.completed = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def submit(self, method, chat_id, priority, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def finish():
+            self.sent[chat_id] += 1
+            self.completed += 1
+            future.set_result(True)
+            if self.completed >= self.expected:
+                self.done.set()
+
+        loop.call_later(self.delay, finish)
+        return future
+
+
+MARKUP = {'inline_keyboard': [[{'text': 'ok', 'callback_data': 'x'}]]}
+
+
+def populate(path: str, pending: int, history: int):
+    from database import Database
+    from outbox import Notification, enqueue
+    db = Database(path)
+    now = int(time.time())
+    with db.connections.connect() as conn:
+        conn.executemany("""
+            INSERT INTO outbox (idempotency_key, chat_id, payload, priority, status, attempts,
+                                next_attempt_ts, created_ts, sent_ts)
+            VALUES (?, ?, '{"text": "old"}', 2, 'sent', 1, ?, ?, ?)
+        """, ((f"history:{n}", n, now, now, now) for n in range(history)))
+        for n in range(pending):
+            # chat_id فريد لكل صف حتى يُكشف أي إرسال مكرر
+            notification = Notification(1000000 + n, f"notification {n}", priority=n % 4, reply_markup=MARKUP)
+            enqueue(conn, f"bench:{n}", notification)
+        conn.commit()
+    return db
+
+
+async def drain(path: str, pending: int, send_ms: float):
+    from outbox_dispatcher import OutboxDispatcher
+    queue = FakeSendQueue(send_ms)
+    queue.expected = pending
+    dispatcher = OutboxDispatcher(path, queue)
+    started = time.perf_counter()
+    await dispatcher.start()
+    await queue.done.wait()
+    elapsed = time.perf_counter() - started
+    await dispatcher.stop()
+    once = len(queue.sent) == pending and set(queue.sent.values()) == {1}
+    return pending / elapsed, once, await dispatcher.stats()
+
+
+def timed(conn: sqlite3.Connection, statements, repeat: int = 20) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for sql in statements:
+            conn.execute(sql).fetchall()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pending', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--sent-history', type=int, default=200000, help='delivered rows already in the table')
+    parser.add_argument('--send-ms', type=float, nargs='+', default=[0, 20], help='time each send takes')
+    parser.add_argument('--batch', type=int, help='OUTBOX_BATCH (default: the configured value)')
+    args = parser.parse_args()
+
+    import outbox_dispatcher
+    if args.batch:
+        outbox_dispatcher.OUTBOX_BATCH = args.batch
+    print(f"OUTBOX_BATCH {outbox_dispatcher.OUTBOX_BATCH}, {args.sent_history} delivered rows in the table")
+    print(f"{'pending':>8}{'send ms':>9}{'notif/s':>10}  sent once  left pending  "
+          f"{'GROUP BY ms':>12}{'partial ms':>11}")
+    for pending in args.pending:
+        for send_ms in args.send_ms:
+            path = os.path.join(tempfile.mkdtemp(prefix='bench-outbox-'), 'bench.db')
+            db = populate(path, pending, args.sent_history)
+            conn = sqlite3.connect(path)
+            group_ms = timed(conn, ["SELECT status, COUNT(*) FROM outbox GROUP BY status"])
+            partial_ms = timed(conn, ["SELECT COUNT(*) FROM outbox WHERE status = 'pending'",
+                                      "SELECT COUNT(*) FROM outbox WHERE status = 'failed'"])
+            rate, once, stats = asyncio.run(drain(path, pending, send_ms))
+            print(f"{pending:>8}{send_ms:>9g}{rate:>10.0f}  {str(once):>9}  {stats['pending']:>12}  "
+                  f"{group_ms:>12.2f}{partial_ms:>11.3f}")
+            conn.close()
+            db.writes.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""Time /revenue_report on the stat buckets against the same report computed by scanning payments.
+
+Builds a migrated database in a temporary directory with --payments
+payments (5M by default), a tenth as many rides and a fiftieth as many
+users spread over two years. Rows are inserted with the stat triggers
+dropped and the buckets rebuilt once afterwards, as rebuild_stats.py
+does after an import. For each window in --days the report is then
+produced by Database.get_revenue_report, which reads stat_daily and
+stat_hourly, and by aggregate queries over payments and rides (finished
+rides by finished_ts) that return the same fields. The two results are
+compared.
+
+    python bench_revenue_report.py
+    python bench_revenue_report.py --payments 500000 --days 7 30
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+SPAN = 2 * 365 * 86400
+METHODS = ('cash', 'bank', 'stc', 'urpay', 'mada')
+STATUSES = ('completed',) * 7 + ('pending', 'failed', 'refunded')
+RIDE_STATUSES = ('completed',) * 6 + ('cancelled', 'cancelled', 'pending', 'accepted')
+
+
+def ride(rnd: random.Random, users: int, now: int) -> tuple:
+    status = rnd.choice(RIDE_STATUSES)
+    created = now - rnd.randint(0, SPAN)
+    # الرحلات المنتهية تنتهي بعد طلبها بدقائق إلى ثلاثة أيام
+    finished = min(created + rnd.randint(600, 3 * 86400), now) if status in ('completed', 'cancelled') else None
+    return rnd.randint(1, users), status, created, finished
+
+
+def populate(path: str, payments: int, seed: int = 1):
+    from migrations import migrate
+    from stats_counters import drop_triggers, install
+    rnd = random.Random(seed)
+    now = int(time.time())
+    users = max(payments // 50, 10)
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    drop_triggers(conn)
+    conn.executemany(
+        "INSERT INTO users (user_id, first_name, user_type, created_ts) VALUES (?, ?, 'client', ?)",
+        ((user_id, f"u{user_id}", now - rnd.randint(0, SPAN)) for user_id in range(1, users + 1)))
+    conn.executemany("""
+        INSERT INTO rides (client_id, pickup_location, destination, status, created_ts, finished_ts)
+        VALUES (?, 'a', 'b', ?, ?, ?)
+    """, (ride(rnd, users, now) for _ in range(payments // 10)))
+    conn.executemany("""
+        INSERT INTO payments (user_id, payment_type, amount, payment_method, payment_status, created_ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, ((rnd.randint(1, users), 'ride_payment' if rnd.random() < 0.9 else 'subscription_payment',
+           rnd.randint(10, 200), rnd.choice(METHODS), rnd.choice(STATUSES), now - rnd.randint(0, SPAN))
+          for _ in range(payments)))
+    conn.commit()
+    started = time.perf_counter()
+    install(conn)
+    conn.commit()
+    conn.close()
+    return time.perf_counter() - started
+
+
+def scan_report(conn: sqlite3.Connection, days: int) -> dict:
+    """The report fields computed straight from payments and rides"""
+    from timeutil import day_range, utc_offset_seconds
+    today_start, today_end = day_range()
+    start = today_start - (days - 1) * 86400
+
+    def breakdown(column: str):
+        rows = conn.execute(f"""
+            SELECT {column}, COUNT(*), SUM(amount) FROM payments
+            WHERE payment_status = 'completed' GROUP BY {column}
+        """).fetchall()
+        return sorted(({column: label, 'count': count, 'total': total} for label, count, total in rows),
+                      key=lambda row: row['total'], reverse=True)
+
+    def period(start_ts: int, end_ts: int) -> dict:
+        revenue, completed, all_payments = conn.execute("""
+            SELECT COALESCE(SUM(amount) FILTER (WHERE payment_status = 'completed'), 0),
+                   COUNT(*) FILTER (WHERE payment_status = 'completed'), COUNT(*)
+            FROM payments WHERE created_ts >= ? AND created_ts < ?
+        """, (start_ts, end_ts)).fetchone()
+        rides, = conn.execute("SELECT COUNT(*) FROM rides WHERE created_ts >= ? AND created_ts < ?",
+                              (start_ts, end_ts)).fetchone()
+        rides_completed, rides_cancelled = conn.execute("""
+            SELECT COUNT(*) FILTER (WHERE status = 'completed'), COUNT(*) FILTER (WHERE status = 'cancelled')
+            FROM rides WHERE finished_ts >= ? AND finished_ts < ?
+        """, (start_ts, end_ts)).fetchone()
+        return {'revenue': revenue, 'payments': completed, 'all_payments': all_payments, 'rides': rides,
+                'rides_completed': rides_completed, 'rides_cancelled': rides_cancelled}
+
+    by_method = breakdown('payment_method')
+    daily = conn.execute("""
+        SELECT DATE(created_ts + ?, 'unixepoch') AS day, SUM(amount) AS total FROM payments
+        WHERE payment_status = 'completed' AND created_ts >= ? AND created_ts < ?
+        GROUP BY day ORDER BY day DESC
+    """, (utc_offset_seconds(), start, today_end)).fetchall()
+    return {
+        'total_revenue': sum(row['total'] for row in by_method),
+        'by_method': by_method,
+        'by_type': breakdown('payment_type'),
+        'daily': [{'day': day, 'total': total} for day, total in daily],
+        'days': days,
+        'period': period(start, today_end),
+        'previous_period': period(start - days * 86400, start),
+    }
+
+
+def timed(func, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--payments', type=int, default=5000000)
+    parser.add_argument('--days', type=int, nargs='+', default=[7, 90, 366])
+    parser.add_argument('--repeat', type=int, default=5, help='runs of the bucket report per window')
+    args = parser.parse_args()
+
+    from database import Database
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-revenue-'), 'bench.db')
+    started = time.perf_counter()
+    rebuild_s = populate(path, args.payments)
+    print(f"built {args.payments} payments in {time.perf_counter() - started:.0f}s "
+          f"(bucket rebuild {rebuild_s:.1f}s)")
+
+    db = Database(path)
+    conn = sqlite3.connect(path)
+    print(f"{'days':>5}{'scan ms':>11}{'buckets ms':>12}{'speedup':>10}  same report")
+    for days in args.days:
+        scanned, scan_ms = timed(lambda: scan_report(conn, days), 1)
+        report, bucket_ms = timed(lambda: db.get_revenue_report(days), args.repeat)
+        print(f"{days:>5}{scan_ms:>11.1f}{bucket_ms:>12.2f}{scan_ms / bucket_ms:>9.0f}x  {report == scanned}")
+    conn.close()
+    db.writes.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Compare write throughput of the group-commit writer with one commit per call.
+
+Each task runs add_user, create_ride, accept_ride and create_payment_record
+in a loop against a fresh database in a temporary directory. In "queued"
+mode they go through AsyncDatabase to the single writer (write_queue),
+which commits many of them together. In "per-call" mode the same
+operations run on the DB executor threads and each commits its own
+transaction, as every Database write did before the writer existed.
+
+    python bench_writes.py
+    python bench_writes.py --tasks 1 16 128 512 --writes 8000
+    SQLITE_SYNCHRONOUS=FULL python bench_writes.py
+"""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import functools
+
+OPERATIONS = 4
+
+
+def _per_call(db, name: str, *args):
+    # نفس عملية الكتابة لكن بمعاملة وحفظ خاص بها في خيط المنفذ
+    from database import Database
+    op = getattr(Database, name).__wrapped__
+    conn = db.connections.connect()
+    try:
+        result = op(db, conn, *args)
+        conn.commit()
+        return result
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+async def run(mode: str, tasks: int, per_task: int) -> dict:
+    from database import Database
+    from async_db import AsyncDatabase, get_executor
+    from write_queue import stop_write_queues
+
+    db = Database(os.path.join(tempfile.mkdtemp(prefix='bench-writes-'), 'bench.db'))
+    facade = AsyncDatabase(db)
+    loop = asyncio.get_running_loop()
+
+    async def write(name: str, *args):
+        if mode == 'queued':
+            return await getattr(facade, name)(*args)
+        return await loop.run_in_executor(get_executor(), functools.partial(_per_call, db, name, *args))
+
+    latencies, errors = [], 0
+
+    async def worker(n: int):
+        nonlocal errors
+        for i in range(per_task):
+            user_id = n * 100000 + i
+            started = time.perf_counter()
+            try:
+                added = await write('add_user', user_id, f"u{user_id}", "bench")
+                ride_id = await write('create_ride', user_id, 'a', 'b')
+                accepted = await write('accept_ride', ride_id, user_id + 1) if ride_id else False
+                payment_id = await write('create_payment_record', user_id, 'ride_payment', 10, 'cash', ride_id)
+            except sqlite3.Error:
+                errors += OPERATIONS
+                continue
+            latencies.append((time.perf_counter() - started) * 1000 / OPERATIONS)
+            errors += (not added) + (ride_id is None) + (not accepted) + (payment_id is None)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(tasks)))
+    elapsed = time.perf_counter() - started
+    stop_write_queues()
+    latencies.sort()
+    writes = tasks * per_task * OPERATIONS
+    return {
+        'mode': mode,
+        'tasks': tasks,
+        'writes': writes,
+        'writes_per_s': round(writes / elapsed),
+        'p50_ms': round(latencies[len(latencies) // 2], 2) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)], 2) if latencies else None,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tasks', type=int, nargs='+', default=[1, 16, 128, 512], help='concurrent writers')
+    parser.add_argument('--writes', type=int, default=8000, help='approximate writes per run')
+    parser.add_argument('--modes', nargs='+', default=['per-call', 'queued'], choices=['per-call', 'queued'])
+    args = parser.parse_args()
+
+    print(f"synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+    for tasks in args.tasks:
+        per_task = max(1, args.writes // OPERATIONS // tasks)
+        for mode in args.modes:
+            result = asyncio.run(run(mode, tasks, per_task))
+            print(f"{result['mode']:>8}  tasks {tasks:>4}: {result['writes_per_s']:>6} writes/s, "
+                  f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, errors {result['errors']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
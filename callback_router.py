@@ -0,0 +1,167 @@
+import bisect
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+# حدود مدرج زمن التنفيذ بالمللي ثانية
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# اسم المسار المستخدم لبيانات أزرار لا يقابلها أي معالج
+UNMATCHED_ROUTE = '<unmatched>'
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class RouteMetrics:
+    """Call count, error count and latency histogram for one route"""
+
+    __slots__ = ('count', 'errors', 'total_ms', 'max_ms', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        # خانة إضافية للقيم الأكبر من آخر حد
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, elapsed_ms: float, failed: bool = False):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound in ms of the bucket holding the q-th quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': self.total_ms / self.count if self.count else 0.0,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'max_ms': self.max_ms,
+            'buckets': list(self.buckets),
+        }
+
+
+class CallbackRouter:
+    """Dispatch table for inline keyboard callback data.
+
+    Exact keys are found with one dict lookup. Prefix routes such as
+    ``accept_ride_<id>`` are keyed by their prefix, which ends with an
+    underscore. A lookup cuts the data after the n-th underscore only for
+    the values of n that a registered prefix has, longest prefix first.
+    The rest of the data is split on ``_`` and converted with the route's
+    converters, and the results are passed to the handler as positional
+    arguments. If they fail to convert, shorter prefixes are tried. Data
+    that matches nothing is counted under UNMATCHED_ROUTE.
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, Tuple[str, Handler]] = {}
+        self._prefixes: Dict[str, Tuple[str, Handler, Sequence[Callable[[str], Any]]]] = {}
+        # أعداد الشرطات السفلية في البادئات المسجلة، من الأكبر للأصغر
+        self._depths: List[int] = []
+        self._metrics: Dict[str, RouteMetrics] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, handler: Handler):
+        """Route callback data equal to key"""
+        if key in self._exact:
+            raise ValueError(f"Duplicate callback route: {key}")
+        self._exact[key] = (key, handler)
+
+    def add_prefix(self, prefix: str, handler: Handler, *converters: Callable[[str], Any]):
+        """Route callback data of the form prefix + '_'.join(params)"""
+        if not prefix.endswith('_'):
+            raise ValueError(f"Callback prefix must end with '_': {prefix}")
+        if prefix in self._prefixes:
+            raise ValueError(f"Duplicate callback route: {prefix}")
+        name = prefix + '_'.join(f"<{getattr(c, '__name__', 'param')}>" for c in converters)
+        self._prefixes[prefix] = (name, handler, converters)
+        self._depths = sorted({p.count('_') for p in self._prefixes}, reverse=True)
+
+    def resolve(self, data: str) -> Tuple[str, Optional[Handler], tuple]:
+        """Return (route name, handler, params) for callback data"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route[0], route[1], ()
+
+        if not self._depths:
+            return UNMATCHED_ROUTE, None, ()
+        cuts = []
+        end = data.find('_')
+        while end >= 0 and len(cuts) < self._depths[0]:
+            cuts.append(end + 1)
+            end = data.find('_', end + 1)
+        for depth in self._depths:
+            if depth > len(cuts):
+                continue
+            cut = cuts[depth - 1]
+            route = self._prefixes.get(data[:cut])
+            if route is not None:
+                name, handler, converters = route
+                params = self._parse(data[cut:], converters)
+                if params is not None:
+                    return name, handler, params
+        return UNMATCHED_ROUTE, None, ()
+
+    @staticmethod
+    def _parse(rest: str, converters: Sequence[Callable[[str], Any]]) -> Optional[tuple]:
+        try:
+            if len(converters) == 1:
+                return (converters[0](rest),) if rest else None
+            if not converters:
+                return () if not rest else None
+            parts = rest.split('_', len(converters) - 1)
+            if len(parts) != len(converters):
+                return None
+            return tuple([convert(part) for convert, part in zip(converters, parts)])
+        except (TypeError, ValueError):
+            return None
+
+    async def dispatch(self, query, context, data: str) -> bool:
+        """Run the handler for data and record its metrics; return False if nothing matched"""
+        name, handler, params = self.resolve(data)
+        start = time.perf_counter()
+        failed = False
+        try:
+            if handler is not None:
+                await handler(query, context, *params)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self._observe(name, (time.perf_counter() - start) * 1000, failed)
+        return handler is not None
+
+    def _observe(self, name: str, elapsed_ms: float, failed: bool):
+        with self._lock:
+            metrics = self._metrics.get(name)
+            if metrics is None:
+                metrics = self._metrics[name] = RouteMetrics()
+            metrics.observe(elapsed_ms, failed)
+
+    def routes(self) -> List[str]:
+        """Names of every registered route"""
+        return [name for name, _ in self._exact.values()] + [name for name, _, _ in self._prefixes.values()]
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """Per-route metric snapshots, busiest route first"""
+        with self._lock:
+            snapshots = {name: metrics.snapshot() for name, metrics in self._metrics.items()}
+        return dict(sorted(snapshots.items(), key=lambda item: item[1]['count'], reverse=True))
@@ -0,0 +1,153 @@
+"""Fail when a hot query's plan scans a large table.
+
+Runs every registered hot Database/ModerationSystem call against a copy
+of the database and captures the EXPLAIN QUERY PLAN of each statement it
+executes, so the check follows the real SQL rather than a copy of it.
+A plan step "SCAN <table>" over a large table fails the check unless it
+walks a partial index (which holds only the rows the query wants) or the
+query lists that table in allow_scan. Large tables are those in
+LARGE_TABLES plus, with --db, any table holding at least --min-rows rows.
+
+    python check_query_plans.py
+    python check_query_plans.py --db /path/to/mashawir_bot.db --verbose
+"""
+import os
+import sys
+import argparse
+import sqlite3
+import tempfile
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from pagination import encode_cursor
+from query_log import capture_plans, plan_scans
+
+# الجداول التي تكبر بلا حد مع الاستخدام
+LARGE_TABLES = ('users', 'rides', 'ratings', 'payments', 'payment_requests', 'subscriptions',
+                'user_warnings', 'outbox', 'stat_daily', 'stat_hourly')
+
+
+class HotQuery(NamedTuple):
+    name: str
+    run: Callable[..., object]
+    # جداول (أو أسماؤها المستعارة) يُسمح بمسحها لأن الاستعلام يقرأ بترتيب الفهرس ويتوقف عند LIMIT
+    allow_scan: Tuple[str, ...] = ()
+
+
+HOT_QUERIES: List[HotQuery] = [
+    HotQuery('get_user', lambda db, mod: db.get_user(7)),
+    HotQuery('get_pending_rides', lambda db, mod: db.get_pending_rides(10)),
+    HotQuery('get_pending_rides(cursor)', lambda db, mod: db.get_pending_rides(10, encode_cursor((1000,)))),
+    HotQuery('get_nearby_pending_rides', lambda db, mod: db.get_nearby_pending_rides(21.42, 39.82)),
+    HotQuery('get_ride_by_id', lambda db, mod: db.get_ride_by_id(1)),
+    HotQuery('accept_ride', lambda db, mod: db.accept_ride(1, 8)),
+    HotQuery('start_ride', lambda db, mod: db.start_ride(1, 8)),
+    HotQuery('complete_ride', lambda db, mod: db.complete_ride(1, 8)),
+    HotQuery('cancel_ride', lambda db, mod: db.cancel_ride(2, 7)),
+    HotQuery('update_ride_status', lambda db, mod: db.update_ride_status(3, 'cancelled')),
+    HotQuery('get_user_rides', lambda db, mod: db.get_user_rides(7, 5)),
+    HotQuery('get_user_rides(cursor)', lambda db, mod: db.get_user_rides(7, 5, encode_cursor((1000,)))),
+    HotQuery('get_captain_active_rides', lambda db, mod: db.get_captain_active_rides(8)),
+    HotQuery('get_subscription_info', lambda db, mod: db.get_subscription_info(8)),
+    HotQuery('get_expired_subscriptions', lambda db, mod: db.get_expired_subscriptions()),
+    HotQuery('get_pending_payments', lambda db, mod: db.get_pending_payments()),
+    HotQuery('get_user_payments', lambda db, mod: db.get_user_payments(7)),
+    HotQuery('get_admin_stats', lambda db, mod: db.get_admin_stats()),
+    HotQuery('get_recent_rides', lambda db, mod: db.get_recent_rides(10), allow_scan=('r',)),
+    HotQuery('get_recent_rides(cursor)', lambda db, mod: db.get_recent_rides(10, encode_cursor((1000,))),
+             allow_scan=('r',)),
+    HotQuery('get_recent_users', lambda db, mod: db.get_recent_users(15), allow_scan=('users',)),
+    HotQuery('get_recent_users(cursor)', lambda db, mod: db.get_recent_users(15, encode_cursor((1700000000, 1000))),
+             allow_scan=('users',)),
+    HotQuery('get_user_details', lambda db, mod: db.get_user_details(7)),
+    HotQuery('get_live_activity', lambda db, mod: db.get_live_activity()),
+    HotQuery('get_revenue_report', lambda db, mod: db.get_revenue_report(7)),
+    HotQuery('list_users', lambda db, mod: db.list_users('captain', 20)),
+    HotQuery('list_users(cursor)', lambda db, mod: db.list_users('captain', 20, encode_cursor((1700000000, 1000)))),
+    HotQuery('get_user_warnings_count', lambda db, mod: mod.get_user_warnings_count(7)),
+    HotQuery('get_active_scheduled_messages', lambda db, mod: mod.get_active_scheduled_messages()),
+]
+
+
+def _aliases(sql: str) -> Dict[str, str]:
+    """Map each FROM/JOIN alias of a statement to its table name"""
+    words = sql.replace(',', ' , ').replace('(', ' ( ').replace(')', ' ) ').split()
+    aliases = {}
+    for i, word in enumerate(words[:-1]):
+        if word.upper() in ('FROM', 'JOIN', 'UPDATE', 'INTO'):
+            table = words[i + 1]
+            aliases[table] = table
+            following = words[i + 2:i + 4]
+            if following and following[0].upper() == 'AS':
+                following = following[1:]
+            if following and following[0].isidentifier() and following[0].upper() not in (
+                    'WHERE', 'JOIN', 'LEFT', 'INNER', 'ON', 'ORDER', 'GROUP', 'LIMIT', 'SET', 'VALUES', 'UNION'):
+                aliases[following[0]] = table
+    return aliases
+
+
+def _partial_indexes(conn: sqlite3.Connection) -> set:
+    return {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'")}
+
+
+def _table_sizes(conn: sqlite3.Connection) -> Dict[str, int]:
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    return {name: conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0] for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', help='database file to copy and check (default: a fresh empty schema)')
+    parser.add_argument('--min-rows', type=int, default=10000, help='row count that makes a table large')
+    parser.add_argument('--verbose', action='store_true', help='print every captured plan')
+    args = parser.parse_args()
+
+    # الاستعلامات الساخنة تتضمن كتابات، فالفحص يعمل دائماً على نسخة
+    workdir = tempfile.mkdtemp(prefix='query-plans-')
+    path = os.path.join(workdir, 'mashawir_bot.db')
+    if args.db:
+        source = sqlite3.connect(args.db)
+        target = sqlite3.connect(path)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    from database import Database
+    from moderation import ModerationSystem
+    db = Database(path)
+    mod = ModerationSystem(path)
+
+    conn = sqlite3.connect(path)
+    partial = _partial_indexes(conn)
+    large = set(LARGE_TABLES)
+    if args.db:
+        large |= {name for name, rows in _table_sizes(conn).items() if rows >= args.min_rows}
+    conn.close()
+
+    failures = []
+    for query in HOT_QUERIES:
+        with capture_plans() as plans:
+            query.run(db, mod)
+        for sql, plan in plans:
+            aliases = _aliases(sql)
+            scanned = [table for table, index in plan_scans(plan)
+                       if aliases.get(table, table) in large and index not in partial
+                       and table not in query.allow_scan]
+            if args.verbose:
+                print(f"{query.name}: {sql[:100]}")
+                for step in plan:
+                    print(f"    {step}")
+            if scanned:
+                failures.append((query.name, sql, plan, scanned))
+
+    for name, sql, plan, scanned in failures:
+        print(f"FAIL {name}: scans {', '.join(scanned)}")
+        print(f"    {sql}")
+        for step in plan:
+            print(f"    {step}")
+    print(f"{len(HOT_QUERIES)} hot queries checked, {len(failures)} plans scan a large table")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
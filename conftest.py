@@ -0,0 +1,3 @@
+# الوحدات في جذر المستودع؛ وجود هذا الملف يضيفه إلى sys.path أثناء الاختبارات
+# load_test.py أداة قياس وليس اختباراً رغم أن اسمه يطابق نمط pytest
+collect_ignore = ['load_test.py']
@@ -0,0 +1,176 @@
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set
+
+# أنماط المحتوى الترويجي (نصوص حرفية تُطابق بعد التطبيع)
+PROMO_PATTERNS = [
+    'للبيع', 'للايجار', 'اعلان', 'اعلانات',
+    'خصم', 'عرض', 'تخفيض', 'مجانا',
+    'www.', 'http', 'bit.ly', 't.me'
+]
+
+# جدول تطبيع النص العربي: حذف التشكيل والتطويل وتوحيد أشكال الألف والياء والهمزة
+_ARABIC_TRANSLATION = {code: None for code in range(0x064B, 0x0660)}  # الحركات والتنوين والشدة
+_ARABIC_TRANSLATION.update({
+    0x0670: None,          # ألف خنجرية
+    0x0640: None,          # تطويل
+    ord('أ'): 'ا',
+    ord('إ'): 'ا',
+    ord('آ'): 'ا',
+    ord('ٱ'): 'ا',
+    ord('ى'): 'ي',
+    ord('ئ'): 'ي',
+    ord('ؤ'): 'و',
+})
+_ARABIC_TRANSLATION = str.maketrans(_ARABIC_TRANSLATION)
+
+# مع عدد قليل من الأنماط يكون البحث الجزئي المبني في C أسرع من الأوتوماتون
+SCAN_THRESHOLD = 128
+
+
+def normalize_arabic(text: str) -> str:
+    """Lowercase text and fold Arabic diacritics, tatweel and alef/ya variants"""
+    return text.lower().translate(_ARABIC_TRANSLATION)
+
+
+class _Node:
+    __slots__ = ('goto', 'fail', 'word', 'match')
+
+    def __init__(self):
+        self.goto: Dict[str, '_Node'] = {}
+        self.fail: Optional['_Node'] = None
+        # الكلمة التي تنتهي عند هذه العقدة
+        self.word: Optional[str] = None
+        # أول كلمة تنتهي هنا أو في إحدى عقد روابط الفشل
+        self.match: Optional[str] = None
+
+
+class AhoCorasickMatcher:
+    """Multi-pattern substring matcher that scans each message once.
+
+    Patterns and input text are normalized with normalize_arabic. Adding a
+    pattern extends the trie and relinks failure pointers; removing one
+    only clears its terminal mark and refreshes match pointers, so the
+    trie is never rebuilt from scratch. Up to SCAN_THRESHOLD patterns the
+    search falls back to plain substring checks, which are faster at that
+    size.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self._lock = threading.RLock()
+        self._root = _Node()
+        self._words: Set[str] = set()
+        self._scan: tuple = ()
+        for pattern in patterns:
+            self._insert(pattern)
+        self._link()
+
+    def __len__(self) -> int:
+        return len(self._words)
+
+    def __contains__(self, pattern: str) -> bool:
+        return normalize_arabic(pattern) in self._words
+
+    def add(self, pattern: str) -> bool:
+        """Add a pattern; return False if it was already present"""
+        with self._lock:
+            if not self._insert(pattern):
+                return False
+            self._link()
+            return True
+
+    def add_many(self, patterns: Iterable[str]) -> int:
+        """Add several patterns with a single relink; return how many were new"""
+        with self._lock:
+            added = sum(1 for pattern in patterns if self._insert(pattern))
+            if added:
+                self._link()
+            return added
+
+    def remove(self, pattern: str) -> bool:
+        """Remove a pattern; return False if it was not present"""
+        normalized = normalize_arabic(pattern)
+        with self._lock:
+            if normalized not in self._words:
+                return False
+            self._words.discard(normalized)
+            node = self._root
+            for char in normalized:
+                node = node.goto[char]
+            node.word = None
+            self._refresh_matches()
+            self._scan = tuple(self._words)
+            return True
+
+    def search(self, text: str) -> Optional[str]:
+        """Return the first pattern found in text, or None"""
+        if not text:
+            return None
+        text = normalize_arabic(text)
+        with self._lock:
+            if len(self._scan) <= SCAN_THRESHOLD:
+                for word in self._scan:
+                    if word in text:
+                        return word
+                return None
+            root = self._root
+            node = root
+            for char in text:
+                while char not in node.goto and node is not root:
+                    node = node.fail
+                node = node.goto.get(char, root)
+                if node.match is not None:
+                    return node.match
+            return None
+
+    def patterns(self) -> List[str]:
+        """Return the normalized patterns currently in the automaton"""
+        with self._lock:
+            return sorted(self._words)
+
+    def _insert(self, pattern: str) -> bool:
+        normalized = normalize_arabic(pattern)
+        if not normalized or normalized in self._words:
+            return False
+        node = self._root
+        for char in normalized:
+            child = node.goto.get(char)
+            if child is None:
+                child = node.goto[char] = _Node()
+            node = child
+        node.word = normalized
+        self._words.add(normalized)
+        return True
+
+    def _bfs(self):
+        queue = deque(self._root.goto.values())
+        while queue:
+            node = queue.popleft()
+            yield node
+            queue.extend(node.goto.values())
+
+    def _link(self):
+        """Recompute failure pointers and match pointers breadth-first"""
+        root = self._root
+        root.fail = root
+        root.match = None
+        queue = deque()
+        for child in root.goto.values():
+            child.fail = root
+            child.match = child.word
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in node.goto.items():
+                fail = node.fail
+                while char not in fail.goto and fail is not root:
+                    fail = fail.fail
+                child.fail = fail.goto.get(char, root)
+                child.match = child.word if child.word is not None else child.fail.match
+                queue.append(child)
+        self._scan = tuple(self._words)
+
+    def _refresh_matches(self):
+        """Recompute match pointers after a pattern is removed"""
+        for node in self._bfs():
+            node.match = node.word if node.word is not None else node.fail.match
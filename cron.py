@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+from typing import FrozenSet, Optional
+from zoneinfo import ZoneInfo
+from timeutil import BOT_TIMEZONE
+
+# الحقول بالترتيب: الدقيقة، الساعة، يوم الشهر، الشهر، يوم الأسبوع (0 = الأحد)
+_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+)
+
+# أقصى مدى للبحث عن الموعد التالي (تعبير مثل 30 فبراير لا يتحقق أبداً)
+_SEARCH_YEARS = 5
+
+
+def _parse_field(text: str, name: str, low: int, high: int) -> FrozenSet[int]:
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Invalid step in cron {name} field: {text}")
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            # "5/15" تعني من 5 حتى النهاية بخطوة 15
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"Cron {name} field out of range {low}-{high}: {text}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """Five-field cron expression evaluated in the bot timezone.
+
+    Supports ``*``, values, ranges, lists and steps (``*/10``, ``8-22/2``).
+    When both day of month and day of week are restricted a day matches
+    either one, as in standard cron. Day of week 0 and 7 are Sunday.
+    """
+
+    __slots__ = ('expression', 'minutes', 'hours', 'days', 'months', 'weekdays', 'tz', '_any_day', '_any_weekday')
+
+    def __init__(self, expression: str, tz: ZoneInfo = BOT_TIMEZONE):
+        fields = expression.split()
+        if len(fields) != len(_FIELDS):
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.expression = ' '.join(fields)
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(text, name, low, high) for text, (name, low, high) in zip(fields, _FIELDS)
+        )
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self.tz = tz
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, moment: datetime) -> bool:
+        in_month = moment.day in self.days
+        # weekday() في بايثون يبدأ بالاثنين، وفي cron يبدأ بالأحد
+        in_week = (moment.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return in_week
+        if self._any_weekday:
+            return in_month
+        return in_month or in_week
+
+    def next_after(self, ts: float) -> int:
+        """First matching minute strictly after ts, as an epoch integer"""
+        moment = datetime.fromtimestamp(ts, self.tz).replace(tzinfo=None, second=0, microsecond=0)
+        moment += timedelta(minutes=1)
+        last_year = moment.year + _SEARCH_YEARS
+
+        # البحث بالتوقيت المحلي: القفز شهراً أو يوماً أو ساعة كاملة عند عدم التطابق
+        while moment.year <= last_year:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return int(moment.replace(tzinfo=self.tz).timestamp())
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+    def __repr__(self) -> str:
+        return f"CronSchedule({self.expression!r})"
+
+
+def parse_cron(expression: Optional[str]) -> Optional[CronSchedule]:
+    """CronSchedule for a stored expression, or None when it is empty"""
+    return CronSchedule(expression) if expression else None
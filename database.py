@@ -2,167 +2,61 @@ import sqlite3
 import os
 from datetime import datetime
 from typing import Optional, List, Dict, Any
+from db_connection import get_connection_manager
+from write_queue import get_write_queue, queued_write
+from migrations import migrate
+from timeutil import now_ts, to_ts, day_range, from_ts
+from geo import distances_from, grid_cell, cells_within
+from subscription_cache import get_subscription_cache
+from outbox import Notification, enqueue
+from ride_transitions import Transition, FAILED, RIDE_RETURNING, failure_reason
+from pagination import Page, fetch_page
+from stats_counters import local_day, reconcile, set_utc_offset, query_range, query_series
 
 class Database:
     def __init__(self, db_path: str = "mashawir_bot.db"):
         self.db_path = db_path
+        self.connections = get_connection_manager(db_path)
+        # كل الكتابات تمر عبر كاتب واحد يجمعها في معاملات مشتركة
+        self.writes = get_write_queue(db_path)
+        self.subscriptions = get_subscription_cache(db_path)
         self.init_database()
+        self.load_subscription_cache()
 
     def init_database(self):
         """Initialize database tables"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-
-            # Users table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    phone_number TEXT,
-                    user_type TEXT CHECK(user_type IN ('client', 'captain')),
-                    is_active BOOLEAN DEFAULT 1,
-                    rating REAL DEFAULT 0.0,
-                    total_rides INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # Rides table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS rides (
-                    ride_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    client_id INTEGER,
-                    captain_id INTEGER,
-                    pickup_location TEXT NOT NULL,
-                    destination TEXT NOT NULL,
-                    pickup_latitude REAL,
-                    pickup_longitude REAL,
-                    destination_latitude REAL,
-                    destination_longitude REAL,
-                    ride_type TEXT CHECK(ride_type IN ('request', 'offer')),
-                    status TEXT CHECK(status IN ('pending', 'accepted', 'in_progress', 'completed', 'cancelled')) DEFAULT 'pending',
-                    price REAL,
-                    passenger_count INTEGER DEFAULT 1,
-                    notes TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (client_id) REFERENCES users (user_id),
-                    FOREIGN KEY (captain_id) REFERENCES users (user_id)
-                )
-            """)
-
-            # Ratings table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS ratings (
-                    rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ride_id INTEGER,
-                    rater_id INTEGER,
-                    rated_id INTEGER,
-                    rating INTEGER CHECK(rating >= 1 AND rating <= 5),
-                    comment TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (ride_id) REFERENCES rides (ride_id),
-                    FOREIGN KEY (rater_id) REFERENCES users (user_id),
-                    FOREIGN KEY (rated_id) REFERENCES users (user_id)
-                )
-            """)
-
-            # Subscriptions table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    subscription_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    subscription_type TEXT CHECK(subscription_type IN ('captain_monthly', 'captain_weekly')),
-                    start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    end_date TIMESTAMP,
-                    is_active BOOLEAN DEFAULT 1,
-                    payment_amount REAL,
-                    payment_method TEXT,
-                    created_by INTEGER,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            """)
-
-            # Payments table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS payments (
-                    payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    ride_id INTEGER,
-                    subscription_id INTEGER,
-                    payment_type TEXT CHECK(payment_type IN ('ride_payment', 'subscription_payment')),
-                    amount REAL NOT NULL,
-                    currency TEXT DEFAULT 'SAR',
-                    payment_method TEXT CHECK(payment_method IN ('cash', 'bank', 'stc', 'urpay', 'mada')),
-                    payment_status TEXT CHECK(payment_status IN ('pending', 'completed', 'failed', 'refunded')) DEFAULT 'pending',
-                    transaction_id TEXT,
-                    payment_proof_url TEXT,
-                    notes TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (ride_id) REFERENCES rides (ride_id),
-                    FOREIGN KEY (subscription_id) REFERENCES subscriptions (subscription_id)
-                )
-            """)
-
-            # Payment requests table for handling payment flows
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS payment_requests (
-                    request_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    payment_type TEXT CHECK(payment_type IN ('ride_payment', 'subscription_payment')),
-                    amount REAL NOT NULL,
-                    description TEXT,
-                    status TEXT CHECK(status IN ('pending', 'awaiting_proof', 'completed', 'cancelled')) DEFAULT 'pending',
-                    ride_id INTEGER,
-                    subscription_days INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (ride_id) REFERENCES rides (ride_id)
-                )
-            """)
-
-            # Monthly driver requests table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS monthly_requests (
-                    request_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    client_id INTEGER,
-                    request_details TEXT NOT NULL,
-                    status TEXT CHECK(status IN ('pending', 'published', 'closed')) DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    published_at TIMESTAMP,
-                    FOREIGN KEY (client_id) REFERENCES users (user_id)
-                )
-            """)
-
+        with self.connections.connect() as conn:
+            migrate(conn)
+            # قد يتغير فرق التوقيت (BOT_TIMEZONE أو التوقيت الصيفي) بين التشغيلات
+            conn.execute("BEGIN IMMEDIATE")
+            if set_utc_offset(conn):
+                reconcile(conn)
             conn.commit()
 
-    def add_user(self, user_id: int, username: str, first_name: str,
+    @queued_write(default=False)
+    def add_user(self, conn: sqlite3.Connection, user_id: int, username: str, first_name: str,
                  last_name: str = None, user_type: str = None) -> bool:
         """Add or update user in database"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT OR REPLACE INTO users
-                    (user_id, username, first_name, last_name, user_type, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (user_id, username, first_name, last_name, user_type, datetime.now()))
-                conn.commit()
-                return True
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
+        cursor = conn.cursor()
+        # تحديث الصف القائم بدلاً من استبداله: الاستبدال كان يمسح نوع المستخدم
+        # وتاريخ انضمامه مع كل /start، ولا يمر بمشغلات عدادات الإحصائيات
+        cursor.execute("""
+            INSERT INTO users
+            (user_id, username, first_name, last_name, user_type, updated_at, created_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                user_type = COALESCE(excluded.user_type, users.user_type),
+                updated_at = excluded.updated_at
+        """, (user_id, username, first_name, last_name, user_type, datetime.now(), now_ts()))
+        return True
 
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user by user_id"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
                 result = cursor.fetchone()
@@ -171,110 +65,155 @@ class Database:
             print(f"Database error: {e}")
             return None
 
-    def update_user_type(self, user_id: int, user_type: str) -> bool:
+    @queued_write(default=False)
+    def update_user_type(self, conn: sqlite3.Connection, user_id: int, user_type: str) -> bool:
         """Update user type (client/captain)"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE users SET user_type = ?, updated_at = ?
-                    WHERE user_id = ?
-                """, (user_type, datetime.now(), user_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
-
-    def create_ride(self, client_id: int, pickup_location: str, destination: str,
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE users SET user_type = ?, updated_at = ?
+            WHERE user_id = ?
+        """, (user_type, datetime.now(), user_id))
+        return cursor.rowcount > 0
+
+    @queued_write(default=None)
+    def create_ride(self, conn: sqlite3.Connection, client_id: int, pickup_location: str, destination: str,
                    ride_type: str = "request", price: float = None,
-                   passenger_count: int = 1, notes: str = None) -> Optional[int]:
+                   passenger_count: int = 1, notes: str = None,
+                   pickup_latitude: float = None, pickup_longitude: float = None,
+                   destination_latitude: float = None, destination_longitude: float = None) -> Optional[int]:
         """Create a new ride"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO rides
+            (client_id, pickup_location, destination, ride_type, price, passenger_count, notes, created_ts,
+             pickup_latitude, pickup_longitude, destination_latitude, destination_longitude, pickup_cell)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (client_id, pickup_location, destination, ride_type, price, passenger_count, notes, now_ts(),
+              pickup_latitude, pickup_longitude, destination_latitude, destination_longitude,
+              grid_cell(pickup_latitude, pickup_longitude)))
+        return cursor.lastrowid
+
+    def get_pending_rides(self, limit: int = 10, cursor: str = None, backward: bool = False) -> Page:
+        """Get a page of pending rides, newest first"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO rides
-                    (client_id, pickup_location, destination, ride_type, price, passenger_count, notes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (client_id, pickup_location, destination, ride_type, price, passenger_count, notes))
-                conn.commit()
-                return cursor.lastrowid
+            with self.connections.connect() as conn:
+                # بدون إحصائيات ANALYZE يختار المخطط فهرس (status, created_at) ثم يرتب كل
+                # الرحلات المعلقة، فيُفرض الفهرس الجزئي المرتب حسب ride_id
+                return fetch_page(conn, """
+                    SELECT r.*, u.username, u.first_name
+                    FROM rides r INDEXED BY idx_rides_pending_id
+                    JOIN users u ON r.client_id = u.user_id
+                    WHERE r.status = 'pending' AND {keyset}
+                    ORDER BY {order}
+                    LIMIT :limit
+                """, {}, ('r.ride_id',), limit, cursor, backward)
         except sqlite3.Error as e:
             print(f"Database error: {e}")
-            return None
-
-    def get_pending_rides(self, limit: int = 10) -> List[Dict[str, Any]]:
-        """Get pending rides"""
+            return Page([], None, None)
+
+    @queued_write(default=False)
+    def update_ride_coordinates(self, conn: sqlite3.Connection, ride_id: int, pickup_latitude: float, pickup_longitude: float,
+                                destination_latitude: float, destination_longitude: float) -> bool:
+        """Store pickup/destination coordinates for a ride"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE rides SET
+            pickup_latitude = ?, pickup_longitude = ?,
+            destination_latitude = ?, destination_longitude = ?,
+            pickup_cell = ?, version = version + 1
+            WHERE ride_id = ?
+        """, (pickup_latitude, pickup_longitude, destination_latitude, destination_longitude,
+              grid_cell(pickup_latitude, pickup_longitude), ride_id))
+        return cursor.rowcount > 0
+
+    def get_nearby_pending_rides(self, latitude: float, longitude: float,
+                                 radius_km: float = 10, limit: int = 5) -> List[Dict[str, Any]]:
+        """Get pending rides whose pickup is within radius_km, nearest first"""
+        cells = cells_within(latitude, longitude, radius_km)
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
+                placeholders = ",".join("?" * len(cells))
+                cursor.execute(f"""
                     SELECT r.*, u.username, u.first_name
                     FROM rides r
                     JOIN users u ON r.client_id = u.user_id
-                    WHERE r.status = 'pending'
-                    ORDER BY r.created_at DESC
-                    LIMIT ?
-                """, (limit,))
-                return [dict(row) for row in cursor.fetchall()]
+                    WHERE r.status = 'pending' AND r.pickup_cell IN ({placeholders})
+                """, cells)
+                candidates = [dict(row) for row in cursor.fetchall()]
+                distances = distances_from(latitude, longitude, [
+                    (ride['pickup_latitude'], ride['pickup_longitude']) for ride in candidates
+                ])
+                nearby = []
+                for ride, distance in zip(candidates, distances):
+                    if distance <= radius_km:
+                        ride['pickup_distance'] = distance
+                        nearby.append(ride)
+                nearby.sort(key=lambda ride: ride['pickup_distance'])
+                return nearby[:limit]
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return []
 
-    def accept_ride(self, ride_id: int, captain_id: int) -> bool:
-        """Accept a ride"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE rides SET captain_id = ?, status = 'accepted', updated_at = ?
-                    WHERE ride_id = ? AND status = 'pending'
-                """, (captain_id, datetime.now(), ride_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
-
-    def update_ride_status(self, ride_id: int, status: str) -> bool:
+    def _transition(self, conn: sqlite3.Connection, ride_id: int, user_id: int, target: str,
+                    sql: str, params: tuple, event: str = None,
+                    notification: Optional[Notification] = None, captain_only: bool = True) -> Transition:
+        """Apply one UPDATE ... RETURNING and queue the client notification in the same transaction"""
+        row = conn.execute(sql + RIDE_RETURNING, params).fetchone()
+        if row is None:
+            return Transition(None, failure_reason(conn, ride_id, user_id, target, captain_only))
+        ride = dict(row)
+        if notification is not None:
+            enqueue(conn, f"ride:{ride_id}:{event}", notification, chat_id=ride['client_id'])
+        return Transition(ride)
+
+    @queued_write(default=FAILED)
+    def accept_ride(self, conn: sqlite3.Connection, ride_id: int, captain_id: int,
+                    notification: Optional[Notification] = None) -> Transition:
+        """Accept a ride; the client notification is committed with the change"""
+        return self._transition(conn, ride_id, captain_id, 'accepted', """
+            UPDATE rides SET captain_id = ?, status = 'accepted', updated_at = ?, version = version + 1
+            WHERE ride_id = ? AND status = 'pending'
+        """, (captain_id, datetime.now(), ride_id), 'accepted', notification)
+
+    @queued_write(default=False)
+    def update_ride_status(self, conn: sqlite3.Connection, ride_id: int, status: str) -> bool:
         """Update ride status"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE rides SET status = ?, updated_at = ?, version = version + 1
+            WHERE ride_id = ?
+        """, (status, datetime.now(), ride_id))
+        return cursor.rowcount > 0
+
+    def get_user_rides(self, user_id: int, limit: int = 20, cursor: str = None, backward: bool = False) -> Page:
+        """Get a page of the user's rides as client or captain, newest first"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE rides SET status = ?, updated_at = ?
-                    WHERE ride_id = ?
-                """, (status, datetime.now(), ride_id))
-                conn.commit()
-                return cursor.rowcount > 0
+            with self.connections.connect() as conn:
+                # كل جزء يمشي فهرسه من المؤشر، ثم يُدمج الجزآن بدل ترتيب كل رحلات المستخدم
+                return fetch_page(conn, """
+                    SELECT * FROM (
+                        SELECT * FROM (
+                            SELECT * FROM rides WHERE client_id = :user_id AND {keyset}
+                            ORDER BY {order} LIMIT :limit
+                        )
+                        UNION
+                        SELECT * FROM (
+                            SELECT * FROM rides WHERE captain_id = :user_id AND {keyset}
+                            ORDER BY {order} LIMIT :limit
+                        )
+                    )
+                    ORDER BY {order}
+                    LIMIT :limit
+                """, {'user_id': user_id}, ('ride_id',), limit, cursor, backward)
         except sqlite3.Error as e:
             print(f"Database error: {e}")
-            return False
-
-    def get_user_rides(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
-        """Get user's rides history"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT * FROM rides
-                    WHERE client_id = ? OR captain_id = ?
-                    ORDER BY created_at DESC
-                    LIMIT ?
-                """, (user_id, user_id, limit))
-                return [dict(row) for row in cursor.fetchall()]
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return []
+            return Page([], None, None)
 
     def get_ride_by_id(self, ride_id: int) -> Optional[Dict[str, Any]]:
         """Get ride details by ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT r.*,
@@ -291,57 +230,37 @@ class Database:
             print(f"Database error: {e}")
             return None
 
-    def cancel_ride(self, ride_id: int, user_id: int) -> bool:
+    @queued_write(default=FAILED)
+    def cancel_ride(self, conn: sqlite3.Connection, ride_id: int, user_id: int) -> Transition:
         """Cancel a ride"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE rides SET status = 'cancelled', updated_at = ?
-                    WHERE ride_id = ? AND (client_id = ? OR captain_id = ?)
-                    AND status IN ('pending', 'accepted')
-                """, (datetime.now(), ride_id, user_id, user_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
-
-    def complete_ride(self, ride_id: int, captain_id: int) -> bool:
+        return self._transition(conn, ride_id, user_id, 'cancelled', """
+            UPDATE rides SET status = 'cancelled', updated_at = ?, version = version + 1
+            WHERE ride_id = ? AND (client_id = ? OR captain_id = ?)
+            AND status IN ('pending', 'accepted')
+        """, (datetime.now(), ride_id, user_id, user_id), captain_only=False)
+
+    @queued_write(default=FAILED)
+    def complete_ride(self, conn: sqlite3.Connection, ride_id: int, captain_id: int,
+                      notification: Optional[Notification] = None) -> Transition:
         """Mark ride as completed"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE rides SET status = 'completed', updated_at = ?
-                    WHERE ride_id = ? AND captain_id = ? AND status = 'in_progress'
-                """, (datetime.now(), ride_id, captain_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
-
-    def start_ride(self, ride_id: int, captain_id: int) -> bool:
+        return self._transition(conn, ride_id, captain_id, 'completed', """
+            UPDATE rides SET status = 'completed', updated_at = ?, version = version + 1
+            WHERE ride_id = ? AND captain_id = ? AND status = 'in_progress'
+        """, (datetime.now(), ride_id, captain_id), 'completed', notification)
+
+    @queued_write(default=FAILED)
+    def start_ride(self, conn: sqlite3.Connection, ride_id: int, captain_id: int,
+                   notification: Optional[Notification] = None) -> Transition:
         """Start an accepted ride"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE rides SET status = 'in_progress', updated_at = ?
-                    WHERE ride_id = ? AND captain_id = ? AND status = 'accepted'
-                """, (datetime.now(), ride_id, captain_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
+        return self._transition(conn, ride_id, captain_id, 'in_progress', """
+            UPDATE rides SET status = 'in_progress', updated_at = ?, version = version + 1
+            WHERE ride_id = ? AND captain_id = ? AND status = 'accepted'
+        """, (datetime.now(), ride_id, captain_id), 'started', notification)
 
     def get_captain_active_rides(self, captain_id: int) -> List[Dict[str, Any]]:
         """Get captain's active rides"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT r.*, u.username, u.first_name
@@ -355,86 +274,83 @@ class Database:
             print(f"Database error: {e}")
             return []
 
-    def add_rating(self, ride_id: int, rater_id: int, rated_id: int,
+    @queued_write(default=False)
+    def add_rating(self, conn: sqlite3.Connection, ride_id: int, rater_id: int, rated_id: int,
                    rating: int, comment: str = None) -> bool:
         """Add a rating for a completed ride"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO ratings (ride_id, rater_id, rated_id, rating, comment)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (ride_id, rater_id, rated_id, rating, comment))
-                conn.commit()
-
-                # Update user's average rating
-                cursor.execute("""
-                    UPDATE users SET rating = (
-                        SELECT AVG(rating) FROM ratings WHERE rated_id = ?
-                    ) WHERE user_id = ?
-                """, (rated_id, rated_id))
-                conn.commit()
-                return True
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
-
-    def add_subscription(self, user_id: int, subscription_type: str,
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO ratings (ride_id, rater_id, rated_id, rating, comment)
+            VALUES (?, ?, ?, ?, ?)
+        """, (ride_id, rater_id, rated_id, rating, comment))
+
+        # Update user's average rating
+        cursor.execute("""
+            UPDATE users SET rating = (
+                SELECT AVG(rating) FROM ratings WHERE rated_id = ?
+            ) WHERE user_id = ?
+        """, (rated_id, rated_id))
+        return True
+
+    @queued_write(default=False)
+    def add_subscription(self, conn: sqlite3.Connection, user_id: int, subscription_type: str,
                         end_date: str, payment_amount: float = None,
-                        payment_method: str = None, created_by: int = None) -> bool:
+                        payment_method: str = None, created_by: int = None,
+                        notification: Optional[Notification] = None) -> bool:
         """Add a subscription for captain"""
+        cursor = conn.cursor()
+
+        # إلغاء الاشتراكات النشطة السابقة
+        cursor.execute("""
+            UPDATE subscriptions SET is_active = 0
+            WHERE user_id = ? AND is_active = 1
+        """, (user_id,))
+
+        # إضافة الاشتراك الجديد
+        end_ts = to_ts(end_date)
+        cursor.execute("""
+            INSERT INTO subscriptions
+            (user_id, subscription_type, end_date, end_ts, payment_amount, payment_method, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, subscription_type, end_date, end_ts, payment_amount, payment_method, created_by))
+
+        if notification is not None:
+            enqueue(conn, f"subscription:{cursor.lastrowid}:activated", notification, chat_id=user_id)
+
+        # الذاكرة تُحدّث بعد حفظ المعاملة فقط
+        self.writes.on_commit(lambda: self.subscriptions.set(user_id, end_ts))
+        return True
+
+    def load_subscription_cache(self):
+        """Load every active subscription into the in-memory cache"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
-
-                # إلغاء الاشتراكات النشطة السابقة
                 cursor.execute("""
-                    UPDATE subscriptions SET is_active = 0
-                    WHERE user_id = ? AND is_active = 1
-                """, (user_id,))
-
-                # إضافة الاشتراك الجديد
-                cursor.execute("""
-                    INSERT INTO subscriptions
-                    (user_id, subscription_type, end_date, payment_amount, payment_method, created_by)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (user_id, subscription_type, end_date, payment_amount, payment_method, created_by))
-
-                conn.commit()
-                return True
+                    SELECT user_id, end_ts FROM subscriptions
+                    WHERE is_active = 1 AND end_ts > ?
+                """, (now_ts(),))
+                self.subscriptions.load((row[0], row[1]) for row in cursor.fetchall())
         except sqlite3.Error as e:
             print(f"Database error: {e}")
-            return False
 
     def is_captain_subscribed(self, user_id: int) -> bool:
         """Check if captain has active subscription"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT COUNT(*) FROM subscriptions
-                    WHERE user_id = ? AND is_active = 1
-                    AND datetime(end_date) > datetime('now')
-                """, (user_id,))
-                count = cursor.fetchone()[0]
-                return count > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
+        # الاشتراكات النشطة محفوظة في الذاكرة وتنتهي تلقائياً عند end_ts
+        return self.subscriptions.is_active(user_id)
 
     def get_subscription_info(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user's subscription information"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT * FROM subscriptions
                     WHERE user_id = ? AND is_active = 1
-                    AND datetime(end_date) > datetime('now')
-                    ORDER BY created_at DESC
+                    AND end_ts > ?
+                    ORDER BY end_ts DESC
                     LIMIT 1
-                """, (user_id,))
+                """, (user_id, now_ts()))
                 result = cursor.fetchone()
                 return dict(result) if result else None
         except sqlite3.Error as e:
@@ -444,59 +360,48 @@ class Database:
     def get_expired_subscriptions(self) -> List[Dict[str, Any]]:
         """Get expired subscriptions that need to be deactivated"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT s.*, u.username, u.first_name
                     FROM subscriptions s
                     JOIN users u ON s.user_id = u.user_id
                     WHERE s.is_active = 1
-                    AND datetime(s.end_date) <= datetime('now')
-                """)
+                    AND s.end_ts <= ?
+                """, (now_ts(),))
                 return [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error as e:
             print(f"Database error: {e}")
             return []
 
-    def deactivate_expired_subscriptions(self) -> int:
+    @queued_write(default=0)
+    def deactivate_expired_subscriptions(self, conn: sqlite3.Connection) -> int:
         """Deactivate expired subscriptions and return count"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE subscriptions SET is_active = 0
-                    WHERE is_active = 1 AND datetime(end_date) <= datetime('now')
-                """)
-                conn.commit()
-                return cursor.rowcount
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return 0
-
-    def create_payment_request(self, user_id: int, payment_type: str, amount: float,
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE subscriptions SET is_active = 0
+            WHERE is_active = 1 AND end_ts <= ?
+        """, (now_ts(),))
+        self.writes.on_commit(self.subscriptions.purge_expired)
+        return cursor.rowcount
+
+    @queued_write(default=None)
+    def create_payment_request(self, conn: sqlite3.Connection, user_id: int, payment_type: str, amount: float,
                              description: str, ride_id: int = None,
                              subscription_days: int = None) -> Optional[int]:
         """Create a payment request"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO payment_requests
-                    (user_id, payment_type, amount, description, ride_id, subscription_days)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (user_id, payment_type, amount, description, ride_id, subscription_days))
-                conn.commit()
-                return cursor.lastrowid
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return None
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO payment_requests
+            (user_id, payment_type, amount, description, ride_id, subscription_days)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, payment_type, amount, description, ride_id, subscription_days))
+        return cursor.lastrowid
 
     def get_payment_request(self, request_id: int) -> Optional[Dict[str, Any]]:
         """Get payment request by ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT pr.*, u.first_name, u.username
@@ -510,64 +415,74 @@ class Database:
             print(f"Database error: {e}")
             return None
 
-    def update_payment_request_status(self, request_id: int, status: str) -> bool:
+    @queued_write(default=False)
+    def update_payment_request_status(self, conn: sqlite3.Connection, request_id: int, status: str) -> bool:
         """Update payment request status"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE payment_requests SET status = ?
-                    WHERE request_id = ?
-                """, (status, request_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
-
-    def create_payment_record(self, user_id: int, payment_type: str, amount: float,
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE payment_requests SET status = ?
+            WHERE request_id = ?
+        """, (status, request_id))
+        return cursor.rowcount > 0
+
+    @queued_write(default=None)
+    def create_payment_record(self, conn: sqlite3.Connection, user_id: int, payment_type: str, amount: float,
                             payment_method: str, ride_id: int = None,
                             subscription_id: int = None, transaction_id: str = None,
                             payment_proof_url: str = None, notes: str = None) -> Optional[int]:
         """Create a payment record"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO payments
-                    (user_id, ride_id, subscription_id, payment_type, amount,
-                     payment_method, transaction_id, payment_proof_url, notes, payment_status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
-                """, (user_id, ride_id, subscription_id, payment_type, amount,
-                      payment_method, transaction_id, payment_proof_url, notes))
-                conn.commit()
-                return cursor.lastrowid
-        except sqlite3.Error as e:
-            print(f"Database error in create_payment_record: {e}")
-            import logging
-            logging.error(f"Database error in create_payment_record: {e}")
-            return None
-
-    def update_payment_status(self, payment_id: int, status: str) -> bool:
-        """Update payment status"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE payments SET payment_status = ?, updated_at = ?
-                    WHERE payment_id = ?
-                """, (status, datetime.now(), payment_id))
-                conn.commit()
-                return cursor.rowcount > 0
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return False
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO payments
+            (user_id, ride_id, subscription_id, payment_type, amount,
+             payment_method, transaction_id, payment_proof_url, notes, payment_status, created_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)
+        """, (user_id, ride_id, subscription_id, payment_type, amount,
+              payment_method, transaction_id, payment_proof_url, notes, now_ts()))
+        return cursor.lastrowid
+
+    @queued_write(default=None)
+    def create_cash_payment(self, conn: sqlite3.Connection, request_id: int, user_id: int, payment_type: str, amount: float,
+                            ride_id: int = None, notes: str = None,
+                            notification: Optional[Notification] = None) -> Optional[int]:
+        """Record a cash payment, complete its request and queue the admin notice in one transaction.
+
+        A callable notification text receives the new payment_id.
+        """
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO payments
+            (user_id, ride_id, payment_type, amount, payment_method, notes, payment_status, created_ts)
+            VALUES (?, ?, ?, ?, 'cash', ?, 'pending', ?)
+        """, (user_id, ride_id, payment_type, amount, notes, now_ts()))
+        payment_id = cursor.lastrowid
+        cursor.execute("""
+            UPDATE payment_requests SET status = 'completed'
+            WHERE request_id = ?
+        """, (request_id,))
+        if notification is not None:
+            enqueue(conn, f"payment:{payment_id}:cash", notification, payment_id=payment_id)
+        return payment_id
+
+    @queued_write(default=False)
+    def update_payment_status(self, conn: sqlite3.Connection, payment_id: int, status: str,
+                              notification: Optional[Notification] = None) -> bool:
+        """Update payment status; the user notification is committed with the change"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE payments SET payment_status = ?, updated_at = ?
+            WHERE payment_id = ?
+        """, (status, datetime.now(), payment_id))
+        updated = cursor.rowcount > 0
+        if updated and notification is not None:
+            row = conn.execute("SELECT user_id FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+            enqueue(conn, f"payment:{payment_id}:{status}", notification, chat_id=row['user_id'])
+        return updated
 
     def get_pending_payments(self, limit: int = 20) -> List[Dict[str, Any]]:
         """Get pending payments for admin review"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT p.*, u.first_name, u.username
@@ -585,8 +500,7 @@ class Database:
     def get_user_payments(self, user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
         """Get user's payment history"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT * FROM payments
@@ -599,26 +513,20 @@ class Database:
             print(f"Database error: {e}")
             return []
 
-    def add_monthly_request(self, client_id: int, details: str) -> Optional[int]:
+    @queued_write(default=None)
+    def add_monthly_request(self, conn: sqlite3.Connection, client_id: int, details: str) -> Optional[int]:
         """Adds a new monthly driver request to the database."""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO monthly_requests (client_id, request_details)
-                    VALUES (?, ?)
-                """, (client_id, details))
-                conn.commit()
-                return cursor.lastrowid
-        except sqlite3.Error as e:
-            print(f"Database error in add_monthly_request: {e}")
-            return None
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO monthly_requests (client_id, request_details)
+            VALUES (?, ?)
+        """, (client_id, details))
+        return cursor.lastrowid
 
     def get_monthly_request(self, request_id: int) -> Optional[Dict[str, Any]]:
         """Gets a monthly request by its ID."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     SELECT r.*, u.first_name, u.username
@@ -632,25 +540,352 @@ class Database:
             print(f"Database error in get_monthly_request: {e}")
             return None
 
-    def update_monthly_request_status(self, request_id: int, status: str) -> bool:
+    @queued_write(default=False)
+    def update_monthly_request_status(self, conn: sqlite3.Connection, request_id: int, status: str) -> bool:
         """Updates the status of a monthly request and sets published_at if applicable."""
+        cursor = conn.cursor()
+        if status == 'published':
+            cursor.execute("""
+                UPDATE monthly_requests
+                SET status = ?, published_at = ?
+                WHERE request_id = ?
+            """, (status, datetime.now(), request_id))
+        else:
+            cursor.execute("""
+                UPDATE monthly_requests
+                SET status = ?
+                WHERE request_id = ?
+            """, (status, request_id))
+        return cursor.rowcount > 0
+    # ============ استعلامات لوحة التحكم ============
+
+    def get_admin_stats(self) -> Dict[str, Any]:
+        """Collect dashboard statistics for /stats from the maintained counters"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
-                if status == 'published':
-                    cursor.execute("""
-                        UPDATE monthly_requests
-                        SET status = ?, published_at = ?
-                        WHERE request_id = ?
-                    """, (status, datetime.now(), request_id))
-                else:
-                    cursor.execute("""
-                        UPDATE monthly_requests
-                        SET status = ?
-                        WHERE request_id = ?
-                    """, (status, request_id))
-                conn.commit()
-                return cursor.rowcount > 0
+                now = now_ts()
+                counters = dict(cursor.execute("SELECT name, value FROM stat_counters").fetchall())
+                offset = cursor.execute(
+                    "SELECT value FROM stat_settings WHERE name = 'utc_offset'"
+                ).fetchone()[0]
+                today = dict(cursor.execute(
+                    "SELECT name, value FROM stat_daily WHERE day = ?", (local_day(now, offset),)
+                ).fetchall())
+
+                def counter(name: str):
+                    return counters.get(name, 0)
+
+                # الاشتراك النشط يعتمد على الوقت الحالي، فيُحسب من الفهرس الجزئي
+                cursor.execute("""
+                    SELECT COUNT(*) FROM subscriptions
+                    WHERE is_active = 1 AND end_ts > ?
+                """, (now,))
+                active_subscriptions = cursor.fetchone()[0]
+
+                completed_count = {
+                    name[len('payments.completed.'):-len('.count')]: value
+                    for name, value in counters.items()
+                    if name.startswith('payments.completed.') and name.endswith('.count')
+                }
+                revenue = sum(
+                    value for name, value in counters.items()
+                    if name.startswith('payments.completed.') and name.endswith('.amount')
+                )
+
+                return {
+                    'total_users': counter('users.total'),
+                    'clients': counter('users.type.client'),
+                    'captains': counter('users.type.captain'),
+                    'total_rides': counter('rides.total'),
+                    'pending_rides': counter('rides.status.pending'),
+                    'active_rides': counter('rides.status.in_progress'),
+                    'completed_rides': counter('rides.status.completed'),
+                    'active_subscriptions': active_subscriptions,
+                    'expired_subscriptions': counter('subscriptions.total') - active_subscriptions,
+                    'pending_payments': counter('payments.status.pending'),
+                    'completed_payments': counter('payments.status.completed'),
+                    'total_revenue': revenue,
+                    'cash_payments': completed_count.get('cash', 0),
+                    # طريقة الدفع الفارغة لا تُحسب رقمية، كما في "payment_method != 'cash'"
+                    'digital_payments': sum(
+                        count for method, count in completed_count.items() if method not in ('cash', 'none')
+                    ),
+                    'today_users': today.get('users.new', 0),
+                    'today_rides': today.get('rides.new', 0),
+                }
+        except sqlite3.Error as e:
+            print(f"Database error in get_admin_stats: {e}")
+            raise
+
+    def ping(self) -> bool:
+        """Run a trivial query to check that the database answers"""
+        try:
+            with self.connections.connect() as conn:
+                conn.execute("SELECT 1").fetchone()
+                return True
+        except sqlite3.Error as e:
+            print(f"Database error in ping: {e}")
+            return False
+
+    def reconcile_stats(self, repair: bool = True) -> List[tuple]:
+        """Recompute the /stats counters from the raw tables and return the drift found"""
+        try:
+            with self.connections.connect() as conn:
+                # قفل الكتابة يمنع تغيّر الجداول بين إعادة الحساب والاستبدال
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    drift = reconcile(conn, repair)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                return drift
+        except sqlite3.Error as e:
+            print(f"Database error in reconcile_stats: {e}")
+            raise
+
+    def get_recent_rides(self, limit: int = 10, cursor: str = None, backward: bool = False) -> Page:
+        """Get a page of the latest rides with client and captain names"""
+        try:
+            with self.connections.connect() as conn:
+                return fetch_page(conn, """
+                    SELECT r.ride_id, r.status, r.created_at,
+                           client.first_name as client_name, client.user_id as client_id,
+                           captain.first_name as captain_name, captain.user_id as captain_id,
+                           r.pickup_location, r.destination
+                    FROM rides r
+                    JOIN users client ON r.client_id = client.user_id
+                    LEFT JOIN users captain ON r.captain_id = captain.user_id
+                    WHERE {keyset}
+                    ORDER BY {order}
+                    LIMIT :limit
+                """, {}, ('r.ride_id',), limit, cursor, backward)
+        except sqlite3.Error as e:
+            print(f"Database error in get_recent_rides: {e}")
+            raise
+
+    def get_recent_users(self, limit: int = 15, cursor: str = None, backward: bool = False) -> Page:
+        """Get a page of the most recently joined users"""
+        return self.list_users(None, limit, cursor, backward)
+
+    def get_user_details(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get a user's profile with ride, subscription and payment statistics"""
+        try:
+            with self.connections.connect() as conn:
+                cursor = conn.cursor()
+
+                # معلومات المستخدم الأساسية
+                cursor.execute("""
+                    SELECT user_id, username, first_name, last_name, user_type, created_at
+                    FROM users WHERE user_id = ?
+                """, (user_id,))
+                user = cursor.fetchone()
+                if not user:
+                    return None
+                details = dict(user)
+
+                # إحصائيات الرحلات
+                cursor.execute("SELECT COUNT(*) FROM rides WHERE client_id = ?", (user_id,))
+                details['rides_as_client'] = cursor.fetchone()[0]
+
+                cursor.execute("SELECT COUNT(*) FROM rides WHERE captain_id = ?", (user_id,))
+                details['rides_as_captain'] = cursor.fetchone()[0]
+
+                # الاشتراكات
+                cursor.execute("""
+                    SELECT COUNT(*) FROM subscriptions
+                    WHERE user_id = ? AND is_active = 1 AND end_ts > ?
+                """, (user_id, now_ts()))
+                details['active_subscription'] = cursor.fetchone()[0]
+
+                # المدفوعات
+                cursor.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payments WHERE user_id = ? AND payment_status = 'completed'", (user_id,))
+                details['payment_count'], details['payment_total'] = cursor.fetchone()
+
+                # آخر نشاط
+                cursor.execute("""
+                    SELECT created_at FROM rides
+                    WHERE client_id = ? OR captain_id = ?
+                    ORDER BY created_at DESC LIMIT 1
+                """, (user_id, user_id))
+                last_activity = cursor.fetchone()
+                details['last_activity'] = last_activity[0] if last_activity else None
+
+                return details
+        except sqlite3.Error as e:
+            print(f"Database error in get_user_details: {e}")
+            raise
+
+    def get_live_activity(self) -> Dict[str, Any]:
+        """Get the latest active rides, pending payments and today's new users, with their counts"""
+        try:
+            with self.connections.connect() as conn:
+                cursor = conn.cursor()
+                now = now_ts()
+                counters = dict(cursor.execute("""
+                    SELECT name, value FROM stat_counters
+                    WHERE name IN ('rides.status.pending', 'rides.status.in_progress', 'payments.status.pending')
+                """).fetchall())
+                offset = cursor.execute(
+                    "SELECT value FROM stat_settings WHERE name = 'utc_offset'"
+                ).fetchone()[0]
+                cursor.execute(
+                    "SELECT value FROM stat_daily WHERE day = ? AND name = 'users.new'",
+                    (local_day(now, offset),)
+                )
+                row = cursor.fetchone()
+
+                # الرحلات النشطة
+                # آخر 5 من كل حالة عبر فهرس (status, created_at) ثم الدمج، بدل ترتيب كل الرحلات النشطة
+                cursor.execute("""
+                    SELECT r.ride_id, client.first_name as client_name,
+                           captain.first_name as captain_name, r.created_at
+                    FROM (
+                        SELECT * FROM (
+                            SELECT ride_id, client_id, captain_id, created_at FROM rides
+                            WHERE status = 'pending' ORDER BY created_at DESC LIMIT 5
+                        )
+                        UNION ALL
+                        SELECT * FROM (
+                            SELECT ride_id, client_id, captain_id, created_at FROM rides
+                            WHERE status = 'in_progress' ORDER BY created_at DESC LIMIT 5
+                        )
+                    ) r
+                    JOIN users client ON r.client_id = client.user_id
+                    LEFT JOIN users captain ON r.captain_id = captain.user_id
+                    ORDER BY r.created_at DESC
+                    LIMIT 5
+                """)
+                active_rides = [dict(row) for row in cursor.fetchall()]
+
+                # المدفوعات المعلقة
+                cursor.execute("""
+                    SELECT p.payment_id, u.first_name, p.amount, p.payment_type, p.created_at
+                    FROM payments p
+                    JOIN users u ON p.user_id = u.user_id
+                    WHERE p.payment_status = 'pending'
+                    ORDER BY p.created_at DESC
+                    LIMIT 5
+                """)
+                pending_payments = [dict(row) for row in cursor.fetchall()]
+
+                # المستخدمين الجدد اليوم
+                today_start, today_end = day_range(now)
+                cursor.execute("""
+                    SELECT first_name, user_type, created_at
+                    FROM users
+                    WHERE created_ts >= ? AND created_ts < ?
+                    ORDER BY created_ts DESC
+                    LIMIT 5
+                """, (today_start, today_end))
+                new_users_today = [dict(row) for row in cursor.fetchall()]
+
+                return {
+                    'active_rides': active_rides,
+                    'pending_payments': pending_payments,
+                    'new_users_today': new_users_today,
+                    'active_rides_count': counters.get('rides.status.pending', 0)
+                    + counters.get('rides.status.in_progress', 0),
+                    'pending_payments_count': counters.get('payments.status.pending', 0),
+                    'new_users_today_count': row[0] if row else 0,
+                }
+        except sqlite3.Error as e:
+            print(f"Database error in get_live_activity: {e}")
+            raise
+
+    def get_revenue_report(self, days: int = 7) -> Dict[str, Any]:
+        """Revenue by method and type, a daily series for the last `days` days and
+        the same window compared with the one before it, all from the stat buckets"""
+        try:
+            with self.connections.connect() as conn:
+                today_start, today_end = day_range()
+                start = today_start - (days - 1) * 86400
+
+                # الإجماليات منذ البداية: أيام stat_daily فقط، بلا مسح لجدول المدفوعات
+                revenue = query_range(conn, 'revenue.')
+
+                def breakdown(kind: str, key: str) -> List[Dict[str, Any]]:
+                    prefix = f'revenue.{kind}.'
+                    rows = {}
+                    for name, value in revenue.items():
+                        if name.startswith(prefix):
+                            label, field = name[len(prefix):].rsplit('.', 1)
+                            rows.setdefault(label, {'count': 0, 'total': 0})[
+                                'count' if field == 'count' else 'total'] = value
+                    return sorted(
+                        ({key: None if label == 'none' else label, **values}
+                         for label, values in rows.items() if values['count']),
+                        key=lambda row: row['total'], reverse=True
+                    )
+
+                def period(start_ts: int, end_ts: int) -> Dict[str, Any]:
+                    values = {}
+                    # الرحلات الجديدة حسب وقت الطلب، والمكتملة والملغاة حسب وقت انتهائها
+                    for prefix in ('revenue.method.', 'rides.', 'payments.new'):
+                        values.update(query_range(conn, prefix, start_ts, end_ts))
+                    return {
+                        'revenue': sum(v for n, v in values.items()
+                                       if n.startswith('revenue.method.') and n.endswith('.amount')),
+                        'payments': sum(v for n, v in values.items()
+                                        if n.startswith('revenue.method.') and n.endswith('.count')),
+                        'all_payments': values.get('payments.new', 0),
+                        'rides': values.get('rides.new', 0),
+                        'rides_completed': values.get('rides.completed', 0),
+                        'rides_cancelled': values.get('rides.cancelled', 0),
+                    }
+
+                # الإيرادات اليومية للفترة (الأحدث أولاً، الأيام التي فيها إيرادات فقط)
+                daily = []
+                for day_start, values in query_series(conn, 'revenue.method.', start, today_end):
+                    total = sum(v for n, v in values.items() if n.endswith('.amount'))
+                    if total:
+                        daily.append({'day': from_ts(day_start).strftime('%Y-%m-%d'), 'total': total})
+                daily.reverse()
+
+                return {
+                    'total_revenue': sum(v for n, v in revenue.items()
+                                         if n.startswith('revenue.method.') and n.endswith('.amount')),
+                    'by_method': breakdown('method', 'payment_method'),
+                    'by_type': breakdown('type', 'payment_type'),
+                    'daily': daily,
+                    'days': days,
+                    'period': period(start, today_end),
+                    'previous_period': period(start - days * 86400, start),
+                }
+        except sqlite3.Error as e:
+            print(f"Database error in get_revenue_report: {e}")
+            raise
+
+    def list_users(self, user_type: str = None, limit: int = 20, cursor: str = None,
+                   backward: bool = False) -> Page:
+        """List a page of the latest users, optionally filtered by type"""
+        try:
+            with self.connections.connect() as conn:
+                return fetch_page(conn, f"""
+                    SELECT user_id, username, first_name, user_type, created_at, created_ts
+                    FROM users
+                    WHERE {"user_type = :user_type AND" if user_type else ""} {{keyset}}
+                    ORDER BY {{order}}
+                    LIMIT :limit
+                """, {'user_type': user_type}, ('created_ts', 'user_id'), limit, cursor, backward)
+        except sqlite3.Error as e:
+            print(f"Database error in list_users: {e}")
+            raise
+
+    def get_payment(self, payment_id: int) -> Optional[Dict[str, Any]]:
+        """Get a payment with the payer's name"""
+        try:
+            with self.connections.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT p.*, u.first_name, u.username
+                    FROM payments p
+                    JOIN users u ON p.user_id = u.user_id
+                    WHERE p.payment_id = ?
+                """, (payment_id,))
+                result = cursor.fetchone()
+                return dict(result) if result else None
         except sqlite3.Error as e:
-            print(f"Database error in update_monthly_request_status: {e}")
-            return False
\ No newline at end of file
+            print(f"Database error in get_payment: {e}")
+            raise
@@ -0,0 +1,150 @@
+import math
+import heapq
+from typing import List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy اختياري؛ تُستخدم الحلقات العادية بدونه
+    np = None
+
+Coordinate = Tuple[float, float]
+
+# نصف قطر الأرض بالكيلومتر
+EARTH_RADIUS_KM = 6371
+
+# حجم خلية الشبكة المكانية بالدرجات (~1.1 كم عند خط عرض مكة).
+# القيمة مخزنة ضمنياً في rides.pickup_cell، لذلك تغييرها يتطلب ترحيلاً يعيد حساب الخلايا.
+GRID_CELL_DEG = 0.01
+_LON_CELLS = int(math.ceil(360 / GRID_CELL_DEG))
+
+# كيلومترات لكل درجة عرض
+_KM_PER_DEG_LAT = 111.32
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """حساب المسافة بين نقطتين بالكيلومتر (صيغة هافرسين)"""
+    # تحويل الدرجات إلى راديان
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+
+    # صيغة هافرسين
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
+
+    return c * EARTH_RADIUS_KM
+
+
+def _cell_indexes(latitude: float, longitude: float):
+    lat_index = int(math.floor((latitude + 90) / GRID_CELL_DEG))
+    lon_index = int(math.floor((longitude + 180) / GRID_CELL_DEG)) % _LON_CELLS
+    return lat_index, lon_index
+
+
+def grid_cell(latitude: Optional[float], longitude: Optional[float]) -> Optional[int]:
+    """Return the integer grid cell id for a coordinate, or None without coordinates"""
+    if latitude is None or longitude is None:
+        return None
+    lat_index, lon_index = _cell_indexes(latitude, longitude)
+    return lat_index * _LON_CELLS + lon_index
+
+
+def cells_within(latitude: float, longitude: float, radius_km: float) -> List[int]:
+    """Return every grid cell that may contain points within radius_km of a coordinate"""
+    dlat = radius_km / _KM_PER_DEG_LAT
+    # خلايا الطول تضيق كلما ابتعدنا عن خط الاستواء
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    dlon = min(radius_km / (_KM_PER_DEG_LAT * cos_lat), 180)
+
+    min_lat, min_lon = _cell_indexes(max(latitude - dlat, -90), longitude - dlon)
+    max_lat, max_lon = _cell_indexes(min(latitude + dlat, 90), longitude + dlon)
+
+    lon_span = _LON_CELLS - 1 if dlon >= 180 else (max_lon - min_lon) % _LON_CELLS
+    cells = []
+    for lat_index in range(min_lat, max_lat + 1):
+        for step in range(lon_span + 1):
+            cells.append(lat_index * _LON_CELLS + (min_lon + step) % _LON_CELLS)
+    return cells
+
+
+# ============ حساب المسافات على دفعات ============
+
+def _pure_distance_rows(origins: Sequence[Coordinate], targets: Sequence[Coordinate]):
+    """Yield one row of haversine distances per origin without NumPy"""
+    # تحويل الأهداف إلى راديان وحساب جيب التمام مرة واحدة فقط
+    prepared = [(math.radians(lat), math.radians(lon)) for lat, lon in targets]
+    prepared = [(lat, lon, math.cos(lat)) for lat, lon in prepared]
+    sin, asin, sqrt = math.sin, math.asin, math.sqrt
+    for lat, lon in origins:
+        lat1, lon1 = math.radians(lat), math.radians(lon)
+        cos1 = math.cos(lat1)
+        row = []
+        for lat2, lon2, cos2 in prepared:
+            a = sin((lat2 - lat1) / 2) ** 2 + cos1 * cos2 * sin((lon2 - lon1) / 2) ** 2
+            row.append(2 * EARTH_RADIUS_KM * asin(sqrt(min(a, 1.0))))
+        yield row
+
+
+def _numpy_distance_matrix(origins: Sequence[Coordinate], targets: Sequence[Coordinate]):
+    o = np.radians(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    t = np.radians(np.asarray(targets, dtype=np.float64).reshape(-1, 2))
+    lat1, lon1 = o[:, 0:1], o[:, 1:2]
+    lat2, lon2 = t[:, 0], t[:, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def distance_matrix(origins: Sequence[Coordinate], targets: Sequence[Coordinate]):
+    """Haversine distances in km between every origin and every target.
+
+    Returns a len(origins) x len(targets) NumPy array when NumPy is
+    installed, otherwise a list of lists.
+    """
+    if np is not None:
+        return _numpy_distance_matrix(origins, targets)
+    return list(_pure_distance_rows(origins, targets))
+
+
+def distances_from(latitude: float, longitude: float, targets: Sequence[Coordinate]) -> List[float]:
+    """Haversine distances in km from one point to many targets"""
+    if not targets:
+        return []
+    if np is not None:
+        return _numpy_distance_matrix([(latitude, longitude)], targets)[0].tolist()
+    return next(_pure_distance_rows([(latitude, longitude)], targets))
+
+
+def nearest_k(origins: Sequence[Coordinate], targets: Sequence[Coordinate],
+              k: int, max_km: float = None) -> List[List[Tuple[int, float]]]:
+    """For each origin, return up to k (target_index, distance_km) pairs, nearest first"""
+    if not targets or k <= 0:
+        return [[] for _ in origins]
+
+    if np is not None:
+        # معالجة المصفوفة على أجزاء حتى لا تستهلك الذاكرة مع الأعداد الكبيرة
+        results = []
+        chunk = max(1, 2_000_000 // len(targets))
+        k_eff = min(k, len(targets))
+        for start in range(0, len(origins), chunk):
+            matrix = _numpy_distance_matrix(origins[start:start + chunk], targets)
+            if k_eff < len(targets):
+                candidates = np.argpartition(matrix, k_eff - 1, axis=1)[:, :k_eff]
+            else:
+                candidates = np.broadcast_to(np.arange(len(targets)), matrix.shape)
+            picked = np.take_along_axis(matrix, candidates, axis=1)
+            order = np.argsort(picked, axis=1)
+            for row_idx, row_dist in zip(np.take_along_axis(candidates, order, axis=1),
+                                         np.take_along_axis(picked, order, axis=1)):
+                pairs = [(int(i), float(d)) for i, d in zip(row_idx, row_dist)]
+                if max_km is not None:
+                    pairs = [(i, d) for i, d in pairs if d <= max_km]
+                results.append(pairs)
+        return results
+
+    results = []
+    for row in _pure_distance_rows(origins, targets):
+        pairs = heapq.nsmallest(k, enumerate(row), key=lambda pair: pair[1])
+        if max_km is not None:
+            pairs = [(i, d) for i, d in pairs if d <= max_km]
+        results.append(pairs)
+    return results
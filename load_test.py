@@ -0,0 +1,401 @@
+"""Drive the bot's update handlers in-process with synthetic clients, captains and group members.
+
+The script builds the same Application as main.py, but with a stand-in
+for the Bot API transport, against a fresh database in a temporary
+directory. Simulated users run concurrently and each follows a scripted
+session:
+- clients send /start, request a ride with locations or text, fill in the
+  monthly form and open their ride list;
+- captains open the available rides, accept, start and complete them, or
+  pay the subscription and send a proof photo;
+- group members post messages for moderation, some of them with links.
+Every update goes through the bot's KeyedUpdateProcessor and then
+Application.process_update, as the running bot does; --concurrency sets
+the processor's limit. Its wall time, including any wait for a slot, is
+recorded per handler, and per callback route for button_callback. The
+result is printed as JSON so runs can be compared between releases.
+
+    python load_test.py
+    python load_test.py --clients 2000 --captains 500 --group-messages 5000 --out load.json
+    python load_test.py --api-latency-ms 40 --think-ms 200
+    python load_test.py --api-latency-ms 40 --concurrency 1
+
+By default the outbound send queue limits are raised so that the handlers
+are measured rather than Telegram's rate limits; pass --telegram-limits
+to keep the configured values.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+from collections import defaultdict
+
+BOT_TOKEN = "123456:LOADTEST"
+ADMIN_ID = 1000
+GROUP_ID = -1001000000000
+FIRST_CLIENT = 2000000
+FIRST_CAPTAIN = 3000000
+FIRST_MEMBER = 4000000
+
+# مواقع داخل مكة لطلبات الرحلات
+MAKKAH_LAT, MAKKAH_LON = 21.4225, 39.8262
+
+
+class FakeBotAPI:
+    """Answers Bot API methods in memory and remembers each chat's last message"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.calls = defaultdict(int)
+        self.last_message = {}
+        self._message_ids = defaultdict(int)
+
+    def _message(self, chat_id, params, message_id=None):
+        if message_id is None:
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'LoadTest'},
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        markup = params.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if markup and 'inline_keyboard' in markup:
+            message['reply_markup'] = markup
+        if chat_id > 0:
+            self.last_message[chat_id] = message
+        return message
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id is not None else None
+        if method in ('sendMessage', 'sendPhoto', 'copyMessage') and chat_id is not None:
+            return self._message(chat_id, params)
+        if method == 'editMessageText' and chat_id is not None:
+            return self._message(chat_id, params, int(params['message_id']))
+        return True
+
+
+def fake_request(api: FakeBotAPI):
+    """BaseRequest that hands every call to api instead of the network"""
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            params = request_data.parameters if request_data is not None else {}
+            result = await api.call(url.rsplit('/', 1)[-1], params)
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return FakeRequest()
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _summary(latencies, errors, duration):
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'throughput_per_s': round(len(ordered) / duration, 1) if duration else None,
+        'p50_ms': round(_percentile(ordered, 0.50), 3),
+        'p95_ms': round(_percentile(ordered, 0.95), 3),
+        'p99_ms': round(_percentile(ordered, 0.99), 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+
+
+class LoadTest:
+    """Synthetic users sending updates through the application's handlers"""
+
+    def __init__(self, app, api, bot_module, rnd, think_ms):
+        self.app = app
+        self.api = api
+        self.bot_module = bot_module
+        self.rnd = rnd
+        self.think = think_ms / 1000
+        self.update_id = 0
+        self.latencies = defaultdict(list)
+        self.route_latencies = defaultdict(list)
+        self.labels = {}
+        self.errors = defaultdict(int)
+
+    async def _pause(self):
+        # وقت تفكير عشوائي حتى تتداخل جلسات المستخدمين
+        await asyncio.sleep(self.rnd.uniform(0, 2 * self.think) if self.think else 0)
+
+    async def _process(self, label, data, route=None):
+        from telegram import Update
+
+        self.update_id += 1
+        data['update_id'] = self.update_id
+        update = Update.de_json(data, self.app.bot)
+        self.labels[self.update_id] = label
+        started = time.perf_counter()
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        elapsed = (time.perf_counter() - started) * 1000
+        self.latencies[label].append(elapsed)
+        if route is not None:
+            self.route_latencies[route].append(elapsed)
+
+    async def on_error(self, update, context):
+        label = self.labels.get(getattr(update, 'update_id', None), 'unknown')
+        self.errors[label] += 1
+
+    def _user(self, user_id, name):
+        return {'id': user_id, 'is_bot': False, 'first_name': name, 'username': f"u{user_id}"}
+
+    def _message(self, user, chat, **fields):
+        message = {
+            'message_id': self.rnd.randint(1, 2 ** 31),
+            'date': int(time.time()),
+            'chat': chat,
+            'from': user,
+        }
+        message.update(fields)
+        return {'message': message}
+
+    async def send_text(self, user, text, label='text_handler', chat=None):
+        chat = chat or {'id': user['id'], 'type': 'private'}
+        fields = {'text': text}
+        if text.startswith('/'):
+            command = text.split()[0]
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        await self._process(label, self._message(user, chat, **fields))
+        await self._pause()
+
+    async def send_location(self, user, latitude, longitude):
+        chat = {'id': user['id'], 'type': 'private'}
+        await self._process('location_handler', self._message(
+            user, chat, location={'latitude': latitude, 'longitude': longitude}))
+        await self._pause()
+
+    async def send_photo(self, user):
+        chat = {'id': user['id'], 'type': 'private'}
+        photo = [{'file_id': f"proof-{user['id']}-{size}", 'file_unique_id': f"p{user['id']}{size}",
+                  'width': size, 'height': size} for size in (90, 800)]
+        await self._process('photo_handler', self._message(user, chat, photo=photo))
+        await self._pause()
+
+    def buttons(self, user, prefix):
+        """Callback data of the buttons in the user's last bot message that start with prefix"""
+        message = self.api.last_message.get(user['id']) or {}
+        return [button['callback_data']
+                for row in message.get('reply_markup', {}).get('inline_keyboard', [])
+                for button in row if button.get('callback_data', '').startswith(prefix)]
+
+    async def tap(self, user, prefix, choose_random=False):
+        """Press a button in the user's last bot message whose data starts with prefix"""
+        matches = self.buttons(user, prefix)
+        if not matches:
+            return False
+        data = self.rnd.choice(matches) if choose_random else matches[0]
+        route = self.bot_module.callbacks.resolve(data)[0]
+        await self._process('button_callback', {'callback_query': {
+            'id': str(self.update_id + 1),
+            'from': user,
+            'chat_instance': str(user['id']),
+            'message': self.api.last_message[user['id']],
+            'data': data,
+        }}, route)
+        await self._pause()
+        return True
+
+    def _near_makkah(self):
+        return (MAKKAH_LAT + self.rnd.uniform(-0.05, 0.05), MAKKAH_LON + self.rnd.uniform(-0.05, 0.05))
+
+    async def client_session(self, n):
+        user = self._user(FIRST_CLIENT + n, f"Client{n}")
+        await self.send_text(user, '/start', 'start_command')
+        await self.tap(user, 'client_button')
+        if self.rnd.random() < 0.2:
+            # نموذج السائق الشهري بدل رحلة فورية
+            await self.send_text(user, "مطلوب سائق شهري\n👥 عدد الأشخاص: 2\n🏠 العزيزية\n🏢 الحرم")
+            return
+        await self.tap(user, 'request_ride')
+        if self.rnd.random() < 0.7:
+            await self.send_location(user, *self._near_makkah())
+            await self.send_location(user, *self._near_makkah())
+        else:
+            await self.send_text(user, 'العزيزية')
+            await self.send_text(user, 'المسجد الحرام')
+        await self.send_text(user, '/start', 'start_command')
+        await self.tap(user, 'client_button')
+        await self.tap(user, 'my_rides')
+
+    async def captain_session(self, n, subscribed):
+        user = self._user(FIRST_CAPTAIN + n, f"Captain{n}")
+        await self.send_text(user, '/start', 'start_command')
+        await self.tap(user, 'captain_button')
+        if not subscribed:
+            await self.tap(user, 'view_rides')
+            await self.tap(user, 'pay_subscription')
+            await self.tap(user, 'payment_method_stc_')
+            await self.tap(user, 'payment_proof_')
+            await self.send_photo(user)
+            return
+
+        # الرحلات تصل مع تقدم جلسات العملاء، فيعيد الكابتن المحاولة
+        for _ in range(10):
+            if not await self.tap(user, 'view_rides'):
+                # رسالة "لا توجد رحلات" بدون أزرار: العودة عبر القائمة
+                await self.send_text(user, '/start', 'start_command')
+                await self.tap(user, 'captain_button')
+                await self.tap(user, 'view_rides')
+            if self.rnd.random() < 0.3:
+                await self.tap(user, 'page_vr_n_')
+            # عدة كباتن قد يقبلون نفس الرحلة؛ الخاسر يعيد المحاولة
+            if await self.tap(user, 'accept_ride_', choose_random=True) and self.buttons(user, 'start_ride_'):
+                break
+            await self._pause()
+        await self.tap(user, 'my_active_rides')
+        await self.tap(user, 'my_active_rides')
+        if await self.tap(user, 'start_ride_'):
+            await self.tap(user, 'my_active_rides')
+            await self.tap(user, 'complete_ride_')
+        await self.tap(user, 'my_payments')
+
+    async def group_session(self, n, messages):
+        user = self._user(FIRST_MEMBER + n, f"Member{n}")
+        chat = {'id': GROUP_ID, 'type': 'supergroup', 'title': 'مشاوير مكة'}
+        for _ in range(messages):
+            if self.rnd.random() < 0.1:
+                text = f"تواصلوا معي https://example.com/{n}"
+            else:
+                text = self.rnd.choice(["مطلوب مشوار من العزيزية للحرم", "هات", "خاص", "متوفر كابتن الآن"])
+            await self.send_text(user, text, 'group_message_handler', chat)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    os.chdir(workdir)
+    # بدون خادم /metrics حتى لا يتعارض مع بوت يعمل على نفس الجهاز
+    os.environ.update({'BOT_TOKEN': BOT_TOKEN, 'ADMIN_CHAT_ID': str(ADMIN_ID), 'METRICS_PORT': '0'})
+    if not args.telegram_limits:
+        for name in ('SEND_GLOBAL_RATE', 'SEND_CHAT_RATE', 'SEND_GROUP_PER_MINUTE'):
+            os.environ[name] = '1000000'
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot_module
+    logging.getLogger().setLevel(args.log_level)
+    from telegram.ext import Application
+    from database import Database
+    from timeutil import now_local
+    from datetime import timedelta
+
+    api = FakeBotAPI(args.api_latency_ms)
+    from update_processor import KeyedUpdateProcessor
+    app = (Application.builder().token(BOT_TOKEN)
+           .request(fake_request(api)).get_updates_request(fake_request(api))
+           .concurrent_updates(KeyedUpdateProcessor(args.concurrency or bot_module.update_processor.max_concurrent_updates))
+           .build())
+    bot_module.add_handlers(app)
+    rnd = random.Random(args.seed)
+    test = LoadTest(app, api, bot_module, rnd, args.think_ms)
+    app.add_error_handler(test.on_error)
+
+    # نصف الكباتن مشتركون مسبقاً حتى تُعرض لهم الرحلات
+    seed_db = Database()
+    end_date = (now_local() + timedelta(days=30)).isoformat()
+    subscribed = set(rnd.sample(range(args.captains), args.captains // 2))
+    for n in subscribed:
+        seed_db.add_user(FIRST_CAPTAIN + n, f"u{FIRST_CAPTAIN + n}", f"Captain{n}", user_type='captain')
+        seed_db.add_subscription(FIRST_CAPTAIN + n, 'captain_monthly', end_date, 10, 'admin_manual', ADMIN_ID)
+
+    await app.initialize()
+    await bot_module.start_background_tasks(app)
+    members = max(1, args.group_messages // 10)
+    sessions = [test.client_session(n) for n in range(args.clients)]
+    sessions += [test.captain_session(n, n in subscribed) for n in range(args.captains)]
+    sessions += [test.group_session(n, args.group_messages // members) for n in range(members)]
+    rnd.shuffle(sessions)
+
+    started = time.perf_counter()
+    await asyncio.gather(*sessions)
+    duration = time.perf_counter() - started
+    await bot_module.stop_background_tasks(app)
+    await app.shutdown()
+    bot_module.stop_warning_writers()
+
+    with seed_db.connections.connect() as conn:
+        rows = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ('users', 'rides', 'payments', 'monthly_requests', 'user_warnings', 'outbox')}
+    total = sum(len(values) for values in test.latencies.values())
+    return {
+        'config': {
+            'clients': args.clients,
+            'captains': args.captains,
+            'group_messages': args.group_messages,
+            'think_ms': args.think_ms,
+            'api_latency_ms': args.api_latency_ms,
+            'telegram_limits': args.telegram_limits,
+            'concurrency': app.update_processor.max_concurrent_updates,
+            'seed': args.seed,
+            'python': platform.python_version(),
+        },
+        'duration_s': round(duration, 3),
+        'updates': total,
+        'throughput_per_s': round(total / duration, 1),
+        'errors': sum(test.errors.values()),
+        'handlers': {label: _summary(values, test.errors.get(label, 0), duration)
+                     for label, values in sorted(test.latencies.items())},
+        'routes': {route: _summary(values, 0, duration)
+                   for route, values in sorted(test.route_latencies.items(), key=lambda item: -len(item[1]))},
+        'api_calls': dict(sorted(api.calls.items())),
+        'rows': rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=1000, help='simulated clients')
+    parser.add_argument('--captains', type=int, default=300, help='simulated captains, half of them subscribed')
+    parser.add_argument('--group-messages', type=int, default=2000, help='messages posted in the group')
+    parser.add_argument('--think-ms', type=float, default=20, help='mean pause between a user\'s updates')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='delay added to every Bot API call')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='updates processed at once (default: MAX_CONCURRENT_UPDATES)')
+    parser.add_argument('--telegram-limits', action='store_true', help='keep the configured send queue limits')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING', help='bot log level while the test runs')
+    parser.add_argument('--out', help='also write the JSON result to this file')
+    args = parser.parse_args()
+
+    # run() ينتقل إلى مجلد مؤقت، فيُحسب مسار الملف قبله
+    out = os.path.abspath(args.out) if args.out else None
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
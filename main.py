@@ -1,15 +1,36 @@
 import os
+import time
 import logging
-import sqlite3
-import math
+import secrets
+import functools
 import asyncio
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from database import Database
-from moderation import ModerationSystem
-# from scheduler import MessageScheduler
+from moderation import ModerationSystem, BAN_WARNINGS
+from async_db import AsyncDatabase, shutdown_executor
+from db_connection import close_all_connections
+from write_queue import stop_write_queues
+from warning_counter import stop_warning_writers
+from timeutil import now_local, from_ts
+from geo import calculate_distance
+from callback_router import CallbackRouter
+from pagination import decode_cursor
+from render_cache import RenderCache, EditTracker, digest
+from update_processor import KeyedUpdateProcessor
+from persistence import SQLitePersistence
+from send_queue import get_send_queue
+from priorities import PRIORITY_RIDE, PRIORITY_PAYMENT
+from outbox import Notification
+from outbox_dispatcher import OutboxDispatcher
+from ride_transitions import ALREADY_DONE, ERROR, NOT_FOUND, NOT_YOURS, TAKEN
+from scheduler import MessageScheduler
+from cron import CronSchedule
+from metrics import (get_metrics, timed, instrumented_request, render_histogram, render_samples,
+                     LoopLagMonitor, MetricsServer, HEALTH_DB_TIMEOUT)
 
 # تحميل متغيرات البيئة من ملف .env
 load_dotenv()
@@ -17,10 +38,41 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 CAPTAIN_GROUP_ID = os.getenv("CAPTAIN_GROUP_ID")
 CAPTAIN_GROUP_ID = os.getenv("CAPTAIN_GROUP_ID")
+# نطاق البحث عن الرحلات القريبة من الكابتن بالكيلومتر
+NEARBY_RADIUS_KM = float(os.getenv("NEARBY_RADIUS_KM", "10"))
+
+# طريقة استقبال التحديثات: polling (الافتراضي) أو webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# العنوان العام الذي يرسل إليه تيليجرام التحديثات في وضع webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# true: تجاهل التحديثات التي وصلت أثناء توقف البوت، false: معالجتها عند التشغيل
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "true").lower() == "true"
+# عنوان Bot API بديل (خادم telegram-bot-api محلي أو بيئة اختبار)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
 # إعداد قاعدة البيانات ونظام الإشراف
-db = Database()
-moderation = ModerationSystem()
+# يتم تنفيذ استعلامات قاعدة البيانات في خيوط منفصلة حتى لا تعطل حلقة الأحداث
+db = AsyncDatabase(Database())
+moderation = AsyncDatabase(ModerationSystem())
+# طابور الرسائل الصادرة: يحترم حدود تيليجرام ويقدّم إشعارات الرحلات والمدفوعات
+send_queue = get_send_queue()
+# إشعارات الرحلات والمدفوعات تُكتب في جدول outbox مع تغيير الحالة ثم يرسلها الموزع
+outbox = OutboxDispatcher()
+# جدولة الرسائل المتكررة وفحص الاشتراكات، تُنشأ عند تشغيل البوت
+scheduler = None
+# زمن تنفيذ كل معالج تحديثات، وتأخر حلقة الأحداث، وخادم /metrics و /healthz
+handler_latency = get_metrics().histogram('bot_handler_duration_seconds', "Update handler latency", ('handler',))
+loop_lag = LoopLagMonitor()
+metrics_server = None
+# معالجة التحديثات بالتوازي مع الحفاظ على ترتيب تحديثات كل مستخدم (ورسائل كل مجموعة)
+update_processor = KeyedUpdateProcessor()
+# بطاقات الرحلات الجاهزة حسب (رقم الرحلة، نسختها) وآخر محتوى لكل رسالة قوائم
+ride_cards = RenderCache()
+message_edits = EditTracker()
 
 # إعداد نظام السجلات
 logging.basicConfig(
@@ -29,22 +81,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """حساب المسافة بين نقطتين بالكيلومتر (صيغة هافرسين)"""
-    # تحويل الدرجات إلى راديان
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-
-    # صيغة هافرسين
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-
-    # نصف قطر الأرض بالكيلومتر
-    r = 6371
-
-    return c * r
-
 # هذا هو الأمر الذي سيتم تشغيله عند إضافة البوت إلى مجموعة أو عند كتابة /start
 async def start_command(update: Update, context):
     logger.info(f"Start command received from user {update.effective_user.id}")
@@ -61,7 +97,7 @@ async def start_command(update: Update, context):
     # إضافة المستخدم إلى قاعدة البيانات
     user = update.effective_user
     try:
-        db.add_user(
+        await db.add_user(
             user_id=user.id,
             username=user.username,
             first_name=user.first_name,
@@ -85,20 +121,120 @@ async def start_command(update: Update, context):
         parse_mode='Markdown'
     )
 
-# معالج الأزرار التفاعلية
-async def button_callback(update: Update, context):
-    query = update.callback_query
-    await query.answer()
+# ============ بطاقات الرحلات وتعديل الرسائل ============
+
+# أزرار ثابتة تُبنى مرة واحدة بدل إعادة بنائها مع كل عرض
+BACK_TO_CAPTAIN_ROW = (InlineKeyboardButton("العودة ↩️", callback_data='captain_button'),)
+VIEW_RIDES_REFRESH_ROW = (InlineKeyboardButton("تحديث القائمة 🔄", callback_data='view_rides'),)
+ACTIVE_RIDES_REFRESH_ROW = (InlineKeyboardButton("تحديث القائمة 🔄", callback_data='my_active_rides'),)
+SUBSCRIPTION_REQUIRED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 دفع الاشتراك (10 ريال)", callback_data='pay_subscription')],
+    [InlineKeyboardButton("📞 تواصل مع الإدارة", url="https://t.me/novacompnay")],
+    BACK_TO_CAPTAIN_ROW
+])
+NO_ACTIVE_RIDES_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("عرض الرحلات المتاحة 🚖", callback_data='view_rides')],
+    BACK_TO_CAPTAIN_ROW
+])
+
+def render_pending_ride_card(ride: dict) -> tuple:
+    """نص بطاقة رحلة متاحة (Markdown) وصف زر قبولها"""
+    card = f"🆔 رحلة #{ride['ride_id']}\n"
+    card += f"🔹 من: {ride['pickup_location']}\n"
+    card += f"🏁 إلى: {ride['destination']}\n"
+
+    # إضافة الإحداثيات إذا كانت متوفرة
+    if ride.get('pickup_latitude') and ride.get('pickup_longitude'):
+        pickup_maps = f"https://maps.google.com/?q={ride['pickup_latitude']},{ride['pickup_longitude']}"
+        card += f"📍 [موقع الانطلاق]({pickup_maps})\n"
+
+    if ride.get('destination_latitude') and ride.get('destination_longitude'):
+        dest_maps = f"https://maps.google.com/?q={ride['destination_latitude']},{ride['destination_longitude']}"
+        card += f"🏁 [موقع الوجهة]({dest_maps})\n"
+
+        # حساب المسافة إذا كانت الإحداثيات متوفرة
+        if ride.get('pickup_latitude') and ride.get('pickup_longitude'):
+            distance = calculate_distance(
+                ride['pickup_latitude'], ride['pickup_longitude'],
+                ride['destination_latitude'], ride['destination_longitude']
+            )
+            card += f"📏 المسافة: {distance:.1f} كم\n"
 
-    user_id = query.from_user.id
-    data = query.data
-    logger.info(f"Button callback received: {data} from user {user_id}")
+    if ride['price']:
+        card += f"💰 السعر: {ride['price']} ريال\n"
+    card += f"👤 العميل: {ride['first_name']}\n\n"
 
-    if data == 'client_button':
-        db.update_user_type(user_id, 'client')
+    button = InlineKeyboardButton(
+        f"✅ قبول الرحلة #{ride['ride_id']} 🚗",
+        callback_data=f"accept_ride_{ride['ride_id']}"
+    )
+    return card, (button,)
+
+def render_active_ride_card(ride: dict) -> tuple:
+    """نص بطاقة رحلة نشطة للكابتن وصف زر بدئها أو إنهائها"""
+    status_emoji = "🟡" if ride['status'] == 'accepted' else "🟢"
+    status_text = "مقبولة" if ride['status'] == 'accepted' else "قيد التنفيذ"
+
+    card = f"{status_emoji} رحلة #{ride['ride_id']}\n"
+    card += f"   من: {ride['pickup_location']}\n"
+    card += f"   إلى: {ride['destination']}\n"
+    card += f"   العميل: {ride['first_name']}\n"
+    card += f"   الحالة: {status_text}\n\n"
+
+    if ride['status'] == 'accepted':
+        button = InlineKeyboardButton(
+            f"بدء الرحلة #{ride['ride_id']} ▶️",
+            callback_data=f"start_ride_{ride['ride_id']}"
+        )
+    else:
+        button = InlineKeyboardButton(
+            f"🏁 إنهاء الرحلة #{ride['ride_id']} ✅",
+            callback_data=f"complete_ride_{ride['ride_id']}"
+        )
+    return card, (button,)
+
+def ride_card(render, ride: dict) -> tuple:
+    """بطاقة الرحلة من الذاكرة؛ تغير الحالة يرفع نسخة الرحلة فتُبنى البطاقة من جديد"""
+    # اسم العميل من جدول آخر فهو جزء من المفتاح مع النسخة
+    return ride_cards.get((render, ride['ride_id']), (ride['version'], ride['first_name']), lambda: render(ride))
+
+def shown_digest(message):
+    """بصمة النص والأزرار كما يعرضها تيليجرام في الرسالة الآن"""
+    if message.text is None:
+        return None
+    markup = message.reply_markup
+    return digest(message.text, markup.to_dict() if markup else None)
+
+async def edit_if_changed(query, text: str, reply_markup=None, **kwargs):
+    """تعديل رسالة الزر فقط إذا تغير محتواها، بدل إرسال طلب يرفضه تيليجرام بـ Message is not modified"""
+    message = query.message
+    if not isinstance(message, Message):
+        await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+        return
 
-        # إرسال رسالة خاصة للعميل مع النموذج
-        client_form = """حياك الله عميلنا العزيز،
+    key = (message.chat_id, message.message_id)
+    content = digest(text, reply_markup.to_dict() if reply_markup else None, sorted(kwargs.items()))
+    shown = shown_digest(message)
+    if message_edits.unchanged(key, content, shown):
+        return
+    try:
+        edited = await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+        # المحتوى معروض بالفعل، مثلاً بعد إعادة تشغيل البوت
+        message_edits.record(key, content, shown, modified=False)
+        return
+    message_edits.record(key, content, shown_digest(edited) if isinstance(edited, Message) else None)
+
+# ============ معالجات الأزرار التفاعلية ============
+
+async def client_button_callback(query, context):
+    user_id = query.from_user.id
+    await db.update_user_type(user_id, 'client')
+
+    # إرسال رسالة خاصة للعميل مع النموذج
+    client_form = """حياك الله عميلنا العزيز،
 
 قم بتعبئة النموذج التالي لوضوح التفاصيل وتوفير سائق مناسب:
 
@@ -120,33 +256,34 @@ async def button_callback(update: Update, context):
 
 ➡️ ملاحظات إضافية:"""
 
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=client_form
-            )
-            # تعيين حالة المستخدم لانتظار النموذج المعبأ
-            context.user_data['step'] = 'waiting_form_response'
-
-            await query.edit_message_text(
-                "تم إرسال نموذج طلب السائق إلى رسائلك الخاصة 📩\n\n"
-                "قم بتعبئة النموذج وإرساله هنا في الرسائل الخاصة، أو انسخه وأرسله في المجموعة.\n\n"
-                "أو يمكنك طلب رحلة فورية:",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🚗 طلب رحلة فورية", callback_data='request_ride')
-                ], [
-                    InlineKeyboardButton("📋 متابعة رحلاتي", callback_data='my_rides')
-                ]])
-            )
-        except Exception as e:
-            await query.edit_message_text(
-                "عذراً، لم أتمكن من إرسال رسالة خاصة لك.\n\nتأكد من أنك بدأت محادثة مع البوت أولاً بالضغط على /start في الرسائل الخاصة."
-            )
+    try:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=client_form
+        )
+        # تعيين حالة المستخدم لانتظار النموذج المعبأ
+        context.user_data['step'] = 'waiting_form_response'
 
-    elif data == 'captain_button':
-        db.update_user_type(user_id, 'captain')
+        await query.edit_message_text(
+            "تم إرسال نموذج طلب السائق إلى رسائلك الخاصة 📩\n\n"
+            "قم بتعبئة النموذج وإرساله هنا في الرسائل الخاصة، أو انسخه وأرسله في المجموعة.\n\n"
+            "أو يمكنك طلب رحلة فورية:",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🚗 طلب رحلة فورية", callback_data='request_ride')
+            ], [
+                InlineKeyboardButton("📋 متابعة رحلاتي", callback_data='my_rides')
+            ]])
+        )
+    except Exception as e:
+        await query.edit_message_text(
+            "عذراً، لم أتمكن من إرسال رسالة خاصة لك.\n\nتأكد من أنك بدأت محادثة مع البوت أولاً بالضغط على /start في الرسائل الخاصة."
+        )
 
-        captain_rules = """عزيزي الكابتن، لا تعرض نفسك للكتم أو الحظر.
+async def captain_button_callback(query, context):
+    user_id = query.from_user.id
+    await db.update_user_type(user_id, 'captain')
+
+    captain_rules = """عزيزي الكابتن، لا تعرض نفسك للكتم أو الحظر.
 
 ❌ ممنوع عرض مكان تواجدك (يُستثنى من ذلك المشتركون في خدمة "كابتن مشترك").
 ❌ ممنوع الإعلانات داخل المجموعة.
@@ -158,702 +295,684 @@ async def button_callback(update: Update, context):
 
 برجاء الالتزام بالقوانين حتى لا تعرض نفسك للحظر."""
 
-        keyboard = [
-            [InlineKeyboardButton("🚖 عرض الرحلات المتاحة", callback_data='view_rides')],
-            [InlineKeyboardButton("📋 رحلاتي النشطة", callback_data='my_active_rides')],
-            [InlineKeyboardButton("💳 اشتراك الكباتن (10 ريال/شهر)", callback_data='pay_subscription')],
-            [InlineKeyboardButton("📊 حالة الدفعات والاشتراك", callback_data='my_payments')],
-            [InlineKeyboardButton("🏠 العودة للقائمة الرئيسية", callback_data='main_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            captain_rules,
-            reply_markup=reply_markup
-        )
-
-    elif data == 'request_ride':
-        await query.edit_message_text(
-            "لطلب رحلة، يرجى إرسال موقع الانطلاق أولاً 📍\n\nيمكنك إرسال الموقع من خلال:\n1. الضغط على رمز المشبك 📎\n2. اختيار 'الموقع' 📍\n3. اختيار موقعك الحالي أو البحث عن موقع آخر"
-        )
-        context.user_data['step'] = 'waiting_pickup'
-
-    elif data == 'view_rides':
-        # فحص الاشتراك قبل عرض الرحلات
-        if not db.is_captain_subscribed(user_id):
-            subscription_info = db.get_subscription_info(user_id)
-            await query.edit_message_text(
-                "❌ عذراً، يجب أن تكون مشتركاً لعرض الرحلات المتاحة\n\n"
-                "💳 اشتراك الكباتن: 10 ريال شهرياً\n"
-                "🎯 احصل على وصول كامل لجميع الرحلات المتاحة",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💳 دفع الاشتراك (10 ريال)", callback_data='pay_subscription')],
-                    [InlineKeyboardButton("📞 تواصل مع الإدارة", url="https://t.me/novacompnay")],
-                    [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
-                ])
-            )
-            return
-
-        rides = db.get_pending_rides()
-        if not rides:
-            await query.edit_message_text("لا توجد رحلات متاحة حالياً 😔")
-            return
+    keyboard = [
+        [InlineKeyboardButton("🚖 عرض الرحلات المتاحة", callback_data='view_rides')],
+        [InlineKeyboardButton("📍 الرحلات القريبة مني", callback_data='nearby_rides')],
+        [InlineKeyboardButton("📋 رحلاتي النشطة", callback_data='my_active_rides')],
+        [InlineKeyboardButton("💳 اشتراك الكباتن (10 ريال/شهر)", callback_data='pay_subscription')],
+        [InlineKeyboardButton("📊 حالة الدفعات والاشتراك", callback_data='my_payments')],
+        [InlineKeyboardButton("🏠 العودة للقائمة الرئيسية", callback_data='main_menu')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        captain_rules,
+        reply_markup=reply_markup
+    )
 
-        message = "الرحلات المتاحة 🚗:\n\n"
-        keyboard = []
+async def request_ride_callback(query, context):
+    await query.edit_message_text(
+        "لطلب رحلة، يرجى إرسال موقع الانطلاق أولاً 📍\n\nيمكنك إرسال الموقع من خلال:\n1. الضغط على رمز المشبك 📎\n2. اختيار 'الموقع' 📍\n3. اختيار موقعك الحالي أو البحث عن موقع آخر"
+    )
+    context.user_data['step'] = 'waiting_pickup'
 
-        for ride in rides[:5]:  # عرض أول 5 رحلات
-            message += f"🆔 رحلة #{ride['ride_id']}\n"
-            message += f"🔹 من: {ride['pickup_location']}\n"
-            message += f"🏁 إلى: {ride['destination']}\n"
+async def view_rides_callback(query, context, cursor: str = None, backward: bool = False):
+    user_id = query.from_user.id
+    # فحص الاشتراك قبل عرض الرحلات
+    if not await db.is_captain_subscribed(user_id):
+        await edit_if_changed(
+            query,
+            "❌ عذراً، يجب أن تكون مشتركاً لعرض الرحلات المتاحة\n\n"
+            "💳 اشتراك الكباتن: 10 ريال شهرياً\n"
+            "🎯 احصل على وصول كامل لجميع الرحلات المتاحة",
+            reply_markup=SUBSCRIPTION_REQUIRED_MARKUP
+        )
+        return
 
-            # إضافة الإحداثيات إذا كانت متوفرة
-            if ride.get('pickup_latitude') and ride.get('pickup_longitude'):
-                pickup_maps = f"https://maps.google.com/?q={ride['pickup_latitude']},{ride['pickup_longitude']}"
-                message += f"📍 [موقع الانطلاق]({pickup_maps})\n"
+    page = await db.get_pending_rides(5, cursor, backward)
+    if not page.items:
+        await edit_if_changed(query, "لا توجد رحلات متاحة حالياً 😔")
+        return
 
-            if ride.get('destination_latitude') and ride.get('destination_longitude'):
-                dest_maps = f"https://maps.google.com/?q={ride['destination_latitude']},{ride['destination_longitude']}"
-                message += f"🏁 [موقع الوجهة]({dest_maps})\n"
+    message = "الرحلات المتاحة 🚗:\n\n"
+    keyboard = []
+    for ride in page.items:
+        card, buttons = ride_card(render_pending_ride_card, ride)
+        message += card
+        keyboard.append(buttons)
 
-                # حساب المسافة إذا كانت الإحداثيات متوفرة
-                if ride.get('pickup_latitude') and ride.get('pickup_longitude'):
-                    distance = calculate_distance(
-                        ride['pickup_latitude'], ride['pickup_longitude'],
-                        ride['destination_latitude'], ride['destination_longitude']
-                    )
-                    message += f"📏 المسافة: {distance:.1f} كم\n"
+    keyboard.extend(page_buttons('vr', page))
+    keyboard.append(VIEW_RIDES_REFRESH_ROW)
+    keyboard.append(BACK_TO_CAPTAIN_ROW)
 
-            if ride['price']:
-                message += f"💰 السعر: {ride['price']} ريال\n"
-            message += f"👤 العميل: {ride['first_name']}\n\n"
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_if_changed(query, message, reply_markup=reply_markup, parse_mode='Markdown', disable_web_page_preview=True)
 
-            keyboard.append([InlineKeyboardButton(
-                f"✅ قبول الرحلة #{ride['ride_id']} 🚗",
-                callback_data=f"accept_ride_{ride['ride_id']}"
-            )])
+async def nearby_rides_callback(query, context):
+    user_id = query.from_user.id
+    # فحص الاشتراك قبل عرض الرحلات
+    if not await db.is_captain_subscribed(user_id):
+        await query.edit_message_text(
+            "❌ عذراً، يجب أن تكون مشتركاً لعرض الرحلات المتاحة\n\n"
+            "💳 اشتراك الكباتن: 10 ريال شهرياً",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 دفع الاشتراك (10 ريال)", callback_data='pay_subscription')],
+                [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
+            ])
+        )
+        return
 
-        keyboard.append([InlineKeyboardButton("تحديث القائمة 🔄", callback_data='view_rides')])
-        keyboard.append([InlineKeyboardButton("العودة ↩️", callback_data='captain_button')])
+    context.user_data['step'] = 'waiting_captain_location'
+    await query.edit_message_text("📍 أرسل موقعك الحالي لعرض أقرب الرحلات إليك")
+    await context.bot.send_message(
+        chat_id=user_id,
+        text="اضغط على الزر بالأسفل لمشاركة موقعك 👇",
+        reply_markup=ReplyKeyboardMarkup(
+            [[KeyboardButton("📍 إرسال موقعي", request_location=True)]],
+            resize_keyboard=True,
+            one_time_keyboard=True
+        )
+    )
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown', disable_web_page_preview=True)
-
-    elif data.startswith('accept_ride_'):
-        ride_id = int(data.split('_')[2])
-        if db.accept_ride(ride_id, user_id):
-            ride = db.get_ride_by_id(ride_id)
-            await query.edit_message_text(
-                f"تم قبول الرحلة #{ride_id} بنجاح! ✅\n\n"
-                f"من: {ride['pickup_location']}\n"
-                f"إلى: {ride['destination']}\n"
-                f"العميل: {ride['client_name']}\n\n"
-                f"يمكنك الآن بدء الرحلة عندما تكون جاهزاً.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(f"بدء الرحلة ▶️", callback_data=f"start_ride_{ride_id}")
-                ], [
-                    InlineKeyboardButton("رحلاتي النشطة 📋", callback_data='my_active_rides')
-                ]])
-            )
+# رسائل أسباب فشل تغيير حالة الرحلة المشتركة بين الأزرار
+RIDE_FAILURE_TEXT = {
+    NOT_FOUND: "لم يتم العثور على الرحلة.",
+    NOT_YOURS: "هذه الرحلة ليست مخصصة لك.",
+    TAKEN: "عذراً، سبقك كابتن آخر إلى هذه الرحلة 😔",
+}
+
+def ride_failure_text(result, already_done: str, wrong_status: str, error: str) -> str:
+    """نص يشرح للمستخدم لماذا لم يتغير وضع الرحلة"""
+    if result.reason == ALREADY_DONE:
+        return already_done
+    if result.reason == ERROR:
+        return error
+    return RIDE_FAILURE_TEXT.get(result.reason, wrong_status)
+
+async def accept_ride_callback(query, context, ride_id):
+    user_id = query.from_user.id
+    # إشعار العميل يُحفظ في نفس معاملة قبول الرحلة
+    notification = Notification(
+        None,
+        f"تم قبول رحلتك #{ride_id} ✅\n\n"
+        f"الكابتن: {query.from_user.first_name}\n"
+        f"سيبدأ الرحلة قريباً وسيتواصل معك.",
+        priority=PRIORITY_RIDE
+    )
+    result = await db.accept_ride(ride_id, user_id, notification)
+    if result:
+        outbox.wake()
+        ride = result.ride
+        await query.edit_message_text(
+            f"تم قبول الرحلة #{ride_id} بنجاح! ✅\n\n"
+            f"من: {ride['pickup_location']}\n"
+            f"إلى: {ride['destination']}\n"
+            f"العميل: {ride['client_name']}\n\n"
+            f"يمكنك الآن بدء الرحلة عندما تكون جاهزاً.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton(f"بدء الرحلة ▶️", callback_data=f"start_ride_{ride_id}")
+            ], [
+                InlineKeyboardButton("رحلاتي النشطة 📋", callback_data='my_active_rides')
+            ]])
+        )
+    else:
+        await query.edit_message_text(ride_failure_text(
+            result,
+            already_done="لقد قبلت هذه الرحلة بالفعل ✅\n\nتجدها في رحلاتك النشطة.",
+            wrong_status="عذراً، هذه الرحلة لم تعد متاحة 😔",
+            error="حدث خطأ في قبول الرحلة."
+        ))
+
+async def publish_request_callback(query, context, request_id):
+    user_id = query.from_user.id
+    # التأكد من أن المستخدم هو المدير
+    if str(user_id) != ADMIN_CHAT_ID:
+        await query.answer("هذا الإجراء مخصص للمدير فقط.", show_alert=True)
+        return
 
-            # إشعار العميل
-            try:
-                await context.bot.send_message(
-                    chat_id=ride['client_id'],
-                    text=f"تم قبول رحلتك #{ride_id} ✅\n\n"
-                    f"الكابتن: {query.from_user.first_name}\n"
-                    f"سيبدأ الرحلة قريباً وسيتواصل معك."
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify client: {e}")
-        else:
-            await query.edit_message_text("عذراً، هذه الرحلة لم تعد متاحة 😔")
+    monthly_request = await db.get_monthly_request(request_id)
+    if not monthly_request:
+        await query.edit_message_text("❌ لم يتم العثور على الطلب.")
+        return
 
-    elif data.startswith('publish_request_'):
-        request_id = int(data.split('_')[2])
+    if monthly_request['status'] == 'published':
+        await query.answer("✅ تم نشر هذا الطلب مسبقاً.", show_alert=True)
+        return
         
-        # التأكد من أن المستخدم هو المدير
-        if str(user_id) != ADMIN_CHAT_ID:
-            await query.answer("هذا الإجراء مخصص للمدير فقط.", show_alert=True)
-            return
-
-        monthly_request = db.get_monthly_request(request_id)
-        if not monthly_request:
-            await query.edit_message_text("❌ لم يتم العثور على الطلب.")
-            return
+    # تجهيز الرسالة للنشر في مجموعة الكباتن
+    captain_message = f"""📢 **طلب توصيل شهري جديد** 📢
+    
+{monthly_request['request_details']}
+"""
 
-        if monthly_request['status'] == 'published':
-            await query.answer("✅ تم نشر هذا الطلب مسبقاً.", show_alert=True)
+    try:
+        # نشر الرسالة في مجموعة الكباتن
+        if not CAPTAIN_GROUP_ID:
+            await query.edit_message_text("❌ لم يتم تعيين مجموعة الكباتن. يرجى تعيين CAPTAIN_GROUP_ID في ملف .env")
             return
             
-        # تجهيز الرسالة للنشر في مجموعة الكباتن
-        captain_message = f"""📢 **طلب توصيل شهري جديد** 📢
+        await send_queue.send(
+            'send_message', CAPTAIN_GROUP_ID,
+            text=captain_message,
+            parse_mode='Markdown'
+        )
+
+        # تحديث حالة الطلب في قاعدة البيانات
+        await db.update_monthly_request_status(request_id, 'published')
         
-{monthly_request['request_details']}
-"""
+        # تحديث رسالة المدير
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ تم النشر بنجاح", callback_data='dummy')],
+            [InlineKeyboardButton("📝 إغلاق الطلب", callback_data=f'close_request_{request_id}')]
+        ])
+        await query.edit_message_text(
+            text=query.message.text,
+            reply_markup=keyboard
+        )
+        await query.answer("✅ تم نشر الطلب في مجموعة الكباتن بنجاح!", show_alert=True)
 
-        try:
-            # نشر الرسالة في مجموعة الكباتن
-            if not CAPTAIN_GROUP_ID:
-                await query.edit_message_text("❌ لم يتم تعيين مجموعة الكباتن. يرجى تعيين CAPTAIN_GROUP_ID في ملف .env")
-                return
-                
-            await context.bot.send_message(
-                chat_id=CAPTAIN_GROUP_ID,
-                text=captain_message,
-                parse_mode='Markdown'
-            )
+    except Exception as e:
+        logger.error(f"Failed to publish request to captain's group: {e}")
+        await query.answer(f"❌ حدث خطأ أثناء النشر: {e}", show_alert=True)
 
-            # تحديث حالة الطلب في قاعدة البيانات
-            db.update_monthly_request_status(request_id, 'published')
-            
-            # تحديث رسالة المدير
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ تم النشر بنجاح", callback_data='dummy')],
-                [InlineKeyboardButton("📝 إغلاق الطلب", callback_data=f'close_request_{request_id}')]
-            ])
-            await query.edit_message_text(
-                text=query.message.text,
-                reply_markup=keyboard
-            )
-            await query.answer("✅ تم نشر الطلب في مجموعة الكباتن بنجاح!", show_alert=True)
+async def my_active_rides_callback(query, context):
+    user_id = query.from_user.id
+    active_rides = await db.get_captain_active_rides(user_id)
+    if not active_rides:
+        await edit_if_changed(
+            query,
+            "لا توجد رحلات نشطة حالياً 😔\n\nيمكنك البحث عن رحلات جديدة من خلال 'عرض الرحلات المتاحة'",
+            reply_markup=NO_ACTIVE_RIDES_MARKUP
+        )
+        return
 
-        except Exception as e:
-            logger.error(f"Failed to publish request to captain's group: {e}")
-            await query.answer(f"❌ حدث خطأ أثناء النشر: {e}", show_alert=True)
-
-    elif data == 'my_active_rides':
-        active_rides = db.get_captain_active_rides(user_id)
-        if not active_rides:
-            await query.edit_message_text(
-                "لا توجد رحلات نشطة حالياً 😔\n\nيمكنك البحث عن رحلات جديدة من خلال 'عرض الرحلات المتاحة'",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("عرض الرحلات المتاحة 🚖", callback_data='view_rides')
-                ], [
-                    InlineKeyboardButton("العودة ↩️", callback_data='captain_button')
-                ]])
-            )
-            return
+    message = "رحلاتك النشطة 🚖:\n\n"
+    keyboard = []
+    for ride in active_rides:
+        card, buttons = ride_card(render_active_ride_card, ride)
+        message += card
+        keyboard.append(buttons)
 
-        message = "رحلاتك النشطة 🚖:\n\n"
-        keyboard = []
+    keyboard.append(ACTIVE_RIDES_REFRESH_ROW)
+    keyboard.append(BACK_TO_CAPTAIN_ROW)
 
-        for ride in active_rides:
-            status_emoji = "🟡" if ride['status'] == 'accepted' else "🟢"
-            status_text = "مقبولة" if ride['status'] == 'accepted' else "قيد التنفيذ"
-
-            message += f"{status_emoji} رحلة #{ride['ride_id']}\n"
-            message += f"   من: {ride['pickup_location']}\n"
-            message += f"   إلى: {ride['destination']}\n"
-            message += f"   العميل: {ride['first_name']}\n"
-            message += f"   الحالة: {status_text}\n\n"
-
-            if ride['status'] == 'accepted':
-                keyboard.append([InlineKeyboardButton(
-                    f"بدء الرحلة #{ride['ride_id']} ▶️",
-                    callback_data=f"start_ride_{ride['ride_id']}"
-                )])
-            elif ride['status'] == 'in_progress':
-                keyboard.append([InlineKeyboardButton(
-                    f"🏁 إنهاء الرحلة #{ride['ride_id']} ✅",
-                    callback_data=f"complete_ride_{ride['ride_id']}"
-                )])
-
-        keyboard.append([InlineKeyboardButton("تحديث القائمة 🔄", callback_data='my_active_rides')])
-        keyboard.append([InlineKeyboardButton("العودة ↩️", callback_data='captain_button')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_if_changed(query, message, reply_markup=reply_markup)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
-
-    elif data.startswith('start_ride_'):
-        ride_id = int(data.split('_')[2])
-        if db.start_ride(ride_id, user_id):
-            ride = db.get_ride_by_id(ride_id)
-            await query.edit_message_text(
-                f"تم بدء الرحلة #{ride_id} بنجاح! 🚖\n\n"
-                f"من: {ride['pickup_location']}\n"
-                f"إلى: {ride['destination']}\n"
-                f"العميل: {ride['client_name']}\n\n"
-                f"اضغط 'إنهاء الرحلة' عند الوصول للوجهة.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton(f"إنهاء الرحلة ✅", callback_data=f"complete_ride_{ride_id}")
-                ], [
-                    InlineKeyboardButton("رحلاتي النشطة 📋", callback_data='my_active_rides')
-                ]])
-            )
+async def start_ride_callback(query, context, ride_id):
+    user_id = query.from_user.id
+    notification = Notification(
+        None,
+        f"تم بدء رحلتك #{ride_id} 🚖\n\n"
+        f"الكابتن: {query.from_user.first_name}\n"
+        f"في الطريق إليك الآن!",
+        priority=PRIORITY_RIDE
+    )
+    result = await db.start_ride(ride_id, user_id, notification)
+    if result:
+        outbox.wake()
+        ride = result.ride
+        await query.edit_message_text(
+            f"تم بدء الرحلة #{ride_id} بنجاح! 🚖\n\n"
+            f"من: {ride['pickup_location']}\n"
+            f"إلى: {ride['destination']}\n"
+            f"العميل: {ride['client_name']}\n\n"
+            f"اضغط 'إنهاء الرحلة' عند الوصول للوجهة.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton(f"إنهاء الرحلة ✅", callback_data=f"complete_ride_{ride_id}")
+            ], [
+                InlineKeyboardButton("رحلاتي النشطة 📋", callback_data='my_active_rides')
+            ]])
+        )
+    else:
+        await query.edit_message_text(ride_failure_text(
+            result,
+            already_done="الرحلة بدأت بالفعل 🚖",
+            wrong_status="لا يمكن بدء هذه الرحلة، فقد تغيرت حالتها (ربما أُلغيت).",
+            error="حدث خطأ في بدء الرحلة."
+        ))
+
+async def complete_ride_callback(query, context, ride_id):
+    user_id = query.from_user.id
+    # إشعار العميل بإمكانية التقييم والدفع
+    notification = Notification(
+        None,
+        f"تم إنهاء رحلتك #{ride_id} بنجاح! ✅\n\n"
+        f"نتمنى أن تكون قد استمتعت بالرحلة.\n"
+        f"يمكنك تقييم الكابتن ودفع قيمة الرحلة:",
+        priority=PRIORITY_RIDE,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🌟 قييم الكابتن 🌟", callback_data=f"rate_info_{ride_id}")],
+            [
+                InlineKeyboardButton("1⭐", callback_data=f"rate_1_{ride_id}_{user_id}"),
+                InlineKeyboardButton("2⭐⭐", callback_data=f"rate_2_{ride_id}_{user_id}"),
+                InlineKeyboardButton("3⭐⭐⭐", callback_data=f"rate_3_{ride_id}_{user_id}")
+            ],
+            [
+                InlineKeyboardButton("4⭐⭐⭐⭐", callback_data=f"rate_4_{ride_id}_{user_id}"),
+                InlineKeyboardButton("5⭐⭐⭐⭐⭐", callback_data=f"rate_5_{ride_id}_{user_id}")
+            ],
+            [InlineKeyboardButton("💰 ادفع للكابتن الآن", callback_data=f"pay_ride_{ride_id}")]
+        ]).to_dict()
+    )
+    result = await db.complete_ride(ride_id, user_id, notification)
+    if result:
+        outbox.wake()
+        await query.edit_message_text(
+            f"تم إنهاء الرحلة #{ride_id} بنجاح! ✅\n\n"
+            f"شكراً لك على الخدمة المميزة 🙏",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("رحلاتي النشطة 📋", callback_data='my_active_rides')
+            ], [
+                InlineKeyboardButton("عرض رحلات جديدة 🚖", callback_data='view_rides')
+            ]])
+        )
+    else:
+        await query.edit_message_text(ride_failure_text(
+            result,
+            already_done="الرحلة منتهية بالفعل ✅",
+            wrong_status="لا يمكن إنهاء هذه الرحلة، فهي لم تبدأ أو تغيرت حالتها.",
+            error="حدث خطأ في إنهاء الرحلة."
+        ))
+
+async def rate_callback(query, context, rating, ride_id, captain_id):
+    user_id = query.from_user.id
+    if await db.add_rating(ride_id, user_id, captain_id, rating):
+        await query.edit_message_text(
+            f"شكراً لك على التقييم! ⭐\n\n"
+            f"تم إعطاء {rating} نجمة للكابتن.\n"
+            f"تقييمك يساعدنا في تحسين الخدمة.\n\n"
+            f"يمكنك الآن دفع قيمة الرحلة:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("💰 دفع قيمة الرحلة", callback_data=f"pay_ride_{ride_id}")]
+            ])
+        )
+    else:
+        await query.edit_message_text("حدث خطأ في حفظ التقييم.")
 
-            # إشعار العميل
-            try:
-                await context.bot.send_message(
-                    chat_id=ride['client_id'],
-                    text=f"تم بدء رحلتك #{ride_id} 🚖\n\n"
-                    f"الكابتن: {query.from_user.first_name}\n"
-                    f"في الطريق إليك الآن!"
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify client: {e}")
-        else:
-            await query.edit_message_text("حدث خطأ في بدء الرحلة.")
-
-    elif data.startswith('complete_ride_'):
-        ride_id = int(data.split('_')[2])
-        if db.complete_ride(ride_id, user_id):
-            ride = db.get_ride_by_id(ride_id)
-            await query.edit_message_text(
-                f"تم إنهاء الرحلة #{ride_id} بنجاح! ✅\n\n"
-                f"شكراً لك على الخدمة المميزة 🙏",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("رحلاتي النشطة 📋", callback_data='my_active_rides')
-                ], [
-                    InlineKeyboardButton("عرض رحلات جديدة 🚖", callback_data='view_rides')
-                ]])
-            )
+async def pay_ride_callback(query, context, ride_id):
+    user_id = query.from_user.id
+    ride = await db.get_ride_by_id(ride_id)
 
-            # إشعار العميل بإمكانية التقييم والدفع
-            try:
-                await context.bot.send_message(
-                    chat_id=ride['client_id'],
-                    text=f"تم إنهاء رحلتك #{ride_id} بنجاح! ✅\n\n"
-                    f"نتمنى أن تكون قد استمتعت بالرحلة.\n"
-                    f"يمكنك تقييم الكابتن ودفع قيمة الرحلة:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🌟 قييم الكابتن 🌟", callback_data=f"rate_info_{ride_id}")],
-                        [
-                            InlineKeyboardButton("1⭐", callback_data=f"rate_1_{ride_id}_{user_id}"),
-                            InlineKeyboardButton("2⭐⭐", callback_data=f"rate_2_{ride_id}_{user_id}"),
-                            InlineKeyboardButton("3⭐⭐⭐", callback_data=f"rate_3_{ride_id}_{user_id}")
-                        ],
-                        [
-                            InlineKeyboardButton("4⭐⭐⭐⭐", callback_data=f"rate_4_{ride_id}_{user_id}"),
-                            InlineKeyboardButton("5⭐⭐⭐⭐⭐", callback_data=f"rate_5_{ride_id}_{user_id}")
-                        ],
-                        [InlineKeyboardButton("💰 ادفع للكابتن الآن", callback_data=f"pay_ride_{ride_id}")]
-                    ])
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify client: {e}")
-        else:
-            await query.edit_message_text("حدث خطأ في إنهاء الرحلة.")
-
-    elif data.startswith('rate_'):
-        parts = data.split('_')
-        rating = int(parts[1])
-        ride_id = int(parts[2])
-        captain_id = int(parts[3])
-
-        if db.add_rating(ride_id, user_id, captain_id, rating):
-            await query.edit_message_text(
-                f"شكراً لك على التقييم! ⭐\n\n"
-                f"تم إعطاء {rating} نجمة للكابتن.\n"
-                f"تقييمك يساعدنا في تحسين الخدمة.\n\n"
-                f"يمكنك الآن دفع قيمة الرحلة:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💰 دفع قيمة الرحلة", callback_data=f"pay_ride_{ride_id}")]
-                ])
-            )
-        else:
-            await query.edit_message_text("حدث خطأ في حفظ التقييم.")
+    if not ride or ride['client_id'] != user_id:
+        await query.edit_message_text("لا يمكن العثور على الرحلة أو ليست مخصصة لك.")
+        return
 
-    elif data.startswith('pay_ride_'):
-        ride_id = int(data.split('_')[2])
-        ride = db.get_ride_by_id(ride_id)
+    if ride['status'] != 'completed':
+        await query.edit_message_text("يمكن دفع قيمة الرحلة فقط بعد إنهائها.")
+        return
 
-        if not ride or ride['client_id'] != user_id:
-            await query.edit_message_text("لا يمكن العثور على الرحلة أو ليست مخصصة لك.")
-            return
+    # عرض خيارات الدفع للرحلة
+    await query.edit_message_text(
+        f"💳 دفع قيمة الرحلة #{ride_id}\n\n"
+        f"🚗 من: {ride['pickup_location']}\n"
+        f"🏁 إلى: {ride['destination']}\n"
+        f"👤 الكابتن: {ride['captain_name'] or 'غير محدد'}\n\n"
+        f"💰 يرجى إدخال قيمة الرحلة المتفق عليها مع الكابتن:",
+        reply_markup=InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("💰 10 ريال", callback_data=f'ride_amount_10_{ride_id}'),
+                InlineKeyboardButton("💰 15 ريال", callback_data=f'ride_amount_15_{ride_id}')
+            ],
+            [
+                InlineKeyboardButton("💰 20 ريال", callback_data=f'ride_amount_20_{ride_id}'),
+                InlineKeyboardButton("💰 25 ريال", callback_data=f'ride_amount_25_{ride_id}')
+            ],
+            [InlineKeyboardButton("💰 30 ريال", callback_data=f'ride_amount_30_{ride_id}')],
+            [InlineKeyboardButton("العودة ↩️", callback_data='my_rides')]
+        ])
+    )
 
-        if ride['status'] != 'completed':
-            await query.edit_message_text("يمكن دفع قيمة الرحلة فقط بعد إنهائها.")
-            return
+async def ride_amount_callback(query, context, amount, ride_id):
+    user_id = query.from_user.id
+    ride = await db.get_ride_by_id(ride_id)
+    if not ride or ride['client_id'] != user_id:
+        await query.edit_message_text("خطأ في العثور على الرحلة.")
+        return
+
+    # إنشاء طلب دفع للرحلة
+    request_id = await db.create_payment_request(
+        user_id=user_id,
+        payment_type='ride_payment',
+        amount=amount,
+        description=f'دفع رحلة #{ride_id}',
+        ride_id=ride_id
+    )
 
-        # عرض خيارات الدفع للرحلة
+    if request_id:
         await query.edit_message_text(
-            f"💳 دفع قيمة الرحلة #{ride_id}\n\n"
-            f"🚗 من: {ride['pickup_location']}\n"
-            f"🏁 إلى: {ride['destination']}\n"
-            f"👤 الكابتن: {ride['captain_name'] or 'غير محدد'}\n\n"
-            f"💰 يرجى إدخال قيمة الرحلة المتفق عليها مع الكابتن:",
+            f"💳 دفع قيمة الرحلة\n\n"
+            f"💰 المبلغ: {amount} ريال سعودي\n"
+            f"🚗 الرحلة: #{ride_id}\n\n"
+            f"اختر طريقة الدفع:",
             reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("💰 10 ريال", callback_data=f'ride_amount_10_{ride_id}'),
-                    InlineKeyboardButton("💰 15 ريال", callback_data=f'ride_amount_15_{ride_id}')
-                ],
-                [
-                    InlineKeyboardButton("💰 20 ريال", callback_data=f'ride_amount_20_{ride_id}'),
-                    InlineKeyboardButton("💰 25 ريال", callback_data=f'ride_amount_25_{ride_id}')
-                ],
-                [InlineKeyboardButton("💰 30 ريال", callback_data=f'ride_amount_30_{ride_id}')],
+                [InlineKeyboardButton("💵 دفع نقدي للكابتن ⭐ (الأسرع والأفضل)", callback_data=f'payment_method_cash_{request_id}')],
+                [InlineKeyboardButton("📱 STC Pay", callback_data=f'payment_method_stc_{request_id}'), InlineKeyboardButton("🏦 الراجحي", callback_data=f'payment_method_bank_{request_id}')],
+                [InlineKeyboardButton("💰 urpay", callback_data=f'payment_method_urpay_{request_id}'), InlineKeyboardButton("💳 مدى MADA", callback_data=f'payment_method_mada_{request_id}')],
                 [InlineKeyboardButton("العودة ↩️", callback_data='my_rides')]
             ])
         )
+    else:
+        await query.edit_message_text("حدث خطأ في إنشاء طلب الدفع.")
 
-    elif data.startswith('ride_amount_'):
-        parts = data.split('_')
-        amount = float(parts[2])
-        ride_id = int(parts[3])
-
-        ride = db.get_ride_by_id(ride_id)
-        if not ride or ride['client_id'] != user_id:
-            await query.edit_message_text("خطأ في العثور على الرحلة.")
-            return
-
-        # إنشاء طلب دفع للرحلة
-        request_id = db.create_payment_request(
-            user_id=user_id,
-            payment_type='ride_payment',
-            amount=amount,
-            description=f'دفع رحلة #{ride_id}',
-            ride_id=ride_id
+async def my_rides_callback(query, context, cursor: str = None, backward: bool = False):
+    user_id = query.from_user.id
+    page = await db.get_user_rides(user_id, 5, cursor, backward)
+    if not page.items:
+        await query.edit_message_text(
+            "لا توجد رحلات سابقة 😔\n\nيمكنك طلب رحلة جديدة الآن:",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("طلب رحلة فورية 🚗", callback_data='request_ride')
+            ], [
+                InlineKeyboardButton("العودة ↩️", callback_data='client_button')
+            ]])
         )
+        return
 
-        if request_id:
-            await query.edit_message_text(
-                f"💳 دفع قيمة الرحلة\n\n"
-                f"💰 المبلغ: {amount} ريال سعودي\n"
-                f"🚗 الرحلة: #{ride_id}\n\n"
-                f"اختر طريقة الدفع:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💵 دفع نقدي للكابتن ⭐ (الأسرع والأفضل)", callback_data=f'payment_method_cash_{request_id}')],
-                    [InlineKeyboardButton("📱 STC Pay", callback_data=f'payment_method_stc_{request_id}'), InlineKeyboardButton("🏦 الراجحي", callback_data=f'payment_method_bank_{request_id}')],
-                    [InlineKeyboardButton("💰 urpay", callback_data=f'payment_method_urpay_{request_id}'), InlineKeyboardButton("💳 مدى MADA", callback_data=f'payment_method_mada_{request_id}')],
-                    [InlineKeyboardButton("العودة ↩️", callback_data='my_rides')]
-                ])
-            )
-        else:
-            await query.edit_message_text("حدث خطأ في إنشاء طلب الدفع.")
-
-    elif data == 'my_rides':
-        user_rides = db.get_user_rides(user_id, 10)
-        if not user_rides:
-            await query.edit_message_text(
-                "لا توجد رحلات سابقة 😔\n\nيمكنك طلب رحلة جديدة الآن:",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("طلب رحلة فورية 🚗", callback_data='request_ride')
-                ], [
-                    InlineKeyboardButton("العودة ↩️", callback_data='client_button')
-                ]])
-            )
-            return
-
-        message = "رحلاتك 📋:\n\n"
-        keyboard = []
+    message = "رحلاتك 📋:\n\n"
+    keyboard = []
+
+    for ride in page.items:
+        status_emoji = {
+            'pending': '🟡',
+            'accepted': '🟢',
+            'in_progress': '🔵',
+            'completed': '✅',
+            'cancelled': '❌'
+        }.get(ride['status'], '❓')
+
+        status_text = {
+            'pending': 'في الانتظار',
+            'accepted': 'مقبولة',
+            'in_progress': 'قيد التنفيذ',
+            'completed': 'مكتملة',
+            'cancelled': 'ملغية'
+        }.get(ride['status'], 'غير معروف')
+
+        message += f"{status_emoji} رحلة #{ride['ride_id']}\n"
+        message += f"   من: {ride['pickup_location']}\n"
+        message += f"   إلى: {ride['destination']}\n"
+        message += f"   الحالة: {status_text}\n"
+        if ride['price']:
+            message += f"   السعر: {ride['price']} ريال\n"
+        message += "\n"
+
+        # إضافة أزرار حسب حالة الرحلة
+        if ride['status'] == 'pending':
+            keyboard.append([InlineKeyboardButton(
+                f"إلغاء الرحلة #{ride['ride_id']} ❌",
+                callback_data=f"cancel_ride_{ride['ride_id']}"
+            )])
 
-        for ride in user_rides[:5]:  # عرض أول 5 رحلات
-            status_emoji = {
-                'pending': '🟡',
-                'accepted': '🟢',
-                'in_progress': '🔵',
-                'completed': '✅',
-                'cancelled': '❌'
-            }.get(ride['status'], '❓')
-
-            status_text = {
-                'pending': 'في الانتظار',
-                'accepted': 'مقبولة',
-                'in_progress': 'قيد التنفيذ',
-                'completed': 'مكتملة',
-                'cancelled': 'ملغية'
-            }.get(ride['status'], 'غير معروف')
-
-            message += f"{status_emoji} رحلة #{ride['ride_id']}\n"
-            message += f"   من: {ride['pickup_location']}\n"
-            message += f"   إلى: {ride['destination']}\n"
-            message += f"   الحالة: {status_text}\n"
-            if ride['price']:
-                message += f"   السعر: {ride['price']} ريال\n"
-            message += "\n"
+    keyboard.extend(page_buttons('mr', page))
+    keyboard.append([InlineKeyboardButton("طلب رحلة جديدة 🚗", callback_data='request_ride')])
+    keyboard.append([InlineKeyboardButton("العودة ↩️", callback_data='client_button')])
 
-            # إضافة أزرار حسب حالة الرحلة
-            if ride['status'] == 'pending':
-                keyboard.append([InlineKeyboardButton(
-                    f"إلغاء الرحلة #{ride['ride_id']} ❌",
-                    callback_data=f"cancel_ride_{ride['ride_id']}"
-                )])
-
-        keyboard.append([InlineKeyboardButton("طلب رحلة جديدة 🚗", callback_data='request_ride')])
-        keyboard.append([InlineKeyboardButton("العودة ↩️", callback_data='client_button')])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
-
-    elif data.startswith('cancel_ride_'):
-        ride_id = int(data.split('_')[2])
-        if db.cancel_ride(ride_id, user_id):
-            await query.edit_message_text(
-                f"تم إلغاء الرحلة #{ride_id} بنجاح ❌\n\n"
-                f"يمكنك طلب رحلة جديدة في أي وقت.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("طلب رحلة جديدة 🚗", callback_data='request_ride')
-                ], [
-                    InlineKeyboardButton("رحلاتي 📋", callback_data='my_rides')
-                ]])
-            )
-        else:
-            await query.edit_message_text("لا يمكن إلغاء هذه الرحلة.")
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_if_changed(query, message, reply_markup=reply_markup)
 
-    elif data == 'pay_subscription':
-        # إنشاء طلب دفع اشتراك
-        request_id = db.create_payment_request(
-            user_id=user_id,
-            payment_type='subscription_payment',
-            amount=10.0,
-            description='اشتراك كابتن - شهر واحد',
-            subscription_days=30
+async def cancel_ride_callback(query, context, ride_id):
+    user_id = query.from_user.id
+    result = await db.cancel_ride(ride_id, user_id)
+    if result:
+        await query.edit_message_text(
+            f"تم إلغاء الرحلة #{ride_id} بنجاح ❌\n\n"
+            f"يمكنك طلب رحلة جديدة في أي وقت.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("طلب رحلة جديدة 🚗", callback_data='request_ride')
+            ], [
+                InlineKeyboardButton("رحلاتي 📋", callback_data='my_rides')
+            ]])
         )
+    else:
+        await query.edit_message_text(ride_failure_text(
+            result,
+            already_done="الرحلة ملغية بالفعل ❌",
+            wrong_status="لا يمكن إلغاء هذه الرحلة بعد بدئها أو انتهائها.",
+            error="حدث خطأ في إلغاء الرحلة."
+        ))
+
+async def pay_subscription_callback(query, context):
+    user_id = query.from_user.id
+    # إنشاء طلب دفع اشتراك
+    request_id = await db.create_payment_request(
+        user_id=user_id,
+        payment_type='subscription_payment',
+        amount=10.0,
+        description='اشتراك كابتن - شهر واحد',
+        subscription_days=30
+    )
 
-        if request_id:
-            await query.edit_message_text(
-                "💳 دفع اشتراك الكباتن\n\n"
-                "💰 المبلغ: 10 ريال سعودي\n"
-                "⏰ المدة: شهر واحد (30 يوم)\n\n"
-                "اختر طريقة الدفع المناسبة:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💳 STC Pay", callback_data=f'payment_method_stc_{request_id}')],
-                    [InlineKeyboardButton("🏦 حوالة بنكية", callback_data=f'payment_method_bank_{request_id}')],
-                    [InlineKeyboardButton("💰 يور باي urpay", callback_data=f'payment_method_urpay_{request_id}')],
-                    [InlineKeyboardButton("💳 مدى MADA", callback_data=f'payment_method_mada_{request_id}')],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data='captain_button')]
-                ])
-            )
-        else:
-            await query.edit_message_text("حدث خطأ في إنشاء طلب الدفع. يرجى المحاولة مرة أخرى.")
-
-    elif data.startswith('payment_method_'):
-        parts = data.split('_')
-        payment_method = parts[2]
-        request_id = int(parts[3])
+    if request_id:
+        await query.edit_message_text(
+            "💳 دفع اشتراك الكباتن\n\n"
+            "💰 المبلغ: 10 ريال سعودي\n"
+            "⏰ المدة: شهر واحد (30 يوم)\n\n"
+            "اختر طريقة الدفع المناسبة:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 STC Pay", callback_data=f'payment_method_stc_{request_id}')],
+                [InlineKeyboardButton("🏦 حوالة بنكية", callback_data=f'payment_method_bank_{request_id}')],
+                [InlineKeyboardButton("💰 يور باي urpay", callback_data=f'payment_method_urpay_{request_id}')],
+                [InlineKeyboardButton("💳 مدى MADA", callback_data=f'payment_method_mada_{request_id}')],
+                [InlineKeyboardButton("❌ إلغاء", callback_data='captain_button')]
+            ])
+        )
+    else:
+        await query.edit_message_text("حدث خطأ في إنشاء طلب الدفع. يرجى المحاولة مرة أخرى.")
 
-        payment_request = db.get_payment_request(request_id)
-        if not payment_request or payment_request['user_id'] != user_id:
-            await query.edit_message_text("طلب الدفع غير صحيح أو منتهي الصلاحية.")
-            return
+async def payment_method_callback(query, context, payment_method, request_id):
+    user_id = query.from_user.id
+    payment_request = await db.get_payment_request(request_id)
+    if not payment_request or payment_request['user_id'] != user_id:
+        await query.edit_message_text("طلب الدفع غير صحيح أو منتهي الصلاحية.")
+        return
 
-        # معلومات الدفع حسب الطريقة
-        payment_info = {
-            'cash': {
-                'name': 'الدفع النقدي',
-                'details': '💵 ادفع نقداً للكابتن مباشرة\n✅ الطريقة الأسرع والأسهل',
-                'instructions': 'قم بدفع المبلغ نقداً للكابتن في نهاية الرحلة ثم اضغط "تم الدفع"'
-            },
-            'stc': {
-                'name': 'STC Pay',
-                'details': '📱 رقم STC Pay: 0501234567\n👤 باسم: إدارة مشاوير مكة',
-                'instructions': 'قم بتحويل المبلغ عبر STC Pay ثم أرسل لقطة شاشة للتحويل'
-            },
-            'bank': {
-                'name': 'الحوالة البنكية',
-                'details': '🏦 البنك: الراجحي\n💳 رقم الحساب: 123456789\n👤 باسم: إدارة مشاوير مكة',
-                'instructions': 'قم بتحويل المبلغ ثم أرسل صورة إيصال التحويل'
-            },
-            'urpay': {
-                'name': 'يور باي urpay',
-                'details': '📱 رقم urpay: 0501234567\n👤 باسم: إدارة مشاوير مكة',
-                'instructions': 'قم بتحويل المبلغ عبر urpay ثم أرسل لقطة شاشة للتحويل'
-            },
-            'mada': {
-                'name': 'مدى MADA',
-                'details': '💳 رقم البطاقة: 1234-5678-9012-3456\n👤 باسم: إدارة مشاوير مكة',
-                'instructions': 'قم بتحويل المبلغ ثم أرسل إيصال التحويل'
-            }
+    # معلومات الدفع حسب الطريقة
+    payment_info = {
+        'cash': {
+            'name': 'الدفع النقدي',
+            'details': '💵 ادفع نقداً للكابتن مباشرة\n✅ الطريقة الأسرع والأسهل',
+            'instructions': 'قم بدفع المبلغ نقداً للكابتن في نهاية الرحلة ثم اضغط "تم الدفع"'
+        },
+        'stc': {
+            'name': 'STC Pay',
+            'details': '📱 رقم STC Pay: 0501234567\n👤 باسم: إدارة مشاوير مكة',
+            'instructions': 'قم بتحويل المبلغ عبر STC Pay ثم أرسل لقطة شاشة للتحويل'
+        },
+        'bank': {
+            'name': 'الحوالة البنكية',
+            'details': '🏦 البنك: الراجحي\n💳 رقم الحساب: 123456789\n👤 باسم: إدارة مشاوير مكة',
+            'instructions': 'قم بتحويل المبلغ ثم أرسل صورة إيصال التحويل'
+        },
+        'urpay': {
+            'name': 'يور باي urpay',
+            'details': '📱 رقم urpay: 0501234567\n👤 باسم: إدارة مشاوير مكة',
+            'instructions': 'قم بتحويل المبلغ عبر urpay ثم أرسل لقطة شاشة للتحويل'
+        },
+        'mada': {
+            'name': 'مدى MADA',
+            'details': '💳 رقم البطاقة: 1234-5678-9012-3456\n👤 باسم: إدارة مشاوير مكة',
+            'instructions': 'قم بتحويل المبلغ ثم أرسل إيصال التحويل'
         }
+    }
 
-        info = payment_info.get(payment_method, payment_info['stc'])
-
-        # خاص للدفع النقدي - لا يحتاج إثبات دفع
-        if payment_method == 'cash':
-            await query.edit_message_text(
-                f"💵 {info['name']}\n\n"
-                f"💰 المبلغ المطلوب: {payment_request['amount']} ريال\n\n"
-                f"{info['details']}\n\n"
-                f"📋 التعليمات:\n"
-                f"{info['instructions']}\n\n"
-                f"✅ بعد دفع المبلغ للكابتن، اضغط 'تم الدفع' للتأكيد",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ تم الدفع نقداً للكابتن 💵", callback_data=f'cash_paid_{request_id}')],
-                    [InlineKeyboardButton("🔄 تغيير طريقة الدفع", callback_data=f'pay_ride_{payment_request.get("ride_id", "")}'  if payment_request.get('payment_type') == 'ride_payment' else 'pay_subscription')],
-                    [InlineKeyboardButton("العودة ↩️", callback_data='my_rides' if payment_request.get('payment_type') == 'ride_payment' else 'captain_button')]
-                ])
-            )
-        else:
-            # الطرق الرقمية - تحتاج إثبات دفع
-            await query.edit_message_text(
-                f"💳 الدفع عبر {info['name']}\n\n"
-                f"💰 المبلغ المطلوب: {payment_request['amount']} ريال\n\n"
-                f"{info['details']}\n\n"
-                f"📋 التعليمات:\n"
-                f"{info['instructions']}\n\n"
-                f"⚠️ ملاحظة: أرسل إثبات الدفع كصورة في هذه المحادثة",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ تم الدفع - إرسال الإثبات", callback_data=f'payment_proof_{request_id}_{payment_method}')],
-                    [InlineKeyboardButton("🔄 تغيير طريقة الدفع", callback_data=f'pay_ride_{payment_request.get("ride_id", "")}' if payment_request.get('payment_type') == 'ride_payment' else 'pay_subscription')],
-                    [InlineKeyboardButton("العودة ↩️", callback_data='my_rides' if payment_request.get('payment_type') == 'ride_payment' else 'captain_button')]
-                ])
-            )
+    info = payment_info.get(payment_method, payment_info['stc'])
 
-    elif data.startswith('cash_paid_'):
-        request_id = int(data.split('_')[2])
-        payment_request = db.get_payment_request(request_id)
+    # خاص للدفع النقدي - لا يحتاج إثبات دفع
+    if payment_method == 'cash':
+        await query.edit_message_text(
+            f"💵 {info['name']}\n\n"
+            f"💰 المبلغ المطلوب: {payment_request['amount']} ريال\n\n"
+            f"{info['details']}\n\n"
+            f"📋 التعليمات:\n"
+            f"{info['instructions']}\n\n"
+            f"✅ بعد دفع المبلغ للكابتن، اضغط 'تم الدفع' للتأكيد",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ تم الدفع نقداً للكابتن 💵", callback_data=f'cash_paid_{request_id}')],
+                [InlineKeyboardButton("🔄 تغيير طريقة الدفع", callback_data=f'pay_ride_{payment_request.get("ride_id", "")}'  if payment_request.get('payment_type') == 'ride_payment' else 'pay_subscription')],
+                [InlineKeyboardButton("العودة ↩️", callback_data='my_rides' if payment_request.get('payment_type') == 'ride_payment' else 'captain_button')]
+            ])
+        )
+    else:
+        # الطرق الرقمية - تحتاج إثبات دفع
+        await query.edit_message_text(
+            f"💳 الدفع عبر {info['name']}\n\n"
+            f"💰 المبلغ المطلوب: {payment_request['amount']} ريال\n\n"
+            f"{info['details']}\n\n"
+            f"📋 التعليمات:\n"
+            f"{info['instructions']}\n\n"
+            f"⚠️ ملاحظة: أرسل إثبات الدفع كصورة في هذه المحادثة",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ تم الدفع - إرسال الإثبات", callback_data=f'payment_proof_{request_id}_{payment_method}')],
+                [InlineKeyboardButton("🔄 تغيير طريقة الدفع", callback_data=f'pay_ride_{payment_request.get("ride_id", "")}' if payment_request.get('payment_type') == 'ride_payment' else 'pay_subscription')],
+                [InlineKeyboardButton("العودة ↩️", callback_data='my_rides' if payment_request.get('payment_type') == 'ride_payment' else 'captain_button')]
+            ])
+        )
 
-        if not payment_request or payment_request['user_id'] != user_id:
-            await query.edit_message_text("طلب الدفع غير صحيح أو منتهي الصلاحية.")
-            return
+async def cash_paid_callback(query, context, request_id):
+    user_id = query.from_user.id
+    payment_request = await db.get_payment_request(request_id)
 
-        # إنشاء دفعة نقدية مع تأكيد فوري
-        try:
-            payment_id = db.create_payment_record(
-                user_id=user_id,
-                payment_type=payment_request['payment_type'],
-                amount=payment_request['amount'],
-                payment_method='cash',
-                ride_id=payment_request.get('ride_id'),
-                payment_proof_url=None,  # لا يوجد إثبات للنقد
-                notes=f"Cash payment for {payment_request['payment_type']} - Request ID: {request_id}"
-            )
-            logger.info(f"Created cash payment record with ID: {payment_id} for user {user_id}")
-        except Exception as e:
-            logger.error(f"Error creating cash payment record: {e}")
-            payment_id = None
+    if not payment_request or payment_request['user_id'] != user_id:
+        await query.edit_message_text("طلب الدفع غير صحيح أو منتهي الصلاحية.")
+        return
 
-        if payment_id:
-            # تحديث حالة طلب الدفع
-            db.update_payment_request_status(request_id, 'completed')
+    # إشعار الإدارة بالدفع النقدي (رقم الدفعة يُعرف داخل المعاملة)
+    ride_info = ""
+    if payment_request.get('ride_id'):
+        ride_info = f"🚗 رقم الرحلة: {payment_request['ride_id']}\n"
+
+    notification = Notification(
+        ADMIN_CHAT_ID,
+        lambda payment_id: f"💵 دفع نقدي جديد\n\n"
+        f"👤 العميل: {query.from_user.first_name}\n"
+        f"🆔 معرف العميل: {user_id}\n"
+        f"💰 المبلغ: {payment_request['amount']} ريال\n"
+        f"📋 النوع: {payment_request['payment_type']}\n"
+        f"{ride_info}"
+        f"🆔 Payment ID: {payment_id}\n\n"
+        f"✅ تم التأكيد تلقائياً (دفع نقدي)",
+        priority=PRIORITY_PAYMENT
+    )
 
-            await query.edit_message_text(
-                "✅ تم تأكيد الدفع النقدي!\n\n"
-                "💵 تم استلام الدفع نقداً من الكابتن\n"
-                "🙏 شكراً لاستخدام خدماتنا"
-            )
+    # إنشاء دفعة نقدية مع تأكيد فوري، وإغلاق طلب الدفع وإشعار الإدارة في نفس المعاملة
+    payment_id = await db.create_cash_payment(
+        request_id=request_id,
+        user_id=user_id,
+        payment_type=payment_request['payment_type'],
+        amount=payment_request['amount'],
+        ride_id=payment_request.get('ride_id'),
+        notes=f"Cash payment for {payment_request['payment_type']} - Request ID: {request_id}",
+        notification=notification
+    )
 
-            # إشعار الإدارة بالدفع النقدي
-            try:
-                ride_info = ""
-                if payment_request.get('ride_id'):
-                    ride_info = f"🚗 رقم الرحلة: {payment_request['ride_id']}\n"
-
-                await context.bot.send_message(
-                    chat_id=ADMIN_CHAT_ID,
-                    text=f"💵 دفع نقدي جديد\n\n"
-                    f"👤 العميل: {update.effective_user.first_name}\n"
-                    f"🆔 معرف العميل: {user_id}\n"
-                    f"💰 المبلغ: {payment_request['amount']} ريال\n"
-                    f"📋 النوع: {payment_request['payment_type']}\n"
-                    f"{ride_info}"
-                    f"🆔 Payment ID: {payment_id}\n\n"
-                    f"✅ تم التأكيد تلقائياً (دفع نقدي)"
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify admin about cash payment: {e}")
-
-            # تفعيل الاشتراك إذا كان الدفع للاشتراك
-            if payment_request['payment_type'] == 'subscription':
-                if db.add_subscription(user_id, 30, payment_request['amount']):
-                    await update.effective_user.send_message(
-                        "🎉 تم تفعيل اشتراكك بنجاح!\n\n"
-                        "⏰ مدة الاشتراك: 30 يوم\n"
-                        "✅ يمكنك الآن الوصول لجميع الرحلات المتاحة"
-                    )
-        else:
-            logger.error(f"Failed to create cash payment record for request {request_id}")
-            await query.edit_message_text("حدث خطأ في معالجة الدفع. يرجى المحاولة مرة أخرى.")
+    if payment_id:
+        logger.info(f"Created cash payment record with ID: {payment_id} for user {user_id}")
+        outbox.wake()
 
-    elif data.startswith('payment_proof_'):
-        parts = data.split('_')
-        request_id = int(parts[2])
-        payment_method = parts[3]
+        await query.edit_message_text(
+            "✅ تم تأكيد الدفع النقدي!\n\n"
+            "💵 تم استلام الدفع نقداً من الكابتن\n"
+            "🙏 شكراً لاستخدام خدماتنا"
+        )
 
-        payment_request = db.get_payment_request(request_id)
-        if not payment_request or payment_request['user_id'] != user_id:
-            await query.edit_message_text("طلب الدفع غير صحيح أو منتهي الصلاحية.")
-            return
+        # تفعيل الاشتراك إذا كان الدفع للاشتراك
+        if payment_request['payment_type'] == 'subscription':
+            if await db.add_subscription(user_id, 30, payment_request['amount']):
+                await query.from_user.send_message(
+                    "🎉 تم تفعيل اشتراكك بنجاح!\n\n"
+                    "⏰ مدة الاشتراك: 30 يوم\n"
+                    "✅ يمكنك الآن الوصول لجميع الرحلات المتاحة"
+                )
+    else:
+        logger.error(f"Failed to create cash payment record for request {request_id}")
+        await query.edit_message_text("حدث خطأ في معالجة الدفع. يرجى المحاولة مرة أخرى.")
 
-        # تحديث حالة طلب الدفع لانتظار الإثبات
-        db.update_payment_request_status(request_id, 'awaiting_proof')
+async def payment_proof_callback(query, context, request_id, payment_method):
+    user_id = query.from_user.id
+    payment_request = await db.get_payment_request(request_id)
+    if not payment_request or payment_request['user_id'] != user_id:
+        await query.edit_message_text("طلب الدفع غير صحيح أو منتهي الصلاحية.")
+        return
 
-        # حفظ معلومات الدفع في بيانات المستخدم للمعالجة اللاحقة
-        context.user_data['payment_request_id'] = request_id
-        context.user_data['payment_method'] = payment_method
-        context.user_data['awaiting_payment_proof'] = True
+    # تحديث حالة طلب الدفع لانتظار الإثبات
+    await db.update_payment_request_status(request_id, 'awaiting_proof')
+
+    # حفظ معلومات الدفع في بيانات المستخدم للمعالجة اللاحقة
+    context.user_data['payment_request_id'] = request_id
+    context.user_data['payment_method'] = payment_method
+    context.user_data['awaiting_payment_proof'] = True
+
+    await query.edit_message_text(
+        "📷 يرجى إرسال صورة إثبات الدفع الآن\n\n"
+        "✅ تأكد من وضوح المبلغ وتاريخ التحويل في الصورة\n"
+        "⏰ سيتم مراجعة الدفع خلال 24 ساعة كحد أقصى\n\n"
+        "💡 نصيحة: اضغط على الصورة ثم اختر 'إرسال كصورة' وليس كملف",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ إلغاء", callback_data='captain_button')]
+        ])
+    )
 
+async def my_payments_callback(query, context):
+    user_id = query.from_user.id
+    user_payments = await db.get_user_payments(user_id, 5)
+    if not user_payments:
         await query.edit_message_text(
-            "📷 يرجى إرسال صورة إثبات الدفع الآن\n\n"
-            "✅ تأكد من وضوح المبلغ وتاريخ التحويل في الصورة\n"
-            "⏰ سيتم مراجعة الدفع خلال 24 ساعة كحد أقصى\n\n"
-            "💡 نصيحة: اضغط على الصورة ثم اختر 'إرسال كصورة' وليس كملف",
+            "📊 لا توجد دفعات سابقة\n\n"
+            "يمكنك دفع اشتراك الكباتن للحصول على وصول كامل للرحلات المتاحة",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ إلغاء", callback_data='captain_button')]
+                [InlineKeyboardButton("💳 دفع الاشتراك", callback_data='pay_subscription')],
+                [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
             ])
         )
+        return
 
-    elif data == 'my_payments':
-        user_payments = db.get_user_payments(user_id, 5)
-        if not user_payments:
-            await query.edit_message_text(
-                "📊 لا توجد دفعات سابقة\n\n"
-                "يمكنك دفع اشتراك الكباتن للحصول على وصول كامل للرحلات المتاحة",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💳 دفع الاشتراك", callback_data='pay_subscription')],
-                    [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
-                ])
-            )
-            return
-
-        message = "📊 حالة دفعاتك:\n\n"
+    message = "📊 حالة دفعاتك:\n\n"
 
-        for payment in user_payments:
-            status_emoji = {
-                'pending': '⏳',
-                'completed': '✅',
-                'failed': '❌',
-                'refunded': '↩️'
-            }.get(payment['payment_status'], '❓')
+    for payment in user_payments:
+        status_emoji = {
+            'pending': '⏳',
+            'completed': '✅',
+            'failed': '❌',
+            'refunded': '↩️'
+        }.get(payment['payment_status'], '❓')
 
-            status_text = {
-                'pending': 'قيد المراجعة',
-                'completed': 'مكتملة',
-                'failed': 'مرفوضة',
-                'refunded': 'مردودة'
-            }.get(payment['payment_status'], 'غير معروف')
+        status_text = {
+            'pending': 'قيد المراجعة',
+            'completed': 'مكتملة',
+            'failed': 'مرفوضة',
+            'refunded': 'مردودة'
+        }.get(payment['payment_status'], 'غير معروف')
 
-            message += f"{status_emoji} {payment['amount']} ريال\n"
-            message += f"📅 {payment['created_at'][:16]}\n"
-            message += f"💳 {payment['payment_method']}\n"
-            message += f"📊 {status_text}\n\n"
+        message += f"{status_emoji} {payment['amount']} ريال\n"
+        message += f"📅 {payment['created_at'][:16]}\n"
+        message += f"💳 {payment['payment_method']}\n"
+        message += f"📊 {status_text}\n\n"
 
-        keyboard = [
-            [InlineKeyboardButton("💳 دفع اشتراك جديد", callback_data='pay_subscription')],
-            [InlineKeyboardButton("🔄 تحديث", callback_data='my_payments')],
-            [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
-        ]
+    keyboard = [
+        [InlineKeyboardButton("💳 دفع اشتراك جديد", callback_data='pay_subscription')],
+        [InlineKeyboardButton("🔄 تحديث", callback_data='my_payments')],
+        [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
+    ]
 
-        try:
-            await query.edit_message_text(
-                message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                logger.info("Payment list not modified, skipping update.")
-                await query.answer("لا توجد تحديثات.")
-            else:
-                logger.error(f"Error updating payment list: {e}")
-                raise
+    await edit_if_changed(query, message, reply_markup=InlineKeyboardMarkup(keyboard))
 
-    elif data == 'subscribe_button':
-        subscription_message = """لالشتراك في المجموعة، يرجى التواصل مع الإدارة عبر المعرف التالي:
+async def subscribe_button_callback(query, context):
+    subscription_message = """لالشتراك في المجموعة، يرجى التواصل مع الإدارة عبر المعرف التالي:
 
 @novacompnay"""
 
-        keyboard = [
-            [InlineKeyboardButton("التواصل مع الإدارة 📞", url="https://t.me/novacompnay")],
-            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='main_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            subscription_message,
-            reply_markup=reply_markup
-        )
+    keyboard = [
+        [InlineKeyboardButton("التواصل مع الإدارة 📞", url="https://t.me/novacompnay")],
+        [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='main_menu')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        subscription_message,
+        reply_markup=reply_markup
+    )
 
-    elif data == 'warning_button':
-        warning_message = """⚠️ تنبيه الأسعار ⚠️
+async def warning_button_callback(query, context):
+    warning_message = """⚠️ تنبيه الأسعار ⚠️
 
 نتمنى من جميع العملاء عدم بخس الأسعار في الخاص أو العام.
 
@@ -861,43 +980,120 @@ async def button_callback(update: Update, context):
 
 نأمل الالتزام من الجميع وشاكرين ومقدرين لتعاونكم."""
 
-        keyboard = [
-            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='main_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            warning_message,
-            reply_markup=reply_markup
-        )
+    keyboard = [
+        [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='main_menu')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        warning_message,
+        reply_markup=reply_markup
+    )
 
-    elif data == 'ads_button':
-        ads_message = """الاستفسار عن باقات إعلاناتكم 📢
+async def ads_button_callback(query, context):
+    ads_message = """الاستفسار عن باقات إعلاناتكم 📢
 
 للاستفسار عن باقات الإعلانات المدفوعة والأسعار، يرجى التواصل مع الإدارة مباشرة."""
 
-        keyboard = [
-            [InlineKeyboardButton("التواصل مع الإدارة 📞", url="https://t.me/novacompnay")],
-            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='main_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            ads_message,
-            reply_markup=reply_markup
-        )
+    keyboard = [
+        [InlineKeyboardButton("التواصل مع الإدارة 📞", url="https://t.me/novacompnay")],
+        [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='main_menu')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        ads_message,
+        reply_markup=reply_markup
+    )
 
-    elif data == 'main_menu':
-        keyboard = [
-            [InlineKeyboardButton("🧑‍💼 أريد طلب رحلة (عميل)", callback_data='client_button')],
-            [InlineKeyboardButton("🚗 أريد توصيل الناس (كابتن)", callback_data='captain_button')],
-            [InlineKeyboardButton("💳 اشتراك الكباتن", callback_data='subscribe_button'), InlineKeyboardButton("⚠️ تنبيه مهم", callback_data='warning_button')],
-            [InlineKeyboardButton("📞 التواصل مع الإدارة", url="https://t.me/novacompnay")],
-            [InlineKeyboardButton("📢 الاستفسار عن باقات الإعلانات", callback_data='ads_button')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            'أهلاً بكم في مجموعة "مشاوير مكة اليومية"!\n\nاختر نوع حسابك للمتابعة:',
-            reply_markup=reply_markup
-        )
+async def main_menu_callback(query, context):
+    keyboard = [
+        [InlineKeyboardButton("🧑‍💼 أريد طلب رحلة (عميل)", callback_data='client_button')],
+        [InlineKeyboardButton("🚗 أريد توصيل الناس (كابتن)", callback_data='captain_button')],
+        [InlineKeyboardButton("💳 اشتراك الكباتن", callback_data='subscribe_button'), InlineKeyboardButton("⚠️ تنبيه مهم", callback_data='warning_button')],
+        [InlineKeyboardButton("📞 التواصل مع الإدارة", url="https://t.me/novacompnay")],
+        [InlineKeyboardButton("📢 الاستفسار عن باقات الإعلانات", callback_data='ads_button')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        'أهلاً بكم في مجموعة "مشاوير مكة اليومية"!\n\nاختر نوع حسابك للمتابعة:',
+        reply_markup=reply_markup
+    )
+
+# ============ التنقل بين الصفحات ============
+
+def page_buttons(code: str, page) -> list:
+    """صف أزرار السابق/التالي لصفحة من قائمة، أو لا شيء إذا كانت القائمة صفحة واحدة"""
+    row = []
+    if page.prev_cursor:
+        row.append(InlineKeyboardButton("◀️ السابق", callback_data=f"page_{code}_p_{page.prev_cursor}"))
+    if page.next_cursor:
+        row.append(InlineKeyboardButton("التالي ▶️", callback_data=f"page_{code}_n_{page.next_cursor}"))
+    return [row] if row else []
+
+def page_markup(code: str, page):
+    buttons = page_buttons(code, page)
+    return InlineKeyboardMarkup(buttons) if buttons else None
+
+def add_page_route(code: str, handler):
+    """تسجيل أزرار التنقل لقائمة: page_<code>_<n|p>_<cursor>"""
+    async def page_callback(query, context, direction: str, cursor: str):
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            return
+        if direction in ('n', 'p'):
+            await handler(query, context, cursor, direction == 'p')
+
+    callbacks.add_prefix(f'page_{code}_', page_callback, str, str)
+
+def admin_page(render):
+    """معالج صفحة لقائمة إدارية: يتحقق من المشرف ثم يعرض الصفحة المطلوبة في نفس الرسالة"""
+    async def handler(query, context, cursor: str, backward: bool):
+        if str(query.from_user.id) != ADMIN_CHAT_ID:
+            return
+        message, reply_markup = await render(cursor, backward)
+        await edit_if_changed(query, message, reply_markup=reply_markup)
+
+    return handler
+
+# جدول توجيه بيانات الأزرار إلى معالجاتها
+callbacks = CallbackRouter()
+callbacks.add('client_button', client_button_callback)
+callbacks.add('captain_button', captain_button_callback)
+callbacks.add('request_ride', request_ride_callback)
+callbacks.add('view_rides', view_rides_callback)
+add_page_route('vr', view_rides_callback)
+callbacks.add('nearby_rides', nearby_rides_callback)
+callbacks.add_prefix('accept_ride_', accept_ride_callback, int)
+callbacks.add_prefix('publish_request_', publish_request_callback, int)
+callbacks.add('my_active_rides', my_active_rides_callback)
+callbacks.add_prefix('start_ride_', start_ride_callback, int)
+callbacks.add_prefix('complete_ride_', complete_ride_callback, int)
+callbacks.add_prefix('rate_', rate_callback, int, int, int)
+callbacks.add_prefix('pay_ride_', pay_ride_callback, int)
+callbacks.add_prefix('ride_amount_', ride_amount_callback, float, int)
+callbacks.add('my_rides', my_rides_callback)
+add_page_route('mr', my_rides_callback)
+callbacks.add_prefix('cancel_ride_', cancel_ride_callback, int)
+callbacks.add('pay_subscription', pay_subscription_callback)
+callbacks.add_prefix('payment_method_', payment_method_callback, str, int)
+callbacks.add_prefix('cash_paid_', cash_paid_callback, int)
+callbacks.add_prefix('payment_proof_', payment_proof_callback, int, str)
+callbacks.add('my_payments', my_payments_callback)
+callbacks.add('subscribe_button', subscribe_button_callback)
+callbacks.add('warning_button', warning_button_callback)
+callbacks.add('ads_button', ads_button_callback)
+callbacks.add('main_menu', main_menu_callback)
+
+# معالج الأزرار التفاعلية
+async def button_callback(update: Update, context):
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+    logger.info(f"Button callback received: {data} from user {query.from_user.id}")
+
+    # التوجيه حسب جدول callbacks بدلاً من سلسلة if/elif
+    await callbacks.dispatch(query, context, data)
 
 # معالج المواقع
 async def location_handler(update: Update, context):
@@ -934,27 +1130,17 @@ async def location_handler(update: Update, context):
         distance = calculate_distance(pickup_lat, pickup_lon, location.latitude, location.longitude)
 
         # إنشاء الرحلة مع الإحداثيات
-        ride_id = db.create_ride(
+        ride_id = await db.create_ride(
             client_id=user_id,
             pickup_location=pickup_location,
-            destination=destination_location
+            destination=destination_location,
+            pickup_latitude=pickup_lat,
+            pickup_longitude=pickup_lon,
+            destination_latitude=location.latitude,
+            destination_longitude=location.longitude
         )
 
-        # تحديث الإحداثيات في قاعدة البيانات
         if ride_id:
-            try:
-                with sqlite3.connect(db.db_path) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE rides SET
-                        pickup_latitude = ?, pickup_longitude = ?,
-                        destination_latitude = ?, destination_longitude = ?
-                        WHERE ride_id = ?
-                    """, (pickup_lat, pickup_lon, location.latitude, location.longitude, ride_id))
-                    conn.commit()
-            except Exception as e:
-                logger.error(f"Failed to update coordinates: {e}")
-
             pickup_maps = context.user_data.get('pickup_maps', '')
             await update.message.reply_text(
                 f"تم إنشاء طلب الرحلة بنجاح! ✅\n\n"
@@ -971,6 +1157,66 @@ async def location_handler(update: Update, context):
         else:
             await update.message.reply_text("حدث خطأ في إنشاء الرحلة. يرجى المحاولة مرة أخرى.")
 
+    elif step == 'waiting_captain_location':
+        context.user_data.pop('step', None)
+        rides = await db.get_nearby_pending_rides(
+            location.latitude, location.longitude, radius_km=NEARBY_RADIUS_KM
+        )
+
+        if not rides:
+            await update.message.reply_text(
+                f"لا توجد رحلات متاحة في نطاق {NEARBY_RADIUS_KM:g} كم منك حالياً 😔",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            await update.message.reply_text(
+                "يمكنك عرض جميع الرحلات المتاحة أو المحاولة لاحقاً:",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🚖 عرض الرحلات المتاحة", callback_data='view_rides')],
+                    [InlineKeyboardButton("📍 إعادة البحث", callback_data='nearby_rides')],
+                    [InlineKeyboardButton("العودة ↩️", callback_data='captain_button')]
+                ])
+            )
+            return
+
+        await update.message.reply_text("تم استلام موقعك ✅", reply_markup=ReplyKeyboardRemove())
+
+        message = "أقرب الرحلات إليك 📍:\n\n"
+        keyboard = []
+
+        for ride in rides:
+            pickup_maps = f"https://maps.google.com/?q={ride['pickup_latitude']},{ride['pickup_longitude']}"
+            message += f"🆔 رحلة #{ride['ride_id']}\n"
+            message += f"📏 يبعد عنك: {ride['pickup_distance']:.1f} كم\n"
+            message += f"📍 [موقع الانطلاق]({pickup_maps})\n"
+
+            if ride.get('destination_latitude') and ride.get('destination_longitude'):
+                dest_maps = f"https://maps.google.com/?q={ride['destination_latitude']},{ride['destination_longitude']}"
+                message += f"🏁 [موقع الوجهة]({dest_maps})\n"
+                distance = calculate_distance(
+                    ride['pickup_latitude'], ride['pickup_longitude'],
+                    ride['destination_latitude'], ride['destination_longitude']
+                )
+                message += f"📏 مسافة الرحلة: {distance:.1f} كم\n"
+
+            if ride['price']:
+                message += f"💰 السعر: {ride['price']} ريال\n"
+            message += f"👤 العميل: {ride['first_name']}\n\n"
+
+            keyboard.append([InlineKeyboardButton(
+                f"✅ قبول الرحلة #{ride['ride_id']} 🚗",
+                callback_data=f"accept_ride_{ride['ride_id']}"
+            )])
+
+        keyboard.append([InlineKeyboardButton("📍 تحديث حسب موقعي", callback_data='nearby_rides')])
+        keyboard.append([InlineKeyboardButton("العودة ↩️", callback_data='captain_button')])
+
+        await update.message.reply_text(
+            message,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='Markdown',
+            disable_web_page_preview=True
+        )
+
 # معالج الصور لإثباتات الدفع
 async def photo_handler(update: Update, context):
     user_id = update.effective_user.id
@@ -984,7 +1230,7 @@ async def photo_handler(update: Update, context):
             await update.message.reply_text("خطأ: لم يتم العثور على طلب الدفع.")
             return
 
-        payment_request = db.get_payment_request(request_id)
+        payment_request = await db.get_payment_request(request_id)
         if not payment_request or payment_request['user_id'] != user_id:
             await update.message.reply_text("خطأ: طلب الدفع غير صحيح.")
             return
@@ -995,7 +1241,7 @@ async def photo_handler(update: Update, context):
 
         # إنشاء سجل دفع
         try:
-            payment_id = db.create_payment_record(
+            payment_id = await db.create_payment_record(
                 user_id=user_id,
                 payment_type=payment_request['payment_type'],
                 amount=payment_request['amount'],
@@ -1011,7 +1257,7 @@ async def photo_handler(update: Update, context):
 
         if payment_id:
             # تحديث حالة طلب الدفع
-            db.update_payment_request_status(request_id, 'completed')
+            await db.update_payment_request_status(request_id, 'completed')
 
             # مسح بيانات الدفع من الجلسة
             context.user_data.pop('awaiting_payment_proof', None)
@@ -1042,8 +1288,8 @@ async def photo_handler(update: Update, context):
                     caption_text += f"🆔 Payment ID: {payment_id}\n\n"
                     caption_text += f"استخدم: /approve_payment {payment_id} لتأكيد الدفع"
 
-                    await context.bot.send_photo(
-                        chat_id=ADMIN_CHAT_ID,
+                    await send_queue.send(
+                        'send_photo', ADMIN_CHAT_ID, PRIORITY_PAYMENT,
                         photo=file_id,
                         caption=caption_text
                     )
@@ -1076,7 +1322,7 @@ async def text_handler(update: Update, context):
         )
 
         # حفظ الطلب في قاعدة البيانات
-        request_id = db.add_monthly_request(client_id=user_id, details=text)
+        request_id = await db.add_monthly_request(client_id=user_id, details=text)
 
         # إشعار المدير بالطلب الجديد
         if request_id and ADMIN_CHAT_ID:
@@ -1092,15 +1338,12 @@ async def text_handler(update: Update, context):
                 [InlineKeyboardButton("🚀 نشر للكباتن", callback_data=f'publish_request_{request_id}')]
             ])
 
-            try:
-                await context.bot.send_message(
-                    chat_id=ADMIN_CHAT_ID,
-                    text=admin_notification,
-                    reply_markup=keyboard,
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.error(f"Failed to send admin notification for new request: {e}")
+            send_queue.notify(
+                ADMIN_CHAT_ID,
+                admin_notification,
+                reply_markup=keyboard,
+                parse_mode='Markdown'
+            )
 
         # مسح حالة المستخدم
         context.user_data.clear()
@@ -1117,7 +1360,7 @@ async def text_handler(update: Update, context):
         pickup_location = context.user_data.get('pickup_location')
 
         # إنشاء الرحلة
-        ride_id = db.create_ride(
+        ride_id = await db.create_ride(
             client_id=user_id,
             pickup_location=pickup_location,
             destination=text
@@ -1148,36 +1391,36 @@ async def group_message_handler(update: Update, context):
     message_text = message.text
 
     # فحص المحتوى المخالف
-    if moderation.check_message_content(message_text):
+    if moderation.backend.check_message_content(message_text):
         try:
             # حذف الرسالة المخالفة
             await message.delete()
 
-            # إضافة تحذير للمستخدم
-            moderation.add_user_warning(
+            # إضافة تحذير للمستخدم (عدّاد في الذاكرة، بدون انتظار قاعدة البيانات)
+            moderation.backend.add_user_warning(
                 user_id=user_id,
                 reason="محتوى مخالف",
                 warned_by=context.bot.id
             )
 
             # فحص إذا كان يجب حظر المستخدم
-            if moderation.should_ban_user(user_id):
+            if moderation.backend.should_ban_user(user_id):
                 try:
                     await context.bot.ban_chat_member(chat_id, user_id)
-                    await context.bot.send_message(
+                    send_queue.notify(
                         chat_id,
                         f"تم حظر المستخدم {message.from_user.first_name} لانتهاك قوانين المجموعة متكرراً."
                     )
                 except Exception as e:
                     logger.error(f"Failed to ban user {user_id}: {e}")
             else:
-                # إرسال تحذير للمستخدم
-                warnings_count = moderation.get_user_warnings_count(user_id)
-                await context.bot.send_message(
+                # إرسال تحذير للمستخدم (العد من الذاكرة: النافذة تغطي مدة قاعدة الحظر)
+                warnings_count = moderation.backend.get_user_warnings_count(user_id)
+                send_queue.notify(
                     chat_id,
                     f"تحذير: {message.from_user.first_name}\n"
                     f"تم حذف رسالتك لانتهاك قوانين المجموعة.\n"
-                    f"عدد التحذيرات: {warnings_count}/3"
+                    f"عدد التحذيرات: {warnings_count}/{BAN_WARNINGS}"
                 )
 
         except Exception as e:
@@ -1194,7 +1437,7 @@ async def add_banned_word_command(update: Update, context):
         return
 
     word = " ".join(context.args)
-    if moderation.add_banned_word(word, update.effective_user.id):
+    if await moderation.add_banned_word(word, update.effective_user.id):
         await update.message.reply_text(f"تم إضافة الكلمة '{word}' إلى قائمة الكلمات المحظورة.")
     else:
         await update.message.reply_text("حدث خطأ في إضافة الكلمة.")
@@ -1209,7 +1452,7 @@ async def remove_banned_word_command(update: Update, context):
         return
 
     word = " ".join(context.args)
-    if moderation.remove_banned_word(word):
+    if await moderation.remove_banned_word(word):
         await update.message.reply_text(f"تم إزالة الكلمة '{word}' من قائمة الكلمات المحظورة.")
     else:
         await update.message.reply_text("الكلمة غير موجودة في القائمة.")
@@ -1219,7 +1462,7 @@ async def list_banned_words_command(update: Update, context):
     if str(update.effective_user.id) != ADMIN_CHAT_ID:
         return
 
-    banned_words = moderation.get_banned_words_list()
+    banned_words = await moderation.get_banned_words_list()
     if banned_words:
         words_list = "\n".join(f"• {word}" for word in banned_words)
         await update.message.reply_text(f"الكلمات المحظورة:\n\n{words_list}")
@@ -1243,13 +1486,16 @@ async def schedule_message_command(update: Update, context):
         duration_days = int(context.args[1])
         message_text = " ".join(context.args[2:])
 
-        if moderation.schedule_message(
+        schedule_id = await moderation.schedule_message(
             chat_id=update.effective_chat.id,
             message_text=message_text,
             interval_hours=interval_hours,
             duration_days=duration_days,
             created_by=update.effective_user.id
-        ):
+        )
+        if schedule_id:
+            if scheduler is not None:
+                await scheduler.add_scheduled_message(schedule_id)
             await update.message.reply_text(
                 f"تم جدولة الرسالة بنجاح!\n"
                 f"التكرار: كل {interval_hours} ساعة\n"
@@ -1261,6 +1507,48 @@ async def schedule_message_command(update: Update, context):
     except ValueError:
         await update.message.reply_text("يرجى إدخال أرقام صحيحة للساعات والأيام.")
 
+async def schedule_cron_command(update: Update, context):
+    """جدولة رسالة متكررة بتعبير cron (بتوقيت مكة)"""
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        return
+
+    if len(context.args) < 7:
+        await update.message.reply_text(
+            "استخدم: /schedule_cron <دقيقة> <ساعة> <يوم> <شهر> <يوم_الأسبوع> <أيام_المدة> <نص_الرسالة>\n"
+            "مثال (كل جمعة 9 صباحاً لمدة 30 يوم): /schedule_cron 0 9 * * 5 30 جمعة مباركة"
+        )
+        return
+
+    cron_expr = " ".join(context.args[:5])
+    try:
+        cron = CronSchedule(cron_expr)
+        duration_days = int(context.args[5])
+    except ValueError as e:
+        await update.message.reply_text(f"تعبير cron أو عدد الأيام غير صحيح: {e}")
+        return
+
+    message_text = " ".join(context.args[6:])
+    schedule_id = await moderation.schedule_message(
+        chat_id=update.effective_chat.id,
+        message_text=message_text,
+        interval_hours=0,
+        duration_days=duration_days,
+        created_by=update.effective_user.id,
+        cron_expr=cron_expr
+    )
+    if schedule_id:
+        if scheduler is not None:
+            await scheduler.add_scheduled_message(schedule_id)
+        first_send = from_ts(cron.next_after(now_local().timestamp()))
+        await update.message.reply_text(
+            f"تم جدولة الرسالة بنجاح!\n"
+            f"الموعد: {cron_expr}\n"
+            f"أول إرسال: {first_send.strftime('%Y-%m-%d %H:%M')}\n"
+            f"المدة: {duration_days} يوم"
+        )
+    else:
+        await update.message.reply_text("حدث خطأ في جدولة الرسالة.")
+
 async def add_subscription_command(update: Update, context):
     """إضافة اشتراك لكابتن"""
     if str(update.effective_user.id) != ADMIN_CHAT_ID:
@@ -1279,10 +1567,10 @@ async def add_subscription_command(update: Update, context):
         amount = float(context.args[2]) if len(context.args) > 2 else 10.0
 
         # حساب تاريخ انتهاء الاشتراك
-        from datetime import datetime, timedelta
-        end_date = datetime.now() + timedelta(days=days)
+        from datetime import timedelta
+        end_date = now_local() + timedelta(days=days)
 
-        if db.add_subscription(
+        if await db.add_subscription(
             user_id=user_id,
             subscription_type='captain_monthly',
             end_date=end_date.isoformat(),
@@ -1300,8 +1588,8 @@ async def add_subscription_command(update: Update, context):
 
             # إشعار المستخدم
             try:
-                await context.bot.send_message(
-                    chat_id=user_id,
+                await send_queue.send(
+                    'send_message', user_id, PRIORITY_PAYMENT,
                     text=f"🎉 تم تفعيل اشتراكك بنجاح!\n\n"
                     f"⏰ مدة الاشتراك: {days} يوم\n"
                     f"📅 ينتهي في: {end_date.strftime('%Y-%m-%d')}\n\n"
@@ -1328,12 +1616,12 @@ async def check_subscription_command(update: Update, context):
 
     try:
         user_id = int(context.args[0])
-        subscription = db.get_subscription_info(user_id)
+        subscription = await db.get_subscription_info(user_id)
 
         if subscription:
             from datetime import datetime
             end_date = datetime.fromisoformat(subscription['end_date'])
-            status = "نشط ✅" if db.is_captain_subscribed(user_id) else "منتهي ❌"
+            status = "نشط ✅" if await db.is_captain_subscribed(user_id) else "منتهي ❌"
 
             await update.message.reply_text(
                 f"📋 معلومات الاشتراك:\n\n"
@@ -1359,98 +1647,39 @@ async def admin_stats_command(update: Update, context):
         return
 
     try:
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-
-            # عدد المستخدمين
-            cursor.execute("SELECT COUNT(*) FROM users")
-            total_users = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM users WHERE user_type = 'client'")
-            clients = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM users WHERE user_type = 'captain'")
-            captains = cursor.fetchone()[0]
-
-            # عدد الرحلات
-            cursor.execute("SELECT COUNT(*) FROM rides")
-            total_rides = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM rides WHERE status = 'pending'")
-            pending_rides = cursor.fetchone()[0]
+        stats = await db.get_admin_stats()
+        cache_stats = db.subscriptions.stats()
 
-            cursor.execute("SELECT COUNT(*) FROM rides WHERE status = 'in_progress'")
-            active_rides = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM rides WHERE status = 'completed'")
-            completed_rides = cursor.fetchone()[0]
-
-            # الاشتراكات
-            cursor.execute("""
-                SELECT COUNT(*) FROM subscriptions
-                WHERE is_active = 1 AND datetime(end_date) > datetime('now')
-            """)
-            active_subscriptions = cursor.fetchone()[0]
-
-            cursor.execute("""
-                SELECT COUNT(*) FROM subscriptions
-                WHERE is_active = 0 OR datetime(end_date) <= datetime('now')
-            """)
-            expired_subscriptions = cursor.fetchone()[0]
-
-            # المدفوعات
-            cursor.execute("SELECT COUNT(*) FROM payments WHERE payment_status = 'pending'")
-            pending_payments = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM payments WHERE payment_status = 'completed'")
-            completed_payments = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM payments WHERE payment_status = 'completed'")
-            total_revenue = cursor.fetchone()[0]
-
-            # المدفوعات النقدية مقابل الرقمية
-            cursor.execute("SELECT COUNT(*) FROM payments WHERE payment_method = 'cash' AND payment_status = 'completed'")
-            cash_payments = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM payments WHERE payment_method != 'cash' AND payment_status = 'completed'")
-            digital_payments = cursor.fetchone()[0]
-
-            # الإحصائيات اليومية
-            cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) = DATE('now')")
-            today_users = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM rides WHERE DATE(created_at) = DATE('now')")
-            today_rides = cursor.fetchone()[0]
-
-            # رسالة الإحصائيات الشاملة
-            stats_message = f"""📊 **لوحة التحكم الرئيسية**
+        # رسالة الإحصائيات الشاملة
+        stats_message = f"""📊 **لوحة التحكم الرئيسية**
 ━━━━━━━━━━━━━━━━━━━━━━
 
 👥 **المستخدمون:**
-   • الإجمالي: {total_users}
-   • العملاء: {clients}
-   • الكباتن: {captains}
-   • انضموا اليوم: {today_users}
+   • الإجمالي: {stats['total_users']}
+   • العملاء: {stats['clients']}
+   • الكباتن: {stats['captains']}
+   • انضموا اليوم: {stats['today_users']}
 
 🚗 **الرحلات:**
-   • الإجمالي: {total_rides}
-   • معلقة: {pending_rides}
-   • نشطة: {active_rides}
-   • مكتملة: {completed_rides}
-   • طلبات اليوم: {today_rides}
+   • الإجمالي: {stats['total_rides']}
+   • معلقة: {stats['pending_rides']}
+   • نشطة: {stats['active_rides']}
+   • مكتملة: {stats['completed_rides']}
+   • طلبات اليوم: {stats['today_rides']}
 
 💳 **الاشتراكات:**
-   • نشطة: {active_subscriptions}
-   • منتهية: {expired_subscriptions}
+   • نشطة: {stats['active_subscriptions']}
+   • منتهية: {stats['expired_subscriptions']}
+   • فحص الاشتراك من الذاكرة: {cache_stats['hits']} نشط / {cache_stats['misses'] + cache_stats['expired']} غير نشط
 
 💰 **المدفوعات:**
-   • معلقة: {pending_payments}
-   • مكتملة: {completed_payments}
-   • إجمالي الإيرادات: {total_revenue:.2f} ريال
+   • معلقة: {stats['pending_payments']}
+   • مكتملة: {stats['completed_payments']}
+   • إجمالي الإيرادات: {stats['total_revenue']:.2f} ريال
 
 📊 **طرق الدفع:**
-   • نقدية: {cash_payments}
-   • رقمية: {digital_payments}
+   • نقدية: {stats['cash_payments']}
+   • رقمية: {stats['digital_payments']}
 
 ━━━━━━━━━━━━━━━━━━━━━━
 ⚡ أوامر لوحة التحكم:
@@ -1462,7 +1691,7 @@ async def admin_stats_command(update: Update, context):
 • `/pending_payments` - المدفوعات المعلقة
 • `/admin_help` - دليل جميع الأوامر 📚"""
 
-            await update.message.reply_text(stats_message)
+        await update.message.reply_text(stats_message)
 
     except Exception as e:
         await update.message.reply_text(f"خطأ في جلب الإحصائيات: {e}")
@@ -1475,44 +1704,33 @@ async def recent_rides_command(update: Update, context):
         return
 
     try:
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT r.ride_id, r.status, r.created_at,
-                       client.first_name as client_name, client.user_id as client_id,
-                       captain.first_name as captain_name, captain.user_id as captain_id,
-                       r.pickup_location, r.destination
-                FROM rides r
-                JOIN users client ON r.client_id = client.user_id
-                LEFT JOIN users captain ON r.captain_id = captain.user_id
-                ORDER BY r.created_at DESC
-                LIMIT 10
-            """)
-            rides = cursor.fetchall()
-
-            if not rides:
-                await update.message.reply_text("📭 لا توجد رحلات بعد")
-                return
-
-            message = "📋 **آخر 10 رحلات:**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
-
-            for ride in rides:
-                status_emoji = {"pending": "⏳", "in_progress": "🚗", "completed": "✅", "cancelled": "❌"}.get(ride[1], "❓")
-                captain_info = f"👨‍✈️ {ride[5]} ({ride[6]})" if ride[5] else "👨‍✈️ لم يتم التعيين بعد"
-
-                message += f"""🆔 **الرحلة #{ride[0]}** {status_emoji}
-👤 العميل: {ride[3]} ({ride[4]})
+        message, reply_markup = await recent_rides_page()
+        await update.message.reply_text(message, reply_markup=reply_markup)
+    except Exception as e:
+        await update.message.reply_text(f"❌ خطأ في جلب الرحلات: {e}")
+
+async def recent_rides_page(cursor: str = None, backward: bool = False):
+    """نص وأزرار صفحة من آخر الرحلات"""
+    page = await db.get_recent_rides(10, cursor, backward)
+    if not page.items:
+        return "📭 لا توجد رحلات بعد", None
+
+    message = "📋 **آخر الرحلات:**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
+
+    for ride in page.items:
+        status_emoji = {"pending": "⏳", "in_progress": "🚗", "completed": "✅", "cancelled": "❌"}.get(ride['status'], "❓")
+        captain_info = f"👨‍✈️ {ride['captain_name']} ({ride['captain_id']})" if ride['captain_name'] else "👨‍✈️ لم يتم التعيين بعد"
+
+        message += f"""🆔 **الرحلة #{ride['ride_id']}** {status_emoji}
+👤 العميل: {ride['client_name']} ({ride['client_id']})
 {captain_info}
-📍 من: {ride[7] or 'لم يحدد'}
-🎯 إلى: {ride[8] or 'لم يحدد'}
-⏰ {ride[2][:16]}
+📍 من: {ride['pickup_location'] or 'لم يحدد'}
+🎯 إلى: {ride['destination'] or 'لم يحدد'}
+⏰ {ride['created_at'][:16]}
 
 """
 
-            await update.message.reply_text(message)
-
-    except Exception as e:
-        await update.message.reply_text(f"❌ خطأ في جلب الرحلات: {e}")
+    return message, page_markup('rr', page)
 
 async def recent_users_command(update: Update, context):
     """👥 عرض آخر المستخدمين المنضمين"""
@@ -1520,36 +1738,30 @@ async def recent_users_command(update: Update, context):
         return
 
     try:
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, username, first_name, user_type, created_at
-                FROM users
-                ORDER BY created_at DESC
-                LIMIT 15
-            """)
-            users = cursor.fetchall()
-
-            if not users:
-                await update.message.reply_text("📭 لا يوجد مستخدمون بعد")
-                return
-
-            message = "👥 **آخر 15 مستخدم انضموا:**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
-
-            for user in users:
-                type_emoji = "👤" if user[3] == "client" else "👨‍✈️" if user[3] == "captain" else "❓"
-                username = f"@{user[1]}" if user[1] else "بدون معرف"
-
-                message += f"""{type_emoji} **{user[2]}** ({user[0]})
+        message, reply_markup = await recent_users_page()
+        await update.message.reply_text(message, reply_markup=reply_markup)
+    except Exception as e:
+        await update.message.reply_text(f"❌ خطأ في جلب المستخدمين: {e}")
+
+async def recent_users_page(cursor: str = None, backward: bool = False):
+    """نص وأزرار صفحة من آخر المستخدمين المنضمين"""
+    page = await db.get_recent_users(15, cursor, backward)
+    if not page.items:
+        return "📭 لا يوجد مستخدمون بعد", None
+
+    message = "👥 **آخر المستخدمين انضماماً:**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
+
+    for user in page.items:
+        type_emoji = "👤" if user['user_type'] == "client" else "👨‍✈️" if user['user_type'] == "captain" else "❓"
+        username = f"@{user['username']}" if user['username'] else "بدون معرف"
+
+        message += f"""{type_emoji} **{user['first_name']}** ({user['user_id']})
 📱 {username}
-📅 {user[4][:16]}
+📅 {user['created_at'][:16]}
 
 """
 
-            await update.message.reply_text(message)
-
-    except Exception as e:
-        await update.message.reply_text(f"❌ خطأ في جلب المستخدمين: {e}")
+    return message, page_markup('ru', page)
 
 async def find_user_command(update: Update, context):
     """🔍 البحث عن مستخدم بالمعرف وعرض تفاصيله"""
@@ -1563,68 +1775,35 @@ async def find_user_command(update: Update, context):
     try:
         user_id = int(context.args[0])
 
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-
-            # معلومات المستخدم الأساسية
-            cursor.execute("""
-                SELECT user_id, username, first_name, last_name, user_type, created_at
-                FROM users WHERE user_id = ?
-            """, (user_id,))
-            user = cursor.fetchone()
-
-            if not user:
-                await update.message.reply_text(f"❌ لم يتم العثور على مستخدم بالمعرف: {user_id}")
-                return
-
-            # إحصائيات الرحلات
-            cursor.execute("SELECT COUNT(*) FROM rides WHERE client_id = ?", (user_id,))
-            rides_as_client = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM rides WHERE captain_id = ?", (user_id,))
-            rides_as_captain = cursor.fetchone()[0]
-
-            # الاشتراكات
-            cursor.execute("""
-                SELECT COUNT(*) FROM subscriptions
-                WHERE user_id = ? AND is_active = 1 AND datetime(end_date) > datetime('now')
-            """, (user_id,))
-            active_subscription = cursor.fetchone()[0]
-
-            # المدفوعات
-            cursor.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payments WHERE user_id = ? AND payment_status = 'completed'", (user_id,))
-            payment_stats = cursor.fetchone()
-
-            # آخر نشاط
-            cursor.execute("""
-                SELECT created_at FROM rides
-                WHERE client_id = ? OR captain_id = ?
-                ORDER BY created_at DESC LIMIT 1
-            """, (user_id, user_id))
-            last_activity = cursor.fetchone()
-
-            type_emoji = "👤" if user[4] == "client" else "👨‍✈️" if user[4] == "captain" else "❓"
-            username = f"@{user[1]}" if user[1] else "بدون معرف"
-            full_name = f"{user[2]} {user[3] or ''}".strip()
-
-            message = f"""🔍 **تفاصيل المستخدم**
+        user = await db.get_user_details(user_id)
+
+        if not user:
+            await update.message.reply_text(f"❌ لم يتم العثور على مستخدم بالمعرف: {user_id}")
+            return
+
+        type_emoji = "👤" if user['user_type'] == "client" else "👨‍✈️" if user['user_type'] == "captain" else "❓"
+        username = f"@{user['username']}" if user['username'] else "بدون معرف"
+        full_name = f"{user['first_name']} {user['last_name'] or ''}".strip()
+        last_activity = user['last_activity']
+
+        message = f"""🔍 **تفاصيل المستخدم**
 ━━━━━━━━━━━━━━━━━━━━━━
 
 {type_emoji} **{full_name}**
-🆔 المعرف: `{user[0]}`
+🆔 المعرف: `{user['user_id']}`
 📱 اسم المستخدم: {username}
-👥 النوع: {"عميل" if user[4] == "client" else "كابتن" if user[4] == "captain" else "غير محدد"}
-📅 انضم في: {user[5][:16]}
+👥 النوع: {"عميل" if user['user_type'] == "client" else "كابتن" if user['user_type'] == "captain" else "غير محدد"}
+📅 انضم في: {user['created_at'][:16]}
 
 📊 **الإحصائيات:**
-🚗 رحلات كعميل: {rides_as_client}
-👨‍✈️ رحلات ككابتن: {rides_as_captain}
-💳 اشتراك نشط: {"✅ نعم" if active_subscription else "❌ لا"}
-💰 إجمالي المدفوعات: {payment_stats[1]:.2f} ريال ({payment_stats[0]} دفعة)
+🚗 رحلات كعميل: {user['rides_as_client']}
+👨‍✈️ رحلات ككابتن: {user['rides_as_captain']}
+💳 اشتراك نشط: {"✅ نعم" if user['active_subscription'] else "❌ لا"}
+💰 إجمالي المدفوعات: {user['payment_total']:.2f} ريال ({user['payment_count']} دفعة)
 
-⏰ **آخر نشاط:** {last_activity[0][:16] if last_activity else "لا يوجد نشاط"}"""
+⏰ **آخر نشاط:** {last_activity[:16] if last_activity else "لا يوجد نشاط"}"""
 
-            await update.message.reply_text(message)
+        await update.message.reply_text(message)
 
     except ValueError:
         await update.message.reply_text("❌ يرجى إدخال معرف مستخدم صحيح (أرقام فقط)")
@@ -1637,73 +1816,42 @@ async def live_activity_command(update: Update, context):
         return
 
     try:
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-
-            # الرحلات النشطة
-            cursor.execute("""
-                SELECT r.ride_id, client.first_name as client_name,
-                       captain.first_name as captain_name, r.created_at
-                FROM rides r
-                JOIN users client ON r.client_id = client.user_id
-                LEFT JOIN users captain ON r.captain_id = captain.user_id
-                WHERE r.status IN ('pending', 'in_progress')
-                ORDER BY r.created_at DESC
-            """)
-            active_rides = cursor.fetchall()
-
-            # المدفوعات المعلقة
-            cursor.execute("""
-                SELECT p.payment_id, u.first_name, p.amount, p.payment_type, p.created_at
-                FROM payments p
-                JOIN users u ON p.user_id = u.user_id
-                WHERE p.payment_status = 'pending'
-                ORDER BY p.created_at DESC
-                LIMIT 5
-            """)
-            pending_payments = cursor.fetchall()
-
-            # المستخدمين الجدد اليوم
-            cursor.execute("""
-                SELECT first_name, user_type, created_at
-                FROM users
-                WHERE DATE(created_at) = DATE('now')
-                ORDER BY created_at DESC
-                LIMIT 5
-            """)
-            new_users_today = cursor.fetchall()
-
-            message = "⚡ **النشاط المباشر**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
-
-            # الرحلات النشطة
-            if active_rides:
-                message += "🚗 **الرحلات النشطة:**\n"
-                for ride in active_rides[:5]:
-                    captain_name = ride[2] if ride[2] else "لم يتم التعيين"
-                    message += f"• #{ride[0]} - {ride[1]} ↔️ {captain_name}\n"
-                message += "\n"
-            else:
-                message += "🚗 **لا توجد رحلات نشطة حالياً**\n\n"
-
-            # المدفوعات المعلقة
-            if pending_payments:
-                message += "💰 **مدفوعات تحتاج موافقة:**\n"
-                for payment in pending_payments:
-                    message += f"• {payment[1]} - {payment[2]:.0f} ريال ({payment[3]})\n"
-                message += "\n"
-            else:
-                message += "💰 **لا توجد مدفوعات معلقة**\n\n"
-
-            # المستخدمين الجدد
-            if new_users_today:
-                message += "👥 **انضموا اليوم:**\n"
-                for user in new_users_today:
-                    type_emoji = "👤" if user[1] == "client" else "👨‍✈️"
-                    message += f"• {type_emoji} {user[0]} - {user[2][:11]}\n"
-            else:
-                message += "👥 **لم ينضم أحد اليوم بعد**"
+        activity = await db.get_live_activity()
+        active_rides = activity['active_rides']
+        pending_payments = activity['pending_payments']
+        new_users_today = activity['new_users_today']
+
+        message = "⚡ **النشاط المباشر**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
+
+        # الرحلات النشطة
+        if active_rides:
+            message += f"🚗 **الرحلات النشطة ({activity['active_rides_count']}):**\n"
+            for ride in active_rides:
+                captain_name = ride['captain_name'] if ride['captain_name'] else "لم يتم التعيين"
+                message += f"• #{ride['ride_id']} - {ride['client_name']} ↔️ {captain_name}\n"
+            message += "\n"
+        else:
+            message += "🚗 **لا توجد رحلات نشطة حالياً**\n\n"
 
-            await update.message.reply_text(message)
+        # المدفوعات المعلقة
+        if pending_payments:
+            message += f"💰 **مدفوعات تحتاج موافقة ({activity['pending_payments_count']}):**\n"
+            for payment in pending_payments:
+                message += f"• {payment['first_name']} - {payment['amount']:.0f} ريال ({payment['payment_type']})\n"
+            message += "\n"
+        else:
+            message += "💰 **لا توجد مدفوعات معلقة**\n\n"
+
+        # المستخدمين الجدد
+        if new_users_today:
+            message += f"👥 **انضموا اليوم ({activity['new_users_today_count']}):**\n"
+            for user in new_users_today:
+                type_emoji = "👤" if user['user_type'] == "client" else "👨‍✈️"
+                message += f"• {type_emoji} {user['first_name']} - {user['created_at'][:11]}\n"
+        else:
+            message += "👥 **لم ينضم أحد اليوم بعد**"
+
+        await update.message.reply_text(message)
 
     except Exception as e:
         await update.message.reply_text(f"❌ خطأ في جلب النشاط المباشر: {e}")
@@ -1713,72 +1861,128 @@ async def revenue_report_command(update: Update, context):
     if str(update.effective_user.id) != ADMIN_CHAT_ID:
         return
 
+    # عدد الأيام اختياري: /revenue_report 30
+    days = 7
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= 366:
+            await update.message.reply_text("❌ الاستخدام: /revenue_report [عدد الأيام 1-366]")
+            return
+        days = int(context.args[0])
+
     try:
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-
-            # إجمالي الإيرادات
-            cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM payments WHERE payment_status = 'completed'")
-            total_revenue = cursor.fetchone()[0]
-
-            # الإيرادات حسب طريقة الدفع
-            cursor.execute("""
-                SELECT payment_method, COUNT(*), COALESCE(SUM(amount), 0)
-                FROM payments
-                WHERE payment_status = 'completed'
-                GROUP BY payment_method
-                ORDER BY SUM(amount) DESC
-            """)
-            payment_methods = cursor.fetchall()
-
-            # الإيرادات حسب نوع الدفع
-            cursor.execute("""
-                SELECT payment_type, COUNT(*), COALESCE(SUM(amount), 0)
-                FROM payments
-                WHERE payment_status = 'completed'
-                GROUP BY payment_type
-                ORDER BY SUM(amount) DESC
-            """)
-            payment_types = cursor.fetchall()
-
-            # إيرادات آخر 7 أيام
-            cursor.execute("""
-                SELECT DATE(created_at) as day, COALESCE(SUM(amount), 0)
-                FROM payments
-                WHERE payment_status = 'completed'
-                AND DATE(created_at) >= DATE('now', '-7 days')
-                GROUP BY DATE(created_at)
-                ORDER BY day DESC
-            """)
-            daily_revenue = cursor.fetchall()
-
-            message = f"""💰 **تقرير الإيرادات التفصيلي**
+        report = await db.get_revenue_report(days)
+        total_revenue = report['total_revenue']
+
+        message = f"""💰 **تقرير الإيرادات التفصيلي**
 ━━━━━━━━━━━━━━━━━━━━━━
 
 💵 **إجمالي الإيرادات:** {total_revenue:.2f} ريال
 
 📊 **حسب طريقة الدفع:**"""
 
-            for method in payment_methods:
-                method_name = {"cash": "نقدي", "stc": "STC Pay", "bank": "حوالة بنكية", "urpay": "urpay", "mada": "مدى"}.get(method[0], method[0])
-                percentage = (method[2] / total_revenue * 100) if total_revenue > 0 else 0
-                message += f"\n• {method_name}: {method[2]:.2f} ريال ({method[1]} دفعة) - {percentage:.1f}%"
+        for method in report['by_method']:
+            method_name = {"cash": "نقدي", "stc": "STC Pay", "bank": "حوالة بنكية", "urpay": "urpay", "mada": "مدى"}.get(method['payment_method'], method['payment_method'])
+            percentage = (method['total'] / total_revenue * 100) if total_revenue > 0 else 0
+            message += f"\n• {method_name}: {method['total']:.2f} ريال ({method['count']} دفعة) - {percentage:.1f}%"
+
+        message += "\n\n📈 **حسب نوع الدفع:**"
+        for ptype in report['by_type']:
+            type_name = {"subscription_payment": "اشتراكات", "ride_payment": "رحلات"}.get(ptype['payment_type'], ptype['payment_type'])
+            percentage = (ptype['total'] / total_revenue * 100) if total_revenue > 0 else 0
+            message += f"\n• {type_name}: {ptype['total']:.2f} ريال ({ptype['count']} دفعة) - {percentage:.1f}%"
+
+        message += f"\n\n📅 **آخر {days} أيام:**"
+        for day in report['daily']:
+            message += f"\n• {day['day']}: {day['total']:.2f} ريال"
 
-            message += "\n\n📈 **حسب نوع الدفع:**"
-            for ptype in payment_types:
-                type_name = {"subscription_payment": "اشتراكات", "ride_payment": "رحلات"}.get(ptype[0], ptype[0])
-                percentage = (ptype[2] / total_revenue * 100) if total_revenue > 0 else 0
-                message += f"\n• {type_name}: {ptype[2]:.2f} ريال ({ptype[1]} دفعة) - {percentage:.1f}%"
+        # مقارنة الفترة بالفترة التي قبلها مباشرة
+        current, previous = report['period'], report['previous_period']
 
-            message += "\n\n📅 **آخر 7 أيام:**"
-            for day in daily_revenue:
-                message += f"\n• {day[0]}: {day[1]:.2f} ريال"
+        def change(key: str) -> str:
+            if not previous[key]:
+                return ""
+            return f" ({(current[key] - previous[key]) / previous[key] * 100:+.1f}%)"
 
-            await update.message.reply_text(message)
+        message += f"\n\n📈 **آخر {days} أيام مقارنة بالـ {days} أيام السابقة:**"
+        message += f"\n• الإيرادات: {current['revenue']:.2f} ريال مقابل {previous['revenue']:.2f}{change('revenue')}"
+        message += f"\n• المدفوعات المكتملة: {current['payments']} مقابل {previous['payments']}{change('payments')}"
+        message += f"\n• الرحلات المطلوبة: {current['rides']} مقابل {previous['rides']}{change('rides')}"
+        message += f"\n• الرحلات المكتملة: {current['rides_completed']} مقابل {previous['rides_completed']}{change('rides_completed')}"
+        message += f"\n• الرحلات الملغاة: {current['rides_cancelled']} مقابل {previous['rides_cancelled']}{change('rides_cancelled')}"
+
+        await update.message.reply_text(message)
 
     except Exception as e:
         await update.message.reply_text(f"❌ خطأ في جلب تقرير الإيرادات: {e}")
 
+async def reconcile_stats_command(update: Update, context):
+    """🧮 مطابقة عدادات الإحصائيات مع الجداول وتصحيح أي انحراف"""
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        return
+
+    # /reconcile_stats check يعرض الانحراف فقط دون تصحيح
+    repair = not (context.args and context.args[0] == 'check')
+    try:
+        drift = await db.reconcile_stats(repair)
+    except Exception as e:
+        await update.message.reply_text(f"❌ خطأ في مطابقة الإحصائيات: {e}")
+        return
+
+    if not drift:
+        await update.message.reply_text("✅ عدادات الإحصائيات مطابقة للجداول، لا يوجد انحراف")
+        return
+
+    message = f"🧮 **انحراف عدادات الإحصائيات** ({len(drift)} عداد)\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    for name, stored, expected in drift[:30]:
+        message += f"• `{name}`: {stored:g} ← الصحيح {expected:g}\n"
+    if len(drift) > 30:
+        message += f"... و{len(drift) - 30} عداد آخر\n"
+    message += "\n✅ تم تصحيح العدادات" if repair else "\nℹ️ لم يتم التصحيح؛ أرسل /reconcile_stats للتصحيح"
+    await update.message.reply_text(message)
+
+async def route_stats_command(update: Update, context):
+    """⏱️ أداء معالجات الأزرار - عدد الاستدعاءات والأخطاء وزمن التنفيذ"""
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        return
+
+    metrics = callbacks.metrics()
+    if not metrics:
+        message = "⏱️ لم يتم استدعاء أي زر منذ تشغيل البوت\n\n"
+    else:
+        message = "⏱️ **أداء معالجات الأزرار**\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    for name, route in list(metrics.items())[:20]:
+        p95 = f"{route['p95_ms']:.0f}" if route['p95_ms'] is not None else "-"
+        message += f"• `{name}`\n"
+        message += f"   📊 {route['count']} استدعاء | ❌ {route['errors']} خطأ\n"
+        message += f"   ⏱️ متوسط {route['avg_ms']:.1f} ms | p95 ≤ {p95} ms | أقصى {route['max_ms']:.0f} ms\n\n"
+
+    # حالة طابور الرسائل الصادرة
+    queue = send_queue.stats()
+    message += "📤 **طابور الإرسال**\n"
+    message += f"   📥 في الانتظار: {queue['depth']} | ✅ أُرسل: {queue['sent']} | ❌ فشل: {queue['failed']}\n"
+    message += f"   🔁 إعادة محاولة: {queue['retried']} | ⛔ تجاوز الحد: {queue['rate_limited']}\n"
+    for priority, latency in queue['latency'].items():
+        if latency['count']:
+            p95 = f"{latency['p95_ms']:.0f}" if latency['p95_ms'] is not None else "-"
+            message += f"   • {priority}: {latency['count']} رسالة | p95 ≤ {p95} ms\n"
+
+    # إشعارات الرحلات والمدفوعات المحفوظة
+    notices = await outbox.stats()
+    message += "\n📬 **إشعارات outbox**\n"
+    message += f"   📥 معلّقة: {notices['pending']} | 🚚 قيد الإرسال: {notices['in_flight']}\n"
+    message += f"   ✅ أُرسل: {notices['sent']} | 🔁 مؤجل: {notices['retried']} | ❌ فشل نهائياً: {notices['failed_total']}\n"
+
+    # ذاكرة بطاقات الرحلات والتعديلات التي لم تُرسل لأن المحتوى لم يتغير
+    cards = ride_cards.stats()
+    edits = message_edits.stats()
+    message += "\n🗂️ **بطاقات الرحلات**\n"
+    message += f"   🎯 نسبة الإصابة: {cards['hit_rate']:.0%} ({cards['hits']} من {cards['hits'] + cards['misses']})"
+    message += f" | ♻️ أُعيد بناؤها بعد تغيير: {cards['invalidated']}\n"
+    message += f"   ✏️ تعديلات: {edits['edits']} | 💾 استدعاءات موفّرة: {edits['skipped']}"
+    message += f" | ⚠️ Message is not modified: {edits['not_modified']}\n"
+
+    await update.message.reply_text(message)
+
 async def admin_help_command(update: Update, context):
     """📚 دليل أوامر الإدارة الشامل"""
     if str(update.effective_user.id) != ADMIN_CHAT_ID:
@@ -1797,7 +2001,7 @@ async def admin_help_command(update: Update, context):
 • `/find_user <ID>` - البحث عن مستخدم بالمعرف
 
 💰 **التقارير المالية:**
-• `/revenue_report` - تقرير الإيرادات التفصيلي
+• `/revenue_report [أيام]` - تقرير الإيرادات التفصيلي ومقارنته بالفترة السابقة
 • `/pending_payments` - المدفوعات المعلقة
 • `/approve_payment <ID>` - تأكيد دفعة
 • `/reject_payment <ID> <السبب>` - رفض دفعة
@@ -1812,8 +2016,13 @@ async def admin_help_command(update: Update, context):
 • `/remove_banned_word <كلمة>` - إزالة كلمة محظورة
 • `/list_banned_words` - عرض الكلمات المحظورة
 
+⏱️ **الأداء:**
+• `/route_stats` - زمن تنفيذ معالجات الأزرار وحالة طابور الإرسال وذاكرة بطاقات الرحلات
+• `/reconcile_stats [check]` - مطابقة عدادات `/stats` مع الجداول وتصحيحها
+
 📅 **الرسائل المجدولة:**
 • `/schedule <ساعات> <أيام> <النص>` - جدولة رسالة
+• `/schedule_cron <د> <س> <يوم> <شهر> <أسبوع> <أيام> <النص>` - جدولة بتعبير cron
 
 ━━━━━━━━━━━━━━━━━━━━━━
 💡 **نصائح:**
@@ -1833,61 +2042,45 @@ async def list_users_command(update: Update, context):
 
     try:
         user_type = context.args[0] if context.args else 'all'
-
-        with sqlite3.connect(db.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-
-            if user_type == 'clients':
-                cursor.execute("""
-                    SELECT user_id, username, first_name, created_at
-                    FROM users WHERE user_type = 'client'
-                    ORDER BY created_at DESC LIMIT 20
-                """)
-                title = "العملاء"
-            elif user_type == 'captains':
-                cursor.execute("""
-                    SELECT user_id, username, first_name, created_at
-                    FROM users WHERE user_type = 'captain'
-                    ORDER BY created_at DESC LIMIT 20
-                """)
-                title = "الكباتن"
-            else:
-                cursor.execute("""
-                    SELECT user_id, username, first_name, user_type, created_at
-                    FROM users ORDER BY created_at DESC LIMIT 20
-                """)
-                title = "جميع المستخدمين"
-
-            users = cursor.fetchall()
-
-            if not users:
-                await update.message.reply_text("لا توجد بيانات للمستخدمين")
-                return
-
-            message = f"📋 {title} (آخر 20):\n\n"
-
-            for user in users:
-                user_dict = dict(user)
-                message += f"👤 {user_dict['first_name']}\n"
-                message += f"   🆔 {user_dict['user_id']}\n"
-                if user_dict.get('username'):
-                    message += f"   📝 @{user_dict['username']}\n"
-                if user_type == 'all':
-                    message += f"   👥 {user_dict['user_type']}\n"
-                message += f"   📅 {user_dict['created_at'][:10]}\n\n"
-
-            # تقسيم الرسالة إذا كانت طويلة
-            if len(message) > 4000:
-                parts = [message[i:i+4000] for i in range(0, len(message), 4000)]
-                for part in parts:
-                    await update.message.reply_text(part)
-            else:
-                await update.message.reply_text(message)
+        message, reply_markup = await list_users_page(user_type)
+        await update.message.reply_text(message, reply_markup=reply_markup)
 
     except Exception as e:
         await update.message.reply_text(f"خطأ: {e}\n\nاستخدم: /list_users [all|clients|captains]")
 
+# لكل فلتر: (رمز القائمة في أزرار التنقل، نوع المستخدم في قاعدة البيانات، العنوان)
+LIST_USERS_FILTERS = {
+    'all': ('ua', None, "جميع المستخدمين"),
+    'clients': ('uc', 'client', "العملاء"),
+    'captains': ('uk', 'captain', "الكباتن"),
+}
+
+async def list_users_page(user_type: str, cursor: str = None, backward: bool = False):
+    """نص وأزرار صفحة من قائمة المستخدمين"""
+    code, db_type, title = LIST_USERS_FILTERS.get(user_type, LIST_USERS_FILTERS['all'])
+    page = await db.list_users(db_type, 20, cursor, backward)
+
+    if not page.items:
+        return "لا توجد بيانات للمستخدمين", None
+
+    message = f"📋 {title}:\n\n"
+
+    for user in page.items:
+        message += f"👤 {user['first_name']}\n"
+        message += f"   🆔 {user['user_id']}\n"
+        if user.get('username'):
+            message += f"   📝 @{user['username']}\n"
+        if db_type is None:
+            message += f"   👥 {user['user_type']}\n"
+        message += f"   📅 {user['created_at'][:10]}\n\n"
+
+    return message, page_markup(code, page)
+
+add_page_route('rr', admin_page(recent_rides_page))
+add_page_route('ru', admin_page(recent_users_page))
+for _kind, (_code, _, _) in LIST_USERS_FILTERS.items():
+    add_page_route(_code, admin_page(functools.partial(list_users_page, _kind)))
+
 async def approve_payment_command(update: Update, context):
     """تأكيد دفعة وتفعيل الاشتراك"""
     if str(update.effective_user.id) != ADMIN_CHAT_ID:
@@ -1901,16 +2094,7 @@ async def approve_payment_command(update: Update, context):
         payment_id = int(context.args[0])
 
         # الحصول على معلومات الدفع
-        with sqlite3.connect(db.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p.*, u.first_name, u.username
-                FROM payments p
-                JOIN users u ON p.user_id = u.user_id
-                WHERE p.payment_id = ?
-            """, (payment_id,))
-            payment = cursor.fetchone()
+        payment = await db.get_payment(payment_id)
 
         if not payment:
             await update.message.reply_text("لم يتم العثور على الدفعة.")
@@ -1920,21 +2104,42 @@ async def approve_payment_command(update: Update, context):
             await update.message.reply_text(f"هذه الدفعة تم معالجتها مسبقاً. الحالة الحالية: {payment['payment_status']}")
             return
 
+        # إشعار العميل بتأكيد دفع الرحلة يُحفظ في نفس معاملة تحديث الحالة
+        notification = None
+        if payment['payment_type'] == 'ride_payment':
+            notification = Notification(
+                payment['user_id'],
+                f"✅ تم تأكيد دفع رحلتك!\n\n"
+                f"💰 المبلغ: {payment['amount']} ريال\n"
+                f"🚗 رقم الرحلة: {payment['ride_id']}\n\n"
+                "شكراً لاستخدامك خدمة مشاوير مكة اليومية 🚖",
+                priority=PRIORITY_PAYMENT
+            )
+
         # تحديث حالة الدفع إلى مكتمل
-        db.update_payment_status(payment_id, 'completed')
+        await db.update_payment_status(payment_id, 'completed', notification)
 
         # إذا كان دفع اشتراك، قم بإضافة الاشتراك
         if payment['payment_type'] == 'subscription_payment':
-            from datetime import datetime, timedelta
-            end_date = datetime.now() + timedelta(days=30)
+            from datetime import timedelta
+            end_date = now_local() + timedelta(days=30)
 
-            subscription_added = db.add_subscription(
+            subscription_added = await db.add_subscription(
                 user_id=payment['user_id'],
                 subscription_type='captain_monthly',
                 end_date=end_date.isoformat(),
                 payment_amount=payment['amount'],
                 payment_method=payment['payment_method'],
-                created_by=update.effective_user.id
+                created_by=update.effective_user.id,
+                notification=Notification(
+                    payment['user_id'],
+                    "🎉 تم تفعيل اشتراكك بنجاح!\n\n"
+                    f"⏰ مدة الاشتراك: 30 يوم\n"
+                    f"📅 ينتهي في: {end_date.strftime('%Y-%m-%d')}\n\n"
+                    "يمكنك الآن الوصول لجميع ميزات الكباتن 🚖\n"
+                    "استخدم /start لبدء استخدام البوت",
+                    priority=PRIORITY_PAYMENT
+                )
             )
 
             if subscription_added:
@@ -1945,19 +2150,7 @@ async def approve_payment_command(update: Update, context):
                     f"📅 مدة الاشتراك: 30 يوم\n"
                     f"📅 ينتهي في: {end_date.strftime('%Y-%m-%d')}"
                 )
-
-                # إشعار المستخدم
-                try:
-                    await context.bot.send_message(
-                        chat_id=payment['user_id'],
-                        text="🎉 تم تفعيل اشتراكك بنجاح!\n\n"
-                        f"⏰ مدة الاشتراك: 30 يوم\n"
-                        f"📅 ينتهي في: {end_date.strftime('%Y-%m-%d')}\n\n"
-                        "يمكنك الآن الوصول لجميع ميزات الكباتن 🚖\n"
-                        "استخدم /start لبدء استخدام البوت"
-                    )
-                except Exception as e:
-                    await update.message.reply_text(f"تم تفعيل الاشتراك لكن فشل إرسال الإشعار: {e}")
+                outbox.wake()
             else:
                 await update.message.reply_text("تم تأكيد الدفع لكن فشل في إضافة الاشتراك.")
 
@@ -1968,18 +2161,7 @@ async def approve_payment_command(update: Update, context):
                 f"💰 المبلغ: {payment['amount']} ريال\n"
                 f"🚗 رقم الرحلة: {payment['ride_id']}"
             )
-
-            # إشعار العميل
-            try:
-                await context.bot.send_message(
-                    chat_id=payment['user_id'],
-                    text=f"✅ تم تأكيد دفع رحلتك!\n\n"
-                    f"💰 المبلغ: {payment['amount']} ريال\n"
-                    f"🚗 رقم الرحلة: {payment['ride_id']}\n\n"
-                    "شكراً لاستخدامك خدمة مشاوير مكة اليومية 🚖"
-                )
-            except Exception as e:
-                await update.message.reply_text(f"تم تأكيد الدفع لكن فشل إرسال الإشعار: {e}")
+            outbox.wake()
 
         else:
             await update.message.reply_text(f"✅ تم تأكيد الدفع بنجاح!")
@@ -2003,23 +2185,25 @@ async def reject_payment_command(update: Update, context):
         reason = " ".join(context.args[1:])
 
         # الحصول على معلومات الدفع
-        with sqlite3.connect(db.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p.*, u.first_name, u.username
-                FROM payments p
-                JOIN users u ON p.user_id = u.user_id
-                WHERE p.payment_id = ?
-            """, (payment_id,))
-            payment = cursor.fetchone()
+        payment = await db.get_payment(payment_id)
 
         if not payment:
             await update.message.reply_text("لم يتم العثور على الدفعة.")
             return
 
-        # تحديث حالة الدفع إلى مرفوض
-        db.update_payment_status(payment_id, 'failed')
+        # تحديث حالة الدفع إلى مرفوض مع حفظ إشعار المستخدم في نفس المعاملة
+        await db.update_payment_status(payment_id, 'failed', Notification(
+            payment['user_id'],
+            f"❌ تم رفض دفعتك\n\n"
+            f"💰 المبلغ: {payment['amount']} ريال\n"
+            f"🔴 السبب: {reason}\n\n"
+            "يرجى التواصل مع الإدارة لمزيد من التوضيح",
+            priority=PRIORITY_PAYMENT,
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("📞 تواصل مع الإدارة", url="https://t.me/novacompnay")
+            ]]).to_dict()
+        ))
+        outbox.wake()
 
         await update.message.reply_text(
             f"❌ تم رفض الدفع\n\n"
@@ -2028,21 +2212,6 @@ async def reject_payment_command(update: Update, context):
             f"🔴 السبب: {reason}"
         )
 
-        # إشعار المستخدم
-        try:
-            await context.bot.send_message(
-                chat_id=payment['user_id'],
-                text=f"❌ تم رفض دفعتك\n\n"
-                f"💰 المبلغ: {payment['amount']} ريال\n"
-                f"🔴 السبب: {reason}\n\n"
-                "يرجى التواصل مع الإدارة لمزيد من التوضيح",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("📞 تواصل مع الإدارة", url="https://t.me/novacompnay")
-                ]])
-            )
-        except Exception as e:
-            await update.message.reply_text(f"تم رفض الدفع لكن فشل إرسال الإشعار: {e}")
-
     except ValueError:
         await update.message.reply_text("يرجى إدخال رقم دفع صحيح.")
     except Exception as e:
@@ -2054,7 +2223,7 @@ async def pending_payments_command(update: Update, context):
         return
 
     try:
-        pending_payments = db.get_pending_payments(10)
+        pending_payments = await db.get_pending_payments(10)
 
         if not pending_payments:
             await update.message.reply_text("لا توجد دفعات معلقة حالياً ✅")
@@ -2078,6 +2247,66 @@ async def pending_payments_command(update: Update, context):
     except Exception as e:
         await update.message.reply_text(f"خطأ: {e}")
 
+def instrument(callback):
+    """تغليف معالج لتسجيل زمن تنفيذه وأخطائه في bot_handler_duration_seconds باسم الدالة"""
+    return timed(handler_latency, callback.__name__)(callback)
+
+async def health_check():
+    """فحص الصحة: زمن استعلام بسيط عبر خيوط القاعدة، بما فيه انتظار خيط متاح"""
+    started = time.perf_counter()
+    try:
+        healthy = await asyncio.wait_for(db.ping(), HEALTH_DB_TIMEOUT)
+    except asyncio.TimeoutError:
+        healthy = False
+    return healthy, {
+        'status': 'ok' if healthy else 'fail',
+        'db_ms': round((time.perf_counter() - started) * 1000, 2),
+        'loop_lag_ms': round(loop_lag.last_ms, 2),
+    }
+
+async def collect_bot_metrics():
+    """مقاييس تحفظها مكونات البوت نفسها (الأزرار، طابور الإرسال، outbox، الذاكرات، التحديثات الجارية)، تُقرأ عند طلب /metrics"""
+    routes = callbacks.metrics()
+    lines = render_histogram('bot_callback_duration_seconds', "Callback query handler latency by route", ('route',),
+                             (((name,), route) for name, route in routes.items()))
+    lines += render_samples('bot_callback_errors_total', "Callback query handler failures by route", 'counter', ('route',),
+                            (((name,), route['errors']) for name, route in routes.items()))
+
+    queue = send_queue.stats()
+    lines += render_samples('bot_send_queue_depth', "Messages waiting in the send queue", 'gauge', (),
+                            [((), queue['depth'])])
+    lines += render_samples('bot_send_queue_messages_total', "Send queue outcomes", 'counter', ('result',),
+                            (((result,), queue[result]) for result in ('sent', 'failed', 'retried', 'rate_limited')))
+    lines += render_histogram('bot_send_queue_latency_seconds', "Time from enqueue to delivery by priority", ('priority',),
+                              (((priority,), latency) for priority, latency in queue['latency'].items()))
+
+    notices = await outbox.stats()
+    lines += render_samples('bot_outbox_rows', "Outbox notifications by state", 'gauge', ('state',),
+                            [(('pending',), notices['pending']), (('in_flight',), notices['in_flight']),
+                             (('failed',), notices['failed_total'])])
+    lines += render_samples('bot_outbox_deliveries_total', "Outbox delivery outcomes since start", 'counter', ('result',),
+                            (((result,), notices[result]) for result in ('sent', 'retried', 'failed')))
+
+    subscriptions = db.subscriptions.stats()
+    lines += render_samples('bot_subscription_cache_lookups_total', "Subscription checks answered from memory", 'counter',
+                            ('result',), (((result,), subscriptions[result]) for result in ('hits', 'misses', 'expired')))
+    cards = ride_cards.stats()
+    edits = message_edits.stats()
+    lines += render_samples('bot_ride_card_cache_lookups_total', "Ride card cache lookups", 'counter', ('result',),
+                            [(('hit',), cards['hits']), (('miss',), cards['misses'])])
+    lines += render_samples('bot_message_edits_total', "List message edits by outcome", 'counter', ('result',),
+                            (((result,), edits[result]) for result in ('edits', 'skipped', 'not_modified')))
+    updates = update_processor.stats()
+    lines += render_samples('bot_updates_in_progress', "Updates running or waiting for their user, chat or a slot", 'gauge',
+                            ('state',), [(('running',), updates['running']), (('waiting',), updates['waiting'])])
+    lines += render_samples('bot_updates_processed_total', "Updates processed since start", 'counter', (),
+                            [((), updates['processed'])])
+    lines += render_samples('bot_event_loop_lag_last_seconds', "Most recent event loop lag sample", 'gauge', (),
+                            [((), loop_lag.last_ms / 1000)])
+    return lines
+
+get_metrics().add_collector(collect_bot_metrics)
+
 async def error_handler(update: Update, context):
     """معالج الأخطاء العام"""
     logger.error(f"Exception while handling an update: {context.error}")
@@ -2088,6 +2317,94 @@ async def error_handler(update: Update, context):
             "عذراً، حدث خطأ في معالجة طلبك. يرجى المحاولة مرة أخرى أو التواصل مع الإدارة."
         )
 
+async def start_background_tasks(application):
+    """تشغيل طابور الإرسال وموزع الإشعارات والجدولة وخادم المقاييس بعد تهيئة البوت"""
+    global scheduler, metrics_server
+    await send_queue.start(application.bot)
+    await outbox.start()
+    scheduler = MessageScheduler(application)
+    await scheduler.start_scheduler()
+    loop_lag.start()
+    metrics_server = MetricsServer(health_check)
+    await metrics_server.start()
+
+async def stop_background_tasks(application):
+    """إيقاف المهام الخلفية وإكمال الرسائل المتبقية قبل إغلاق اتصال البوت"""
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await loop_lag.stop()
+    if scheduler is not None:
+        await scheduler.stop_scheduler()
+    # ما لم يُسحب من outbox يبقى في قاعدة البيانات للتشغيل التالي
+    await outbox.stop()
+    await send_queue.stop()
+
+def add_handlers(app):
+    """تسجيل معالجات الأوامر والأزرار والرسائل ومعالج الأخطاء على التطبيق"""
+    # إضافة الأوامر والمعالجات
+    app.add_handler(CommandHandler("start", instrument(start_command)))
+    app.add_handler(CallbackQueryHandler(instrument(button_callback)))
+    app.add_handler(MessageHandler(filters.LOCATION, instrument(location_handler)))
+    app.add_handler(MessageHandler(filters.PHOTO, instrument(photo_handler)))
+
+    # أوامر الإدارة
+    app.add_handler(CommandHandler("add_banned_word", instrument(add_banned_word_command)))
+    app.add_handler(CommandHandler("remove_banned_word", instrument(remove_banned_word_command)))
+    app.add_handler(CommandHandler("list_banned_words", instrument(list_banned_words_command)))
+    app.add_handler(CommandHandler("schedule", instrument(schedule_message_command)))
+    app.add_handler(CommandHandler("schedule_cron", instrument(schedule_cron_command)))
+    app.add_handler(CommandHandler("add_subscription", instrument(add_subscription_command)))
+    app.add_handler(CommandHandler("check_subscription", instrument(check_subscription_command)))
+    app.add_handler(CommandHandler("stats", instrument(admin_stats_command)))
+    app.add_handler(CommandHandler("list_users", instrument(list_users_command)))
+    app.add_handler(CommandHandler("approve_payment", instrument(approve_payment_command)))
+    app.add_handler(CommandHandler("reject_payment", instrument(reject_payment_command)))
+    app.add_handler(CommandHandler("pending_payments", instrument(pending_payments_command)))
+
+    # أوامر لوحة التحكم المتقدمة
+    app.add_handler(CommandHandler("recent_rides", instrument(recent_rides_command)))
+    app.add_handler(CommandHandler("recent_users", instrument(recent_users_command)))
+    app.add_handler(CommandHandler("find_user", instrument(find_user_command)))
+    app.add_handler(CommandHandler("live_activity", instrument(live_activity_command)))
+    app.add_handler(CommandHandler("revenue_report", instrument(revenue_report_command)))
+    app.add_handler(CommandHandler("route_stats", instrument(route_stats_command)))
+    app.add_handler(CommandHandler("reconcile_stats", instrument(reconcile_stats_command)))
+    app.add_handler(CommandHandler("admin_help", instrument(admin_help_command)))
+
+    # معالج رسائل المجموعة (للإشراف)
+    app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS, instrument(group_message_handler)))
+
+    # معالج الرسائل الخاصة
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, instrument(text_handler)))
+
+    # إضافة معالج الأخطاء
+    app.add_error_handler(error_handler)
+
+def run_webhook(app):
+    """تشغيل البوت بوضع webhook عبر خادم HTTP المدمج في المكتبة
+
+    يرفض الخادم أي طلب لا يحمل الرمز السري في ترويسة
+    X-Telegram-Bot-Api-Secret-Token، وعند الإيقاف يتوقف عن استقبال
+    الطلبات ثم يُكمل معالجة التحديثات الموجودة في الطابور قبل الإغلاق.
+    """
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL is required when BOT_MODE=webhook")
+
+    # بدون رمز محدد يُولد رمز عشوائي لكل تشغيل ويُسجل مع الـ webhook
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+
+    logger.info(f"Bot started webhook server on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    print(f"Webhook listening on port {WEBHOOK_PORT}...")
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=secret_token,
+        drop_pending_updates=DROP_PENDING_UPDATES
+    )
+
 def main():
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN not found in environment variables")
@@ -2099,67 +2416,34 @@ def main():
         print("Bot is starting...")
 
 
-        app = Application.builder().token(BOT_TOKEN).build()
-
-        # إضافة الأوامر والمعالجات
-        app.add_handler(CommandHandler("start", start_command))
-        app.add_handler(CallbackQueryHandler(button_callback))
-        app.add_handler(MessageHandler(filters.LOCATION, location_handler))
-        app.add_handler(MessageHandler(filters.PHOTO, photo_handler))
-
-        # أوامر الإدارة
-        app.add_handler(CommandHandler("add_banned_word", add_banned_word_command))
-        app.add_handler(CommandHandler("remove_banned_word", remove_banned_word_command))
-        app.add_handler(CommandHandler("list_banned_words", list_banned_words_command))
-        app.add_handler(CommandHandler("schedule", schedule_message_command))
-        app.add_handler(CommandHandler("add_subscription", add_subscription_command))
-        app.add_handler(CommandHandler("check_subscription", check_subscription_command))
-        app.add_handler(CommandHandler("stats", admin_stats_command))
-        app.add_handler(CommandHandler("list_users", list_users_command))
-        app.add_handler(CommandHandler("approve_payment", approve_payment_command))
-        app.add_handler(CommandHandler("reject_payment", reject_payment_command))
-        app.add_handler(CommandHandler("pending_payments", pending_payments_command))
-
-        # أوامر لوحة التحكم المتقدمة
-        app.add_handler(CommandHandler("recent_rides", recent_rides_command))
-        app.add_handler(CommandHandler("recent_users", recent_users_command))
-        app.add_handler(CommandHandler("find_user", find_user_command))
-        app.add_handler(CommandHandler("live_activity", live_activity_command))
-        app.add_handler(CommandHandler("revenue_report", revenue_report_command))
-        app.add_handler(CommandHandler("admin_help", admin_help_command))
-
-        # معالج رسائل المجموعة (للإشراف)
-        app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS, group_message_handler))
-
-        # معالج الرسائل الخاصة
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, text_handler))
-
-        # إضافة معالج الأخطاء
-        app.add_error_handler(error_handler)
-
-        # بدء جدولة الرسائل والمهام الخلفية (سيتم تفعيلها لاحقاً)
-        # Initialize and start scheduler
-        # scheduler = None
-
-        # Start scheduler as background task
-        # async def post_init(application):
-        #     nonlocal scheduler
-        #     scheduler = MessageScheduler(application)
-        #     asyncio.create_task(scheduler.start_scheduler())
-
-        # app.post_init = post_init
-        # logger.info("Message scheduler enabled and will start after bot initialization")
+        # حفظ حالة المحادثات (user_data/chat_data) في قاعدة البيانات لتبقى بعد إعادة التشغيل
+        builder = Application.builder().token(BOT_TOKEN).persistence(SQLitePersistence())
+        # كل استدعاءات Bot API (ما عدا getUpdates) تمر عبر طلب يقيس زمنها ونتيجتها
+        builder = builder.request(instrumented_request(HTTPXRequest(connection_pool_size=256)))
+        builder = builder.post_init(start_background_tasks).post_stop(stop_background_tasks)
+        builder = builder.concurrent_updates(update_processor)
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        app = builder.build()
 
-        # تشغيل البوت
-        logger.info("Bot started polling...")
-        print("Polling...")
+        add_handlers(app)
 
-        app.run_polling(drop_pending_updates=True)
+        # تشغيل البوت
+        if BOT_MODE == 'webhook':
+            run_webhook(app)
+        else:
+            logger.info("Bot started polling...")
+            print("Polling...")
+            app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
 
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         print(f"Fatal error: {e}")
     finally:
+        stop_warning_writers()
+        stop_write_queues()
+        shutdown_executor()
+        close_all_connections()
         logger.info("Bot shutdown")
 
 if __name__ == '__main__':
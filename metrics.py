@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from callback_router import RouteMetrics, LATENCY_BUCKETS_MS
+
+logger = logging.getLogger(__name__)
+
+# خادم المقاييس المحلي: /metrics بصيغة Prometheus و /healthz (المنفذ 0 يعطله)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+# الفاصل بالثواني بين قياسات تأخر حلقة الأحداث
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+# أقصى زمن بالثواني لاستعلام فحص الصحة قبل اعتبار القاعدة غير متاحة
+HEALTH_DB_TIMEOUT = float(os.getenv("HEALTH_DB_TIMEOUT", "2"))
+
+Labels = Tuple[str, ...]
+
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+_INF = 'le="+Inf"'
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names: Iterable[str], values: Iterable[Any], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render_histogram(name: str, help_text: str, labelnames: Labels,
+                     items: Iterable[Tuple[Labels, Dict[str, Any]]]) -> List[str]:
+    """Prometheus lines for RouteMetrics snapshots, converting the ms buckets to seconds"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for values, snapshot in items:
+        seen = 0
+        labels = _label_text(labelnames, values)
+        for bound, count in zip(LATENCY_BUCKETS_MS, snapshot['buckets']):
+            seen += count
+            le = 'le="%g"' % (bound / 1000)
+            lines.append(f"{name}_bucket{_label_text(labelnames, values, le)} {seen}")
+        lines.append(f"{name}_bucket{_label_text(labelnames, values, _INF)} {snapshot['count']}")
+        lines.append(f"{name}_sum{labels} {snapshot['avg_ms'] * snapshot['count'] / 1000:.6f}")
+        lines.append(f"{name}_count{labels} {snapshot['count']}")
+    return lines
+
+
+def render_samples(name: str, help_text: str, kind: str, labelnames: Labels,
+                   items: Iterable[Tuple[Labels, float]]) -> List[str]:
+    """Prometheus lines for a counter or gauge family"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for values, value in items:
+        lines.append(f"{name}{_label_text(labelnames, values)} {value:g}")
+    return lines
+
+
+class Histogram:
+    """Latency histogram family with one RouteMetrics per combination of label values"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Labels, errors: bool = True):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.errors = errors
+        self._series: Dict[Labels, RouteMetrics] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Labels, elapsed_ms: float, failed: bool = False):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = RouteMetrics()
+            series.observe(elapsed_ms, failed)
+
+    def snapshots(self) -> Dict[Labels, Dict[str, Any]]:
+        with self._lock:
+            return {labels: series.snapshot() for labels, series in self._series.items()}
+
+    def render(self) -> List[str]:
+        snapshots = sorted(self.snapshots().items())
+        lines = render_histogram(self.name, self.help_text, self.labelnames, snapshots)
+        if self.errors:
+            # الأخطاء كعداد منفصل باسم العائلة بدون لاحقة الزمن
+            errors = self.name.replace('_duration_seconds', '') + '_errors_total'
+            lines += render_samples(errors, f"Failures counted in {self.name}", 'counter', self.labelnames,
+                                    ((labels, snapshot['errors']) for labels, snapshot in snapshots))
+        return lines
+
+
+class Counter:
+    """Monotonic counter family"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Labels):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Labels, value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return render_samples(self.name, self.help_text, 'counter', self.labelnames, items)
+
+
+class MetricsRegistry:
+    """Metric families of this process, rendered in the Prometheus text format.
+
+    Families are created on first use and returned again for the same
+    name, so modules can declare the ones they record at import time.
+    Collectors add families whose values live elsewhere (router, send
+    queue, outbox) and are read only when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self._families: Dict[str, Any] = {}
+        self._collectors: List[Callable[[], Awaitable[List[str]]]] = []
+        self._lock = threading.Lock()
+
+    def _family(self, cls, name: str, help_text: str, labelnames: Labels, **kwargs):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = cls(name, help_text, labelnames, **kwargs)
+            return family
+
+    def histogram(self, name: str, help_text: str, labelnames: Labels = (), errors: bool = True) -> Histogram:
+        """Histogram family; errors=True also exposes <name>_errors_total"""
+        return self._family(Histogram, name, help_text, labelnames, errors=errors)
+
+    def counter(self, name: str, help_text: str, labelnames: Labels = ()) -> Counter:
+        return self._family(Counter, name, help_text, labelnames)
+
+    def add_collector(self, collect: Callable[[], Awaitable[List[str]]]):
+        """Register an async callable returning extra exposition lines"""
+        self._collectors.append(collect)
+
+    async def render(self) -> str:
+        lines: List[str] = []
+        for family in list(self._families.values()):
+            lines += family.render()
+        for collect in self._collectors:
+            try:
+                lines += await collect()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+_registry: Optional[MetricsRegistry] = None
+
+
+def get_metrics() -> MetricsRegistry:
+    """Return the process-wide metrics registry"""
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry()
+    return _registry
+
+
+def timed(histogram: Histogram, name: str):
+    """Decorator recording an async callable's latency and failures under label name"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            failed = False
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                histogram.observe((name,), (time.perf_counter() - started) * 1000, failed)
+
+        return wrapper
+
+    return decorator
+
+
+def instrumented_request(request):
+    """Wrap a telegram BaseRequest so every Bot API call is timed and counted by method"""
+    from telegram.request import BaseRequest
+
+    registry = get_metrics()
+    latency = registry.histogram('bot_api_request_duration_seconds', "Bot API call latency by method", ('method',))
+    results = registry.counter('bot_api_requests_total', "Bot API calls by method and result", ('method', 'result'))
+
+    class InstrumentedRequest(BaseRequest):
+        @property
+        def read_timeout(self):
+            return request.read_timeout
+
+        async def initialize(self):
+            await request.initialize()
+
+        async def shutdown(self):
+            await request.shutdown()
+
+        async def do_request(self, url, method, request_data=None, **timeouts):
+            api_method = url.rsplit('/', 1)[-1]
+            started = time.perf_counter()
+            result = 'error'
+            try:
+                code, payload = await request.do_request(url, method, request_data, **timeouts)
+                result = 'ok' if code < 400 else str(code)
+                return code, payload
+            except Exception as e:
+                result = type(e).__name__
+                raise
+            finally:
+                latency.observe((api_method,), (time.perf_counter() - started) * 1000, result != 'ok')
+                results.inc((api_method, result))
+
+    return InstrumentedRequest()
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a sleeping task"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last_ms = 0.0
+        self.histogram = get_metrics().histogram(
+            'bot_event_loop_lag_seconds', "Delay between a timer's due time and its callback", errors=False)
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_ms = max(0.0, loop.time() - due) * 1000
+            self.histogram.observe((), self.last_ms)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="loop-lag-monitor")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class MetricsServer:
+    """Minimal HTTP server on the bot's event loop serving /metrics and /healthz.
+
+    health is an async callable returning (healthy, details); details are
+    returned as JSON with status 200 or 503.
+    """
+
+    def __init__(self, health: Callable[[], Awaitable[Tuple[bool, Dict[str, Any]]]],
+                 listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.health = health
+        self.listen = listen
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        if self._server is not None or not self.port:
+            return
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        logger.info(f"Metrics server listening on {self.listen}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # تجاهل الترويسات حتى السطر الفارغ
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+
+            if path == '/metrics':
+                status, content_type, body = 200, _CONTENT_TYPE, await get_metrics().render()
+            elif path == '/healthz':
+                healthy, details = await self.health()
+                status, content_type = (200 if healthy else 503), "application/json"
+                body = json.dumps(details)
+            else:
+                status, content_type, body = 404, "text/plain", "not found\n"
+
+            payload = body.encode('utf-8')
+            reason = {200: 'OK', 404: 'Not Found', 503: 'Service Unavailable'}[status]
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
@@ -0,0 +1,623 @@
+import sqlite3
+import logging
+from typing import Callable, List, Tuple
+from timeutil import to_ts, utc_offset_seconds
+from geo import grid_cell
+from stats_counters import install as install_stats
+
+logger = logging.getLogger(__name__)
+
+# كل ترحيل يُطبق مرة واحدة فقط ويُسجل رقمه في جدول schema_version.
+# لا تعدّل ترحيلاً تم نشره؛ أضف ترحيلاً جديداً برقم أعلى بدلاً من ذلك.
+
+
+def _m001_baseline(conn: sqlite3.Connection):
+    """Create the original tables (no-op on existing database files)"""
+    # Users table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone_number TEXT,
+            user_type TEXT CHECK(user_type IN ('client', 'captain')),
+            is_active BOOLEAN DEFAULT 1,
+            rating REAL DEFAULT 0.0,
+            total_rides INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Rides table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rides (
+            ride_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            captain_id INTEGER,
+            pickup_location TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            pickup_latitude REAL,
+            pickup_longitude REAL,
+            destination_latitude REAL,
+            destination_longitude REAL,
+            ride_type TEXT CHECK(ride_type IN ('request', 'offer')),
+            status TEXT CHECK(status IN ('pending', 'accepted', 'in_progress', 'completed', 'cancelled')) DEFAULT 'pending',
+            price REAL,
+            passenger_count INTEGER DEFAULT 1,
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (client_id) REFERENCES users (user_id),
+            FOREIGN KEY (captain_id) REFERENCES users (user_id)
+        )
+    """)
+
+    # Ratings table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ratings (
+            rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ride_id INTEGER,
+            rater_id INTEGER,
+            rated_id INTEGER,
+            rating INTEGER CHECK(rating >= 1 AND rating <= 5),
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (ride_id) REFERENCES rides (ride_id),
+            FOREIGN KEY (rater_id) REFERENCES users (user_id),
+            FOREIGN KEY (rated_id) REFERENCES users (user_id)
+        )
+    """)
+
+    # Subscriptions table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            subscription_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            subscription_type TEXT CHECK(subscription_type IN ('captain_monthly', 'captain_weekly')),
+            start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end_date TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            payment_amount REAL,
+            payment_method TEXT,
+            created_by INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    # Payments table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            ride_id INTEGER,
+            subscription_id INTEGER,
+            payment_type TEXT CHECK(payment_type IN ('ride_payment', 'subscription_payment')),
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'SAR',
+            payment_method TEXT CHECK(payment_method IN ('cash', 'bank', 'stc', 'urpay', 'mada')),
+            payment_status TEXT CHECK(payment_status IN ('pending', 'completed', 'failed', 'refunded')) DEFAULT 'pending',
+            transaction_id TEXT,
+            payment_proof_url TEXT,
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (ride_id) REFERENCES rides (ride_id),
+            FOREIGN KEY (subscription_id) REFERENCES subscriptions (subscription_id)
+        )
+    """)
+
+    # Payment requests table for handling payment flows
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payment_requests (
+            request_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            payment_type TEXT CHECK(payment_type IN ('ride_payment', 'subscription_payment')),
+            amount REAL NOT NULL,
+            description TEXT,
+            status TEXT CHECK(status IN ('pending', 'awaiting_proof', 'completed', 'cancelled')) DEFAULT 'pending',
+            ride_id INTEGER,
+            subscription_days INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (ride_id) REFERENCES rides (ride_id)
+        )
+    """)
+
+    # Monthly driver requests table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_requests (
+            request_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            request_details TEXT NOT NULL,
+            status TEXT CHECK(status IN ('pending', 'published', 'closed')) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            published_at TIMESTAMP,
+            FOREIGN KEY (client_id) REFERENCES users (user_id)
+        )
+    """)
+
+    # Banned words table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS banned_words (
+            word_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            word TEXT UNIQUE NOT NULL,
+            added_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # User warnings table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_warnings (
+            warning_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            reason TEXT,
+            warned_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Scheduled messages table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_messages (
+            schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            message_text TEXT,
+            interval_hours INTEGER,
+            duration_days INTEGER,
+            created_by INTEGER,
+            is_active BOOLEAN DEFAULT 1,
+            last_sent TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _m002_hot_path_indexes(conn: sqlite3.Connection):
+    """Add indexes for the queries the bot runs on every update"""
+    # الرحلات المعلقة والنشطة مرتبة حسب وقت الإنشاء
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_rides_status_created
+        ON rides (status, created_at)
+    """)
+    # رحلات الكابتن النشطة + الجزء الخاص بالكابتن من get_user_rides
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_rides_captain_status
+        ON rides (captain_id, status)
+    """)
+    # الجزء الخاص بالعميل من get_user_rides
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_rides_client_created
+        ON rides (client_id, created_at)
+    """)
+    # الاشتراك النشط للمستخدم
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active_user
+        ON subscriptions (user_id, end_date)
+        WHERE is_active = 1
+    """)
+    # المدفوعات المعلقة لمراجعة الإدارة
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_payments_pending
+        ON payments (created_at)
+        WHERE payment_status = 'pending'
+    """)
+    # سجل مدفوعات المستخدم
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_payments_user_created
+        ON payments (user_id, created_at)
+    """)
+    # عدد تحذيرات المستخدم خلال فترة
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_warnings_user_created
+        ON user_warnings (user_id, created_at)
+    """)
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """Add a column unless a previous partial run already added it"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _parse_legacy(value, naive_utc: bool):
+    """Parse a legacy TEXT timestamp, leaving unparsable values as NULL"""
+    try:
+        return to_ts(value, naive_utc=naive_utc)
+    except (TypeError, ValueError):
+        logger.warning(f"Unparsable timestamp left as NULL during migration: {value!r}")
+        return None
+
+
+def _m003_epoch_timestamps(conn: sqlite3.Connection):
+    """Store query-relevant times as epoch integers so ranges can use indexes"""
+    # القيم الافتراضية CURRENT_TIMESTAMP بتوقيت UTC، أما تواريخ انتهاء
+    # الاشتراك فكتبت بـ datetime.now() بتوقيت الخادم المحلي
+    conn.create_function("utc_text_to_ts", 1, lambda v: _parse_legacy(v, naive_utc=True))
+    conn.create_function("local_text_to_ts", 1, lambda v: _parse_legacy(v, naive_utc=False))
+
+    _add_column(conn, "users", "created_ts", "INTEGER")
+    conn.execute("UPDATE users SET created_ts = utc_text_to_ts(created_at)")
+
+    _add_column(conn, "rides", "created_ts", "INTEGER")
+    conn.execute("UPDATE rides SET created_ts = utc_text_to_ts(created_at)")
+
+    _add_column(conn, "subscriptions", "end_ts", "INTEGER")
+    conn.execute("UPDATE subscriptions SET end_ts = local_text_to_ts(end_date)")
+
+    _add_column(conn, "payments", "created_ts", "INTEGER")
+    conn.execute("UPDATE payments SET created_ts = utc_text_to_ts(created_at)")
+
+    _add_column(conn, "user_warnings", "created_ts", "INTEGER")
+    conn.execute("UPDATE user_warnings SET created_ts = utc_text_to_ts(created_at)")
+
+    # موعد الإرسال التالي ونهاية الجدولة محسوبان مسبقاً بدل حسابهما في كل استعلام
+    _add_column(conn, "scheduled_messages", "next_send_ts", "INTEGER")
+    _add_column(conn, "scheduled_messages", "expires_ts", "INTEGER")
+    conn.execute("""
+        UPDATE scheduled_messages SET
+            next_send_ts = COALESCE(utc_text_to_ts(last_sent) + interval_hours * 3600,
+                                    utc_text_to_ts(created_at)),
+            expires_ts = utc_text_to_ts(created_at) + duration_days * 86400
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_ts ON users (created_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rides_created_ts ON rides (created_ts)")
+
+    conn.execute("DROP INDEX IF EXISTS idx_subscriptions_active_user")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active_user_end
+        ON subscriptions (user_id, end_ts)
+        WHERE is_active = 1
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end
+        ON subscriptions (end_ts)
+        WHERE is_active = 1
+    """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_payments_completed_created_ts
+        ON payments (created_ts)
+        WHERE payment_status = 'completed'
+    """)
+
+    conn.execute("DROP INDEX IF EXISTS idx_user_warnings_user_created")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_warnings_user_created_ts
+        ON user_warnings (user_id, created_ts)
+    """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_scheduled_messages_next_send
+        ON scheduled_messages (next_send_ts)
+        WHERE is_active = 1
+    """)
+
+
+def _m004_ride_pickup_grid(conn: sqlite3.Connection):
+    """Index pending rides by the grid cell of their pickup point"""
+    conn.create_function("grid_cell", 2, grid_cell)
+    _add_column(conn, "rides", "pickup_cell", "INTEGER")
+    conn.execute("""
+        UPDATE rides SET pickup_cell = grid_cell(pickup_latitude, pickup_longitude)
+        WHERE pickup_latitude IS NOT NULL AND pickup_longitude IS NOT NULL
+    """)
+    # فهرس جزئي: الرحلة تخرج منه تلقائياً عند قبولها أو إلغائها
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_rides_pending_cell
+        ON rides (pickup_cell)
+        WHERE status = 'pending'
+    """)
+
+
+def _m005_conversation_state(conn: sqlite3.Connection):
+    """Store per-user and per-chat bot state (context.user_data / chat_data)"""
+    # kind = 'user' أو 'chat'، والبيانات مخزنة بصيغة JSON
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_ts INTEGER NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    """)
+
+
+def _m006_notification_outbox(conn: sqlite3.Connection):
+    """Notifications written in the same transaction as the state change they announce"""
+    # status = pending | sent | failed، و payload هو معاملات الإرسال بصيغة JSON
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL DEFAULT 'send_message',
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_ts INTEGER NOT NULL,
+            created_ts INTEGER NOT NULL,
+            sent_ts INTEGER,
+            last_error TEXT
+        )
+    """)
+    # فهرس جزئي بترتيب السحب: الإشعار يخرج منه عند إرساله أو فشله نهائياً
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (priority, outbox_id)
+        WHERE status = 'pending'
+    """)
+
+
+def _m007_scheduled_message_cron(conn: sqlite3.Connection):
+    """Allow scheduled messages to repeat on a cron expression instead of a fixed interval"""
+    _add_column(conn, "scheduled_messages", "cron_expr", "TEXT")
+
+
+# مشغلات الترحيل 8 كما نُشرت، مستقلة عن stats_counters التي تتغير تعريفاتها؛
+# الترحيل 9 يستبدلها بالتعريفات الحالية
+def _m008_bump(name: str, delta: str, when: str = "1") -> str:
+    return f"""
+        INSERT INTO stat_counters (name, value) SELECT {name}, {delta} WHERE {when}
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;"""
+
+
+def _m008_bump_daily(row: str, name: str, delta: str) -> str:
+    return f"""
+        INSERT INTO stat_daily (day, name, value)
+        SELECT ({row}.created_ts + COALESCE((SELECT value FROM stat_settings WHERE name = 'utc_offset'), 0)) / 86400,
+               '{name}', {delta}
+        WHERE {row}.created_ts IS NOT NULL
+        ON CONFLICT (day, name) DO UPDATE SET value = value + excluded.value;"""
+
+
+def _m008_row_changes(table: str, row: str, sign: str) -> str:
+    if table == 'users':
+        return (_m008_bump("'users.total'", sign)
+                + _m008_bump(f"'users.type.' || COALESCE({row}.user_type, 'none')", sign)
+                + _m008_bump_daily(row, 'users.new', sign))
+    if table == 'rides':
+        return (_m008_bump("'rides.total'", sign)
+                + _m008_bump(f"'rides.status.' || COALESCE({row}.status, 'none')", sign)
+                + _m008_bump_daily(row, 'rides.new', sign))
+    if table == 'subscriptions':
+        return _m008_bump("'subscriptions.total'", sign)
+    completed = f"{row}.payment_status = 'completed'"
+    return (_m008_bump(f"'payments.status.' || COALESCE({row}.payment_status, 'none')", sign)
+            + _m008_bump(f"'payments.completed.' || COALESCE({row}.payment_method, 'none') || '.count'",
+                         sign, completed)
+            + _m008_bump(f"'payments.completed.' || COALESCE({row}.payment_method, 'none') || '.amount'",
+                         f"{sign} * COALESCE({row}.amount, 0)", completed))
+
+
+_M008_TRACKED_COLUMNS = {
+    'users': ('user_type', 'created_ts'),
+    'rides': ('status', 'created_ts'),
+    'subscriptions': (),
+    'payments': ('payment_status', 'payment_method', 'amount'),
+}
+
+
+def _m008_stat_counters(conn: sqlite3.Connection):
+    """Counters for /stats kept current by triggers, backfilled from the existing rows"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_counters (
+            name TEXT PRIMARY KEY,
+            value NUMERIC NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    # day = رقم اليوم المحلي: (created_ts + فرق التوقيت) / 86400
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_daily (
+            day INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, name)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_settings (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    offset = utc_offset_seconds()
+    conn.execute("INSERT OR REPLACE INTO stat_settings (name, value) VALUES ('utc_offset', ?)", (offset,))
+
+    for table, columns in _M008_TRACKED_COLUMNS.items():
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS stat_{table}_insert AFTER INSERT ON {table}
+            BEGIN {_m008_row_changes(table, 'NEW', '1')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS stat_{table}_delete AFTER DELETE ON {table}
+            BEGIN {_m008_row_changes(table, 'OLD', '-1')}
+            END
+        """)
+        if columns:
+            changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in columns)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS stat_{table}_update
+                AFTER UPDATE OF {', '.join(columns)} ON {table}
+                WHEN {changed}
+                BEGIN {_m008_row_changes(table, 'OLD', '-1')} {_m008_row_changes(table, 'NEW', '1')}
+                END
+            """)
+
+    # القيم الابتدائية من الصفوف الموجودة
+    conn.execute("DELETE FROM stat_counters")
+    conn.execute("""
+        INSERT INTO stat_counters (name, value)
+        SELECT 'users.total', COUNT(*) FROM users
+        UNION ALL
+        SELECT 'users.type.' || COALESCE(user_type, 'none'), COUNT(*) FROM users GROUP BY 1
+        UNION ALL
+        SELECT 'rides.total', COUNT(*) FROM rides
+        UNION ALL
+        SELECT 'rides.status.' || COALESCE(status, 'none'), COUNT(*) FROM rides GROUP BY 1
+        UNION ALL
+        SELECT 'subscriptions.total', COUNT(*) FROM subscriptions
+        UNION ALL
+        SELECT 'payments.status.' || COALESCE(payment_status, 'none'), COUNT(*) FROM payments GROUP BY 1
+        UNION ALL
+        SELECT 'payments.completed.' || COALESCE(payment_method, 'none') || '.count', COUNT(*)
+        FROM payments WHERE payment_status = 'completed' GROUP BY 1
+        UNION ALL
+        SELECT 'payments.completed.' || COALESCE(payment_method, 'none') || '.amount', COALESCE(SUM(amount), 0)
+        FROM payments WHERE payment_status = 'completed' GROUP BY 1
+    """)
+    conn.execute("DELETE FROM stat_daily")
+    for table, name in (('users', 'users.new'), ('rides', 'rides.new')):
+        conn.execute(f"""
+            INSERT INTO stat_daily (day, name, value)
+            SELECT (created_ts + ?) / 86400, '{name}', COUNT(*) FROM {table}
+            WHERE created_ts IS NOT NULL GROUP BY 1
+        """, (offset,))
+
+
+def _m009_stat_rollups(conn: sqlite3.Connection):
+    """Daily and hourly revenue, payment and ride buckets for range reports"""
+    # hour = رقم الساعة المحلية: (created_ts + فرق التوقيت) / 3600
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_hourly (
+            hour INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, name)
+        ) WITHOUT ROWID
+    """)
+    # استبدال مشغلات الترحيل 8 بالتعريفات الحالية وإعادة بناء العدادات والدلاء
+    install_stats(conn)
+
+
+def _m010_keyset_indexes(conn: sqlite3.Connection):
+    """Indexes that let paginated listings walk from a cursor without sorting"""
+    # الفهرس على عمود واحد ينتهي ضمنياً بـ rowid (= ride_id)، فيعطي رحلات
+    # العميل أو الكابتن مرتبة حسب ride_id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rides_client_id ON rides (client_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rides_captain_id ON rides (captain_id)")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_rides_pending_id
+        ON rides (ride_id)
+        WHERE status = 'pending'
+    """)
+    # قائمة المستخدمين حسب النوع: (user_type, created_ts, user_id)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_type_created_ts ON users (user_type, created_ts)")
+
+
+def _m011_ride_version(conn: sqlite3.Connection):
+    """Row version on rides, bumped by every update, for cached ride cards"""
+    _add_column(conn, "rides", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _m012_outbox_failed_index(conn: sqlite3.Connection):
+    """Partial index on failed outbox rows so the metrics count them without a scan"""
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_failed
+        ON outbox (outbox_id)
+        WHERE status = 'failed'
+    """)
+
+
+def _m013_users_created_ts_backfill(conn: sqlite3.Connection):
+    """Give users whose legacy join time did not parse a created_ts so keyset pages reach them"""
+    # الصف بمفتاح NULL يخرج من مقارنة (created_ts, user_id) ولا يمكن ترميزه في المؤشر؛
+    # وقت الانضمام المجهول يُعامل كأقدم وقت فيظهر في آخر القائمة
+    conn.execute("UPDATE users SET created_ts = 0 WHERE created_ts IS NULL")
+
+
+def _m014_ride_finished_ts(conn: sqlite3.Connection):
+    """Completion time on finished rides so completed and cancelled rides are bucketed when they end"""
+    _add_column(conn, "rides", "finished_ts", "INTEGER")
+    # complete_ride و cancel_ride كتبا updated_at بـ datetime.now() بتوقيت الخادم المحلي،
+    # وكلتا الحالتين نهائيتان فهو وقت الانتهاء
+    conn.create_function("local_text_to_ts", 1, lambda v: _parse_legacy(v, naive_utc=False))
+    conn.execute("""
+        UPDATE rides SET finished_ts = local_text_to_ts(updated_at)
+        WHERE status IN ('completed', 'cancelled')
+    """)
+    # يُختم وقت الانتهاء لحظة تغير الحالة أياً كان مسار الكتابة، ويُمسح إن أعيد فتح الرحلة
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS rides_finished_ts AFTER UPDATE OF status ON rides
+        WHEN NEW.status IS NOT OLD.status
+        BEGIN
+            UPDATE rides SET finished_ts = CASE WHEN NEW.status IN ('completed', 'cancelled')
+                                                THEN CAST(strftime('%s', 'now') AS INTEGER) END
+            WHERE ride_id = NEW.ride_id;
+        END
+    """)
+    # دلاء rides.completed و rides.cancelled حسب finished_ts بدل rides.status.* حسب created_ts
+    install_stats(conn)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "baseline schema", _m001_baseline),
+    (2, "hot path indexes", _m002_hot_path_indexes),
+    (3, "epoch timestamps", _m003_epoch_timestamps),
+    (4, "ride pickup grid", _m004_ride_pickup_grid),
+    (5, "conversation state", _m005_conversation_state),
+    (6, "notification outbox", _m006_notification_outbox),
+    (7, "scheduled message cron", _m007_scheduled_message_cron),
+    (8, "stat counters", _m008_stat_counters),
+    (9, "stat rollups", _m009_stat_rollups),
+    (10, "keyset pagination indexes", _m010_keyset_indexes),
+    (11, "ride version", _m011_ride_version),
+    (12, "outbox failed index", _m012_outbox_failed_index),
+    (13, "users created_ts backfill", _m013_users_created_ts_backfill),
+    (14, "ride finished_ts", _m014_ride_finished_ts),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Return the highest applied migration version"""
+    row = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()
+    return row[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations in order and return the resulting version.
+
+    Each migration runs in its own IMMEDIATE transaction so concurrent
+    processes opening the same file never apply a step twice, and a failed
+    step leaves the schema at the previous version.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+    for version, description, apply in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # إعادة الفحص بعد الحصول على قفل الكتابة
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+            logger.info(f"Applied schema migration {version}: {description}")
+        except Exception:
+            conn.rollback()
+            logger.error(f"Schema migration {version} failed: {description}")
+            raise
+
+    return get_schema_version(conn)
@@ -1,54 +1,42 @@
 import sqlite3
-import re
-from datetime import datetime, timedelta
-from typing import List, Set
+from typing import List, Optional, Set
+from content_filter import PROMO_PATTERNS, AhoCorasickMatcher, normalize_arabic
+from cron import CronSchedule
+from db_connection import get_connection_manager
+from migrations import migrate
+from timeutil import now_ts
+from warning_counter import get_warning_counter
+from write_queue import get_write_queue, queued_write
+
+# قاعدة الحظر: 3 تحذيرات خلال آخر 30 يوماً
+BAN_WARNINGS = 3
+BAN_WINDOW_DAYS = 30
 
 class ModerationSystem:
+    _promo_patterns = {normalize_arabic(pattern) for pattern in PROMO_PATTERNS}
+
     def __init__(self, db_path: str = "mashawir_bot.db"):
         self.db_path = db_path
+        self.connections = get_connection_manager(db_path)
+        self.writes = get_write_queue(db_path)
+        self.warnings = get_warning_counter(db_path)
+        # معالج المجموعة يعدّ من الذاكرة داخل حلقة الأحداث؛ نافذة أقصر من قاعدة
+        # الحظر كانت ستحوّل كل عدّ إلى كتابة واستعلام يحجبان الحلقة
+        if self.warnings.window < BAN_WINDOW_DAYS * 86400:
+            raise ValueError(f"WARNING_WINDOW_DAYS must be at least {BAN_WINDOW_DAYS}")
         self.init_moderation_tables()
         self.load_banned_words()
+        if not self.warnings.loaded:
+            self.load_warnings()
+        self.warnings.start_writer(self._write_warnings)
 
     def init_moderation_tables(self):
         """Initialize moderation tables"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connections.connect() as conn:
             cursor = conn.cursor()
 
-            # Banned words table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS banned_words (
-                    word_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    word TEXT UNIQUE NOT NULL,
-                    added_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # User warnings table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_warnings (
-                    warning_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    reason TEXT,
-                    warned_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # Scheduled messages table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS scheduled_messages (
-                    schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
-                    message_text TEXT,
-                    interval_hours INTEGER,
-                    duration_days INTEGER,
-                    created_by INTEGER,
-                    is_active BOOLEAN DEFAULT 1,
-                    last_sent TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            # جداول الإشراف جزء من مخطط قاعدة البيانات الموحد
+            migrate(conn)
 
             # Insert default banned words
             default_banned_words = [
@@ -65,90 +53,101 @@ class ModerationSystem:
     def load_banned_words(self) -> Set[str]:
         """Load banned words from database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT word FROM banned_words")
                 self.banned_words = {row[0].lower() for row in cursor.fetchall()}
-                return self.banned_words
         except sqlite3.Error:
             self.banned_words = set()
-            return self.banned_words
+        # مطابق واحد للكلمات المحظورة وأنماط الترويج يفحص الرسالة بمرور واحد
+        self.matcher = AhoCorasickMatcher(PROMO_PATTERNS)
+        self.matcher.add_many(self.banned_words)
+        return self.banned_words
 
-    def add_banned_word(self, word: str, added_by: int) -> bool:
+    @queued_write(default=False)
+    def add_banned_word(self, conn: sqlite3.Connection, word: str, added_by: int) -> bool:
         """Add a word to banned list"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO banned_words (word, added_by) VALUES (?, ?)
-                """, (word.lower(), added_by))
-                conn.commit()
-                self.banned_words.add(word.lower())
-                return True
-        except sqlite3.Error:
-            return False
-
-    def remove_banned_word(self, word: str) -> bool:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO banned_words (word, added_by) VALUES (?, ?)
+        """, (word.lower(), added_by))
+        self.writes.on_commit(lambda: self._match(word))
+        return True
+
+    def _match(self, word: str):
+        self.banned_words.add(word.lower())
+        self.matcher.add(word)
+
+    @queued_write(default=False)
+    def remove_banned_word(self, conn: sqlite3.Connection, word: str) -> bool:
         """Remove a word from banned list"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM banned_words WHERE word = ?", (word.lower(),))
-                conn.commit()
-                self.banned_words.discard(word.lower())
-                return cursor.rowcount > 0
-        except sqlite3.Error:
-            return False
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM banned_words WHERE word = ?", (word.lower(),))
+        self.writes.on_commit(lambda: self._unmatch(word))
+        return cursor.rowcount > 0
+
+    def _unmatch(self, word: str):
+        """Drop a removed word from the matcher unless another pattern still needs it"""
+        self.banned_words.discard(word.lower())
+        normalized = normalize_arabic(word)
+        if normalized in self._promo_patterns:
+            return
+        if any(normalize_arabic(other) == normalized for other in self.banned_words):
+            return
+        self.matcher.remove(normalized)
 
     def check_message_content(self, message_text: str) -> bool:
         """Check if message contains banned content"""
         if not message_text:
             return False
 
-        message_lower = message_text.lower()
-
-        # Check for banned words
-        for banned_word in self.banned_words:
-            if banned_word in message_lower:
-                return True
-
-        # Check for promotional content patterns
-        promo_patterns = [
-            r'للبيع', r'للايجار', r'اعلان', r'اعلانات',
-            r'خصم', r'عرض', r'تخفيض', r'مجانا',
-            r'www\.', r'http', r'bit\.ly', r't\.me'
-        ]
+        # الكلمات المحظورة وأنماط الترويج في مرور واحد على النص بعد التطبيع
+        return self.matcher.search(message_text) is not None
 
-        for pattern in promo_patterns:
-            if re.search(pattern, message_lower):
-                return True
-
-        return False
-
-    def add_user_warning(self, user_id: int, reason: str, warned_by: int) -> bool:
-        """Add warning to user"""
+    def load_warnings(self):
+        """Load warnings inside the counting window into the in-memory counter"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
-                    INSERT INTO user_warnings (user_id, reason, warned_by)
-                    VALUES (?, ?, ?)
-                """, (user_id, reason, warned_by))
-                conn.commit()
-                return True
-        except sqlite3.Error:
-            return False
+                    SELECT user_id, created_ts FROM user_warnings
+                    WHERE created_ts > ?
+                """, (now_ts() - self.warnings.window,))
+                self.warnings.load(cursor.fetchall())
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+
+    def _write_warnings(self, rows):
+        """Insert a batch of queued warnings (called from the warning writer thread)"""
+        def write(conn: sqlite3.Connection):
+            conn.executemany("""
+                INSERT INTO user_warnings (user_id, reason, warned_by, created_ts)
+                VALUES (?, ?, ?, ?)
+            """, rows)
+
+        self.writes.run(write)
+
+    def add_user_warning(self, user_id: int, reason: str, warned_by: int) -> bool:
+        """Add warning to user"""
+        # يُحسب التحذير فوراً في الذاكرة ويُكتب إلى قاعدة البيانات على دفعات
+        self.warnings.record(user_id, reason, warned_by)
+        return True
 
-    def get_user_warnings_count(self, user_id: int, days: int = 30) -> int:
+    def get_user_warnings_count(self, user_id: int, days: int = BAN_WINDOW_DAYS) -> int:
         """Get user warning count in last N days"""
+        if days * 86400 <= self.warnings.window:
+            return self.warnings.count(user_id, days)
+
+        # فترة أطول من نافذة الذاكرة: كتابة المؤجل ثم العد من قاعدة البيانات
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            self.warnings.flush()
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
-                since_date = datetime.now() - timedelta(days=days)
+                since_ts = now_ts() - days * 86400
                 cursor.execute("""
                     SELECT COUNT(*) FROM user_warnings
-                    WHERE user_id = ? AND created_at > ?
-                """, (user_id, since_date))
+                    WHERE user_id = ? AND created_ts > ?
+                """, (user_id, since_ts))
                 return cursor.fetchone()[0]
         except sqlite3.Error:
             return 0
@@ -156,63 +155,69 @@ class ModerationSystem:
     def should_ban_user(self, user_id: int) -> bool:
         """Check if user should be banned based on warnings"""
         warnings_count = self.get_user_warnings_count(user_id)
-        return warnings_count >= 3
-
-    def schedule_message(self, chat_id: int, message_text: str, interval_hours: int,
-                        duration_days: int, created_by: int) -> bool:
-        """Schedule a recurring message"""
+        return warnings_count >= BAN_WARNINGS
+
+    @queued_write(default=None)
+    def schedule_message(self, conn: sqlite3.Connection, chat_id: int, message_text: str, interval_hours: int,
+                        duration_days: int, created_by: int, cron_expr: str = None) -> Optional[int]:
+        """Schedule a recurring message and return its schedule_id.
+
+        With cron_expr the message repeats on the cron schedule (bot timezone)
+        and interval_hours is ignored; otherwise it is sent now and then every
+        interval_hours.
+        """
+        cursor = conn.cursor()
+        now = now_ts()
+        next_send_ts = CronSchedule(cron_expr).next_after(now) if cron_expr else now
+        cursor.execute("""
+            INSERT INTO scheduled_messages
+            (chat_id, message_text, interval_hours, duration_days, created_by,
+             next_send_ts, expires_ts, cron_expr)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (chat_id, message_text, interval_hours, duration_days, created_by,
+              next_send_ts, now + duration_days * 86400, cron_expr))
+        return cursor.lastrowid
+
+    def get_active_scheduled_messages(self) -> List[dict]:
+        """Get every scheduled message that still has a send before it expires"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO scheduled_messages
-                    (chat_id, message_text, interval_hours, duration_days, created_by)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (chat_id, message_text, interval_hours, duration_days, created_by))
-                conn.commit()
-                return True
-        except sqlite3.Error:
-            return False
-
-    def get_pending_scheduled_messages(self) -> List[dict]:
-        """Get messages that need to be sent"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-
-                now = datetime.now()
                 cursor.execute("""
                     SELECT * FROM scheduled_messages
-                    WHERE is_active = 1
-                    AND (last_sent IS NULL OR
-                         datetime(last_sent, '+' || interval_hours || ' hours') <= datetime('now'))
-                    AND datetime(created_at, '+' || duration_days || ' days') > datetime('now')
-                """)
-
+                    WHERE is_active = 1 AND expires_ts > ?
+                    AND next_send_ts < expires_ts
+                """, (now_ts(),))
                 return [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error:
             return []
 
-    def mark_message_sent(self, schedule_id: int) -> bool:
-        """Mark scheduled message as sent"""
+    def get_scheduled_message(self, schedule_id: int) -> Optional[dict]:
+        """Get a scheduled message by ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE scheduled_messages
-                    SET last_sent = datetime('now')
-                    WHERE schedule_id = ?
-                """, (schedule_id,))
-                conn.commit()
-                return True
+                cursor.execute("SELECT * FROM scheduled_messages WHERE schedule_id = ?", (schedule_id,))
+                row = cursor.fetchone()
+                return dict(row) if row else None
         except sqlite3.Error:
-            return False
+            return None
+
+    @queued_write(default=False)
+    def mark_message_sent(self, conn: sqlite3.Connection, schedule_id: int, next_send_ts: int) -> bool:
+        """Mark scheduled message as sent and store when it is due next"""
+        conn.execute("""
+            UPDATE scheduled_messages
+            SET last_sent = datetime('now'),
+                next_send_ts = ?
+            WHERE schedule_id = ?
+        """, (next_send_ts, schedule_id))
+        return True
 
     def get_banned_words_list(self) -> List[str]:
         """Get list of all banned words"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT word FROM banned_words ORDER BY word")
                 return [row[0] for row in cursor.fetchall()]
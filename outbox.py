@@ -0,0 +1,51 @@
+import json
+import sqlite3
+from typing import Callable, Optional, Union
+from priorities import PRIORITY_NORMAL
+from timeutil import now_ts
+
+ChatId = Union[int, str]
+
+
+class Notification:
+    """A send_message call to store in the outbox with a state change.
+
+    text may be a callable; it is then called with the values the database
+    method passes to enqueue(), such as the id of the row it just created.
+    Options are stored as JSON, so reply_markup is given in its Bot API
+    form (``InlineKeyboardMarkup(...).to_dict()``).
+    """
+
+    __slots__ = ('chat_id', 'text', 'priority', 'options')
+
+    def __init__(self, chat_id: Optional[ChatId], text: Union[str, Callable[..., str]],
+                 priority: int = PRIORITY_NORMAL, **options):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.options = options
+
+
+def enqueue(conn: sqlite3.Connection, key: str, notification: Notification,
+            chat_id: Optional[ChatId] = None, **values) -> bool:
+    """Add a notification to the outbox inside the caller's transaction.
+
+    Does not commit. The key identifies the event (e.g. ``ride:12:accepted``);
+    a second notification with the same key is ignored. chat_id is used when
+    the notification does not name its recipient.
+    """
+    target = notification.chat_id if notification.chat_id is not None else chat_id
+    if target is None:
+        return False
+
+    text = notification.text(**values) if callable(notification.text) else notification.text
+    # أزرار الرسالة تصل بصيغة Bot API ويعيد الموزع بناءها عند الإرسال
+    payload = {'text': text, **notification.options}
+
+    now = now_ts()
+    cursor = conn.execute("""
+        INSERT OR IGNORE INTO outbox
+        (idempotency_key, chat_id, payload, priority, next_attempt_ts, created_ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (key, target, json.dumps(payload, ensure_ascii=False), notification.priority, now, now))
+    return cursor.rowcount > 0
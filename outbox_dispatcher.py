@@ -0,0 +1,240 @@
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+import functools
+from typing import Any, Dict, List, Optional, Set, Tuple
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+from async_db import get_executor
+from db_connection import get_connection_manager
+from send_queue import get_send_queue
+from timeutil import now_ts
+from write_queue import get_write_queue
+
+logger = logging.getLogger(__name__)
+
+# عدد الإشعارات التي يسحبها الموزع من الجدول في كل دورة
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200"))
+# أقصى مدة بالثواني بين فحصين للجدول (الإضافات الجديدة توقظ الموزع فوراً)
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+# عدد دورات الإرسال الفاشلة قبل اعتبار الإشعار فاشلاً نهائياً
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# مدة الاحتفاظ بالإشعارات المرسلة قبل حذفها
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+_PURGE_INTERVAL = 3600
+
+
+class OutboxDispatcher:
+    """Deliver outbox rows through the send queue.
+
+    Each cycle writes the results of the sends that finished since the last
+    cycle, then claims due pending rows in priority order, up to OUTBOX_BATCH
+    in flight; a row counts as in flight until its result is written. A send
+    that still fails after the queue's own retries is tried again in a later
+    cycle with exponential backoff. BadRequest and Forbidden, or
+    OUTBOX_MAX_ATTEMPTS failed cycles, mark the row failed. A row is marked
+    sent only after Telegram accepted it, so a crash between the two can
+    repeat a message but never drops one.
+    """
+
+    def __init__(self, db_path: str = "mashawir_bot.db", send_queue=None):
+        self.connections = get_connection_manager(db_path)
+        self.writes = get_write_queue(db_path)
+        self.send_queue = send_queue or get_send_queue()
+        self._in_flight: Set[int] = set()
+        # نتائج بانتظار الكتابة: (outbox_id, attempts, error)
+        self._results: List[Tuple[int, int, Optional[Exception]]] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._last_purge = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def _run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args))
+
+    # ============ دورة الحياة ============
+
+    async def start(self):
+        """Start delivering; rows left pending by a previous run go out first"""
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._loop(), name="outbox-dispatcher")
+        logger.info("Outbox dispatcher started")
+
+    def wake(self):
+        """Check the outbox now instead of at the next poll"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def stop(self, timeout: float = 30):
+        """Stop claiming rows, wait for sends in flight and record their results"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox dispatcher stopped with {len(self._in_flight)} sends in flight")
+        except Exception as e:
+            logger.error(f"Outbox dispatcher error on stop: {e}")
+        self._task = None
+        # ما لم يُسجل يبقى pending ويُرسل في التشغيل التالي
+        await self._record()
+
+    # ============ التوزيع ============
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._record()
+                if self._stopping:
+                    if not self._in_flight:
+                        return
+                else:
+                    claimed = await self._claim()
+                    if claimed and len(self._in_flight) < OUTBOX_BATCH:
+                        # ما زالت هناك صفوف مستحقة على الأرجح
+                        continue
+                    await self._purge_sent()
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error: {e}")
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def _select_due(self, limit: int) -> List[sqlite3.Row]:
+        with self.connections.connect() as conn:
+            return conn.execute("""
+                SELECT outbox_id, chat_id, method, payload, priority, attempts
+                FROM outbox
+                WHERE status = 'pending' AND next_attempt_ts <= ?
+                ORDER BY priority, outbox_id
+                LIMIT ?
+            """, (now_ts(), limit)).fetchall()
+
+    async def _claim(self) -> int:
+        room = OUTBOX_BATCH - len(self._in_flight)
+        if room <= 0:
+            return 0
+        # الصفوف الجارية ما زالت pending فتُطلب إضافية بعددها ثم تُستبعد
+        rows = await self._run_db(self._select_due, room + len(self._in_flight))
+        claimed = 0
+        for row in rows:
+            if row['outbox_id'] in self._in_flight or claimed >= room:
+                continue
+            self._dispatch(row)
+            claimed += 1
+        return claimed
+
+    def _dispatch(self, row: sqlite3.Row):
+        outbox_id = row['outbox_id']
+        attempts = row['attempts'] + 1
+        kwargs = json.loads(row['payload'])
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], self.send_queue.bot)
+        self._in_flight.add(outbox_id)
+
+        future = self.send_queue.submit(row['method'], row['chat_id'], row['priority'], **kwargs)
+
+        def done(f: asyncio.Future):
+            error = RuntimeError("send cancelled") if f.cancelled() else f.exception()
+            # يبقى المعرف في _in_flight حتى تُكتب النتيجة، وإلا قد يُسحب الصف مرة أخرى
+            self._results.append((outbox_id, attempts, error))
+            # تسجيل النتائج وسحب دفعة جديدة عند اكتمال نصف الدفعة، دون انتظار الفحص الدوري
+            if self._stopping or len(self._results) == OUTBOX_BATCH // 2:
+                self.wake()
+
+        future.add_done_callback(done)
+
+    # ============ تسجيل النتائج ============
+
+    def _write_results(self, conn: sqlite3.Connection, sent: list, retry: list, failed: list):
+        conn.executemany("""
+            UPDATE outbox SET status = 'sent', attempts = ?, sent_ts = ?, last_error = NULL
+            WHERE outbox_id = ?
+        """, sent)
+        conn.executemany("""
+            UPDATE outbox SET attempts = ?, next_attempt_ts = ?, last_error = ?
+            WHERE outbox_id = ?
+        """, retry)
+        conn.executemany("""
+            UPDATE outbox SET status = 'failed', attempts = ?, last_error = ?
+            WHERE outbox_id = ?
+        """, failed)
+
+    async def _record(self):
+        if not self._results:
+            return
+        results, self._results = self._results, []
+        now = now_ts()
+        sent, retry, failed = [], [], []
+        for outbox_id, attempts, error in results:
+            if error is None:
+                sent.append((attempts, now, outbox_id))
+            elif isinstance(error, (BadRequest, Forbidden)) or attempts >= OUTBOX_MAX_ATTEMPTS:
+                failed.append((attempts, str(error), outbox_id))
+            else:
+                # 30 ثانية ثم تتضاعف حتى ساعة
+                retry.append((attempts, now + min(3600, 30 * 2 ** (attempts - 1)), str(error), outbox_id))
+        try:
+            await self.writes.run_async(self._write_results, sent, retry, failed)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to record outbox results: {e}")
+            # الإعادة للدورة التالية؛ الصفوف تبقى pending حتى ذلك الحين
+            self._results.extend(results)
+            return
+        self._in_flight.difference_update(outbox_id for outbox_id, _, _ in results)
+        self.sent += len(sent)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        for _, error, outbox_id in failed:
+            logger.error(f"Outbox notification {outbox_id} failed permanently: {error}")
+
+    def _delete_sent(self, conn: sqlite3.Connection, before_ts: int) -> int:
+        cursor = conn.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND sent_ts < ?",
+            (before_ts,)
+        )
+        return cursor.rowcount
+
+    async def _purge_sent(self):
+        now = now_ts()
+        if now - self._last_purge < _PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        deleted = await self.writes.run_async(self._delete_sent, now - OUTBOX_RETENTION_DAYS * 86400)
+        if deleted:
+            logger.info(f"Purged {deleted} delivered outbox notifications")
+
+    # ============ المقاييس ============
+
+    def _count_unfinished(self) -> Tuple[int, int]:
+        # كل عدّ يمر على فهرسه الجزئي فقط، لا على الإشعارات المرسلة المتراكمة
+        with self.connections.connect() as conn:
+            pending = conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+            failed = conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'failed'").fetchone()[0]
+        return pending, failed
+
+    async def stats(self) -> Dict[str, Any]:
+        pending, failed = await self._run_db(self._count_unfinished)
+        return {
+            'pending': pending,
+            'failed_total': failed,
+            'in_flight': len(self._in_flight),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
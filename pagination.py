@@ -0,0 +1,89 @@
+import sqlite3
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# مؤشر الصفحة هو قيم مفتاح الترتيب لآخر صف معروض، بالأساس 36 ومفصولة بنقاط،
+# حتى يبقى callback_data أقصر من حد تيليجرام (64 بايت)
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+Cursor = Tuple[int, ...]
+
+
+def _base36(value: int) -> str:
+    if value < 0:
+        return '-' + _base36(-value)
+    text = ''
+    while True:
+        value, digit = divmod(value, 36)
+        text = _DIGITS[digit] + text
+        if not value:
+            return text
+
+
+def encode_cursor(values: Sequence[int]) -> str:
+    return '.'.join(_base36(int(value)) for value in values)
+
+
+def decode_cursor(text: str) -> Cursor:
+    """Parse a cursor from callback data; raises ValueError when it is malformed"""
+    return tuple(int(part, 36) for part in text.split('.'))
+
+
+class Page:
+    """One page of a keyset-paginated listing, newest first.
+
+    next_cursor and prev_cursor are encoded cursors for the neighbouring
+    pages, or None at either end.
+    """
+
+    __slots__ = ('items', 'next_cursor', 'prev_cursor')
+
+    def __init__(self, items: List[Dict[str, Any]], next_cursor: Optional[str], prev_cursor: Optional[str]):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def fetch_page(conn: sqlite3.Connection, sql: str, params: Dict[str, Any], keys: Sequence[str],
+               limit: int, cursor: Optional[str] = None, backward: bool = False) -> Page:
+    """Run a keyset query and return the page after (or before) cursor.
+
+    sql contains ``{keyset}`` where the cursor condition goes, ``{order}``
+    for the ORDER BY terms and ``:limit``; each may appear more than once
+    (e.g. in both halves of a UNION). keys are the unique sort columns,
+    newest first when descending; the last part of each name must be a
+    column of the result. Every page is an index range of limit + 1 rows,
+    so page N costs the same as page 1.
+    """
+    values = decode_cursor(cursor) if cursor else None
+    if values is not None and len(values) != len(keys):
+        raise ValueError(f"Cursor has {len(values)} values, expected {len(keys)}")
+
+    args = dict(params)
+    if values is None:
+        keyset = "1"
+    else:
+        placeholders = ', '.join(f":cursor{n}" for n in range(len(keys)))
+        # السابق: الصفوف الأحدث من المؤشر بترتيب تصاعدي ثم تُعكس
+        keyset = f"({', '.join(keys)}) {'>' if backward else '<'} ({placeholders})"
+        args.update({f"cursor{n}": value for n, value in enumerate(values)})
+    order = ', '.join(f"{key} {'ASC' if backward else 'DESC'}" for key in keys)
+    args['limit'] = limit + 1
+
+    rows = [dict(row) for row in conn.execute(sql.format(keyset=keyset, order=order), args).fetchall()]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+
+    def key_of(row: Dict[str, Any]) -> str:
+        return encode_cursor([row[key.rsplit('.', 1)[-1]] for key in keys])
+
+    if not rows:
+        # حُذفت صفوف الصفحة منذ عرضها: العودة إلى الصفحة الأولى
+        if values is not None:
+            return fetch_page(conn, sql, params, keys, limit)
+        return Page([], None, None)
+    if backward:
+        return Page(rows, key_of(rows[-1]), key_of(rows[0]) if more else None)
+    return Page(rows, key_of(rows[-1]) if more else None, key_of(rows[0]) if values is not None else None)
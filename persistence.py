@@ -0,0 +1,188 @@
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+import functools
+from typing import Dict, Optional, Set, Tuple
+from telegram.ext import BasePersistence, PersistenceInput
+from async_db import get_executor
+from db_connection import get_connection_manager
+from migrations import migrate
+from timeutil import now_ts
+from write_queue import get_write_queue
+
+logger = logging.getLogger(__name__)
+
+# كل كم ثانية يسلّم التطبيق بيانات المستخدمين المتغيرة للحفظ
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "10"))
+
+StateKey = Tuple[str, int]  # ('user' | 'chat', id)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persist context.user_data and context.chat_data in the bot's SQLite file.
+
+    Nothing is loaded at startup. refresh_user_data/refresh_chat_data load
+    a user's or chat's state the first time one of its updates arrives.
+    Every update_interval seconds the Application hands over the entries
+    that changed. They are serialized into a dirty map, and a background
+    task writes the whole batch in one transaction through the write
+    queue. flush() writes whatever is left at shutdown.
+    """
+
+    def __init__(self, db_path: str = "mashawir_bot.db", update_interval: float = STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.connections = get_connection_manager(db_path)
+        self.write_queue = get_write_queue(db_path)
+        with self.connections.connect() as conn:
+            migrate(conn)
+
+        self._loaded: Set[StateKey] = set()
+        self._loading: Dict[StateKey, asyncio.Future] = {}
+        # None تعني حذف الحالة المخزنة
+        self._dirty: Dict[StateKey, Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.writes = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args))
+
+    # ============ القراءة (عند أول تحديث للمستخدم أو المحادثة) ============
+
+    def _load(self, kind: str, key: int) -> Optional[dict]:
+        with self.connections.connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM conversation_state WHERE kind = ? AND key = ?",
+                (kind, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def _refresh(self, kind: str, key: int, data: dict):
+        state_key = (kind, key)
+        if state_key in self._loaded:
+            return
+
+        pending = self._loading.get(state_key)
+        if pending is not None:
+            # تحميل جارٍ لنفس المفتاح من تحديث آخر
+            await pending
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[state_key] = future
+        try:
+            stored = await self._run(self._load, kind, key)
+            self.loads += 1
+            if stored:
+                # القيم التي كُتبت في الذاكرة قبل اكتمال التحميل لها الأولوية
+                for name, value in stored.items():
+                    data.setdefault(name, value)
+            self._loaded.add(state_key)
+        except (sqlite3.Error, ValueError) as e:
+            logger.error(f"Failed to load {kind} state for {key}: {e}")
+        finally:
+            del self._loading[state_key]
+            future.set_result(None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh('chat', chat_id, chat_data)
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        # التحميل كسول لكل مستخدم، لذلك لا يعتمد وقت التشغيل على عدد المستخدمين
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    # ============ الكتابة المؤجلة ============
+
+    def _mark(self, kind: str, key: int, data: Optional[dict]):
+        try:
+            payload = json.dumps(data, ensure_ascii=False) if data else None
+        except (TypeError, ValueError) as e:
+            logger.error(f"Cannot persist {kind} state for {key}: {e}")
+            return
+        self._dirty[(kind, key)] = payload
+        # مهمة واحدة تكتب كل ما تراكم خلال دورة الحفظ الحالية
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_dirty())
+
+    def _write(self, conn: sqlite3.Connection, batch: Dict[StateKey, Optional[str]]):
+        now = now_ts()
+        upserts = [(kind, key, data, now) for (kind, key), data in batch.items() if data is not None]
+        deletes = [(kind, key) for (kind, key), data in batch.items() if data is None]
+        conn.executemany("""
+            INSERT INTO conversation_state (kind, key, data, updated_ts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                data = excluded.data,
+                updated_ts = excluded.updated_ts
+        """, upserts)
+        conn.executemany(
+            "DELETE FROM conversation_state WHERE kind = ? AND key = ?",
+            deletes
+        )
+
+    async def _flush_dirty(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self.write_queue.run_async(self._write, batch)
+            self.writes += len(batch)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to persist conversation state: {e}")
+            # إعادة المدخلات التي لم تتغير بعدها لمحاولة كتابتها في الدورة التالية
+            for state_key, payload in batch.items():
+                self._dirty.setdefault(state_key, payload)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark('user', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._mark('chat', chat_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark('chat', chat_id, None)
+
+    async def flush(self) -> None:
+        """Write all pending state; called by the Application on shutdown"""
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_dirty()
+
+    # ============ بيانات غير مستخدمة في البوت ============
+    # لا يستخدم البوت bot_data أو callback_data أو ConversationHandler دائم
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
@@ -0,0 +1,13 @@
+# فئات أولوية الإرسال: الرقم الأصغر يُرسل أولاً
+# وحدة بلا اعتماد على مكتبة تيليجرام حتى يستخدمها outbox من داخل database
+PRIORITY_RIDE = 0       # قبول وبدء وإنهاء الرحلات
+PRIORITY_PAYMENT = 1    # تأكيد ورفض المدفوعات والاشتراكات
+PRIORITY_NORMAL = 2     # إشعارات الإدارة والمجموعات
+PRIORITY_BULK = 3       # الرسائل المجدولة والإشعارات الجماعية
+
+PRIORITY_NAMES = {
+    PRIORITY_RIDE: 'ride',
+    PRIORITY_PAYMENT: 'payment',
+    PRIORITY_NORMAL: 'normal',
+    PRIORITY_BULK: 'bulk',
+}
@@ -0,0 +1,195 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from logging.handlers import RotatingFileHandler
+from typing import Any, Callable, List, Optional, Tuple
+from metrics import get_metrics
+
+# العبارات الأبطأ من هذا الحد بالمللي ثانية تُسجل مع معاملاتها وخطة تنفيذها (0 يعطل السجل)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "50"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_LOG_BYTES = int(os.getenv("SLOW_QUERY_LOG_BYTES", str(5 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "3"))
+
+# العبارات التي يمكن شرح خطتها بـ EXPLAIN QUERY PLAN
+_EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|REPLACE|UPDATE|DELETE)\b', re.IGNORECASE)
+_SCAN = re.compile(r'^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?')
+_MAX_PARAMS_LEN = 500
+
+_slow_statements = get_metrics().counter(
+    'bot_db_slow_statements_total', "SQL statements slower than SLOW_QUERY_MS")
+# الحد بالثواني كما يعيده time.perf_counter، واللانهاية تعطل السجل
+_SLOW_S = SLOW_QUERY_MS / 1000 if SLOW_QUERY_MS > 0 else float('inf')
+_clock = time.perf_counter
+_capturing = 0
+_logger: Optional[logging.Logger] = None
+_logger_lock = threading.Lock()
+_capture = threading.local()
+
+
+def _slow_logger() -> logging.Logger:
+    """Logger writing to the rotating slow-query file, opened on first use"""
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            logger = logging.getLogger('slow_queries')
+            logger.propagate = False
+            logger.setLevel(logging.WARNING)
+            handler = RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=SLOW_QUERY_LOG_BYTES,
+                                          backupCount=SLOW_QUERY_LOG_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            logger.addHandler(handler)
+            _logger = logger
+        return _logger
+
+
+def explain(conn: sqlite3.Connection, sql: str, params: Any = ()) -> List[str]:
+    """Return the EXPLAIN QUERY PLAN detail lines of a statement, empty if it has none"""
+    if not _EXPLAINABLE.match(sql):
+        return []
+    # تنفيذ مباشر دون المرور بالتوقيت حتى لا يُسجل الشرح نفسه
+    rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [row[3] for row in rows]
+
+
+def plan_scans(plan: List[str]) -> List[Tuple[str, Optional[str]]]:
+    """(table or alias, index or None) for every full scan step in a query plan"""
+    return [match.groups() for match in map(_SCAN.match, plan) if match]
+
+
+def _log_slow(conn: sqlite3.Connection, sql: str, params: Any, elapsed_ms: float, many: bool = False):
+    _slow_statements.inc(())
+    if not SLOW_QUERY_LOG:
+        return
+    try:
+        plan = ['(executemany)'] if many else explain(conn, sql, params)
+    except sqlite3.Error as e:
+        plan = [f'(explain failed: {e})']
+    text = ' '.join(sql.split())
+    shown = repr(params)
+    if len(shown) > _MAX_PARAMS_LEN:
+        shown = shown[:_MAX_PARAMS_LEN] + '...'
+    _slow_logger().warning(f"{elapsed_ms:.1f} ms | {text} | params={shown} | plan: {'; '.join(plan) or '-'}")
+
+
+class capture_plans:
+    """Collect (sql, plan) for every statement this thread runs through TimedConnection.
+
+    Used by check_query_plans.py to see what the Database methods really
+    execute instead of keeping copies of their SQL.
+    """
+
+    def __enter__(self) -> List[Tuple[str, List[str]]]:
+        global _capturing
+        self.plans: List[Tuple[str, List[str]]] = []
+        _capture.plans = self.plans
+        _capturing += 1
+        return self.plans
+
+    def __exit__(self, *exc):
+        global _capturing
+        _capture.plans = None
+        _capturing -= 1
+        return False
+
+
+def current_capture() -> Optional[List[Tuple[str, List[str]]]]:
+    """The plan list this thread is capturing into, if any"""
+    return getattr(_capture, 'plans', None) if _capturing else None
+
+
+def captured_into(plans: List[Tuple[str, List[str]]], func: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap func so the statements it runs on another thread land in plans"""
+    def run(*args, **kwargs):
+        previous = getattr(_capture, 'plans', None)
+        _capture.plans = plans
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _capture.plans = previous
+    return run
+
+
+def _captured(conn: sqlite3.Connection, sql: str, params: Any):
+    plans = getattr(_capture, 'plans', None)
+    if plans is not None and _EXPLAINABLE.match(sql):
+        plans.append((' '.join(sql.split()), explain(conn, sql, params)))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor timing execute plus the fetch that follows it.
+
+    Statements under the threshold keep their running time in _pending
+    so that a slow fetchall/fetchone of the same statement is still
+    caught; the bookkeeping is kept inline because it runs for every
+    statement the bot executes.
+    """
+
+    _pending: Optional[Tuple[str, Any, float]] = None
+
+    def execute(self, sql: str, parameters: Any = ()):
+        if _capturing:
+            _captured(self.connection, sql, parameters)
+        started = _clock()
+        cursor = super().execute(sql, parameters)
+        elapsed = _clock() - started
+        if elapsed >= _SLOW_S:
+            self._pending = None
+            _log_slow(self.connection, sql, parameters, elapsed * 1000)
+        else:
+            # قد يحدث معظم العمل أثناء قراءة الصفوف، فيُحتسب مع التنفيذ
+            self._pending = (sql, parameters, elapsed)
+        return cursor
+
+    def executemany(self, sql: str, seq_of_parameters):
+        self._pending = None
+        started = _clock()
+        cursor = super().executemany(sql, seq_of_parameters)
+        elapsed = _clock() - started
+        if elapsed >= _SLOW_S:
+            _log_slow(self.connection, sql, '(batch)', elapsed * 1000, many=True)
+        return cursor
+
+    def fetchone(self):
+        started = _clock()
+        row = super().fetchone()
+        if self._pending is not None:
+            self._fetched(_clock() - started)
+        return row
+
+    def fetchall(self):
+        started = _clock()
+        rows = super().fetchall()
+        if self._pending is not None:
+            self._fetched(_clock() - started)
+        return rows
+
+    def _fetched(self, elapsed: float):
+        sql, parameters, total = self._pending
+        total += elapsed
+        if total >= _SLOW_S:
+            self._pending = None
+            _log_slow(self.connection, sql, parameters, total * 1000)
+        else:
+            self._pending = (sql, parameters, total)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements all go through TimedCursor.
+
+    Pass as ``factory`` to sqlite3.connect. Connection.execute is
+    overridden too because the C implementation does not call the
+    cursor's execute method.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
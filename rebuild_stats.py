@@ -0,0 +1,49 @@
+"""Rebuild the stat counters and daily/hourly buckets from the raw tables.
+
+Migrations already backfill the buckets on upgrade. Use this tool after
+restoring or importing rows with the triggers disabled, or to check a
+database offline. It holds the write lock for the whole rebuild, so run
+it while the bot is stopped on large databases.
+
+    python rebuild_stats.py
+    python rebuild_stats.py --db /path/to/mashawir_bot.db --check
+"""
+import sys
+import time
+import argparse
+import sqlite3
+from migrations import migrate
+from stats_counters import reconcile, set_utc_offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default='mashawir_bot.db', help='database file')
+    parser.add_argument('--check', action='store_true', help='report drift without rewriting')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    migrate(conn)
+    started = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        set_utc_offset(conn)
+        drift = reconcile(conn, repair=not args.check)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for name, stored, expected in drift[:50]:
+        print(f"{name}: {stored:g} -> {expected:g}")
+    if len(drift) > 50:
+        print(f"... {len(drift) - 50} more")
+    action = "found" if args.check else "fixed"
+    print(f"{len(drift)} drifted values {action} in {time.perf_counter() - started:.1f}s")
+    return 1 if args.check and drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
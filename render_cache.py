@@ -0,0 +1,107 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class RenderCache:
+    """LRU cache of rendered ride cards keyed by ride, validated by version.
+
+    Each key keeps only the version it was rendered from. The ride's
+    version column is bumped by every write to the ride, so a status change
+    makes the next lookup re-render and replace the old card.
+    """
+
+    def __init__(self, max_entries: int = 2000):
+        self._max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Tuple[Hashable, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def get(self, key: Hashable, version: Hashable, render: Callable[[], Any]) -> Any:
+        """Return the cached value for key at version, rendering it on a miss"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.invalidated += 1
+        self.misses += 1
+        value = render()
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key: Hashable):
+        """Drop the cached value for key"""
+        if self._entries.pop(key, None) is not None:
+            self.invalidated += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters, the number of cached entries and the hit rate"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def digest(*parts: Any) -> bytes:
+    """Short stable hash of the repr of parts"""
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).digest()
+
+
+class EditTracker:
+    """Remembers what each bot message last showed so no-op edits can be skipped.
+
+    For every message edited through it the tracker keeps the digest of the
+    content that was sent and the digest of the message as Telegram returned
+    it. An edit is unchanged only if the new content digest matches and the
+    message still shows what it showed after that edit, so a message later
+    changed by another handler is edited again.
+    """
+
+    def __init__(self, max_messages: int = 5000):
+        self._max_messages = max_messages
+        self._messages: 'OrderedDict[Tuple[int, int], Tuple[bytes, bytes]]' = OrderedDict()
+        self.edits = 0
+        self.skipped = 0
+        self.not_modified = 0
+
+    def unchanged(self, message_key: Tuple[int, int], content: bytes, shown: Optional[bytes]) -> bool:
+        """Return True (and count a saved call) if editing to content would change nothing"""
+        entry = self._messages.get(message_key)
+        if entry is None or shown is None or entry != (content, shown):
+            return False
+        self._messages.move_to_end(message_key)
+        self.skipped += 1
+        return True
+
+    def record(self, message_key: Tuple[int, int], content: bytes, shown: Optional[bytes], modified: bool = True):
+        """Remember the content a message now shows after an edit call"""
+        if modified:
+            self.edits += 1
+        else:
+            self.not_modified += 1
+        if shown is None:
+            self._messages.pop(message_key, None)
+            return
+        self._messages[message_key] = (content, shown)
+        self._messages.move_to_end(message_key)
+        if len(self._messages) > self._max_messages:
+            self._messages.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Return edit counters; skipped edits are API calls saved, not_modified ones were wasted"""
+        return {
+            'messages': len(self._messages),
+            'edits': self.edits,
+            'skipped': self.skipped,
+            'not_modified': self.not_modified,
+        }
@@ -0,0 +1,280 @@
+"""Replay recorded Telegram updates against a locally running bot.
+
+The script starts a stand-in for the Bot API on 127.0.0.1 and runs
+main.py in a subprocess with TELEGRAM_API_URL pointing at it. In webhook
+mode the updates are POSTed to the bot's webhook server with the secret
+token header. In polling mode they are handed out through getUpdates.
+For each update the script measures the time from delivery to the bot's
+first Bot API call for that chat, then stops the bot with SIGTERM and
+counts how many updates reached the database.
+
+    python replay_updates.py --mode webhook --count 200
+    python replay_updates.py --mode webhook --count 100 --interval 0.05
+    python replay_updates.py --mode polling --updates recorded.jsonl
+"""
+import os
+import sys
+import json
+import time
+import signal
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_TOKEN = "123456:REPLAY"
+SECRET_TOKEN = "replay-secret"
+
+
+class FakeBotAPI:
+    """Minimal Bot API: answers the methods the bot calls and serves getUpdates"""
+
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+        self.delivered_at = {}
+        self.first_reply_at = {}
+        self.calls = 0
+        self.polling = threading.Event()
+
+    def publish(self, updates):
+        """Make updates available to getUpdates and stamp their delivery time"""
+        with self.condition:
+            now = time.perf_counter()
+            for update in updates:
+                self.delivered_at.setdefault(_chat_id(update), now)
+            self.pending.extend(updates)
+            self.condition.notify_all()
+
+    def get_updates(self, offset, timeout):
+        self.polling.set()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                updates = [u for u in self.pending if u['update_id'] >= offset]
+                if updates or time.monotonic() >= deadline:
+                    self.pending = updates
+                    return updates
+                self.condition.wait(deadline - time.monotonic())
+
+    def record_call(self, params):
+        self.calls += 1
+        chat_id = params.get('chat_id')
+        if chat_id is not None:
+            self.first_reply_at.setdefault(int(chat_id), time.perf_counter())
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or '{}')
+                else:
+                    params = {k: _json_value(v[0]) for k, v in parse_qs(body).items()}
+
+                if method == 'getUpdates':
+                    result = api.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+                elif method == 'getMe':
+                    result = {'id': 1, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+                elif method in ('sendMessage', 'editMessageText'):
+                    api.record_call(params)
+                    result = {
+                        'message_id': 1, 'date': int(time.time()),
+                        'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                        'text': params.get('text', '')
+                    }
+                else:
+                    api.record_call(params)
+                    result = True
+
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+def _json_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _chat_id(update):
+    message = update.get('message') or update.get('callback_query', {}).get('message') or {}
+    return message.get('chat', {}).get('id')
+
+
+def synthetic_updates(count, first_user=900000000):
+    """/start messages from `count` distinct private chats"""
+    updates = []
+    for n in range(count):
+        user_id = first_user + n
+        updates.append({
+            'update_id': n + 1,
+            'message': {
+                'message_id': n + 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{n}'},
+                'text': '/start',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+            }
+        })
+    return updates
+
+
+def _free_port():
+    with ThreadingHTTPServer(('127.0.0.1', 0), BaseHTTPRequestHandler) as server:
+        return server.server_address[1]
+
+
+def _wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def _post_update(url, update):
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode(), method='POST',
+        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def replay(mode, updates, workdir, python, interval=0.0):
+    api = FakeBotAPI()
+    api_server = ThreadingHTTPServer(('127.0.0.1', 0), api.handler())
+    threading.Thread(target=api_server.serve_forever, daemon=True).start()
+    webhook_port = _free_port()
+
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'BOT_MODE': mode,
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{api_server.server_address[1]}/bot",
+        'WEBHOOK_URL': f"http://127.0.0.1:{webhook_port}",
+        'WEBHOOK_LISTEN': '127.0.0.1',
+        'WEBHOOK_PORT': str(webhook_port),
+        'WEBHOOK_SECRET': SECRET_TOKEN,
+        'DROP_PENDING_UPDATES': 'false',
+        'STATE_FLUSH_INTERVAL': '1',
+    })
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    bot = subprocess.Popen([python, main_py], cwd=workdir, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if mode == 'webhook':
+            url = f"http://127.0.0.1:{webhook_port}/telegram"
+
+            def webhook_ready():
+                try:
+                    _post_update(url, {'update_id': 0})
+                    return True
+                except (urllib.error.URLError, ConnectionError):
+                    return False
+
+            if not _wait_for(webhook_ready, 30):
+                raise RuntimeError("webhook server did not start")
+
+            # طلب بدون الرمز السري يجب أن يُرفض
+            bad = urllib.request.Request(url, data=b'{}', method='POST', headers={'Content-Type': 'application/json'})
+            try:
+                urllib.request.urlopen(bad, timeout=5)
+                rejected = False
+            except urllib.error.HTTPError as e:
+                rejected = e.code == 403
+
+            for update in updates:
+                api.delivered_at.setdefault(_chat_id(update), time.perf_counter())
+                _post_update(url, update)
+                time.sleep(interval)
+        else:
+            rejected = None
+            if not api.polling.wait(30):
+                raise RuntimeError("bot did not start polling")
+            if interval:
+                for update in updates:
+                    api.publish([update])
+                    time.sleep(interval)
+            else:
+                api.publish(updates)
+
+        chats = {_chat_id(u) for u in updates}
+        _wait_for(lambda: chats <= set(api.first_reply_at), 60)
+    finally:
+        # إيقاف البوت كما يفعل مدير الخدمة، مع انتظار إكمال الطابور
+        bot.send_signal(signal.SIGTERM)
+        exit_code = bot.wait(timeout=60)
+        api_server.shutdown()
+
+    latencies = [
+        (api.first_reply_at[chat] - api.delivered_at[chat]) * 1000
+        for chat in api.delivered_at if chat in api.first_reply_at
+    ]
+    with sqlite3.connect(os.path.join(workdir, 'mashawir_bot.db')) as conn:
+        stored = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    return {
+        'mode': mode,
+        'interval_s': interval,
+        'updates': len(updates),
+        'replied': len(latencies),
+        'stored_users': stored,
+        'secret_rejected': rejected,
+        'exit_code': exit_code,
+        'latency_ms': {
+            'p50': round(_percentile(latencies, 0.5), 2),
+            'p95': round(_percentile(latencies, 0.95), 2),
+            'max': round(max(latencies), 2),
+        } if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=['webhook', 'polling'], default='webhook')
+    parser.add_argument('--count', type=int, default=100, help='number of synthetic /start updates')
+    parser.add_argument('--updates', help='JSON lines file of recorded updates')
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='seconds between updates (0 sends them as one burst)')
+    parser.add_argument('--python', default=sys.executable, help='interpreter with the bot dependencies')
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthetic_updates(args.count)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(json.dumps(replay(args.mode, updates, workdir, args.python, args.interval), indent=2))
+
+
+if __name__ == '__main__':
+    main()
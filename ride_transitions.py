@@ -0,0 +1,68 @@
+import sqlite3
+from typing import Any, Dict, Optional
+
+# أسباب فشل انتقال حالة الرحلة
+NOT_FOUND = 'not_found'        # لا توجد رحلة بهذا الرقم
+NOT_YOURS = 'not_yours'        # الرحلة ليست للمستخدم (أو لكابتن آخر)
+TAKEN = 'taken'                # قبلها كابتن آخر أولاً
+ALREADY_DONE = 'already_done'  # الرحلة في الحالة المطلوبة بفعل نفس المستخدم (ضغطة مكررة)
+WRONG_STATUS = 'wrong_status'  # تغيرت حالتها (ألغيت أو اكتملت مثلاً)
+ERROR = 'error'                # خطأ في قاعدة البيانات
+
+# أعمدة الرحلة مع أسماء العميل والكابتن بنفس مفاتيح get_ride_by_id
+RIDE_RETURNING = """
+    RETURNING *,
+        (SELECT username FROM users WHERE user_id = rides.client_id) AS client_username,
+        (SELECT first_name FROM users WHERE user_id = rides.client_id) AS client_name,
+        (SELECT username FROM users WHERE user_id = rides.captain_id) AS captain_username,
+        (SELECT first_name FROM users WHERE user_id = rides.captain_id) AS captain_name
+"""
+
+
+class Transition:
+    """Outcome of a ride state change.
+
+    ride is the updated ride (with client/captain names) when the change
+    was applied, otherwise None and reason says why. A Transition is true
+    only when it was applied, so callers that treated the old bool result
+    keep working.
+    """
+
+    __slots__ = ('ride', 'reason')
+
+    def __init__(self, ride: Optional[Dict[str, Any]], reason: Optional[str] = None):
+        self.ride = ride
+        self.reason = reason
+
+    def __bool__(self) -> bool:
+        return self.ride is not None
+
+    def __repr__(self) -> str:
+        return f"Transition(ride={self.ride and self.ride['ride_id']}, reason={self.reason})"
+
+
+FAILED = Transition(None, ERROR)
+
+
+def failure_reason(conn: sqlite3.Connection, ride_id: int, user_id: int, target: str,
+                   captain_only: bool = True) -> str:
+    """Why a transition of ride_id to target by user_id matched no row.
+
+    Runs in the transaction of the failed UPDATE, so it sees the state
+    that beat it. captain_only is False for changes the client may make
+    as well (cancelling).
+    """
+    row = conn.execute(
+        "SELECT status, client_id, captain_id FROM rides WHERE ride_id = ?", (ride_id,)
+    ).fetchone()
+    if row is None:
+        return NOT_FOUND
+    status, client_id, captain_id = row
+    owner = captain_id == user_id or (not captain_only and client_id == user_id)
+    if status == target and owner:
+        return ALREADY_DONE
+    if target == 'accepted' and captain_id is not None and captain_id != user_id:
+        return TAKEN
+    if not owner and target != 'accepted':
+        return NOT_YOURS
+    return WRONG_STATUS
@@ -1,93 +1,244 @@
+import os
+import time
+import heapq
 import asyncio
 import logging
-from datetime import datetime
+import itertools
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application
 from moderation import ModerationSystem
 from database import Database
+from async_db import AsyncDatabase
+from callback_router import RouteMetrics
+from cron import CronSchedule, parse_cron
+from send_queue import get_send_queue
+from priorities import PRIORITY_BULK
 
 logger = logging.getLogger(__name__)
 
+# موعد فحص الاشتراكات المنتهية بصيغة cron وبتوقيت البوت
+SUBSCRIPTION_CLEANUP_CRON = os.getenv("SUBSCRIPTION_CLEANUP_CRON", "*/10 * * * *")
+# مدة إعادة المحاولة بالثواني لرسالة مجدولة فشل إرسالها
+SCHEDULE_RETRY_SECONDS = 600
+
+# أقصى مدة نوم قبل إعادة قراءة الساعة، تحسباً لتعديل ساعة النظام
+_MAX_SLEEP = 60
+
+# تستقبل الدالة موعدها المجدول وتعيد موعدها التالي أو None للتوقف
+TimerCallback = Callable[[float], Awaitable[Optional[float]]]
+
+
+class TimerEngine:
+    """Fire async callbacks at epoch times kept in a min-heap.
+
+    The loop sleeps until the earliest entry is due, or until a job is
+    added, so nothing runs while no timer is due. Each callback runs in
+    its own task and receives the time it was scheduled for. It returns
+    its next fire time, or None to stop. Scheduling an existing key
+    replaces it; the stale heap entry is skipped when it is popped.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        self._jobs: Dict[str, Tuple[int, TimerCallback]] = {}
+        self._seq = itertools.count()
+        self._changed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self.fired = 0
+        # التأخر بين الموعد المجدول ولحظة التنفيذ
+        self.lateness = RouteMetrics()
+
+    def schedule(self, key: str, when: float, callback: TimerCallback):
+        """Run callback at epoch time `when`, replacing any job with the same key"""
+        seq = next(self._seq)
+        self._jobs[key] = (seq, callback)
+        heapq.heappush(self._heap, (when, seq, key))
+        if self._changed is not None:
+            self._changed.set()
+
+    def cancel(self, key: str):
+        self._jobs.pop(key, None)
+
+    def next_fire(self) -> Optional[float]:
+        """Epoch time of the earliest live job"""
+        while self._heap and self._jobs.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    async def start(self):
+        if self._task is None:
+            self._changed = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="timer-engine")
+
+    async def stop(self, timeout: float = 10):
+        """Stop the loop and wait for callbacks that are already running"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._running:
+            await asyncio.wait(self._running, timeout=timeout)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                when, seq, key = heapq.heappop(self._heap)
+                job = self._jobs.get(key)
+                if job is None or job[0] != seq:
+                    continue
+                del self._jobs[key]
+                self._fire(key, when, job[1])
+
+            when = self.next_fire()
+            # بدون مهام مجدولة ينتظر الإضافة التالية فقط
+            delay = None if when is None else min(max(0.0, when - time.time()), _MAX_SLEEP)
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, key: str, when: float, callback: TimerCallback):
+        self.fired += 1
+        self.lateness.observe((time.time() - when) * 1000)
+        task = asyncio.create_task(self._call(key, when, callback), name=f"timer-{key}")
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _call(self, key: str, when: float, callback: TimerCallback):
+        try:
+            next_when = await callback(when)
+        except Exception as e:
+            logger.error(f"Timer {key} failed: {e}")
+            return
+        # لا نكتب فوق موعد جديد أُضيف للمفتاح أثناء التنفيذ
+        if next_when is not None and key not in self._jobs:
+            self.schedule(key, next_when, callback)
+
+
 class MessageScheduler:
     def __init__(self, application: Application):
         self.application = application
-        self.moderation = ModerationSystem()
-        self.database = Database()
+        self.moderation = AsyncDatabase(ModerationSystem())
+        self.database = AsyncDatabase(Database())
+        self.send_queue = get_send_queue()
+        self.engine = TimerEngine()
+        self.cleanup_schedule = CronSchedule(SUBSCRIPTION_CLEANUP_CRON)
         self.is_running = False
 
     async def start_scheduler(self):
-        """Start the message scheduler"""
+        """Load scheduled messages into the timer heap and start firing them"""
         if self.is_running:
             return
 
         self.is_running = True
-        logger.info("Message scheduler started")
-
-        while self.is_running:
-            try:
-                await self.send_scheduled_messages()
-                await self.cleanup_expired_subscriptions()
-                # فحص كل 10 دقائق
-                await asyncio.sleep(600)
-            except Exception as e:
-                logger.error(f"Scheduler error: {e}")
-                await asyncio.sleep(600)
+        for message in await self.moderation.get_active_scheduled_messages():
+            self._add_message(message)
+        self.engine.schedule(
+            'subscriptions', self.cleanup_schedule.next_after(time.time()), self._cleanup_job
+        )
+        await self.engine.start()
+        logger.info(f"Message scheduler started with {len(self.engine)} timers")
 
     async def stop_scheduler(self):
         """Stop the message scheduler"""
         self.is_running = False
+        await self.engine.stop()
         logger.info("Message scheduler stopped")
 
-    async def send_scheduled_messages(self):
-        """Send pending scheduled messages"""
-        try:
-            pending_messages = self.moderation.get_pending_scheduled_messages()
+    async def add_scheduled_message(self, schedule_id: int):
+        """Put a message created by /schedule on the timer heap"""
+        message = await self.moderation.get_scheduled_message(schedule_id)
+        if message:
+            self._add_message(message)
 
-            for message_data in pending_messages:
-                try:
-                    await self.application.bot.send_message(
-                        chat_id=message_data['chat_id'],
-                        text=message_data['message_text']
-                    )
+    def _add_message(self, message: dict):
+        try:
+            cron = parse_cron(message.get('cron_expr'))
+        except ValueError as e:
+            logger.error(f"Invalid cron for scheduled message {message['schedule_id']}: {e}")
+            return
 
-                    # تحديث آخر إرسال
-                    self.moderation.mark_message_sent(message_data['schedule_id'])
+        async def fire(when: float) -> Optional[float]:
+            return await self.send_scheduled_message(message, cron, when)
+
+        self.engine.schedule(f"message:{message['schedule_id']}", message['next_send_ts'], fire)
+
+    async def send_scheduled_message(self, message: dict, cron: Optional[CronSchedule],
+                                     when: float) -> Optional[float]:
+        """Send one scheduled message and return when it is due next"""
+        now = time.time()
+        if cron is not None:
+            next_ts = cron.next_after(now)
+        elif message['interval_hours'] and message['interval_hours'] > 0:
+            interval = message['interval_hours'] * 3600
+            next_ts = when + interval
+            # المواعيد الفائتة أثناء توقف البوت لا تُرسل دفعة واحدة
+            if next_ts <= now:
+                next_ts += ((now - next_ts) // interval + 1) * interval
+        else:
+            next_ts = None
 
-                    logger.info(f"Sent scheduled message to chat {message_data['chat_id']}")
+        try:
+            await self.send_queue.send(
+                'send_message', message['chat_id'], PRIORITY_BULK,
+                text=message['message_text']
+            )
+        except Exception as e:
+            logger.error(f"Failed to send scheduled message {message['schedule_id']}: {e}")
+            retry_ts = now + SCHEDULE_RETRY_SECONDS
+            return retry_ts if next_ts is None or retry_ts < next_ts else next_ts
 
-                except Exception as e:
-                    logger.error(f"Failed to send scheduled message {message_data['schedule_id']}: {e}")
+        logger.info(f"Sent scheduled message to chat {message['chat_id']}")
+        if next_ts is None or next_ts >= message['expires_ts']:
+            await self.moderation.mark_message_sent(message['schedule_id'], message['expires_ts'])
+            return None
+        await self.moderation.mark_message_sent(message['schedule_id'], int(next_ts))
+        return next_ts
 
-        except Exception as e:
-            logger.error(f"Error getting scheduled messages: {e}")
+    async def _cleanup_job(self, when: float) -> float:
+        await self.cleanup_expired_subscriptions()
+        return self.cleanup_schedule.next_after(time.time())
 
     async def cleanup_expired_subscriptions(self):
         """تنظيف الاشتراكات المنتهية الصلاحية"""
         try:
             # الحصول على الاشتراكات المنتهية قبل إلغائها
-            expired_subscriptions = self.database.get_expired_subscriptions()
+            expired_subscriptions = await self.database.get_expired_subscriptions()
 
             # إلغاء الاشتراكات المنتهية
-            deactivated_count = self.database.deactivate_expired_subscriptions()
+            deactivated_count = await self.database.deactivate_expired_subscriptions()
 
             if deactivated_count > 0:
                 logger.info(f"Deactivated {deactivated_count} expired subscriptions")
 
-                # إشعار المستخدمين بانتهاء الاشتراك
-                for subscription in expired_subscriptions:
-                    try:
-                        await self.application.bot.send_message(
-                            chat_id=subscription['user_id'],
-                            text="⚠️ انتهت صلاحية اشتراكك\n\n"
-                            "لا يمكنك الآن الوصول للرحلات المتاحة.\n"
-                            "للتجديد، يرجى التواصل مع الإدارة.",
-                            reply_markup=InlineKeyboardMarkup([[
-                                InlineKeyboardButton("للتجديد تواصل مع الإدارة 💳", url="https://t.me/novacompnay")
-                            ]])
-                        )
+                # إشعار المستخدمين بانتهاء الاشتراك (دفعة واحدة عبر الطابور)
+                keyboard = InlineKeyboardMarkup([[
+                    InlineKeyboardButton("للتجديد تواصل مع الإدارة 💳", url="https://t.me/novacompnay")
+                ]])
+                sends = [
+                    self.send_queue.submit(
+                        'send_message', subscription['user_id'], PRIORITY_BULK,
+                        text="⚠️ انتهت صلاحية اشتراكك\n\n"
+                        "لا يمكنك الآن الوصول للرحلات المتاحة.\n"
+                        "للتجديد، يرجى التواصل مع الإدارة.",
+                        reply_markup=keyboard
+                    )
+                    for subscription in expired_subscriptions
+                ]
+                results = await asyncio.gather(*sends, return_exceptions=True)
+                for subscription, result in zip(expired_subscriptions, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to notify user {subscription['user_id']}: {result}")
+                    else:
                         logger.info(f"Notified user {subscription['user_id']} about expired subscription")
-                    except Exception as e:
-                        logger.error(f"Failed to notify user {subscription['user_id']}: {e}")
 
         except Exception as e:
-            logger.error(f"Error cleaning up expired subscriptions: {e}")
\ No newline at end of file
+            logger.error(f"Error cleaning up expired subscriptions: {e}")
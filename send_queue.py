@@ -0,0 +1,304 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import itertools
+from datetime import timedelta
+from typing import Any, Dict, Optional, Union
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from callback_router import RouteMetrics
+from priorities import PRIORITY_NORMAL, PRIORITY_NAMES
+
+logger = logging.getLogger(__name__)
+
+# حدود تيليجرام: ~30 رسالة/ثانية إجمالاً، ~1/ثانية لكل محادثة خاصة، ~20/دقيقة لكل مجموعة
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", "20"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+
+# عدد دلاء المحادثات الذي يُنظف بعده ما امتلأ منها (محادثات خاملة)
+_BUCKET_PURGE_THRESHOLD = 10000
+
+ChatId = Union[int, str]
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking.
+
+    reserve() always takes a token and returns how long the caller must
+    wait before using it, so back-to-back reservations queue up in time.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'clock')
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take one token and return the seconds to wait before it is valid"""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, without taking it"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def penalize(self, seconds: float):
+        """Block the bucket for `seconds` (used after a RetryAfter)"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('method', 'chat_id', 'kwargs', 'priority', 'future', 'created', 'attempts', 'reserved')
+
+    def __init__(self, method: str, chat_id: ChatId, kwargs: Dict[str, Any], priority: int, future: asyncio.Future):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.created = time.perf_counter()
+        self.attempts = 0
+        # تم حجز دور المحادثة مسبقاً قبل إعادة الجدولة
+        self.reserved = False
+
+
+class SendQueue:
+    """Central outbound queue for Bot API sends.
+
+    Jobs are taken in priority order by a fixed pool of workers. A worker
+    only takes a job once the global bucket has a token, so the priority
+    order is decided when a send slot is free rather than when the job was
+    queued. It then reserves a token from the chat's bucket. If that token
+    is not yet valid, the job is put back on the queue at the time it
+    becomes valid, so one busy chat never ties up a worker. RetryAfter blocks the chat's bucket
+    for the requested time; network errors are retried with exponential
+    backoff; BadRequest and Forbidden fail the job at once.
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS):
+        self.workers = workers
+        self.bot = None
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._global = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._chats: Dict[ChatId, TokenBucket] = {}
+        self._delayed = 0
+        self._in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.latency = {name: RouteMetrics() for name in PRIORITY_NAMES.values()}
+
+    # ============ دورة الحياة ============
+
+    async def start(self, bot):
+        """Bind the bot and start the workers"""
+        if self._tasks:
+            return
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"send-worker-{n}") for n in range(self.workers)]
+        logger.info(f"Send queue started with {self.workers} workers")
+
+    async def stop(self, timeout: float = 30):
+        """Wait up to `timeout` seconds for queued sends, then stop the workers"""
+        if not self._tasks:
+            return
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.depth():
+            logger.warning(f"Send queue stopped with {self.depth()} messages still queued")
+
+    # ============ الإرسال ============
+
+    def submit(self, method: str, chat_id: ChatId, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        """Queue bot.<method>(chat_id=chat_id, **kwargs) and return a future for its result"""
+        future = asyncio.get_running_loop().create_future()
+        if self._queue is None:
+            future.set_exception(RuntimeError("Send queue is not running"))
+            return future
+        job = _Job(method, chat_id, kwargs, priority, future)
+        self._put(job)
+        return future
+
+    async def send(self, method: str, chat_id: ChatId, priority: int = PRIORITY_NORMAL, **kwargs) -> Any:
+        """Queue a send and wait for its result; raises the final error on failure"""
+        return await self.submit(method, chat_id, priority, **kwargs)
+
+    def notify(self, chat_id: ChatId, text: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        """Fire-and-forget send_message; failures are logged by the queue"""
+        future = self.submit('send_message', chat_id, priority, text=text, **kwargs)
+        # استهلاك الاستثناء حتى لا يظهر تحذير "exception was never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def _put(self, job: _Job):
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+
+    def _put_later(self, job: _Job, delay: float):
+        self._delayed += 1
+
+        def release():
+            self._delayed -= 1
+            self._put(job)
+
+        asyncio.get_running_loop().call_later(delay, release)
+
+    def _chat_bucket(self, chat_id: ChatId) -> TokenBucket:
+        # ADMIN_CHAT_ID وأمثاله نصوص رقمية؛ توحيدها مع المعرفات الرقمية
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _BUCKET_PURGE_THRESHOLD:
+                self._chats = {key: b for key, b in self._chats.items() if not b.is_idle()}
+            if _is_group(chat_id):
+                bucket = TokenBucket(SEND_GROUP_PER_MINUTE / 60, 3)
+            else:
+                bucket = TokenBucket(SEND_CHAT_RATE, 3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _worker(self):
+        while True:
+            wait = self._global.wait_time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, job = await self._queue.get()
+            try:
+                if job.future.done():
+                    continue
+                if not job.reserved:
+                    delay = self._chat_bucket(job.chat_id).reserve()
+                    if delay > 0:
+                        job.reserved = True
+                        self._put_later(job, delay)
+                        continue
+                job.reserved = False
+
+                # قد يسبقنا عامل آخر إلى الرمز إذا انتظرنا داخل get()
+                delay = self._global.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self._in_flight += 1
+                try:
+                    await self._attempt(job)
+                finally:
+                    self._in_flight -= 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Send queue worker error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _attempt(self, job: _Job):
+        job.attempts += 1
+        try:
+            result = await getattr(self.bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            wait = _seconds(e.retry_after)
+            self._chat_bucket(job.chat_id).penalize(wait)
+            self._retry_or_fail(job, e, wait)
+        except (BadRequest, Forbidden) as e:
+            self._fail(job, e)
+        except NetworkError as e:
+            self._retry_or_fail(job, e, min(60, 2 ** (job.attempts - 1)) + random.random())
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self.latency[PRIORITY_NAMES.get(job.priority, 'normal')].observe((time.perf_counter() - job.created) * 1000)
+            # المستدعي قد يكون ألغى انتظاره أثناء الإرسال
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def _retry_or_fail(self, job: _Job, error: Exception, delay: float):
+        if job.attempts >= SEND_MAX_ATTEMPTS:
+            self._fail(job, error)
+            return
+        self.retried += 1
+        job.reserved = True
+        self._put_later(job, delay)
+
+    def _fail(self, job: _Job, error: Exception):
+        self.failed += 1
+        self.latency[PRIORITY_NAMES.get(job.priority, 'normal')].observe(
+            (time.perf_counter() - job.created) * 1000, failed=True
+        )
+        logger.error(f"Failed to {job.method} to chat {job.chat_id} after {job.attempts} attempt(s): {error}")
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    # ============ المقاييس ============
+
+    def depth(self) -> int:
+        """Messages queued, waiting for a retry or rate-limit slot, or being sent"""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + self._delayed + self._in_flight
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'depth': self.depth(),
+            'delayed': self._delayed,
+            'in_flight': self._in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'latency': {name: metrics.snapshot() for name, metrics in self.latency.items()},
+        }
+
+
+def _is_group(chat_id: ChatId) -> bool:
+    # معرفات المجموعات والقنوات سالبة أو تبدأ بـ @
+    if isinstance(chat_id, str):
+        return chat_id.startswith('@') or chat_id.startswith('-')
+    return chat_id < 0
+
+
+def _seconds(value: Union[int, float, timedelta]) -> float:
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+_send_queue: Optional[SendQueue] = None
+
+
+def get_send_queue() -> SendQueue:
+    """Return the shared outbound send queue"""
+    global _send_queue
+    if _send_queue is None:
+        _send_queue = SendQueue()
+    return _send_queue
@@ -0,0 +1,424 @@
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+from timeutil import utc_offset_seconds
+
+# العدادات والدلاء الزمنية تُحدّث بمشغلات (triggers) داخل نفس معاملة الكتابة،
+# فلا يمكن أن تفوتها أي عملية إدراج أو تعديل مهما كان مسار الكتابة.
+#
+# stat_counters: الإجماليات الحالية
+#   users.total, users.type.<user_type|none>
+#   rides.total, rides.status.<status>
+#   subscriptions.total
+#   payments.status.<payment_status>
+#   payments.completed.<payment_method>.count / .amount
+# stat_daily و stat_hourly: دلاء لكل يوم ولكل ساعة بتوقيت البوت (رقم اليوم أو
+# الساعة المحلية منذ 1970) حسب وقت الحدث، وهو created_ts للصف ما لم يُذكر غيره:
+#   users.new, rides.new
+#   rides.completed, rides.cancelled (حسب finished_ts: لحظة انتهاء الرحلة)
+#   payments.new, payments.status.<payment_status>
+#   revenue.method.<payment_method>.count / .amount
+#   revenue.type.<payment_type>.count / .amount
+#
+# كل تعريف أدناه هو (اسم العداد، القيمة، الشرط) بتعبيرات SQL يُستبدل فيها {r}
+# بـ NEW. أو OLD. داخل المشغلات وبلا بادئة عند إعادة الحساب من الجداول.
+# أي تغيير في التعريفات يحتاج ترحيلاً جديداً يستدعي install(). الترحيلات
+# الأقدم تستدعيها قبل وجود أعمدة أضيفت لاحقاً، فتُتخطى التعريفات التي
+# لا توجد أعمدتها بعد حتى يعيد الترحيل الذي يضيفها استدعاء install().
+
+Spec = Tuple[str, str, str]
+
+_COMPLETED = "{r}payment_status = 'completed'"
+
+_COUNTERS: Dict[str, List[Spec]] = {
+    'users': [
+        ("'users.total'", "1", "1"),
+        ("'users.type.' || COALESCE({r}user_type, 'none')", "1", "1"),
+    ],
+    'rides': [
+        ("'rides.total'", "1", "1"),
+        ("'rides.status.' || COALESCE({r}status, 'none')", "1", "1"),
+    ],
+    'subscriptions': [
+        ("'subscriptions.total'", "1", "1"),
+    ],
+    'payments': [
+        ("'payments.status.' || COALESCE({r}payment_status, 'none')", "1", "1"),
+        ("'payments.completed.' || COALESCE({r}payment_method, 'none') || '.count'", "1", _COMPLETED),
+        ("'payments.completed.' || COALESCE({r}payment_method, 'none') || '.amount'",
+         "COALESCE({r}amount, 0)", _COMPLETED),
+    ],
+}
+
+# الدلاء حسب (الجدول، عمود وقت الحدث)
+_BUCKETS: Dict[Tuple[str, str], List[Spec]] = {
+    ('users', 'created_ts'): [
+        ("'users.new'", "1", "1"),
+    ],
+    ('rides', 'created_ts'): [
+        ("'rides.new'", "1", "1"),
+    ],
+    ('rides', 'finished_ts'): [
+        ("'rides.' || {r}status", "1", "{r}status IN ('completed', 'cancelled')"),
+    ],
+    ('subscriptions', 'created_ts'): [],
+    ('payments', 'created_ts'): [
+        ("'payments.new'", "1", "1"),
+        ("'payments.status.' || COALESCE({r}payment_status, 'none')", "1", "1"),
+        ("'revenue.method.' || COALESCE({r}payment_method, 'none') || '.count'", "1", _COMPLETED),
+        ("'revenue.method.' || COALESCE({r}payment_method, 'none') || '.amount'",
+         "COALESCE({r}amount, 0)", _COMPLETED),
+        ("'revenue.type.' || COALESCE({r}payment_type, 'none') || '.count'", "1", _COMPLETED),
+        ("'revenue.type.' || COALESCE({r}payment_type, 'none') || '.amount'",
+         "COALESCE({r}amount, 0)", _COMPLETED),
+    ],
+}
+
+# الأعمدة التي يؤثر تعديلها على العدادات في كل جدول
+_TRACKED_COLUMNS = {
+    'users': ('user_type', 'created_ts'),
+    'rides': ('status', 'created_ts', 'finished_ts'),
+    'subscriptions': (),
+    'payments': ('payment_status', 'payment_method', 'payment_type', 'amount', 'created_ts'),
+}
+
+# الأعمدة التي تعتمد عليها أسماء العدادات وشروطها (غير القيم المجمّعة)؛
+# إعادة الحساب تجمّع الجدول حسبها أولاً
+_DIMENSIONS = {
+    'users': ('user_type',),
+    'rides': ('status',),
+    'subscriptions': (),
+    'payments': ('payment_status', 'payment_method', 'payment_type'),
+}
+
+# (الجدول، عمود الدلو، طول الدلو بالثواني)
+_BUCKET_TABLES = (('stat_daily', 'day', 86400), ('stat_hourly', 'hour', 3600))
+
+_OFFSET_SQL = "COALESCE((SELECT value FROM stat_settings WHERE name = 'utc_offset'), 0)"
+
+BucketKey = Tuple[int, str]
+
+
+def create_tables(conn: sqlite3.Connection):
+    """Create the counter and bucket tables"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_counters (
+            name TEXT PRIMARY KEY,
+            value NUMERIC NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    # day = رقم اليوم المحلي: (وقت الحدث + فرق التوقيت) / 86400
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_daily (
+            day INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, name)
+        ) WITHOUT ROWID
+    """)
+    # hour = رقم الساعة المحلية: (وقت الحدث + فرق التوقيت) / 3600
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_hourly (
+            hour INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, name)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_settings (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+
+
+# ============ المشغلات ============
+
+def _expand(spec: Spec, row: str) -> Tuple[str, str, str]:
+    return tuple(part.format(r=f"{row}." if row else "") for part in spec)
+
+
+def _bump(spec: Spec, row: str, sign: str) -> str:
+    name, value, when = _expand(spec, row)
+    # INSERT ... SELECT مع WHERE حتى لا يلتبس ON CONFLICT بشرط ربط
+    return f"""
+        INSERT INTO stat_counters (name, value) SELECT {name}, {sign} * ({value}) WHERE {when}
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;"""
+
+
+def _bump_buckets(spec: Spec, row: str, sign: str, time_column: str) -> str:
+    name, value, when = _expand(spec, row)
+    return ''.join(f"""
+        INSERT INTO {table} ({column}, name, value)
+        SELECT ({row}.{time_column} + {_OFFSET_SQL}) / {width}, {name}, {sign} * ({value})
+        WHERE {row}.{time_column} IS NOT NULL AND ({when})
+        ON CONFLICT ({column}, name) DO UPDATE SET value = value + excluded.value;"""
+                   for table, column, width in _BUCKET_TABLES)
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _bucket_specs(conn: sqlite3.Connection) -> Dict[Tuple[str, str], List[Spec]]:
+    """The bucket definitions whose time column exists in the current schema"""
+    columns = {table: _table_columns(conn, table) for table, _ in _BUCKETS}
+    return {key: specs for key, specs in _BUCKETS.items() if key[1] in columns[key[0]]}
+
+
+def _row_changes(table: str, row: str, sign: str, buckets: Dict[Tuple[str, str], List[Spec]]) -> str:
+    return (''.join(_bump(spec, row, sign) for spec in _COUNTERS[table])
+            + ''.join(_bump_buckets(spec, row, sign, time_column)
+                      for (bucket_table, time_column), specs in buckets.items() if bucket_table == table
+                      for spec in specs))
+
+
+def create_triggers(conn: sqlite3.Connection):
+    """Create the triggers that keep the counters and buckets current"""
+    buckets = _bucket_specs(conn)
+    for table, tracked in _TRACKED_COLUMNS.items():
+        existing = _table_columns(conn, table)
+        columns = [column for column in tracked if column in existing]
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS stat_{table}_insert AFTER INSERT ON {table}
+            BEGIN {_row_changes(table, 'NEW', '1', buckets)}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS stat_{table}_delete AFTER DELETE ON {table}
+            BEGIN {_row_changes(table, 'OLD', '-1', buckets)}
+            END
+        """)
+        if columns:
+            changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in columns)
+            # التعديل = حذف مساهمة الصف القديم وإضافة مساهمة الصف الجديد
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS stat_{table}_update
+                AFTER UPDATE OF {', '.join(columns)} ON {table}
+                WHEN {changed}
+                BEGIN {_row_changes(table, 'OLD', '-1', buckets)} {_row_changes(table, 'NEW', '1', buckets)}
+                END
+            """)
+
+
+def drop_triggers(conn: sqlite3.Connection):
+    for table in _TRACKED_COLUMNS:
+        for event in ('insert', 'delete', 'update'):
+            conn.execute(f"DROP TRIGGER IF EXISTS stat_{table}_{event}")
+
+
+def set_utc_offset(conn: sqlite3.Connection, offset: int = None) -> bool:
+    """Store the bot timezone offset the triggers use to bucket rows by local day.
+
+    Returns True when the stored offset changed; the buckets then need a
+    reconcile() to move existing rows to their new days and hours.
+    """
+    offset = utc_offset_seconds() if offset is None else offset
+    row = conn.execute("SELECT value FROM stat_settings WHERE name = 'utc_offset'").fetchone()
+    if row is not None and row[0] == offset:
+        return False
+    conn.execute("""
+        INSERT INTO stat_settings (name, value) VALUES ('utc_offset', ?)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+    """, (offset,))
+    return row is not None
+
+
+def get_utc_offset(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM stat_settings WHERE name = 'utc_offset'").fetchone()
+    return row[0] if row else 0
+
+
+def install(conn: sqlite3.Connection):
+    """Create the tables, replace the triggers with the current definitions and rebuild every value.
+
+    Runs inside the caller's transaction (a migration).
+    """
+    create_tables(conn)
+    drop_triggers(conn)
+    set_utc_offset(conn)
+    create_triggers(conn)
+    reconcile(conn)
+
+
+# ============ إعادة الحساب من الجداول الأصلية ============
+
+def _aggregate(conn: sqlite3.Connection, table: str, specs: List[Spec], bucket: Optional[str] = None,
+               params: tuple = (), time_column: str = 'created_ts') -> List[tuple]:
+    """Evaluate specs over one scan of table, as rows of ([bucket,] name, value).
+
+    The table is first grouped by its dimension columns (and the bucket),
+    then each spec runs over those few groups instead of over every row.
+    """
+    values = list(dict.fromkeys(_expand(spec, '')[1] for spec in specs))
+    keys = ([f"{bucket} AS bucket"] if bucket else []) + list(_DIMENSIONS[table])
+    group_by = f"GROUP BY {', '.join(str(n + 1) for n in range(len(keys)))}" if keys else ""
+    pre = f"""
+        SELECT {', '.join(keys + [f"SUM({value}) AS v{n}" for n, value in enumerate(values)])}
+        FROM {table} {f"WHERE {time_column} IS NOT NULL" if bucket else ""} {group_by}
+    """
+    selects = []
+    for spec in specs:
+        name, value, when = _expand(spec, '')
+        columns = (["bucket"] if bucket else []) + [name, f"SUM(v{values.index(value)})"]
+        selects.append(f"SELECT {', '.join(columns)} FROM pre WHERE {when} "
+                       f"GROUP BY {', '.join(str(n + 1) for n in range(len(columns) - 1))}")
+    # الجدول الوسيط يُستخدم أكثر من مرة فيُبنى مرة واحدة فقط
+    return conn.execute(f"WITH pre AS MATERIALIZED ({pre}) " + " UNION ALL ".join(selects), params).fetchall()
+
+
+def compute_counters(conn: sqlite3.Connection) -> Dict[str, float]:
+    """Recompute every counter from the raw tables"""
+    counters: Dict[str, float] = {}
+    for table, specs in _COUNTERS.items():
+        for key, total in _aggregate(conn, table, specs):
+            if total is not None:
+                counters[key] = counters.get(key, 0) + total
+    return counters
+
+
+def compute_hourly(conn: sqlite3.Connection) -> Dict[BucketKey, float]:
+    """Recompute the per-hour buckets from the raw tables"""
+    offset = get_utc_offset(conn)
+    hourly: Dict[BucketKey, float] = {}
+    for (table, time_column), specs in _bucket_specs(conn).items():
+        if not specs:
+            continue
+        for hour, key, total in _aggregate(conn, table, specs, f"({time_column} + ?) / 3600", (offset,),
+                                           time_column):
+            if total is not None:
+                hourly[(hour, key)] = hourly.get((hour, key), 0) + total
+    return hourly
+
+
+def _rollup_days(hourly: Dict[BucketKey, float]) -> Dict[BucketKey, float]:
+    # الساعات محلية، فكل 24 منها يوم محلي كامل
+    daily: Dict[BucketKey, float] = {}
+    for (hour, name), value in hourly.items():
+        key = (hour // 24, name)
+        daily[key] = daily.get(key, 0) + value
+    return daily
+
+
+def _stored_counters(conn: sqlite3.Connection) -> Dict[str, float]:
+    return {name: value for name, value in conn.execute("SELECT name, value FROM stat_counters")}
+
+
+def _stored_buckets(conn: sqlite3.Connection, table: str, column: str) -> Dict[BucketKey, float]:
+    return {(bucket, name): value for bucket, name, value in conn.execute(f"SELECT {column}, name, value FROM {table}")}
+
+
+def _diff(stored: dict, expected: dict) -> List[tuple]:
+    drift = []
+    for key in sorted(set(stored) | set(expected), key=str):
+        have, want = stored.get(key, 0), expected.get(key, 0)
+        # مبالغ الإيرادات أعداد عشرية، فالفرق الصغير جداً ليس انحرافاً
+        if abs(have - want) > 1e-6:
+            drift.append((key, have, want))
+    return drift
+
+
+def reconcile(conn: sqlite3.Connection, repair: bool = True) -> List[Tuple[str, float, float]]:
+    """Compare the counters and buckets with the raw tables and return (name, stored, expected) for each drift.
+
+    Bucket drift is reported with names like ``rides.new@day:20378``. With
+    repair=True the stored values are replaced in the same transaction.
+    The caller commits.
+    """
+    counters = compute_counters(conn)
+    hourly = compute_hourly(conn)
+    expected = {'stat_daily': _rollup_days(hourly), 'stat_hourly': hourly}
+
+    drift = _diff(_stored_counters(conn), counters)
+    for table, column, _ in _BUCKET_TABLES:
+        drift += [(f"{name}@{column}:{bucket}", have, want)
+                  for (bucket, name), have, want in _diff(_stored_buckets(conn, table, column), expected[table])]
+
+    if repair and drift:
+        conn.execute("DELETE FROM stat_counters")
+        conn.executemany("INSERT INTO stat_counters (name, value) VALUES (?, ?)", counters.items())
+        for table, column, _ in _BUCKET_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+            conn.executemany(
+                f"INSERT INTO {table} ({column}, name, value) VALUES (?, ?, ?)",
+                [(bucket, name, value) for (bucket, name), value in expected[table].items()]
+            )
+    return drift
+
+
+# ============ الاستعلام عن الفترات ============
+
+def local_day(ts: int, offset: int) -> int:
+    """Local day number of an epoch time, matching the bucketing in the triggers"""
+    return (ts + offset) // 86400
+
+
+def _prefix_range(prefix: str) -> Tuple[str, str]:
+    # نطاق أسماء بدل LIKE حتى يُستخدم المفتاح (day/hour, name)
+    return prefix, prefix + '\uffff'
+
+
+def query_range(conn: sqlite3.Connection, prefix: str, start_ts: Optional[int] = None,
+                end_ts: Optional[int] = None) -> Dict[str, float]:
+    """Sum the buckets whose name starts with prefix over [start_ts, end_ts).
+
+    The bounds are rounded down to whole local hours; None means unbounded.
+    Whole days are read from stat_daily and only the partial days at the
+    edges from stat_hourly, so the cost grows with the number of days in
+    the window rather than with the rows behind it.
+    """
+    offset = get_utc_offset(conn)
+    first_hour = None if start_ts is None else (start_ts + offset) // 3600
+    last_hour = None if end_ts is None else (end_ts + offset) // 3600
+    # الأيام الكاملة داخل الفترة: [first_day, last_day)
+    first_day = None if first_hour is None else -(-first_hour // 24)
+    last_day = None if last_hour is None else last_hour // 24
+
+    totals: Dict[str, float] = {}
+
+    def add(rows):
+        for name, value in rows:
+            totals[name] = totals.get(name, 0) + value
+
+    if first_day is None or last_day is None or first_day < last_day:
+        add(conn.execute("""
+            SELECT name, SUM(value) FROM stat_daily
+            WHERE day >= ? AND day < ? AND name >= ? AND name < ?
+            GROUP BY name
+        """, (-2 ** 62 if first_day is None else first_day,
+              2 ** 62 if last_day is None else last_day) + _prefix_range(prefix)))
+        edges = []
+        if first_hour is not None:
+            edges.append((first_hour, first_day * 24))
+        if last_hour is not None:
+            edges.append((last_day * 24, last_hour))
+    else:
+        # الفترة أقصر من يوم كامل بين حدود الأيام
+        edges = [(first_hour, last_hour)]
+
+    for low, high in edges:
+        if low < high:
+            add(conn.execute("""
+                SELECT name, SUM(value) FROM stat_hourly
+                WHERE hour >= ? AND hour < ? AND name >= ? AND name < ?
+                GROUP BY name
+            """, (low, high) + _prefix_range(prefix)))
+    return totals
+
+
+def query_series(conn: sqlite3.Connection, prefix: str, start_ts: int, end_ts: int,
+                 step: str = 'day') -> List[Tuple[int, Dict[str, float]]]:
+    """Buckets overlapping [start_ts, end_ts) as (bucket start epoch, {name: value}), oldest first.
+
+    step is 'day' or 'hour'; buckets with no data are left out.
+    """
+    offset = get_utc_offset(conn)
+    table, column, width = _BUCKET_TABLES[0] if step == 'day' else _BUCKET_TABLES[1]
+    series: Dict[int, Dict[str, float]] = {}
+    for bucket, name, value in conn.execute(f"""
+        SELECT {column}, name, value FROM {table}
+        WHERE {column} >= ? AND {column} < ? AND name >= ? AND name < ?
+        ORDER BY {column}
+    """, ((start_ts + offset) // width, -(-(end_ts + offset) // width)) + _prefix_range(prefix)):
+        series.setdefault(bucket, {})[name] = value
+    return [(bucket * width - offset, values) for bucket, values in series.items()]
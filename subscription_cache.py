@@ -0,0 +1,86 @@
+import os
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from timeutil import now_ts
+
+
+class SubscriptionCache:
+    """In-memory map of user_id -> subscription end time for active subscriptions.
+
+    The cache is loaded with every active subscription at startup and kept
+    current by the Database write paths, so a user without an entry is not
+    subscribed. Entries lapse by comparing end_ts with the clock, without a
+    database round-trip.
+    """
+
+    def __init__(self, clock: Callable[[], int] = now_ts):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._end_ts: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def load(self, entries: Iterable[Tuple[int, int]]):
+        """Replace the cache contents with (user_id, end_ts) pairs"""
+        end_ts: Dict[int, int] = {}
+        for user_id, ts in entries:
+            if ts is not None and ts > end_ts.get(user_id, 0):
+                end_ts[user_id] = ts
+        with self._lock:
+            self._end_ts = end_ts
+
+    def set(self, user_id: int, end_ts: Optional[int]):
+        """Record a user's new active subscription"""
+        with self._lock:
+            if end_ts is None:
+                self._end_ts.pop(user_id, None)
+            else:
+                self._end_ts[user_id] = end_ts
+
+    def is_active(self, user_id: int) -> bool:
+        """Return True if the user has a subscription that has not yet expired"""
+        now = self._clock()
+        with self._lock:
+            end_ts = self._end_ts.get(user_id)
+            if end_ts is None:
+                self.misses += 1
+                return False
+            if end_ts <= now:
+                self.expired += 1
+                return False
+            self.hits += 1
+            return True
+
+    def purge_expired(self) -> int:
+        """Drop entries whose end time has passed and return how many were removed"""
+        now = self._clock()
+        with self._lock:
+            expired = [user_id for user_id, ts in self._end_ts.items() if ts <= now]
+            for user_id in expired:
+                del self._end_ts[user_id]
+        return len(expired)
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters and the number of cached subscriptions"""
+        return {
+            'entries': len(self._end_ts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+        }
+
+
+_caches: Dict[str, SubscriptionCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_subscription_cache(db_path: str) -> SubscriptionCache:
+    """Return the shared subscription cache for a database file"""
+    key = os.path.abspath(db_path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = SubscriptionCache()
+            _caches[key] = cache
+        return cache
@@ -0,0 +1,76 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from cron import CronSchedule, parse_cron
+
+UTC = ZoneInfo('UTC')
+
+
+def ts(text: str, tz: ZoneInfo = UTC) -> int:
+    return int(datetime.fromisoformat(text).replace(tzinfo=tz).timestamp())
+
+
+def next_after(expression: str, text: str) -> str:
+    moment = CronSchedule(expression, UTC).next_after(ts(text))
+    return datetime.fromtimestamp(moment, UTC).strftime('%Y-%m-%d %H:%M')
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+    # الخطوات
+    ('*/15 * * * *', '2026-03-10 10:07', '2026-03-10 10:15'),
+    ('*/15 * * * *', '2026-03-10 10:50', '2026-03-10 11:00'),
+    ('5/20 * * * *', '2026-03-10 10:06', '2026-03-10 10:25'),
+    ('5/20 * * * *', '2026-03-10 10:45', '2026-03-10 11:05'),
+    ('0 8-22/2 * * *', '2026-03-10 09:00', '2026-03-10 10:00'),
+    ('0 8-22/2 * * *', '2026-03-10 22:00', '2026-03-11 08:00'),
+    # المدى والقوائم
+    ('30 9-17 * * 1-5', '2026-03-13 17:45', '2026-03-16 09:30'),
+    ('0 6,18 * * *', '2026-03-10 07:00', '2026-03-10 18:00'),
+    ('0 0 1 1 *', '2026-03-10 00:00', '2027-01-01 00:00'),
+    ('0 0 29 2 *', '2026-03-10 00:00', '2028-02-29 00:00'),
+])
+def test_steps_ranges_and_lists(expression, after, expected):
+    assert next_after(expression, after) == expected
+
+
+def test_next_after_is_strictly_after():
+    assert next_after('*/15 * * * *', '2026-03-10 10:15') == '2026-03-10 10:30'
+    assert next_after('*/15 * * * *', '2026-03-10 10:14:59') == '2026-03-10 10:15'
+
+
+def test_day_of_month_or_day_of_week():
+    # 2026-03-10 ثلاثاء: الجمعة 13 تسبق يوم 17
+    assert next_after('0 12 17 * 5', '2026-03-10 13:00') == '2026-03-13 12:00'
+    assert next_after('0 12 17 * 5', '2026-03-13 12:00') == '2026-03-17 12:00'
+    # عند تقييد أحدهما فقط لا يُنظر للآخر
+    assert next_after('0 12 * * 5', '2026-03-13 12:00') == '2026-03-20 12:00'
+    assert next_after('0 12 17 * *', '2026-03-10 13:00') == '2026-03-17 12:00'
+
+
+def test_sunday_is_zero_and_seven():
+    assert CronSchedule('0 9 * * 0').weekdays == CronSchedule('0 9 * * 7').weekdays == {0}
+    assert next_after('0 9 * * 0', '2026-03-10 00:00') == '2026-03-15 09:00'
+    assert next_after('0 9 * * 7', '2026-03-10 00:00') == '2026-03-15 09:00'
+    assert next_after('0 9 * * 5-7', '2026-03-14 10:00') == '2026-03-15 09:00'
+
+
+@pytest.mark.parametrize('expression', ['0 0 30 2 *', '0 0 31 4,6,9,11 *'])
+def test_never_matches(expression):
+    with pytest.raises(ValueError, match='never matches'):
+        CronSchedule(expression, UTC).next_after(ts('2026-03-10 00:00'))
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '0 24 * * *', '*/0 * * * *', '0 0 0 * *', '0 0 * 13 *'])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_bot_timezone():
+    riyadh = ZoneInfo('Asia/Riyadh')
+    schedule = CronSchedule('0 9 * * *', riyadh)
+    assert schedule.next_after(ts('2026-03-10 05:00')) == ts('2026-03-10 09:00', riyadh)
+    assert schedule.next_after(ts('2026-03-10 06:00')) == ts('2026-03-11 09:00', riyadh)
+    assert parse_cron('') is None
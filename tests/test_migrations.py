@@ -0,0 +1,130 @@
+import time
+import sqlite3
+from datetime import datetime
+import pytest
+import migrations
+from migrations import MIGRATIONS, get_schema_version, migrate
+from stats_counters import query_range, reconcile
+
+# الاستعلامات الساخنة والفهرس الذي يجب أن يخدم كل منها
+HOT_QUERIES = [
+    ('pending rides',
+     "SELECT * FROM rides WHERE status = 'pending' ORDER BY created_at DESC LIMIT 10",
+     'idx_rides_status_created'),
+    ('captain rides by status',
+     "SELECT * FROM rides WHERE captain_id = ? AND status IN ('accepted', 'in_progress')",
+     'idx_rides_captain_status'),
+    ('active subscription',
+     "SELECT end_ts FROM subscriptions WHERE user_id = ? AND is_active = 1 AND end_ts > ?",
+     'idx_subscriptions_active_user_end'),
+    ('user warnings',
+     "SELECT COUNT(*) FROM user_warnings WHERE user_id = ? AND created_ts > ?",
+     'idx_user_warnings_user_created_ts'),
+]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'plans.db'))
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def plan(conn: sqlite3.Connection, sql: str):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, (1,) * sql.count('?'))]
+
+
+def test_migrate_records_latest_version_once(conn):
+    latest = MIGRATIONS[-1][0]
+    assert get_schema_version(conn) == latest
+    assert migrate(conn) == latest
+
+
+@pytest.mark.parametrize('name, sql, index', HOT_QUERIES, ids=[query[0] for query in HOT_QUERIES])
+def test_hot_query_searches_index(conn, name, sql, index):
+    steps = plan(conn, sql)
+    assert any(step.startswith('SEARCH') and f'INDEX {index} ' in step for step in steps), steps
+
+
+def test_pending_payments_walk_partial_index(conn):
+    # الفهرس الجزئي لا يحوي إلا المدفوعات المعلقة، فالمرور عليه كاملاً هو الخطة المثلى
+    steps = plan(conn, "SELECT * FROM payments WHERE payment_status = 'pending' ORDER BY created_at")
+    assert steps == ['SCAN payments USING INDEX idx_payments_pending']
+
+
+def test_user_rides_or_uses_both_indexes(conn):
+    steps = plan(conn, "SELECT * FROM rides WHERE client_id = ? OR captain_id = ? ORDER BY created_at DESC")
+    assert steps[0] == 'MULTI-INDEX OR'
+    searches = [step for step in steps if step.startswith('SEARCH rides USING')]
+    assert len(searches) == 2
+    assert any('(client_id=?)' in step for step in searches)
+    assert any('(captain_id=?)' in step for step in searches)
+
+
+@pytest.mark.parametrize('status, index', [('pending', 'idx_outbox_pending'), ('failed', 'idx_outbox_failed')])
+def test_outbox_counts_walk_partial_index(conn, status, index):
+    # مقاييس outbox تعدّ المعلق والفاشل فقط دون المرور على الإشعارات المرسلة
+    steps = plan(conn, f"SELECT COUNT(*) FROM outbox WHERE status = '{status}'")
+    assert steps == [f'SCAN outbox USING INDEX {index}']
+
+
+def test_stat_migrations_backfill_rows_from_version_7(tmp_path, monkeypatch):
+    conn = sqlite3.connect(str(tmp_path / 'upgrade.db'))
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS[:7])
+    assert migrate(conn) == 7
+    conn.executemany("INSERT INTO users (user_id, first_name, created_ts) VALUES (?, 'u', ?)",
+                     [(n, 1700000000 + n * 3600) for n in range(1, 51)])
+    conn.executemany("""
+        INSERT INTO payments (user_id, payment_type, amount, payment_method, payment_status, created_ts)
+        VALUES (?, 'ride_payment', 20, 'cash', 'completed', ?)
+    """, [(n, 1700000000 + n * 3600) for n in range(1, 51)])
+    conn.commit()
+
+    # الترحيل 8 بتعريفه المنشور: عدادات ودلاء يومية فقط
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS[:8])
+    assert migrate(conn) == 8
+    counters = dict(conn.execute("SELECT name, value FROM stat_counters"))
+    assert counters['users.total'] == 50
+    assert counters['payments.completed.cash.amount'] == 1000
+    assert not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'stat_hourly'").fetchone()
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS)
+    assert migrate(conn) == MIGRATIONS[-1][0]
+    assert reconcile(conn, repair=False) == []
+    conn.close()
+
+
+def test_finished_rides_are_bucketed_when_they_end(tmp_path, monkeypatch):
+    conn = sqlite3.connect(str(tmp_path / 'rides.db'))
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS[:13])
+    assert migrate(conn) == 13
+    now = int(time.time())
+    # رحلة قديمة انتهت قبل الترحيل: updated_at بتوقيت الخادم المحلي كما يكتبه complete_ride
+    conn.execute("""
+        INSERT INTO rides (client_id, pickup_location, destination, status, created_ts, updated_at)
+        VALUES (1, 'a', 'b', 'completed', ?, ?)
+    """, (now - 20 * 86400, datetime.fromtimestamp(now - 15 * 86400)))
+    conn.commit()
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS)
+    migrate(conn)
+    assert conn.execute("SELECT finished_ts FROM rides").fetchone()[0] == now - 15 * 86400
+
+    # رحلة طُلبت قبل ثمانية أيام وأُلغيت الآن تُعدّ في أيام الإلغاء لا أيام الطلب
+    ride_id = conn.execute("""
+        INSERT INTO rides (client_id, pickup_location, destination, status, created_ts)
+        VALUES (1, 'a', 'b', 'pending', ?)
+    """, (now - 8 * 86400,)).lastrowid
+    conn.execute("UPDATE rides SET status = 'cancelled' WHERE ride_id = ?", (ride_id,))
+    assert abs(conn.execute("SELECT finished_ts FROM rides WHERE ride_id = ?", (ride_id,)).fetchone()[0] - now) <= 2
+    week = query_range(conn, 'rides.', now - 7 * 86400, now + 3600)
+    assert week.get('rides.cancelled') == 1
+    assert 'rides.new' not in week and 'rides.completed' not in week
+    assert query_range(conn, 'rides.completed', now - 16 * 86400, now - 14 * 86400) == {'rides.completed': 1}
+
+    # إعادة فتح الرحلة تسحبها من دلو الإلغاء
+    conn.execute("UPDATE rides SET status = 'pending' WHERE ride_id = ?", (ride_id,))
+    assert conn.execute("SELECT finished_ts FROM rides WHERE ride_id = ?", (ride_id,)).fetchone()[0] is None
+    assert query_range(conn, 'rides.cancelled').get('rides.cancelled', 0) == 0
+    assert reconcile(conn, repair=False) == []
+    conn.close()
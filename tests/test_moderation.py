@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import warning_counter
+from moderation import BAN_WINDOW_DAYS, ModerationSystem
+from warning_counter import WarningCounter
+
+
+def test_window_shorter_than_ban_rule_is_rejected(tmp_path, monkeypatch):
+    path = str(tmp_path / 'short.db')
+    monkeypatch.setitem(warning_counter._counters, os.path.abspath(path), WarningCounter(BAN_WINDOW_DAYS - 1))
+    with pytest.raises(ValueError, match='WARNING_WINDOW_DAYS'):
+        ModerationSystem(path)
+
+
+def test_ban_rule_counts_from_memory(tmp_path):
+    moderation = ModerationSystem(str(tmp_path / 'moderation.db'))
+    try:
+        for _ in range(3):
+            moderation.add_user_warning(7, 'spam', 1)
+        # لا كتابة ولا استعلام: التحذيرات ما زالت في طابور الكتابة المؤجلة
+        assert moderation.warnings.pending() == 3
+        assert moderation.get_user_warnings_count(7) == 3
+        assert moderation.should_ban_user(7)
+        assert moderation.warnings.pending() == 3
+    finally:
+        moderation.warnings.stop_writer()
+        moderation.writes.stop()
+    with moderation.connections.connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM user_warnings WHERE user_id = 7").fetchone()[0] == 3
+
+
+def failing_writer(failures: int, written: list):
+    calls = []
+
+    def write(rows):
+        calls.append(len(rows))
+        if len(calls) <= failures:
+            raise RuntimeError('database is locked')
+        written.extend(rows)
+    return write
+
+
+def test_stop_retries_the_final_flush(monkeypatch):
+    monkeypatch.setattr(warning_counter, '_STOP_RETRY_DELAY', 0)
+    written = []
+    counter = WarningCounter()
+    counter.start_writer(failing_writer(2, written))
+    counter.record(7, 'spam', 1)
+    assert counter.stop_writer() == 0
+    assert [row[0] for row in written] == [7]
+    assert counter.failed_flushes == 2
+
+
+def test_stop_reports_warnings_it_could_not_write(monkeypatch, caplog):
+    monkeypatch.setattr(warning_counter, '_STOP_RETRY_DELAY', 0)
+    written = []
+    counter = WarningCounter()
+    counter.start_writer(failing_writer(warning_counter._STOP_FLUSH_ATTEMPTS, written))
+    counter.record(7, 'spam', 1)
+    counter.record(8, 'spam', 1)
+    assert counter.stop_writer() == 2
+    assert written == [] and counter.pending() == 2
+    assert 'with 2 warnings not written' in caplog.text
@@ -0,0 +1,30 @@
+import sqlite3
+
+import migrations
+from database import Database
+from migrations import MIGRATIONS, migrate
+
+
+def test_list_users_pages_reach_users_without_join_time(tmp_path, monkeypatch):
+    path = str(tmp_path / 'users.db')
+    conn = sqlite3.connect(path)
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS[:12])
+    migrate(conn)
+    # created_at قديم لم يُقرأ في الترحيل 3 فبقي created_ts فارغاً
+    conn.executemany("INSERT INTO users (user_id, first_name, created_at, created_ts) VALUES (?, 'u', ?, ?)",
+                     [(n, 'legacy', None) for n in range(1, 6)]
+                     + [(n, None, 1700000000 + n) for n in range(6, 14)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS)
+
+    db = Database(path)
+    seen, cursor = [], None
+    while True:
+        page = db.list_users(None, 4, cursor)
+        seen += [user['user_id'] for user in page.items]
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    db.writes.stop()
+    assert seen == list(range(13, 5, -1)) + list(range(5, 0, -1))
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import TimerEngine
+
+START = 1000.0
+
+
+class FakeTimers:
+    """ساعة وهمية: انتظار المحرك بمهلة يقدّم الساعة بدلاً من النوم"""
+
+    def __init__(self, now: float):
+        self.now = now
+        self.waits = []
+
+    def time(self) -> float:
+        return self.now
+
+    async def wait_for(self, awaitable, timeout):
+        self.waits.append(timeout)
+        if timeout is None:
+            return await awaitable
+        awaitable.close()
+        self.now += timeout
+        await asyncio.sleep(0)
+        raise asyncio.TimeoutError
+
+
+@pytest.fixture
+def timers(monkeypatch):
+    timers = FakeTimers(START)
+    monkeypatch.setattr(scheduler, 'time', timers)
+    monkeypatch.setattr(asyncio, 'wait_for', timers.wait_for)
+    return timers
+
+
+async def idle(engine: TimerEngine, timers: FakeTimers):
+    """Yield until the engine waits with nothing left to run"""
+    for _ in range(1000):
+        await asyncio.sleep(0)
+        if timers.waits and timers.waits[-1] is None and not engine._running and not engine._changed.is_set():
+            return
+    raise AssertionError(f"engine never went idle: {timers.waits}")
+
+
+def recorder(calls: list, key: str, repeat: float = None, times: int = 1):
+    async def callback(when):
+        calls.append((key, when))
+        if repeat is not None and sum(1 for call in calls if call[0] == key) < times:
+            return when + repeat
+        return None
+    return callback
+
+
+def test_fires_in_order_and_records_lateness(timers):
+    calls = []
+
+    async def run():
+        engine = TimerEngine()
+        engine.schedule('late', START - 2, recorder(calls, 'late'))
+        engine.schedule('soon', START + 5, recorder(calls, 'soon'))
+        # أبعد من _MAX_SLEEP: ينام على دفعات ثم يعيد قراءة الساعة
+        engine.schedule('far', START + 150, recorder(calls, 'far'))
+        await engine.start()
+        await idle(engine, timers)
+        await engine.stop()
+        return engine
+
+    engine = asyncio.run(run())
+    assert calls == [('late', START - 2), ('soon', START + 5), ('far', START + 150)]
+    assert timers.waits == [5, 60, 60, 25, None]
+    assert engine.fired == 3
+    # التأخر يُقاس لحظة الإطلاق: ثانيتان للمتأخر وصفر لما أُطلق في موعده
+    assert engine.lateness.count == 3
+    assert engine.lateness.max_ms == pytest.approx(2000)
+    assert engine.lateness.total_ms == pytest.approx(2000)
+    assert len(engine) == 0
+
+
+def test_empty_heap_waits_without_timeout(timers):
+    calls = []
+
+    async def run():
+        engine = TimerEngine()
+        await engine.start()
+        await idle(engine, timers)
+        assert timers.waits == [None]
+        assert timers.now == START
+
+        # الإضافة توقظ المحرك، والموعد الذي تعيده الدالة يُجدول من جديد
+        engine.schedule('job', START + 10, recorder(calls, 'job', repeat=10, times=3))
+        await idle(engine, timers)
+        await engine.stop()
+
+    asyncio.run(run())
+    assert calls == [('job', START + 10), ('job', START + 20), ('job', START + 30)]
+    assert timers.waits == [None, 10, None, 10, None, 10, None]
+
+
+def test_rescheduling_a_key_replaces_it(timers):
+    calls = []
+
+    async def run():
+        engine = TimerEngine()
+        engine.schedule('job', START + 10, recorder(calls, 'old'))
+        engine.schedule('job', START + 20, recorder(calls, 'new'))
+        engine.schedule('gone', START + 5, recorder(calls, 'gone'))
+        engine.cancel('gone')
+        assert engine.next_fire() == START + 20
+        await engine.start()
+        await idle(engine, timers)
+        await engine.stop()
+
+    asyncio.run(run())
+    assert calls == [('new', START + 20)]
+    assert timers.waits == [20, None]
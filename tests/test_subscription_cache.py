@@ -0,0 +1,46 @@
+import database
+from database import Database
+from subscription_cache import SubscriptionCache
+from timeutil import from_ts
+
+END_TS = 1767225600  # 2026-01-01 00:00 UTC
+USER_ID = 42
+
+
+class FakeClock:
+    def __init__(self, now: int):
+        self.now = now
+
+    def __call__(self) -> int:
+        return self.now
+
+
+def test_entry_lapses_exactly_at_end_ts():
+    clock = FakeClock(END_TS - 1)
+    cache = SubscriptionCache(clock)
+    cache.set(USER_ID, END_TS)
+    assert cache.is_active(USER_ID)
+    clock.now = END_TS
+    assert not cache.is_active(USER_ID)
+    assert not cache.is_active(USER_ID + 1)
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1, 'expired': 1}
+    assert cache.purge_expired() == 1
+
+
+def test_reload_from_database_agrees_across_the_boundary(tmp_path, monkeypatch):
+    clock = FakeClock(END_TS - 1)
+    # load_subscription_cache يقرأ الوقت من نفس الساعة المحقونة
+    monkeypatch.setattr(database, 'now_ts', clock)
+    db = Database(str(tmp_path / 'subs.db'))
+    db.subscriptions = SubscriptionCache(clock)
+    assert db.add_subscription(USER_ID, 'captain_monthly', from_ts(END_TS).isoformat())
+    maintained = db.subscriptions
+
+    for now, expected in ((END_TS - 1, True), (END_TS, False)):
+        clock.now = now
+        assert maintained.is_active(USER_ID) is expected
+        db.subscriptions = SubscriptionCache(clock)
+        db.load_subscription_cache()
+        assert db.is_captain_subscribed(USER_ID) is expected
+        db.subscriptions = maintained
+    db.writes.stop()
@@ -0,0 +1,59 @@
+import sqlite3
+import threading
+import pytest
+from write_queue import WriteQueue
+
+
+def _insert(conn, value):
+    return conn.execute("INSERT INTO t (v) VALUES (?)", (value,)).lastrowid
+
+
+@pytest.fixture
+def writes(tmp_path):
+    path = str(tmp_path / 'w.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT UNIQUE)")
+    conn.close()
+    queue = WriteQueue(path)
+    yield queue
+    queue.stop()
+
+
+def test_batch_commits_and_isolates_failures(writes):
+    futures = [writes.submit(_insert, f"v{i}") for i in range(5)] + [writes.submit(_insert, "v0")]
+    assert [f.result(5) for f in futures[:5]] == [1, 2, 3, 4, 5]
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[5].result(5)
+    assert writes.run(lambda conn: conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]) == 5
+
+
+def test_failed_commit_with_stop_resolves_every_future(writes):
+    def failing_commit():
+        raise sqlite3.OperationalError("disk I/O error")
+
+    gate = threading.Event()
+    blocker = writes.submit(lambda conn: gate.wait(5))
+    # حفظ اتصال الكاتب يُستبدل من داخل عملية تعمل في خيطه ضمن نفس الدفعة
+    writes.submit(lambda conn: setattr(conn, 'commit', failing_commit))
+    queued = [writes.submit(_insert, f"v{i}") for i in range(3)]
+    # الكاتب يقرأ علامة الإيقاف داخل الدفعة ثم يفشل الحفظ
+    writes._queue.put(None)
+    writer = writes._thread
+    gate.set()
+    for future in [blocker] + queued:
+        assert isinstance(future.exception(5), sqlite3.OperationalError)
+    writer.join(5)
+    assert not writer.is_alive()
+
+
+def test_stop_drains_operations_queued_behind_the_sentinel(writes):
+    gate = threading.Event()
+    writes.submit(lambda conn: gate.wait(5))
+    writes._queue.put(None)
+    # عمليات وصلت بعد علامة الإيقاف تُنفذ قبل خروج الكاتب
+    late = [writes.submit(_insert, f"late{i}") for i in range(3)]
+    writer = writes._thread
+    gate.set()
+    assert [f.result(5) for f in late] == [1, 2, 3]
+    writer.join(5)
+    assert not writer.is_alive()
@@ -0,0 +1,53 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple, Union
+from zoneinfo import ZoneInfo
+
+# جميع حدود الأيام والتقارير تحسب بتوقيت مكة المكرمة
+BOT_TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "Asia/Riyadh"))
+
+
+def now_ts() -> int:
+    """Current time as a UTC epoch integer"""
+    return int(time.time())
+
+
+def now_local() -> datetime:
+    """Current time as an aware datetime in the bot timezone"""
+    return datetime.now(BOT_TIMEZONE)
+
+
+def to_ts(value: Union[str, datetime, None], naive_utc: bool = False) -> Optional[int]:
+    """Convert a stored timestamp to an epoch integer.
+
+    SQLite CURRENT_TIMESTAMP values are naive UTC (``naive_utc=True``);
+    values written with ``datetime.now()`` are naive server-local time.
+    Aware values keep their own offset.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None and naive_utc:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def from_ts(ts: int) -> datetime:
+    """Convert an epoch integer to an aware datetime in the bot timezone"""
+    return datetime.fromtimestamp(ts, BOT_TIMEZONE)
+
+
+def day_range(ts: Optional[int] = None) -> Tuple[int, int]:
+    """Return the [start, end) epoch range of the local day containing ts"""
+    local = from_ts(now_ts() if ts is None else ts)
+    start = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    # الجمع على datetime واعٍ بالمنطقة الزمنية يتم بالتوقيت المحلي
+    end = start + timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def utc_offset_seconds(ts: Optional[int] = None) -> int:
+    """Offset of the bot timezone from UTC at ts, for grouping epochs by local day"""
+    return int(from_ts(now_ts() if ts is None else ts).utcoffset().total_seconds())
@@ -0,0 +1,112 @@
+import os
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# أقصى عدد من التحديثات قيد المعالجة في نفس الوقت (1 = معالجة متسلسلة)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+_GROUP_CHATS = ('group', 'supergroup', 'channel')
+
+
+def update_key(update: object) -> Optional[Hashable]:
+    """Ordering key of an update: its chat for group messages, otherwise its user"""
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    # زر يُضغط في مجموعة يتبع مسار صاحبه، فالترتيب بالمجموعة للرسائل فقط
+    if chat is not None and chat.type in _GROUP_CHATS and update.callback_query is None:
+        return ('chat', chat.id)
+    user = update.effective_user
+    if user is not None:
+        return ('user', user.id)
+    if chat is not None:
+        return ('chat', chat.id)
+    # بلا مستخدم ولا محادثة: لا ترتيب
+    return None
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, in arrival order for each update_key"""
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        # لكل مفتاح مشغول طابور التحديثات المنتظرة خلف التحديث الجاري
+        self._keys: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # يُحجز المفتاح أولاً؛ أول تحديث له فقط ينتظر مكاناً من حد التوازي، ثم
+        # ينتقل المكان مباشرة لتحديثه التالي، فالمفتاح المزدحم يشغل مكاناً واحداً
+        key = update_key(update)
+        self.waiting += 1
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        waiters = self._keys.get(key)
+        has_slot = False
+        if waiters is None:
+            waiters = self._keys[key] = deque()
+        else:
+            future = asyncio.get_running_loop().create_future()
+            waiters.append(future)
+            try:
+                has_slot = await future
+            except asyncio.CancelledError:
+                self.waiting -= 1
+                if future.done() and not future.cancelled():
+                    self._hand_over(key, waiters, future.result())
+                raise
+        if not has_slot:
+            try:
+                await self._semaphore.acquire()
+            except asyncio.CancelledError:
+                self.waiting -= 1
+                self._hand_over(key, waiters, False)
+                raise
+        try:
+            await self.do_process_update(update, coroutine)
+        finally:
+            self._hand_over(key, waiters, True)
+
+    def _hand_over(self, key: Hashable, waiters: Deque[asyncio.Future], has_slot: bool):
+        """Wake the key's next waiting update, or free the key and its slot"""
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(has_slot)
+                return
+        del self._keys[key]
+        if has_slot:
+            self._semaphore.release()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.waiting -= 1
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.processed += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        """Return the limit, waiting and running updates, busy keys and the total processed"""
+        return {
+            'limit': self.max_concurrent_updates,
+            'running': self.running,
+            'keys': len(self._keys),
+            'waiting': self.waiting,
+            'processed': self.processed,
+        }
@@ -0,0 +1,213 @@
+import os
+import logging
+import threading
+import time
+from bisect import bisect_right
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from timeutil import now_ts
+
+logger = logging.getLogger(__name__)
+
+# نافذة عدّ التحذيرات بالأيام، وإعدادات الكتابة المؤجلة إلى جدول user_warnings
+WARNING_WINDOW_DAYS = int(os.getenv("WARNING_WINDOW_DAYS", "30"))
+WARNING_FLUSH_INTERVAL = float(os.getenv("WARNING_FLUSH_INTERVAL", "2"))
+WARNING_FLUSH_BATCH = int(os.getenv("WARNING_FLUSH_BATCH", "100"))
+
+# كل كم ثانية تُحذف التحذيرات التي خرجت من النافذة من الذاكرة
+_PURGE_INTERVAL = 600
+
+# عند الإيقاف تُعاد محاولة الكتابة الأخيرة بعدد محدود قبل التخلي عن الصفوف المتبقية
+_STOP_FLUSH_ATTEMPTS = 3
+_STOP_RETRY_DELAY = 0.5
+
+WarningRow = Tuple[int, str, int, int]  # (user_id, reason, warned_by, created_ts)
+
+
+class WarningCounter:
+    """Per-user sliding-window warning counts with write-behind persistence.
+
+    The counter is loaded with the warnings inside the window at startup.
+    record() updates it and queues the row. A background writer thread then
+    inserts the queued rows in batches, so warn/ban decisions never wait on
+    SQL.
+    """
+
+    def __init__(self, window_days: int = WARNING_WINDOW_DAYS, clock: Callable[[], int] = now_ts):
+        self.window = window_days * 86400
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._times: Dict[int, List[int]] = {}
+        self._pending: List[WarningRow] = []
+        self.loaded = False
+        self.flushed = 0
+        self.failed_flushes = 0
+
+        self._write: Optional[Callable[[List[WarningRow]], None]] = None
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._writer: Optional[threading.Thread] = None
+
+    def load(self, entries: Iterable[Tuple[int, int]]):
+        """Replace the counts with (user_id, created_ts) pairs from the database"""
+        times: Dict[int, List[int]] = {}
+        for user_id, ts in entries:
+            if ts is not None:
+                times.setdefault(user_id, []).append(ts)
+        for values in times.values():
+            values.sort()
+        with self._lock:
+            # التحذيرات التي لم تُكتب بعد ليست في قاعدة البيانات
+            for user_id, _, _, ts in self._pending:
+                times.setdefault(user_id, []).append(ts)
+            self._times = times
+            self.loaded = True
+
+    def record(self, user_id: int, reason: str, warned_by: int) -> int:
+        """Count a new warning, queue it for writing and return the user's count in the window"""
+        now = self._clock()
+        with self._lock:
+            times = self._times.setdefault(user_id, [])
+            times.append(now)
+            self._prune(user_id, times, now)
+            self._pending.append((user_id, reason, warned_by, now))
+            pending = len(self._pending)
+            count = len(times)
+        if pending >= WARNING_FLUSH_BATCH:
+            self._wakeup.set()
+        return count
+
+    def count(self, user_id: int, days: Optional[int] = None) -> int:
+        """Return the user's warnings in the last `days` days (at most the window)"""
+        now = self._clock()
+        seconds = self.window if days is None else min(days * 86400, self.window)
+        with self._lock:
+            times = self._times.get(user_id)
+            if not times:
+                return 0
+            return len(times) - bisect_right(times, now - seconds)
+
+    def pending(self) -> int:
+        """Number of warnings waiting to be written"""
+        return len(self._pending)
+
+    def purge_expired(self) -> int:
+        """Drop warnings that have left the window and return how many were removed"""
+        now = self._clock()
+        removed = 0
+        with self._lock:
+            for user_id, times in list(self._times.items()):
+                before = len(times)
+                self._prune(user_id, times, now)
+                removed += before - len(times)
+        return removed
+
+    def _prune(self, user_id: int, times: List[int], now: int):
+        cut = bisect_right(times, now - self.window)
+        if cut:
+            del times[:cut]
+        if not times:
+            self._times.pop(user_id, None)
+
+    # ============ الكتابة المؤجلة ============
+
+    def start_writer(self, write: Callable[[List[WarningRow]], None]):
+        """Start the background thread that writes queued warnings with `write`"""
+        with self._flush_lock:
+            if self._writer is not None:
+                return
+            self._write = write
+            self._stopping = False
+            self._writer = threading.Thread(target=self._run_writer, name="warning-writer", daemon=True)
+            self._writer.start()
+
+    def flush(self) -> int:
+        """Write every queued warning now and return how many rows were written"""
+        with self._flush_lock:
+            if self._write is None:
+                return 0
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            try:
+                self._write(rows)
+            except Exception:
+                # إعادة الصفوف إلى مقدمة الطابور لمحاولة كتابتها في الدورة التالية
+                with self._lock:
+                    self._pending[:0] = rows
+                self.failed_flushes += 1
+                raise
+            self.flushed += len(rows)
+            return len(rows)
+
+    def stop_writer(self) -> int:
+        """Stop the writer thread after a final flush and return how many warnings were left unwritten"""
+        writer = self._writer
+        if writer is None:
+            return 0
+        self._stopping = True
+        self._wakeup.set()
+        writer.join()
+        self._writer = None
+        lost = len(self._pending)
+        if lost:
+            logger.error(f"Warning writer stopped with {lost} warnings not written to user_warnings")
+        return lost
+
+    def _run_writer(self):
+        last_purge = time.monotonic()
+        while not self._stopping:
+            self._wakeup.wait(WARNING_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning flush error: {e}")
+            if time.monotonic() - last_purge >= _PURGE_INTERVAL:
+                self.purge_expired()
+                last_purge = time.monotonic()
+        self._final_flush()
+
+    def _final_flush(self):
+        for attempt in range(1, _STOP_FLUSH_ATTEMPTS + 1):
+            try:
+                self.flush()
+                return
+            except Exception as e:
+                print(f"Warning flush error on stop (attempt {attempt}/{_STOP_FLUSH_ATTEMPTS}): {e}")
+            if attempt < _STOP_FLUSH_ATTEMPTS:
+                time.sleep(_STOP_RETRY_DELAY * attempt)
+
+    def stats(self) -> Dict[str, int]:
+        """Return counters for monitoring"""
+        return {
+            'users': len(self._times),
+            'pending': len(self._pending),
+            'flushed': self.flushed,
+            'failed_flushes': self.failed_flushes,
+        }
+
+
+_counters: Dict[str, WarningCounter] = {}
+_counters_lock = threading.Lock()
+
+
+def get_warning_counter(db_path: str) -> WarningCounter:
+    """Return the shared warning counter for a database file"""
+    key = os.path.abspath(db_path)
+    with _counters_lock:
+        counter = _counters.get(key)
+        if counter is None:
+            counter = WarningCounter()
+            _counters[key] = counter
+        return counter
+
+
+def stop_warning_writers() -> int:
+    """Flush queued warnings, stop the writer of every shared counter and return how many were left unwritten"""
+    with _counters_lock:
+        counters = list(_counters.values())
+    return sum(counter.stop_writer() for counter in counters)
@@ -0,0 +1,264 @@
+import os
+import time
+import queue
+import asyncio
+import sqlite3
+import logging
+import functools
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from db_connection import get_connection_manager
+from metrics import get_metrics
+from query_log import captured_into, current_capture
+
+logger = logging.getLogger(__name__)
+
+# أقصى عدد من عمليات الكتابة في معاملة واحدة
+WRITE_BATCH = int(os.getenv("WRITE_BATCH", "128"))
+# أقصى مدة بالمللي ثانية تبقى فيها المعاملة مفتوحة لإضافة عمليات منتظرة
+WRITE_BATCH_MS = float(os.getenv("WRITE_BATCH_MS", "5"))
+
+Operation = Tuple[Callable[..., Any], tuple, dict, Future]
+
+_batch_latency = get_metrics().histogram(
+    'bot_db_write_batch_duration_seconds', "Time from BEGIN to COMMIT of a group commit")
+_batch_ops = get_metrics().counter(
+    'bot_db_write_ops_total', "Write operations run by the single writer", ('result',))
+
+
+class WriteQueue:
+    """Single writer thread that runs queued write operations in group commits.
+
+    An operation is a callable op(conn, *args) that issues its statements
+    on the writer's connection without committing; it may register
+    callbacks with on_commit() for work that must follow the commit
+    (memory caches). The writer opens a transaction, runs every queued
+    operation inside its own SAVEPOINT, and commits once the queue is
+    empty, WRITE_BATCH operations have run or WRITE_BATCH_MS has passed.
+    A failing operation is rolled back to its savepoint alone; each
+    caller's future resolves with its operation's result only after the
+    commit. As the only writer of the process it never waits on another
+    connection of its own for SQLite's write lock.
+    """
+
+    def __init__(self, db_path: str, max_batch: int = WRITE_BATCH, max_batch_ms: float = WRITE_BATCH_MS):
+        self.connections = get_connection_manager(db_path)
+        self.max_batch = max_batch
+        self.max_batch_s = max_batch_ms / 1000
+        self._queue: 'queue.SimpleQueue[Optional[Operation]]' = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._after_commit: List[Callable[[], Any]] = []
+        self.batches = 0
+        self.operations = 0
+        self.failed = 0
+        self.largest_batch = 0
+
+    # ============ الإرسال ============
+
+    def submit(self, op: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queue op(conn, *args, **kwargs) and return a future for its result"""
+        future: Future = Future()
+        if threading.current_thread() is self._thread:
+            # عملية داخل عملية أخرى: تُنفذ في نفس المعاملة بدل انتظار الكاتب لنفسه
+            try:
+                future.set_result(op(self.connections.connect(), *args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+        plans = current_capture()
+        if plans is not None:
+            # check_query_plans يلتقط خطط الكتابات التي تنفذ في خيط الكاتب أيضاً
+            op = captured_into(plans, op)
+        self._ensure_started()
+        self._queue.put((op, args, kwargs, future))
+        return future
+
+    def run(self, op: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run op on the writer and wait for its committed result"""
+        return self.submit(op, *args, **kwargs).result()
+
+    async def run_async(self, op: Callable[..., Any], *args, **kwargs) -> Any:
+        """Await op's committed result without holding an executor thread"""
+        return await asyncio.wrap_future(self.submit(op, *args, **kwargs))
+
+    def on_commit(self, callback: Callable[[], Any]):
+        """Run callback on the writer thread after the current batch commits (call from an op)"""
+        self._after_commit.append(callback)
+
+    # ============ الكاتب ============
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = self.connections.connect()
+        stopping = False
+        while True:
+            if stopping:
+                # لا يخرج الكاتب قبل تنفيذ كل ما في الطابور حتى لا تبقى نتيجة معلقة
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    return
+            else:
+                item = self._queue.get()
+            if item is None:
+                stopping = True
+                continue
+            if self._commit_batch(conn, item):
+                stopping = True
+
+    def _commit_batch(self, conn: sqlite3.Connection, item: Operation) -> bool:
+        """Run item and whatever is queued behind it in one transaction; True if asked to stop"""
+        outcomes: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        stop = False
+        # مستقبل العملية التي في اليد ولم تُضف نتيجتها بعد
+        current: Optional[Future] = None
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            while True:
+                op, args, kwargs, current = item
+                # العمليات التي ألغاها أصحابها قبل دورها لا تُنفذ
+                if current.set_running_or_notify_cancel():
+                    outcomes.append((current, *self._apply(conn, op, args, kwargs)))
+                current = None
+                if len(outcomes) >= self.max_batch or time.perf_counter() - started >= self.max_batch_s:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+            conn.commit()
+        except BaseException as e:
+            # فشل BEGIN أو COMMIT: لا شيء من الدفعة محفوظ
+            logger.error(f"Write batch failed: {e}")
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            self._after_commit = []
+            if current is not None and (current.running() or current.set_running_or_notify_cancel()):
+                outcomes.append((current, None, e))
+            self._finish([(future, None, e) for future, _, _ in outcomes])
+            return stop
+
+        _batch_latency.observe((), (time.perf_counter() - started) * 1000)
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Write commit callback failed: {e}")
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(outcomes))
+        self._finish(outcomes)
+        return stop
+
+    def _apply(self, conn: sqlite3.Connection, op, args, kwargs) -> Tuple[Any, Optional[BaseException]]:
+        conn.execute("SAVEPOINT write_op")
+        mark = len(self._after_commit)
+        try:
+            result = op(conn, *args, **kwargs)
+        except BaseException as e:
+            conn.execute("ROLLBACK TO write_op")
+            conn.execute("RELEASE write_op")
+            # استدعاءات ما بعد الحفظ لعملية تراجعت لا تُنفذ
+            del self._after_commit[mark:]
+            return None, e
+        conn.execute("RELEASE write_op")
+        return result, None
+
+    def _finish(self, results: List[Tuple[Future, Any, Optional[BaseException]]]):
+        for future, result, error in results:
+            self.operations += 1
+            if error is None:
+                future.set_result(result)
+                _batch_ops.inc(('ok',))
+            else:
+                self.failed += 1
+                future.set_exception(error)
+                _batch_ops.inc(('error',))
+
+    def stop(self, timeout: float = 10):
+        """Commit what is queued, then stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return batch and operation counts and the average batch size"""
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'failed': self.failed,
+            'largest_batch': self.largest_batch,
+            'avg_batch': self.operations / self.batches if self.batches else 0.0,
+            'queued': self._queue.qsize(),
+        }
+
+
+_queues: Dict[str, WriteQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_write_queue(db_path: str) -> WriteQueue:
+    """Return the shared writer for a database file"""
+    key = os.path.abspath(db_path)
+    with _queues_lock:
+        writes = _queues.get(key)
+        if writes is None:
+            writes = _queues[key] = WriteQueue(db_path)
+        return writes
+
+
+def stop_write_queues():
+    """Drain and stop the writer of every database file"""
+    with _queues_lock:
+        queues = list(_queues.values())
+    for writes in queues:
+        writes.stop()
+
+
+def queued_write(default: Any = None):
+    """Decorator turning op(self, conn, ...) into a method run by self.writes.
+
+    The method returns the op's committed result, or prints the database
+    error and returns default. AsyncDatabase awaits the op through the
+    queued attribute instead of holding a DB executor thread while the
+    batch commits.
+    """
+    def decorator(op):
+        def failed(e: sqlite3.Error):
+            print(f"Database error in {op.__name__}: {e}")
+            return default
+
+        @functools.wraps(op)
+        def method(self, *args, **kwargs):
+            try:
+                return self.writes.run(functools.partial(op, self), *args, **kwargs)
+            except sqlite3.Error as e:
+                return failed(e)
+
+        async def queued(self, *args, **kwargs):
+            try:
+                return await self.writes.run_async(functools.partial(op, self), *args, **kwargs)
+            except sqlite3.Error as e:
+                return failed(e)
+
+        method.queued = queued
+        return method
+
+    return decorator